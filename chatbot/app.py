@@ -1,15 +1,35 @@
 import os
 import json
+import threading
 from flask import Flask, request, jsonify, render_template, Response
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import text
+from sqlalchemy import select, tuple_
 from dotenv import load_dotenv
-from datetime import datetime
+from werkzeug.http import is_resource_modified
+from datetime import datetime, timedelta
 import logging
 
 from database.models import db, DifyApp, Conversation, Message
+from database.storage import storage
+from database.migrations import migrate
+from database.keyphrase_index import search_keyphrases, top_keyphrases
+from database.message_search import search_conversations
+from database.payload_store import load_raw_response
+from database.retention import delete_conversation_rows, delete_conversations
 from utils.dify_client import DifyClient
+from utils.http_pool import get_default_pool
 from utils.response_parser import ResponseParser
+from utils.chat_service import ChatRequestError, start_chat_turn, sse_event, SSE_DONE
+from utils.persistence import persistence
+from utils.analysis_cache import analysis_cache, build_analysis_entry, ANALYSIS_FIELDS
+from utils.analysis_jobs import analysis_jobs, STATUS_PENDING
+from utils.json_stream import stream_json_object, stream_ndjson, NDJSON_MIMETYPE
+from utils.retention_job import retention_job
+from utils.response_cache import response_cache
+from utils.chat_scheduler import chat_scheduler
+from utils.turn_streams import turn_streams, resume_position, is_stream_id, StreamGapError, StreamElsewhereError
+from utils.metrics import metrics, PROMETHEUS_CONTENT_TYPE
+from utils.app_registry import app_registry
 
 # 環境変数読み込み
 load_dotenv()
@@ -20,242 +40,404 @@ app = Flask(__name__)
 # データベースファイルパスを絶対パスで設定
 basedir = os.path.abspath(os.path.dirname(__file__))
 database_path = os.path.join(basedir, 'database', 'database.db')
-app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database_path}'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', f'sqlite:///{database_path}')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'your-secret-key-here')
 
-# データベース初期化
+# データベース初期化（ストレージプロファイル → SQLAlchemy → 接続フック）
+storage.configure(app)
 db.init_app(app)
+storage.init_app(app)
+persistence.init_app(app)
+analysis_cache.init_app(app)
+analysis_jobs.init_app(app)
+retention_job.init_app(app)
+response_cache.init_app(app)
+chat_scheduler.init_app(app)
+turn_streams.init_app(app)
+metrics.init_app(app)
+app_registry.init_app(app)
+
+# /metrics にゲージとして出力する統計
+metrics.register_stats('dify_pool', lambda: get_default_pool().stats())
+metrics.register_stats('persistence', persistence.stats)
+metrics.register_stats('analysis_cache', analysis_cache.stats)
+metrics.register_stats('analysis_jobs', analysis_jobs.stats)
+metrics.register_stats('response_cache', response_cache.stats)
+metrics.register_stats('chat_scheduler', chat_scheduler.stats)
+metrics.register_stats('turn_streams', turn_streams.stats)
+metrics.register_stats('app_registry', app_registry.stats)
+
+# 起動時のDB初期化（スキーマ移行）の結果。initialize_database で更新する
+startup_report = {'schema_version': 0, 'migrations_applied': 0, 'init_seconds': 0.0}
+metrics.register_stats('startup', lambda: dict(startup_report))
+
+# initialize_database の完了（起動時に呼ばないWSGIサーバーでは最初のリクエストで実行する）
+database_initialized = threading.Event()
+_initialize_lock = threading.Lock()
 
 # ログ設定
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# SSEレスポンス共通ヘッダー
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Access-Control-Allow-Origin': '*'
+}
+
 @app.route('/')
 def index():
     """メインチャット画面"""
-    dify_apps = DifyApp.query.all()
-    return render_template('index.html', dify_apps=dify_apps)
+    return render_template('index.html', dify_apps=app_registry.all())
 
 @app.route('/analysis/<message_id>')
 def analysis_page(message_id):
     """レスポンス解析画面"""
-    message = db.session.get(Message, message_id)
-    if not message:
-        return "メッセージが見つかりません", 404
-    return render_template('analysis.html', message=message)
+    with storage.read_session() as session:
+        message = session.get(Message, message_id)
+        if not message:
+            return "メッセージが見つかりません", 404
+        return render_template('analysis.html', message=message)
 
 @app.route('/api/chat-stream', methods=['POST'])
 def chat_stream():
     """ストリーミングチャット API"""
     try:
-        data = request.get_json()
-        message_content = data.get('message', '').strip()
-        dify_app_id = data.get('dify_app_id')
-        conversation_id = data.get('conversation_id')
-        
-        if not message_content:
-            return jsonify({'error': 'メッセージが空です'}), 400
-        
-        # Difyアプリ情報取得
-        dify_app = db.session.get(DifyApp, dify_app_id)
-        if not dify_app:
-            return jsonify({'error': '指定されたDifyアプリが見つかりません'}), 404
-        
-        # APIキー取得
-        api_key = os.getenv(dify_app.api_key_env_name)
-        if not api_key:
-            return jsonify({'error': f'APIキー {dify_app.api_key_env_name} が設定されていません'}), 500
-        
-        # 会話管理（トランザクション統一）
         try:
-            conversation = None
-            if conversation_id:
-                conversation = db.session.get(Conversation, conversation_id)
-            
-            if not conversation:
-                # 新規会話作成
-                conversation = Conversation(
-                    title=f"新しい会話 - {datetime.now().strftime('%Y/%m/%d %H:%M')}",
-                    dify_app_id=dify_app_id
-                )
-                db.session.add(conversation)
-                db.session.flush()  # IDを取得するためflush
-                logger.info(f"新規会話作成 - ID: {conversation.id}")
-            
-            # ユーザーメッセージ保存
-            user_message = Message(
-                conversation_id=conversation.id,
-                role='user',
-                content=message_content
-            )
-            db.session.add(user_message)
-            db.session.commit()  # 一度だけコミット
-            logger.info(f"ユーザーメッセージ保存 - ID: {user_message.id}")
-            
-        except Exception as e:
-            db.session.rollback()
-            logger.error(f"メッセージ保存エラー: {str(e)}")
-            return jsonify({'error': f'メッセージの保存に失敗しました: {str(e)}'}), 500
-        
-        # ストリーミング関数に渡すためのデータ
-        conversation_id_for_stream = conversation.id
-        dify_conversation_id_for_stream = conversation.dify_conversation_id
+            turn = start_chat_turn(request.get_json())
+        except ChatRequestError as e:
+            headers = {'Retry-After': str(e.retry_after)} if e.retry_after else {}
+            return jsonify({'error': e.message}), e.status_code, headers
         
         # Dify API クライアント初期化
-        dify_client = DifyClient(api_key)
+        dify_client = DifyClient(turn.api_key)
         
         def generate_response():
-            """ストリーミングレスポンス生成"""
+            """ストリーミングレスポンス生成（クライアント接続とは別のスレッドで最後まで実行）"""
             with app.app_context():
                 try:
-                    assistant_message = Message(
-                        conversation_id=conversation_id_for_stream,
-                        role='assistant',
-                        content='',
-                        raw_dify_response=''
-                    )
+                    # 実行枠が空くまで順番待ちを通知
+                    yield from turn.wait_for_slot()
                     
-                    full_response = ''
-                    raw_response_data = []
-                    
-                    # Dify APIストリーミング呼び出し
-                    for chunk in dify_client.stream_chat(
-                        message_content, 
-                        dify_conversation_id_for_stream
-                    ):
+                    # Dify APIストリーミング呼び出し（応答キャッシュ・同一質問の相乗りを経由）
+                    for chunk in response_cache.stream_chat(turn, dify_client):
                         if chunk:
-                            yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
-                            
-                            # レスポンスデータ蓄積
-                            raw_response_data.append(chunk)
-                            
-                            # messageイベントから回答内容を蓄積（Difyワークフロー形式）
-                            if chunk.get('event') == 'message':
-                                answer_part = chunk.get('answer', '')
-                                if answer_part:
-                                    full_response += answer_part
+                            yield turn.handle_chunk(chunk)
                             
-                            # conversation_id 更新とメッセージ保存
+                            # conversation_id 更新とメッセージ保存（永続化キュー経由）
                             if chunk.get('event') == 'message_end':
-                                try:
-                                    # 新しいセッションでconversationを取得して更新
-                                    with app.app_context():
-                                        conv_to_update = db.session.get(Conversation, conversation_id_for_stream)
-                                        if conv_to_update and chunk.get('conversation_id'):
-                                            conv_to_update.dify_conversation_id = chunk.get('conversation_id')
-                                            db.session.commit()
-                                    
-                                    # 完全なレスポンス構築（messageイベントから蓄積した内容を使用）
-                                    assistant_message.content = full_response
-                                    assistant_message.raw_dify_response = json.dumps(raw_response_data, ensure_ascii=False)
-                                    
-                                    # キーフレーズ抽出
-                                    parser = ResponseParser()
-                                    keyphrase_data = parser.extract_keyphrases(raw_response_data)
-                                    assistant_message.keyphrase_data = json.dumps(keyphrase_data, ensure_ascii=False)
-                                    
-                                    db.session.add(assistant_message)
-                                    db.session.commit()
-                                    
-                                    logger.info(f"メッセージ保存完了 - DB message_id: {assistant_message.id}, content_length: {len(assistant_message.content)}")
-                                    
-                                    # message_id を含む最終データ送信
-                                    final_data = chunk.copy()
-                                    final_data['message_id'] = assistant_message.id
-                                    final_data['full_answer'] = full_response  # 完全な回答も送信
-                                    logger.info(f"フロントエンドに送信するmessage_id: {final_data['message_id']}")
-                                    yield f"data: {json.dumps(final_data, ensure_ascii=False)}\n\n"
-                                    
-                                except Exception as db_error:
-                                    db.session.rollback()
-                                    logger.error(f"データベース保存エラー: {str(db_error)}")
-                                    error_data = {'error': f'データベース保存エラー: {str(db_error)}', 'event': 'error'}
-                                    yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                                yield turn.complete(chunk)
                     
-                    yield "data: [DONE]\n\n"
+                    # フェーズ別の所要時間（METRICS_TIMING_EVENT またはリクエストの "timing": true）
+                    if turn.timing_event:
+                        yield turn.timing_frame()
+                    yield SSE_DONE
                     
                 except Exception as e:
                     logger.error(f"ストリーミングエラー: {str(e)}")
-                    error_data = {'error': str(e), 'event': 'error'}
-                    yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+                    yield sse_event({'error': str(e), 'event': 'error'})
+                
+                finally:
+                    # message_end 前に終了（上流のエラー）した場合の後始末
+                    turn.release()
+                    turn.abort()
         
+        # クライアントが切断しても上流の受信と保存は続け、再接続で続きを送れるようにする
+        # （Server-Timing はストリーム開始までのフェーズのみ。全フェーズは末尾の timing イベント）
+        stream = turn_streams.start(turn, generate_response())
         return Response(
-            generate_response(),
+            stream.frames(),
             mimetype='text/event-stream',
-            headers={
-                'Cache-Control': 'no-cache',
-                'Connection': 'keep-alive',
-                'Access-Control-Allow-Origin': '*'
-            }
+            headers={**SSE_HEADERS, 'X-Stream-Id': str(stream.stream_id),
+                     'Server-Timing': turn.timings.server_timing()}
         )
-        
+    
     except Exception as e:
         logger.error(f"チャットAPIエラー: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/chat-stream/<stream_id>', methods=['GET'])
+def resume_chat_stream(stream_id):
+    """
+    切断したチャットストリームへの再接続
+    
+    stream_id は最初のイベント（stream_started）で受け取ったトークン。
+    Last-Event-ID ヘッダー（または last_event_id パラメータ）の次のフレームから送信する。
+    保持期間を過ぎた場合・トークンが一致しない場合は 404、再送できる範囲を過ぎた場合は 410（会話を開き直す）。
+    
+    バッファはワーカープロセスごとに持つため、ストリームを開始したワーカーにしか
+    再接続できない。別のワーカーに届いた場合は 421 を返す（複数ワーカーで動かす場合は
+    スティッキールーティングにすること。README 参照）。
+    """
+    try:
+        stream = turn_streams.get(stream_id) if is_stream_id(stream_id) else None
+    except StreamElsewhereError:
+        return jsonify({'error': 'このストリームは別のワーカーで実行されています。再接続は同じワーカーに届く構成（単一ワーカーまたはスティッキールーティング）が必要です'}), 421
+    if stream is None:
+        return jsonify({'error': 'ストリームが見つかりません（終了後の保持期間を過ぎています）'}), 404
+    
+    after_seq = resume_position(
+        stream_id, request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    )
+    try:
+        stream.check(after_seq)
+    except StreamGapError:
+        return jsonify({
+            'error': '再送できる範囲を過ぎています。会話を開き直してください',
+            'conversation_id': stream.conversation_id,
+        }), 410
+    
+    return Response(
+        stream.frames(after_seq),
+        mimetype='text/event-stream',
+        headers={**SSE_HEADERS, 'X-Stream-Id': str(stream.stream_id)}
+    )
+
+# 会話一覧のページサイズ
+CONVERSATION_PAGE_DEFAULT = 50
+CONVERSATION_PAGE_MAX = 200
+
+def _parse_conversation_cursor(value):
+    """カーソル文字列 '<updated_at ISO形式>,<id>' を分解"""
+    updated_at, _, conversation_id = value.rpartition(',')
+    return datetime.fromisoformat(updated_at), int(conversation_id)
+
 @app.route('/api/conversations', methods=['GET'])
 def get_conversations():
-    """会話履歴一覧取得"""
+    """
+    会話履歴一覧取得
+    
+    クエリパラメータ:
+        limit: 取得件数（既定 50、最大 200）
+        before: 前ページ末尾のカーソル '<updated_at>,<id>'（キーセットページング）
+    
+    次ページのカーソルは X-Next-Cursor ヘッダーで返す。
+    タイトル・件数などはメッセージ保存時に更新されるサマリー列から返すため、
+    messages テーブルは参照しない。
+    """
     try:
-        conversations = db.session.query(Conversation).order_by(Conversation.updated_at.desc()).all()
+        limit = min(max(request.args.get('limit', CONVERSATION_PAGE_DEFAULT, type=int), 1), CONVERSATION_PAGE_MAX)
+        before = request.args.get('before')
+        try:
+            cursor = _parse_conversation_cursor(before) if before else None
+        except ValueError:
+            return jsonify({'error': 'before パラメータの形式が不正です'}), 400
+        
+        query = (
+            select(
+                Conversation.id,
+                Conversation.preview_title,
+                Conversation.message_count,
+                Conversation.last_message_at,
+                Conversation.last_token_usage,
+                Conversation.created_at,
+                Conversation.updated_at,
+                DifyApp.name
+            )
+            .outerjoin(DifyApp, DifyApp.id == Conversation.dify_app_id)
+            .order_by(Conversation.updated_at.desc(), Conversation.id.desc())
+            .limit(limit + 1)
+        )
+        if cursor:
+            query = query.where(tuple_(Conversation.updated_at, Conversation.id) < tuple_(*cursor))
+        
+        with storage.read_session() as session:
+            rows = session.execute(query).all()
+        
+        has_more = len(rows) > limit
+        rows = rows[:limit]
         
         result = []
-        for conv in conversations:
-            try:
-                # 最初のメッセージで会話タイトルを生成
-                first_message = db.session.query(Message).filter_by(
-                    conversation_id=conv.id, role='user'
-                ).first()
-                
-                title = first_message.content[:50] + "..." if first_message and len(first_message.content) > 50 else (first_message.content if first_message else "空の会話")
-                
-                result.append({
-                    'id': conv.id,
-                    'title': title,
-                    'dify_app_name': conv.dify_app.name if conv.dify_app else 'Unknown App',
-                    'created_at': conv.created_at.isoformat(),
-                    'updated_at': conv.updated_at.isoformat()
-                })
-            except Exception as conv_error:
-                logger.warning(f"会話データ処理エラー (ID: {conv.id}): {str(conv_error)}")
-                # エラーがあっても他の会話は表示
-                continue
+        for row in rows:
+            result.append({
+                'id': row.id,
+                'title': row.preview_title or "空の会話",
+                'dify_app_name': row.name or 'Unknown App',
+                'message_count': row.message_count,
+                'last_message_at': row.last_message_at.isoformat() if row.last_message_at else None,
+                'last_token_usage': json.loads(row.last_token_usage) if row.last_token_usage else None,
+                'created_at': row.created_at.isoformat(),
+                'updated_at': row.updated_at.isoformat()
+            })
+        
+        response = jsonify(result)
+        if has_more and result:
+            response.headers['X-Next-Cursor'] = f"{result[-1]['updated_at']},{result[-1]['id']}"
         
         logger.info(f"会話一覧取得完了: {len(result)}件")
-        return jsonify(result)
+        return response
     
     except Exception as e:
         logger.error(f"会話履歴取得エラー: {str(e)}")
         return jsonify({'error': f'会話履歴の取得に失敗しました: {str(e)}'}), 500
 
+@app.route('/api/conversations/search', methods=['GET'])
+def search_conversation_history():
+    """
+    会話履歴の全文検索
+    
+    クエリパラメータ:
+        q: 検索語（空白区切りの語をすべて含むメッセージが一致）
+        dify_app_id: 指定するとそのアプリの会話に限定
+        limit: 取得件数（既定 50、最大 200）
+        offset: 読み飛ばす件数
+    
+    関連度順に会話を返し、各会話の代表メッセージのスニペット（<mark> でハイライト済み、
+    本文はHTMLエスケープ済み）を snippet_html に付ける。次ページの offset は
+    X-Next-Offset ヘッダーで返す。
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索語を指定してください'}), 400
+    dify_app_id = request.args.get('dify_app_id', type=int)
+    limit = min(max(request.args.get('limit', CONVERSATION_PAGE_DEFAULT, type=int), 1), CONVERSATION_PAGE_MAX)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    
+    try:
+        with storage.read_session() as session:
+            results, has_more = search_conversations(session, query, dify_app_id, limit, offset)
+        
+        response = jsonify(results)
+        if has_more:
+            response.headers['X-Next-Offset'] = str(offset + limit)
+        return response
+    
+    except Exception as e:
+        logger.error(f"会話検索エラー: {str(e)}")
+        return jsonify({'error': f'会話の検索に失敗しました: {str(e)}'}), 500
+
+# 会話メッセージのページサイズ上限とストリーミング時の取得単位
+MESSAGE_PAGE_MAX = 200
+MESSAGE_STREAM_BATCH = 200
+
+def _visible_messages(conversation_id):
+    """会話の表示対象メッセージの条件（応答待ち＝内容未保存のアシスタント行は除外）"""
+    return (
+        Message.conversation_id == conversation_id,
+        db.or_(Message.role != 'assistant', Message.content != '')
+    )
+
+def _message_page_bounds(session, conversation_id, limit, before_id=None, after_id=None):
+    """
+    ページに含めるメッセージIDの範囲を ID のみのクエリで決める
+    
+    after_id 指定時はそれより新しい方から、それ以外は before_id（未指定なら最新）より
+    古い方へ limit 件。
+    
+    Returns:
+        Tuple: (最小ID, 最大ID, 続きがあるか)。該当なしは (None, None, False)
+    """
+    query = select(Message.id).where(*_visible_messages(conversation_id)).limit(limit + 1)
+    if after_id is not None:
+        query = query.where(Message.id > after_id).order_by(Message.id)
+    else:
+        if before_id is not None:
+            query = query.where(Message.id < before_id)
+        query = query.order_by(Message.id.desc())
+    ids = session.execute(query).scalars().all()
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    if not ids:
+        return None, None, False
+    return min(ids), max(ids), has_more
+
 @app.route('/api/conversations/<int:conversation_id>', methods=['GET'])
 def get_conversation(conversation_id):
-    """特定の会話履歴取得"""
+    """
+    特定の会話履歴取得
+    
+    メッセージはサーバー側カーソルから1件ずつ直列化してストリーミングで返すため、
+    長い会話でも全件をメモリに載せない。
+    
+    クエリパラメータ:
+        format: 'json'（既定、従来と同じ構造）または 'ndjson'
+                （1行目が会話情報、以降1行1メッセージ。Accept: application/x-ndjson でも可）
+        limit: 返すメッセージ数（最大 200）。未指定なら全件
+        before_message_id: これより古いメッセージを新しい方から limit 件（未指定なら最新 limit 件）
+        after_message_id: これより新しいメッセージを古い方から limit 件
+    
+    メッセージは常に古い順に並ぶ。続きがある場合、次に要求するカーソルを
+    X-Before-Message-Id（さらに古いページ）または X-After-Message-Id（さらに新しいページ）
+    ヘッダーで返す。
+    """
     try:
-        conversation = db.session.get(Conversation, conversation_id)
-        if not conversation:
-            return jsonify({'error': '会話が見つかりません'}), 404
+        output_format = request.args.get('format')
+        if output_format is None:
+            output_format = 'ndjson' if request.accept_mimetypes.best == NDJSON_MIMETYPE else 'json'
+        if output_format not in ('json', 'ndjson'):
+            return jsonify({'error': 'format は json または ndjson を指定してください'}), 400
         
-        messages = db.session.query(Message).filter_by(conversation_id=conversation_id).order_by(Message.created_at).all()
+        limit = request.args.get('limit', type=int)
+        before_id = request.args.get('before_message_id', type=int)
+        after_id = request.args.get('after_message_id', type=int)
+        if before_id is not None and after_id is not None:
+            return jsonify({'error': 'before_message_id と after_message_id は同時に指定できません'}), 400
+        if limit is None and (before_id is not None or after_id is not None):
+            limit = MESSAGE_PAGE_MAX
+        if limit is not None:
+            limit = min(max(limit, 1), MESSAGE_PAGE_MAX)
         
-        result = {
-            'id': conversation.id,
-            'title': conversation.title,
-            'dify_app_id': conversation.dify_app_id,
-            'dify_conversation_id': conversation.dify_conversation_id,
-            'messages': [
-                {
-                    'id': msg.id,
-                    'role': msg.role,
-                    'content': msg.content,
-                    'created_at': msg.created_at.isoformat()
-                }
-                for msg in messages
-            ]
-        }
+        statement = (
+            select(Message.id, Message.role, Message.content, Message.created_at)
+            .where(*_visible_messages(conversation_id))
+            .order_by(Message.id)
+        )
+        page_headers = {}
+        with storage.read_session() as session:
+            conversation = session.get(Conversation, conversation_id)
+            if not conversation:
+                return jsonify({'error': '会話が見つかりません'}), 404
+            
+            header = {
+                'id': conversation.id,
+                'title': conversation.title,
+                'dify_app_id': conversation.dify_app_id,
+                'dify_conversation_id': conversation.dify_conversation_id,
+            }
+            
+            if limit is not None:
+                low, high, has_more = _message_page_bounds(session, conversation_id, limit, before_id, after_id)
+                if low is None:
+                    statement = statement.where(db.false())
+                else:
+                    statement = statement.where(Message.id.between(low, high))
+                    if has_more and after_id is not None:
+                        page_headers['X-After-Message-Id'] = str(high)
+                    elif has_more:
+                        page_headers['X-Before-Message-Id'] = str(low)
+        
+        def generate_messages():
+            """メッセージを yield_per 単位で取得しながら1件ずつ返す"""
+            with app.app_context():
+                with storage.read_session() as session:
+                    rows = session.execute(statement.execution_options(yield_per=MESSAGE_STREAM_BATCH))
+                    for row in rows:
+                        yield {
+                            'id': row.id,
+                            'role': row.role,
+                            'content': row.content,
+                            'created_at': row.created_at.isoformat()
+                        }
+        
+        def generate_response():
+            try:
+                if output_format == 'ndjson':
+                    yield from stream_ndjson(header, generate_messages())
+                else:
+                    yield from stream_json_object(header, 'messages', generate_messages())
+            except Exception as e:
+                # ステータスは送信済みのため、ログに残して応答を打ち切る
+                logger.error(f"会話ストリーミングエラー (ID: {conversation_id}): {str(e)}")
+                if output_format == 'ndjson':
+                    yield json.dumps({'error': str(e)}, ensure_ascii=False) + '\n'
         
-        return jsonify(result)
+        return Response(
+            generate_response(),
+            mimetype=NDJSON_MIMETYPE if output_format == 'ndjson' else 'application/json',
+            headers=page_headers
+        )
     
     except Exception as e:
         logger.error(f"会話取得エラー: {str(e)}")
@@ -265,13 +447,13 @@ def get_conversation(conversation_id):
 def delete_conversation(conversation_id):
     """会話削除"""
     try:
-        conversation = db.session.get(Conversation, conversation_id)
-        if not conversation:
+        # 関連メッセージ・生レスポンスも含めてテーブルごとに1文で削除
+        deleted = delete_conversation_rows(db.session, [conversation_id])
+        if not deleted['conversations']:
+            db.session.rollback()
             return jsonify({'error': '会話が見つかりません'}), 404
-        
-        # 関連メッセージと会話を削除（カスケード削除）
-        db.session.delete(conversation)
         db.session.commit()
+        analysis_cache.invalidate_many(deleted['message_ids'])
         
         logger.info(f"会話削除完了 - ID: {conversation_id}")
         return jsonify({'message': '会話が削除されました', 'deleted_id': conversation_id})
@@ -281,53 +463,271 @@ def delete_conversation(conversation_id):
         logger.error(f"会話削除エラー: {str(e)}")
         return jsonify({'error': f'会話の削除に失敗しました: {str(e)}'}), 500
 
-@app.route('/api/messages/<message_id>/analysis', methods=['GET'])
+@app.route('/api/conversations/bulk-delete', methods=['POST'])
+def bulk_delete_conversations():
+    """
+    会話の一括削除
+    
+    リクエストボディ（JSON、指定した条件すべてに一致する会話を削除）:
+        conversation_ids: 会話IDのリスト
+        dify_app_id: Difyアプリ
+        older_than_days: 最終更新からの経過日数
+    
+    削除した会話・メッセージ・生レスポンスの件数と所要時間を返す。
+    """
+    data = request.get_json(silent=True) or {}
+    conversation_ids = data.get('conversation_ids')
+    dify_app_id = data.get('dify_app_id')
+    older_than_days = data.get('older_than_days')
+    
+    if conversation_ids is not None and (
+        not isinstance(conversation_ids, list) or not all(isinstance(i, int) for i in conversation_ids)
+    ):
+        return jsonify({'error': 'conversation_ids は整数のリストで指定してください'}), 400
+    if dify_app_id is not None and not isinstance(dify_app_id, int):
+        return jsonify({'error': 'dify_app_id は整数で指定してください'}), 400
+    if older_than_days is not None and (not isinstance(older_than_days, (int, float)) or older_than_days < 0):
+        return jsonify({'error': 'older_than_days は0以上の数値で指定してください'}), 400
+    if conversation_ids is None and dify_app_id is None and older_than_days is None:
+        return jsonify({'error': 'conversation_ids / dify_app_id / older_than_days のいずれかを指定してください'}), 400
+    
+    try:
+        report = delete_conversations(
+            conversation_ids=conversation_ids,
+            dify_app_id=dify_app_id,
+            older_than=datetime.utcnow() - timedelta(days=older_than_days) if older_than_days is not None else None,
+            on_deleted=analysis_cache.invalidate_many
+        )
+        logger.info(f"会話一括削除完了 - 会話 {report['conversations']}件, メッセージ {report['messages']}件")
+        return jsonify(report)
+    
+    except Exception as e:
+        logger.error(f"会話一括削除エラー: {str(e)}")
+        return jsonify({'error': f'会話の一括削除に失敗しました: {str(e)}'}), 500
+
+@app.route('/api/messages/<int:message_id>/analysis', methods=['GET'])
 def get_message_analysis(message_id):
-    """メッセージ解析データ取得"""
+    """
+    メッセージ解析データ取得
+    
+    クエリパラメータ:
+        fields: 返すフィールドをカンマ区切りで指定（content, raw_response, keyphrases, analysis, created_at）
+        events_offset / limit: raw_response の一部だけを返す
+    
+    パース済みの解析データは LRU キャッシュから返し、ETag / Last-Modified による
+    条件付きリクエストには 304 を返す。解析ジョブが未完了の間は 202 と
+    {"status": "pending"} を返す。
+    """
     try:
-        message = db.session.get(Message, message_id)
-        if not message:
-            return jsonify({'error': 'メッセージが見つかりません'}), 404
+        fields = ANALYSIS_FIELDS
+        if request.args.get('fields'):
+            fields = tuple(name.strip() for name in request.args['fields'].split(',') if name.strip())
+            unknown = [name for name in fields if name not in ANALYSIS_FIELDS]
+            if unknown:
+                return jsonify({'error': f"不明なフィールド: {', '.join(unknown)}"}), 400
+        events_offset = request.args.get('events_offset', 0, type=int)
+        limit = request.args.get('limit', type=int)
+        if events_offset < 0 or (limit is not None and limit < 0):
+            return jsonify({'error': 'events_offset / limit は0以上で指定してください'}), 400
         
-        if not message.raw_dify_response:
-            return jsonify({'error': 'レスポンスデータが見つかりません'}), 404
+        job_state = analysis_jobs.status(message_id)
+        if job_state:
+            return _analysis_pending(message_id, job_state)
         
-        raw_data = json.loads(message.raw_dify_response)
-        keyphrase_data = json.loads(message.keyphrase_data) if message.keyphrase_data else {}
+        entry = analysis_cache.get(message_id)
+        if entry is None:
+            with storage.read_session() as session:
+                message = session.get(Message, message_id)
+                if not message:
+                    return jsonify({'error': 'メッセージが見つかりません'}), 404
+                
+                # 生レスポンスは圧縮テーブルから読み込む
+                raw_data = load_raw_response(session, message_id)
+                
+                # 永続化キューに書き込み待ちがあれば反映を待つ
+                if raw_data is None and persistence.pending():
+                    persistence.flush(timeout=2.0)
+                    session.rollback()
+                    session.refresh(message)
+                    raw_data = load_raw_response(session, message_id)
+                
+                if raw_data is None:
+                    # 保持期間を過ぎて生レスポンスだけ削除された場合は解析結果のみ返す
+                    if message.analysis_status == STATUS_PENDING or not (message.analysis_data or message.keyphrase_data):
+                        return jsonify({'error': 'レスポンスデータが見つかりません'}), 404
+                    raw_data = []
+                
+                # 解析が未完了でこのプロセスにジョブが無ければ（再起動など）投入し直す
+                if message.analysis_status == STATUS_PENDING:
+                    return _analysis_pending(message_id, analysis_jobs.submit(message_id, raw_data))
+                
+                entry = build_analysis_entry(
+                    message.id, message.content, raw_data, message.keyphrase_data, message.created_at,
+                    message.analysis_data
+                )
+            analysis_cache.put(entry)
         
-        result = {
-            'message_id': message.id,
-            'content': message.content,
-            'raw_response': raw_data,
-            'keyphrases': keyphrase_data,
-            'created_at': message.created_at.isoformat()
-        }
+        # 表現ごとに異なる ETag（フィールド・範囲指定を含める）
+        etag = entry.etag
+        if fields != ANALYSIS_FIELDS or events_offset or limit is not None:
+            etag = f"{etag}-{','.join(fields)}-{events_offset}-{limit}"
         
-        return jsonify(result)
+        if is_resource_modified(request.environ, etag=etag, last_modified=entry.created_at):
+            response = jsonify(entry.to_dict(fields, events_offset, limit))
+        else:
+            response = Response(status=304)
+        response.set_etag(etag)
+        response.last_modified = entry.created_at
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
     
     except Exception as e:
         logger.error(f"メッセージ解析取得エラー: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+def _analysis_pending(message_id, job_state):
+    """解析ジョブ未完了の応答（202、キャッシュさせない）"""
+    response = jsonify({'message_id': message_id, 'status': 'pending', 'job_state': job_state})
+    response.status_code = 202
+    response.headers['Retry-After'] = '1'
+    response.cache_control.no_store = True
+    return response
+
 @app.route('/api/dify-apps', methods=['GET'])
 def get_dify_apps():
     """Difyアプリ一覧取得"""
     try:
-        apps = DifyApp.query.all()
-        result = [
-            {
-                'id': app.id,
-                'name': app.name,
-                'description': app.description
-            }
-            for app in apps
-        ]
-        return jsonify(result)
+        return jsonify([entry.to_dict() for entry in app_registry.all()])
     
     except Exception as e:
         logger.error(f"Difyアプリ取得エラー: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/keyphrases/search', methods=['GET'])
+def search_keyphrase_index():
+    """
+    キーフレーズ検索（会話横断）
+    
+    クエリパラメータ:
+        q: 検索語（部分一致）
+        dify_app_id: 指定するとそのアプリの会話に限定
+        limit: 返すキーフレーズ数（既定20、最大100）
+        conversations: キーフレーズごとに返す会話数（既定5、最大50）
+    """
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': '検索語を指定してください'}), 400
+    dify_app_id = request.args.get('dify_app_id', type=int)
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    conversations = min(max(request.args.get('conversations', 5, type=int), 1), 50)
+    
+    try:
+        with storage.read_session() as session:
+            results = search_keyphrases(session, query, dify_app_id, limit, conversations)
+        return jsonify({'query': query, 'results': results})
+    
+    except Exception as e:
+        logger.error(f"キーフレーズ検索エラー: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/dify-apps/<int:dify_app_id>/keyphrases', methods=['GET'])
+def get_top_keyphrases(dify_app_id):
+    """Difyアプリごとの出現回数上位のキーフレーズ（limit: 既定20、最大100）"""
+    limit = min(max(request.args.get('limit', 20, type=int), 1), 100)
+    try:
+        if app_registry.get(dify_app_id) is None:
+            return jsonify({'error': '指定されたDifyアプリが見つかりません'}), 404
+        with storage.read_session() as session:
+            results = top_keyphrases(session, dify_app_id, limit)
+        return jsonify({'dify_app_id': dify_app_id, 'keyphrases': results})
+    
+    except Exception as e:
+        logger.error(f"キーフレーズ集計エラー: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/stats/dify-pool', methods=['GET'])
+def get_dify_pool_stats():
+    """Dify API 接続プール統計取得"""
+    return jsonify(get_default_pool().stats())
+
+@app.route('/api/stats/persistence', methods=['GET'])
+def get_persistence_stats():
+    """永続化キュー統計取得"""
+    return jsonify(persistence.stats())
+
+@app.route('/api/stats/analysis-cache', methods=['GET'])
+def get_analysis_cache_stats():
+    """解析キャッシュ統計取得"""
+    return jsonify(analysis_cache.stats())
+
+@app.route('/api/stats/analysis-jobs', methods=['GET'])
+def get_analysis_job_stats():
+    """解析ジョブ統計取得"""
+    return jsonify(analysis_jobs.stats())
+
+@app.route('/api/stats/response-cache', methods=['GET'])
+def get_response_cache_stats():
+    """応答キャッシュ統計取得"""
+    return jsonify(response_cache.stats())
+
+@app.route('/api/stats/chat-scheduler', methods=['GET'])
+def get_chat_scheduler_stats():
+    """Difyアプリごとの実行中・待ち行列の統計取得"""
+    return jsonify(chat_scheduler.stats())
+
+@app.route('/api/stats/turn-streams', methods=['GET'])
+def get_turn_stream_stats():
+    """再接続用にバッファ中のストリームの統計取得"""
+    return jsonify(turn_streams.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """フェーズ別レイテンシのヒストグラムと各コンポーネントの統計（Prometheus 形式）"""
+    return Response(metrics.render_prometheus(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+@app.route('/api/maintenance/response-cache', methods=['DELETE'])
+def clear_response_cache():
+    """応答キャッシュを破棄（Difyアプリの設定・ナレッジを更新した後など）"""
+    return jsonify({'cleared': response_cache.clear()})
+
+@app.route('/api/maintenance/dify-apps/reload', methods=['POST'])
+def reload_dify_apps():
+    """Difyアプリと .env のAPIキーを読み込み直す（他のプロセスは版数・.env の確認で追従する）"""
+    try:
+        return jsonify(app_registry.reload())
+    except Exception as e:
+        logger.error(f"Difyアプリ再読み込みエラー: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/maintenance/retention', methods=['GET'])
+def get_retention_status():
+    """保持期間ジョブの設定と前回の実行結果"""
+    return jsonify(retention_job.status())
+
+@app.route('/api/maintenance/retention', methods=['POST'])
+def run_retention():
+    """
+    保持期間ジョブを今すぐ実行
+    
+    リクエストボディ（JSON、省略時は設定値）: conversation_days, payload_days, vacuum_pages
+    """
+    data = request.get_json(silent=True) or {}
+    options = {}
+    for name in ('conversation_days', 'payload_days', 'vacuum_pages'):
+        value = data.get(name)
+        if value is None:
+            continue
+        if not isinstance(value, int) or value < 0:
+            return jsonify({'error': f'{name} は0以上の整数で指定してください'}), 400
+        options[name] = value
+    
+    try:
+        return jsonify(retention_job.run(**options))
+    except Exception as e:
+        logger.error(f"保持期間ジョブエラー: {str(e)}")
+        return jsonify({'error': f'保持期間ジョブに失敗しました: {str(e)}'}), 500
+
 # エラーハンドラー
 @app.errorhandler(404)
 def not_found_error(error):
@@ -349,49 +749,51 @@ def handle_exception(error):
     logger.error(f"未処理例外: {str(error)}", exc_info=True)
     return jsonify({'error': f'予期しないエラーが発生しました: {str(error)}'}), 500
 
-# データベース初期化
+def initialize_database():
+    """
+    未適用のスキーマ移行を適用し、Difyアプリのレジストリを読み込む（起動時に1回呼ぶ）
+    
+    WSGI の開発サーバーは __main__ から、ASGI は lifespan の startup から呼ぶ。
+    gunicorn・flask run などそれ以外のWSGIサーバーでは、最初のリクエストの前に
+    ensure_database_initialized から呼ばれる（複数のワーカーが同時に呼んでも、
+    migrate が移行ごとに書き込みロックを取って確認し直すため二重には適用されない）。
+    """
+    with app.app_context():
+        # データベースディレクトリが存在することを確認
+        database_dir = os.path.dirname(database_path)
+        os.makedirs(database_dir, exist_ok=True)
+        
+        try:
+            report = migrate(db.engine)
+            app_registry.load()
+        except Exception as e:
+            logger.error(f"データベース初期化エラー: {str(e)}")
+            raise
+        
+        startup_report.update(
+            schema_version=report['version'],
+            migrations_applied=len(report['applied']),
+            init_seconds=report['seconds'],
+        )
+        applied = f"、適用: {', '.join(report['applied'])}" if report['applied'] else ''
+        logger.info(f"データベース初期化完了: スキーマバージョン {report['version']}{applied} "
+                    f"({report['seconds'] * 1000:.1f}ms)")
+        database_initialized.set()
+
 @app.before_request
 def ensure_database_initialized():
-    """初回リクエスト時にデータベース初期化"""
-    if not hasattr(app, '_database_initialized'):
-        with app.app_context():
-            # データベースディレクトリが存在することを確認
-            database_dir = os.path.dirname(database_path)
-            os.makedirs(database_dir, exist_ok=True)
-            
-            try:
-                db.create_all()
-                
-                # 初期データがない場合のみ挿入
-                if db.session.query(DifyApp).count() == 0:
-                    sample_apps = [
-                        DifyApp(name='sample1', description='Sample Dify Application 1', api_key_env_name='DIFY_API_KEY_SAMPLE1'),
-                        DifyApp(name='sample2', description='Sample Dify Application 2', api_key_env_name='DIFY_API_KEY_SAMPLE2'),
-                        DifyApp(name='sample3', description='Sample Dify Application 3', api_key_env_name='DIFY_API_KEY_SAMPLE3')
-                    ]
-                    
-                    for app_data in sample_apps:
-                        db.session.add(app_data)
-                    
-                    db.session.commit()
-                    logger.info("初期Difyアプリデータを作成しました")
-                
-                # インデックス作成（パフォーマンス最適化）
-                try:
-                    with db.engine.connect() as connection:
-                        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_conversations_dify_app_id ON conversations(dify_app_id)"))
-                        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations(created_at)"))
-                        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id)"))
-                        connection.commit()
-                    logger.info("データベースインデックスを作成しました")
-                except Exception as e:
-                    logger.warning(f"インデックス作成に失敗しました: {e}")
-                
-                app._database_initialized = True
-                
-            except Exception as e:
-                logger.error(f"データベース初期化エラー: {str(e)}")
-                raise
+    """
+    initialize_database が未実行なら最初のリクエストの前に1回だけ実行
+    
+    移行前のスキーマ・空のレジストリで応答しないようにする。実行済みなら
+    フラグを確認するだけで戻る。失敗した場合はそのリクエストを 500 にし、次のリクエストで再試行する。
+    """
+    if database_initialized.is_set():
+        return
+    with _initialize_lock:
+        if not database_initialized.is_set():
+            initialize_database()
 
 if __name__ == '__main__':
+    initialize_database()
     app.run(debug=True, host='0.0.0.0', port=5000)
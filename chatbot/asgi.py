@@ -0,0 +1,244 @@
+"""
+ASGI エントリーポイント
+
+/api/chat-stream（再接続の /api/chat-stream/<ID> を含む）を asyncio ネイティブに
+処理し、その他のエンドポイントは既存の Flask アプリケーションへ委譲する。上流の待機中にスレッドを占有しないため、
+1プロセスで多数のSSEストリームを同時に扱える。
+
+起動例:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+from urllib.parse import parse_qs
+from contextlib import aclosing
+from typing import AsyncGenerator, Optional
+
+from asgiref.wsgi import WsgiToAsgi
+
+from app import app, initialize_database, SSE_HEADERS
+from utils.chat_service import ChatRequestError, ChatTurn, start_chat_turn, sse_event, SSE_DONE
+from utils.dify_client import DifyClient
+from utils.http_pool import close_async_clients
+from utils.persistence import persistence
+from utils.analysis_jobs import analysis_jobs
+from utils.response_cache import response_cache
+from utils.turn_streams import turn_streams, resume_position, is_stream_id, TurnStream, StreamGapError, StreamElsewhereError
+
+logger = logging.getLogger(__name__)
+
+flask_application = WsgiToAsgi(app)
+
+RESUME_PATH_PREFIX = '/api/chat-stream/'
+
+
+def _run_in_app_context(func, *args):
+    """Flaskアプリケーションコンテキスト内で同期関数を実行"""
+    with app.app_context():
+        return func(*args)
+
+
+async def _read_body(receive) -> bytes:
+    """リクエストボディを全て読み込む"""
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            break
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+    return body
+
+
+async def _send_json(send, status: int, data, headers=None):
+    """JSONレスポンスを送信"""
+    body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ] + [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _generate_response(turn: ChatTurn) -> AsyncGenerator[str, None]:
+    """ストリーミングレスポンス生成（非同期版）"""
+    dify_client = DifyClient(turn.api_key)
+    try:
+        # 実行枠が空くまで順番待ちを通知
+        async with aclosing(turn.await_slot()) as waiting:
+            async for frame in waiting:
+                yield frame
+        
+        async with aclosing(response_cache.astream_chat(turn, dify_client)) as stream:
+            async for chunk in stream:
+                if chunk:
+                    yield turn.handle_chunk(chunk)
+                    
+                    # conversation_id 更新とメッセージ保存（永続化キュー経由）
+                    if chunk.get('event') == 'message_end':
+                        yield turn.complete(chunk)
+        
+        if turn.timing_event:
+            yield turn.timing_frame()
+        yield SSE_DONE
+    
+    except Exception as e:
+        logger.error(f"ストリーミングエラー: {str(e)}")
+        yield sse_event({'error': str(e), 'event': 'error'})
+    
+    finally:
+        # message_end 前に終了（上流のエラー）した場合の後始末
+        turn.release()
+        turn.abort()
+
+
+async def _pump_stream(stream: TurnStream, send, after_seq: int = 0, headers=None):
+    """バッファ中のSSEフレームをクライアントへ送信"""
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [(b'content-type', b'text/event-stream; charset=utf-8')] + [
+            (name.lower().encode(), value.encode()) for name, value in {**SSE_HEADERS, **(headers or {})}.items()
+        ] + [(b'x-stream-id', str(stream.stream_id).encode())],
+    })
+    async with aclosing(stream.aframes(after_seq)) as frames:
+        async for frame in frames:
+            await send({'type': 'http.response.body', 'body': frame.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+
+
+async def _serve_stream(stream: TurnStream, receive, send, after_seq: int = 0, headers=None):
+    """クライアントが切断するまでフレームを送信（上流の受信は切断後も続く）"""
+    pump = asyncio.create_task(_pump_stream(stream, send, after_seq, headers))
+    watcher = asyncio.create_task(_cancel_on_disconnect(receive, pump))
+    try:
+        await pump
+    except asyncio.CancelledError:
+        if not pump.cancelled():
+            raise
+        logger.info(f"クライアント切断（上流の受信は継続） - メッセージID: {stream.message_id}")
+    finally:
+        watcher.cancel()
+
+
+async def _cancel_on_disconnect(receive, task: asyncio.Task):
+    """クライアント切断を検知したら送信をキャンセル"""
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            task.cancel()
+            return
+
+
+async def chat_stream(scope, receive, send):
+    """ストリーミングチャット API（ASGI版）"""
+    body = await _read_body(receive)
+    try:
+        data = json.loads(body) if body else None
+    except ValueError:
+        await _send_json(send, 400, {'error': 'リクエストJSONが不正です'})
+        return
+    
+    try:
+        turn = await asyncio.to_thread(_run_in_app_context, start_chat_turn, data)
+    except ChatRequestError as e:
+        headers = {'Retry-After': str(e.retry_after)} if e.retry_after else None
+        await _send_json(send, e.status_code, {'error': e.message}, headers)
+        return
+    except Exception as e:
+        logger.error(f"チャットAPIエラー: {str(e)}")
+        await _send_json(send, 500, {'error': str(e)})
+        return
+    
+    # 上流の受信はクライアント接続と切り離したタスクで最後まで実行する
+    # （Server-Timing はストリーム開始までのフェーズのみ。全フェーズは末尾の timing イベント）
+    stream = turn_streams.astart(turn, _generate_response(turn))
+    await _serve_stream(stream, receive, send, headers={'Server-Timing': turn.timings.server_timing()})
+
+
+async def resume_chat_stream(scope, receive, send, stream_id: str):
+    """切断したチャットストリームへの再接続（ASGI版。app.resume_chat_stream と同じ仕様）"""
+    try:
+        stream = turn_streams.get(stream_id)
+    except StreamElsewhereError:
+        await _send_json(send, 421, {'error': 'このストリームは別のワーカーで実行されています。再接続は同じワーカーに届く構成（単一ワーカーまたはスティッキールーティング）が必要です'})
+        return
+    if stream is None:
+        await _send_json(send, 404, {'error': 'ストリームが見つかりません（終了後の保持期間を過ぎています）'})
+        return
+    
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    last_event_id = headers.get('last-event-id') or (query.get('last_event_id') or [None])[0]
+    after_seq = resume_position(stream_id, last_event_id)
+    try:
+        stream.check(after_seq)
+    except StreamGapError:
+        await _send_json(send, 410, {
+            'error': '再送できる範囲を過ぎています。会話を開き直してください',
+            'conversation_id': stream.conversation_id,
+        })
+        return
+    await _serve_stream(stream, receive, send, after_seq)
+
+
+async def _delegate_to_flask(scope, receive, send):
+    """
+    Flask アプリケーションへ委譲（空のコンテキストで実行）
+    
+    keep-alive の接続では、uvicorn が前のリクエストの send() の中から次のリクエストの
+    タスクを作ることがある。WsgiToAsgi の send() は asgiref の AsyncToSync 内で動くため、
+    そのまま引き継ぐと終了済みの CurrentThreadExecutor を使おうとして失敗する。
+    """
+    task = contextvars.Context().run(asyncio.ensure_future, flask_application(scope, receive, send))
+    await task
+
+
+def _resume_stream_id(scope) -> Optional[str]:
+    """GET /api/chat-stream/<ID> ならストリームID"""
+    if scope['method'] != 'GET' or not scope['path'].startswith(RESUME_PATH_PREFIX):
+        return None
+    value = scope['path'][len(RESUME_PATH_PREFIX):]
+    return value if is_stream_id(value) else None
+
+
+async def _lifespan(receive, send):
+    """起動時にDB初期化、終了時に実行中のターン・解析ジョブを待ってから上流クライアントと永続化キューを停止"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await asyncio.to_thread(initialize_database)
+            except Exception as e:
+                await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # 受信中のターン → 解析ジョブ → 永続化キューの順に止める
+            # （先に永続化キューを止めると、後から終わったターン・解析の結果を保存できない）
+            await turn_streams.adrain()
+            await close_async_clients()
+            await asyncio.to_thread(analysis_jobs.shutdown)
+            await asyncio.to_thread(persistence.shutdown)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    """ASGIアプリケーション"""
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+    elif scope['type'] == 'http' and scope['path'] == '/api/chat-stream' and scope['method'] == 'POST':
+        await chat_stream(scope, receive, send)
+    elif scope['type'] == 'http' and _resume_stream_id(scope) is not None:
+        await resume_chat_stream(scope, receive, send, _resume_stream_id(scope))
+    else:
+        await _delegate_to_flask(scope, receive, send)
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+キーフレーズ索引のバックフィルスクリプト
+既存メッセージの keyphrase_data を正規化して message_keyphrases と
+全文索引（keyphrases_fts）に登録する（一度だけ実行、中断しても再実行可）
+"""
+
+import sys
+import time
+
+from app import app, initialize_database
+from database.keyphrase_index import backfill_keyphrase_index
+from utils.response_parser import ResponseParser
+
+
+def main():
+    """テーブル作成と索引登録"""
+    print("=== キーフレーズ索引のバックフィル ===")
+    
+    # 索引用テーブル・全文索引・トリガーの作成
+    initialize_database()
+    
+    with app.app_context():
+        started = time.perf_counter()
+        try:
+            report = backfill_keyphrase_index(ResponseParser.keyphrase_rows)
+        except Exception as e:
+            print(f"バックフィルに失敗しました: {e}")
+            return 1
+        elapsed = time.perf_counter() - started
+    
+    print(f"{report['messages']}件のメッセージから{report['rows']}件の出現を登録しました ({elapsed:.2f}秒)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,36 @@
+#!/usr/bin/env python3
+"""
+会話サマリー列のバックフィルスクリプト
+既存DBの conversations に preview_title / message_count / last_message_at /
+last_token_usage を追加し、messages から再計算する（一度だけ実行）
+"""
+
+import sys
+import time
+
+from app import app, initialize_database
+from database.summary import backfill_conversation_summaries
+
+
+def main():
+    """列追加とサマリー再計算"""
+    print("=== 会話サマリーのバックフィル ===")
+    
+    # 不足している列の追加
+    initialize_database()
+    
+    with app.app_context():
+        started = time.perf_counter()
+        try:
+            updated = backfill_conversation_summaries()
+        except Exception as e:
+            print(f"バックフィルに失敗しました: {e}")
+            return 1
+        elapsed = time.perf_counter() - started
+    
+    print(f"{updated}件の会話を更新しました ({elapsed:.2f}秒)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+解析ジョブ（キーフレーズ抽出・表示用整形・統計）の実行方式の比較
+
+N 件のストリームが同時に message_end を受信した状況を再現し、
+解析をストリーミングスレッドで直接実行する方式（ANALYSIS_WORKERS=0、従来相当）と
+スレッドプール / プロセスプールへ投入する方式で以下を計測する。
+
+- complete()（最終フレーム送信まで）の所要時間
+- 同時に動いている別ストリームのフレーム生成間隔（GIL競合の影響）
+- 全件の解析結果が Message に保存されるまでの時間とスループット
+
+使い方:
+    python benchmarks/bench_analysis_jobs.py --completions 8 32 --resources 300 --workers 4
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODES = ('inline', 'thread', 'process')
+
+
+def dify_chunks(tokens: int, resources: int, phrases: int = 40):
+    """retriever_resources を多く含む応答のチャンク列"""
+    envelope = {'conversation_id': 'bench', 'message_id': 'msg', 'task_id': 'task', 'created_at': 1700000000}
+    chunks = [{'event': 'message', **envelope, 'answer': f'回答{i}'} for i in range(tokens)]
+    chunks.append({
+        'event': 'message_end',
+        **envelope,
+        'metadata': {
+            'usage': {'prompt_tokens': 800, 'completion_tokens': tokens, 'total_tokens': 800 + tokens},
+            'retriever_resources': [
+                {'position': i, 'document_name': f'doc-{i}.pdf', 'score': 0.8,
+                 'content': '\r\n'.join(f'キーフレーズ{(i * 7 + j) % 500}' for j in range(phrases))}
+                for i in range(resources)
+            ],
+        },
+    })
+    return chunks
+
+
+def percentile(values, ratio: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(ratio * (len(ordered) - 1)))]
+
+
+def run_worker(args):
+    """子プロセス側: 方式ごとに同時完了を再現して結果をJSON出力"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from sqlalchemy import select, func
+    from app import app, initialize_database
+    from database.models import db, Message
+    from utils.chat_service import start_chat_turn, sse_event
+    from utils.persistence import persistence
+    from utils.analysis_jobs import analysis_jobs, STATUS_DONE
+    
+    initialize_database()
+    chunks = dify_chunks(args.tokens, args.resources)
+    
+    def prepare(count: int):
+        turns = []
+        with app.app_context():
+            for i in range(count):
+                turn = start_chat_turn({'message': f'ベンチマーク {i}', 'dify_app_id': 1})
+                for chunk in chunks[:-1]:
+                    turn.handle_chunk(chunk)
+                turns.append(turn)
+        return turns
+    
+    def run_round(count: int):
+        turns = prepare(count)
+        barrier = threading.Barrier(count + 1)
+        complete_seconds = []
+        lock = threading.Lock()
+        
+        def finish(turn):
+            barrier.wait()
+            started = time.perf_counter()
+            turn.handle_chunk(chunks[-1])
+            turn.complete(chunks[-1])
+            elapsed = time.perf_counter() - started
+            with lock:
+                complete_seconds.append(elapsed)
+        
+        # 同時に流れている別ストリームのフレーム生成間隔
+        frame_gaps = []
+        stop = threading.Event()
+        
+        def probe():
+            last = time.perf_counter()
+            while not stop.is_set():
+                sse_event(chunks[0])
+                time.sleep(0.001)
+                now = time.perf_counter()
+                frame_gaps.append(now - last - 0.001)
+                last = now
+        
+        threads = [threading.Thread(target=finish, args=(turn,)) for turn in turns]
+        probe_thread = threading.Thread(target=probe)
+        probe_thread.start()
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        streams_done = time.perf_counter() - started
+        analysis_jobs.wait()
+        persistence.flush()
+        total = time.perf_counter() - started
+        stop.set()
+        probe_thread.join()
+        
+        with app.app_context():
+            ids = [turn.assistant_message_id for turn in turns]
+            done = db.session.execute(
+                select(func.count()).select_from(Message)
+                .where(Message.id.in_(ids), Message.analysis_status == STATUS_DONE)
+            ).scalar_one()
+        assert done == count, (done, count)
+        return {
+            'complete_p50_ms': round(statistics.median(complete_seconds) * 1000, 2),
+            'complete_p99_ms': round(percentile(complete_seconds, 0.99) * 1000, 2),
+            'probe_gap_p99_ms': round(percentile(frame_gaps, 0.99) * 1000, 2),
+            'streams_done_ms': round(streams_done * 1000, 1),
+            'all_stored_ms': round(total * 1000, 1),
+            'analyses_per_second': round(count / total, 1),
+        }
+    
+    report = {}
+    for mode in args.modes:
+        analysis_jobs.shutdown()
+        analysis_jobs.workers = 0 if mode == 'inline' else args.workers
+        analysis_jobs.executor_type = 'process' if mode == 'process' else 'thread'
+        run_round(max(2, args.workers))  # ワーカー起動分のウォームアップ
+        report[mode] = {str(count): run_round(count) for count in args.completions}
+    analysis_jobs.shutdown()
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='解析ジョブの実行方式の比較')
+    parser.add_argument('--completions', nargs='+', type=int, default=[8, 32], help='同時に完了するストリーム数')
+    parser.add_argument('--tokens', type=int, default=300, help='応答あたりの message イベント数')
+    parser.add_argument('--resources', type=int, default=300, help='retriever_resources 件数')
+    parser.add_argument('--workers', type=int, default=4, help='プールのワーカー数')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-analysis-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}", DIFY_API_KEY_SAMPLE1='bench')
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--tokens', str(args.tokens), '--resources', str(args.resources), '--workers', str(args.workers),
+               '--completions', *map(str, args.completions), '--modes', *args.modes]
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    print(f"message イベント {args.tokens} 件 + retriever_resources {args.resources} 件, ワーカー {args.workers}")
+    for mode, rounds in report.items():
+        for count, result in rounds.items():
+            print(
+                f"  {mode:8s} 同時 {int(count):3d} 件: complete p50 {result['complete_p50_ms']:7.2f}ms "
+                f"p99 {result['complete_p99_ms']:7.2f}ms | 別ストリーム間隔 p99 {result['probe_gap_p99_ms']:7.2f}ms | "
+                f"全件保存 {result['all_stored_ms']:8.1f}ms ({result['analyses_per_second']:6.1f} 件/秒)"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+会話削除と保持期間ジョブのベンチマーク
+
+生レスポンス・キーフレーズ索引・全文索引を持つ会話を一時DBに投入し、以下を計測する。
+
+- 従来方式: 会話ごとに ORM のカスケード削除（子の Message を読み込んで1行ずつ削除）
+- DELETE /api/conversations/<id>（テーブルごとに1文で削除）
+- POST /api/conversations/bulk-delete（Difyアプリ指定の一括削除）
+- 保持期間ジョブ（古い生レスポンスの削除 + incremental_vacuum）
+
+使い方:
+    python benchmarks/bench_bulk_delete.py --conversations 2000 --messages-per-conversation 50
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(connection, conversations: int, per_conversation: int, payload_bytes: int):
+    """会話・メッセージ・生レスポンス（圧縮済みを想定したランダムなバイト列）・キーフレーズ索引を投入"""
+    rng = random.Random(1)
+    old = '2000-01-01 00:00:00'
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, created_at, updated_at, message_count) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [(i, f'会話 {i}', i % 3 + 1, old, old, per_conversation) for i in range(1, conversations + 1)],
+    )
+    connection.exec_driver_sql(
+        "INSERT INTO keyphrases (id, phrase) VALUES (?, ?)", [(i, f'キーフレーズ{i}') for i in range(1, 501)]
+    )
+    message_id = 0
+    for conversation_id in range(1, conversations + 1):
+        messages, payloads, keyphrases = [], [], []
+        for _ in range(per_conversation):
+            message_id += 1
+            messages.append((message_id, conversation_id, 'assistant', f'回答本文 {message_id} 検索用のテキスト', old))
+            payloads.append((message_id, 'zlib', payload_bytes * 3, rng.randbytes(payload_bytes)))
+            keyphrases.extend(
+                (message_id, 1, k, 1, conversation_id, conversation_id % 3 + 1) for k in rng.sample(range(1, 501), 5)
+            )
+        connection.exec_driver_sql(
+            "INSERT INTO messages (id, conversation_id, role, content, created_at) VALUES (?, ?, ?, ?, ?)", messages
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO message_payloads (message_id, codec, raw_size, data) VALUES (?, ?, ?, ?)", payloads
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO message_keyphrases (message_id, document_index, keyphrase_id, count, conversation_id, dify_app_id) "
+            "VALUES (?, ?, ?, ?, ?, ?)", keyphrases
+        )
+
+
+def run_worker(args):
+    """子プロセス側: シード → 削除方式ごとに計測"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from app import app, initialize_database
+    from database.models import db, Conversation
+    from utils.retention_job import retention_job
+    
+    initialize_database()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            seed(connection, args.conversations, args.messages_per_conversation, args.payload_bytes)
+        db_file = db.engine.url.database
+    
+    report = {'db_bytes': os.path.getsize(db_file)}
+    sample = args.sample
+    
+    # 従来方式（変更前の delete_conversation と同じ）
+    started = time.perf_counter()
+    with app.app_context():
+        for conversation_id in range(1, sample + 1):
+            db.session.delete(db.session.get(Conversation, conversation_id))
+            db.session.commit()
+    report['legacy_ms'] = round((time.perf_counter() - started) / sample * 1000, 2)
+    
+    client = app.test_client()
+    started = time.perf_counter()
+    for conversation_id in range(sample + 1, 2 * sample + 1):
+        assert client.delete(f'/api/conversations/{conversation_id}').status_code == 200
+    report['single_ms'] = round((time.perf_counter() - started) / sample * 1000, 2)
+    
+    # 保持期間ジョブ（全メッセージの生レスポンスを削除）
+    report['retention'] = retention_job.run(conversation_days=0, payload_days=1)
+    
+    started = time.perf_counter()
+    response = client.post('/api/conversations/bulk-delete', json={'dify_app_id': 1})
+    report['bulk'] = response.get_json()
+    report['bulk']['wall_seconds'] = round(time.perf_counter() - started, 3)
+    report['vacuum_after_bulk'] = retention_job.run(conversation_days=0, payload_days=0)['vacuum']
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会話削除と保持期間ジョブのベンチマーク')
+    parser.add_argument('--conversations', type=int, default=2000, help='会話数')
+    parser.add_argument('--messages-per-conversation', type=int, default=50, help='会話あたりのメッセージ数')
+    parser.add_argument('--payload-bytes', type=int, default=4000, help='生レスポンス（圧縮後）のバイト数')
+    parser.add_argument('--sample', type=int, default=50, help='1件ずつ削除する会話数（方式ごと）')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-delete-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    command = [sys.executable, os.path.abspath(__file__), '--worker'] + [
+        value for name in ('conversations', 'messages_per_conversation', 'payload_bytes', 'sample')
+        for value in (f"--{name.replace('_', '-')}", str(getattr(args, name)))
+    ]
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    mib = lambda value: value / 1024 / 1024
+    print(f"会話 {args.conversations:,d} 件 x メッセージ {args.messages_per_conversation} 件, DB {mib(report['db_bytes']):.1f} MiB")
+    print(f"  従来 (ORM カスケード)       : {report['legacy_ms']:8.2f} ms / 会話")
+    print(f"  DELETE /api/conversations/<id>: {report['single_ms']:8.2f} ms / 会話")
+    bulk = report['bulk']
+    print(f"  一括削除 (Difyアプリ指定)   : 会話 {bulk['conversations']:,d} 件 / メッセージ {bulk['messages']:,d} 件 "
+          f"{bulk['wall_seconds']:.2f}秒 ({bulk['messages'] / bulk['wall_seconds']:,.0f} メッセージ/秒)")
+    retention = report['retention']
+    payloads = retention['payloads']
+    print(f"  保持期間ジョブ              : 生レスポンス {payloads['payloads']:,d} 件 ({mib(payloads['payload_bytes']):.1f} MiB) "
+          f"削除 {payloads['seconds']:.2f}秒, vacuum {mib(retention['vacuum']['bytes_reclaimed']):.1f} MiB 解放 "
+          f"{retention['vacuum']['seconds']:.2f}秒, ファイル {mib(retention['file_bytes_before']):.1f} → "
+          f"{mib(retention['file_bytes_after']):.1f} MiB")
+    vacuum = report['vacuum_after_bulk']
+    print(f"  一括削除後の vacuum         : {mib(vacuum['bytes_reclaimed']):.1f} MiB 解放, "
+          f"ファイル {mib(vacuum['file_bytes']):.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
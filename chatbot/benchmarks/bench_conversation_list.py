@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+会話一覧 (/api/conversations) のベンチマーク
+
+一時DBに合成データ（会話 N 件、各会話にユーザー/アシスタントのメッセージ）を
+一括投入し、従来の「会話ごとに最初のメッセージとアプリを個別取得する」方式と
+現在のエンドポイント（サマリー列の1クエリ + キーセットページング）を比較する。
+発行SQL数・レスポンスサイズ・レイテンシを表示する。
+
+使い方:
+    python benchmarks/bench_conversation_list.py --sizes 10000 100000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(connection, conversations: int):
+    """会話とメッセージを一括投入（ORMを通さず executemany で高速に作る）"""
+    base = 1700000000
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, dify_conversation_id, created_at, updated_at, "
+        "preview_title, message_count, last_message_at) "
+        "VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'), datetime(?, 'unixepoch'), ?, 2, datetime(?, 'unixepoch'))",
+        [
+            (i, f'会話 {i}', i % 3 + 1, f'dify-{i}', base + i, base + i * 2, f'会話 {i} の最初の質問です。', base + i * 2)
+            for i in range(1, conversations + 1)
+        ],
+    )
+    connection.exec_driver_sql(
+        "INSERT INTO messages (conversation_id, role, content, created_at) "
+        "VALUES (?, ?, ?, datetime(?, 'unixepoch'))",
+        [
+            row
+            for i in range(1, conversations + 1)
+            for row in (
+                (i, 'user', f'会話 {i} の最初の質問です。' + 'とても長い本文' * 20, base + i),
+                (i, 'assistant', '回答' * 100, base + i),
+            )
+        ],
+    )
+
+
+def legacy_list(session):
+    """変更前の実装（比較用）: 会話ごとに最初のメッセージとアプリを取得"""
+    from database.models import Conversation, Message
+    
+    conversations = session.query(Conversation).order_by(Conversation.updated_at.desc()).all()
+    result = []
+    for conv in conversations:
+        first_message = session.query(Message).filter_by(
+            conversation_id=conv.id, role='user'
+        ).order_by(Message.created_at).first()
+        
+        title = "空の会話"
+        if first_message:
+            title = first_message.content[:50] + "..." if len(first_message.content) > 50 else first_message.content
+        
+        result.append({
+            'id': conv.id,
+            'title': title,
+            'dify_app_name': conv.dify_app.name if conv.dify_app else 'Unknown App',
+            'created_at': conv.created_at.isoformat(),
+            'updated_at': conv.updated_at.isoformat()
+        })
+    return json.dumps(result)
+
+
+def run_worker(args):
+    """子プロセス側: 指定件数で計測してJSON出力"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from sqlalchemy import event
+    from app import app, initialize_database
+    from database.models import db
+    
+    initialize_database()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            seed(connection, args.size)
+        
+        statements = [0]
+        event.listen(db.engine, 'before_cursor_execute', lambda *_: statements.__setitem__(0, statements[0] + 1))
+        
+        report = {'size': args.size}
+        
+        if not args.skip_legacy:
+            statements[0] = 0
+            started = time.perf_counter()
+            body = legacy_list(db.session)
+            report['legacy'] = {
+                'queries': statements[0],
+                'bytes': len(body.encode('utf-8')),
+                'ms': round((time.perf_counter() - started) * 1000, 1),
+            }
+            db.session.remove()
+    
+    client = app.test_client()
+    pages = []
+    cursor = None
+    for _ in range(args.pages):
+        url = f'/api/conversations?limit={args.limit}'
+        if cursor:
+            url += f'&before={cursor}'
+        statements[0] = 0
+        started = time.perf_counter()
+        response = client.get(url)
+        elapsed = time.perf_counter() - started
+        pages.append({
+            'queries': statements[0],
+            'bytes': len(response.get_data()),
+            'ms': round(elapsed * 1000, 2),
+        })
+        cursor = response.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    report['paged'] = pages
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会話一覧エンドポイントのベンチマーク')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000])
+    parser.add_argument('--limit', type=int, default=50)
+    parser.add_argument('--pages', type=int, default=5, help='辿るページ数')
+    parser.add_argument('--skip-legacy', action='store_true', help='従来方式の計測を省略')
+    parser.add_argument('--size', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    for size in args.sizes:
+        tmpdir = tempfile.mkdtemp(prefix='chatbot-convlist-')
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+        command = [
+            sys.executable, os.path.abspath(__file__), '--worker', '--size', str(size),
+            '--limit', str(args.limit), '--pages', str(args.pages),
+        ]
+        if args.skip_legacy:
+            command.append('--skip-legacy')
+        output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+        report = json.loads(output.stdout.strip().splitlines()[-1])
+        
+        print(f"\n会話 {size} 件")
+        legacy = report.get('legacy')
+        if legacy:
+            print(f"  従来方式 (全件)       : {legacy['queries']:7d} queries  {legacy['bytes'] / 1024:10.1f} KiB  {legacy['ms']:10.1f} ms")
+        for index, page in enumerate(report['paged'], 1):
+            print(f"  1クエリ方式 page {index:<4d}: {page['queries']:7d} queries  {page['bytes'] / 1024:10.1f} KiB  {page['ms']:10.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+会話履歴の全文検索のベンチマーク
+
+ランダムな日本語・英語の本文を持つメッセージを一時DBに投入し、FTS5 索引
+（database.message_search.ensure_message_search）を作成したうえで、以下を計測する。
+
+- 従来方式: messages.content LIKE '%語%' の全件走査
+- GET /api/conversations/search?q=（FTS5 + スニペット、まれな語・頻出語・ページング）
+- 1〜2文字の語（2文字の組の索引 database.bigram_index。従来は LIKE の全件走査）
+
+使い方:
+    python benchmarks/bench_conversation_search.py --messages 100000
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ['検索', '結果', '本文', '会議', '資料', '設計', '要件', '確認', '手順', '障害', '対応', '運用', '契約', '顧客', '製品',
+         'サーバ', 'ネットワーク', '請求', '承認', '申請', 'について', 'を', 'は', 'が', 'です。', 'ます。',
+         'database', 'deploy', 'timeout', 'latency', 'release']
+
+
+def content(rng: random.Random, words: int) -> str:
+    # 出現頻度に偏りを持たせる
+    return ''.join(WORDS[min(len(WORDS) - 1, int(rng.paretovariate(0.7)) - 1)] for _ in range(words)) \
+        + f" 案件{rng.randrange(100000)}"
+
+
+def seed(connection, messages: int, words: int, batch: int = 20000):
+    """会話（1会話あたり10件）とメッセージを一括投入（FTS5 索引はトリガーで更新される）"""
+    rng = random.Random(1)
+    conversations = max(1, messages // 10)
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, created_at, updated_at, preview_title, message_count) "
+        "VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, 10)",
+        [(i, f'会話 {i}', i % 3 + 1, f'質問 {i}') for i in range(1, conversations + 1)],
+    )
+    for start in range(0, messages, batch):
+        connection.exec_driver_sql(
+            "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+            [(i // 10 + 1, 'user' if i % 2 == 0 else 'assistant', content(rng, words))
+             for i in range(start, min(messages, start + batch))],
+        )
+
+
+def measure(client, urls):
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, (url, response.status_code)
+    ordered = sorted(latencies)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(ordered[min(len(ordered) - 1, int(0.99 * (len(ordered) - 1)))] * 1000, 2),
+    }
+
+
+def run_worker(args):
+    """子プロセス側: シード → 計測"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from urllib.parse import quote
+    from sqlalchemy import text
+    from app import app, initialize_database
+    from database.models import db
+    
+    initialize_database()
+    with app.app_context():
+        started = time.perf_counter()
+        with db.engine.begin() as connection:
+            seed(connection, args.messages, args.words)
+        seed_seconds = time.perf_counter() - started
+        db_file = db.engine.url.database
+        with db.engine.connect() as connection:
+            fts_pages = connection.execute(text(
+                "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name LIKE 'messages_fts%'"
+            )).scalar() if args.dbstat else None
+            bigram_pages = connection.execute(text(
+                "SELECT COALESCE(SUM(pgsize), 0) FROM dbstat WHERE name LIKE 'messages_bigram%'"
+            )).scalar() if args.dbstat else None
+    
+    rng = random.Random(2)
+    queries = [rng.choice(WORDS[:20]) + rng.choice(WORDS[:20]) for _ in range(args.samples)]
+    queries = [q if len(q) >= 3 else q + 'を' for q in queries]
+    english = [rng.choice(['database', 'timeout', 'latency release', 'deploy 案件']) for _ in range(args.samples)]
+    short = [rng.choice(WORDS[:15]) for _ in range(args.samples)]
+    # 一致件数の少ない2文字の語（案件番号に含まれる2桁の数字、約4%のメッセージ）と1文字の語
+    short_rare = [str(rng.randrange(10, 100)) for _ in range(args.samples)]
+    single = [rng.choice('検結会資設要確手障対') for _ in range(args.samples)]
+    # 一致件数の少ない語（案件番号）
+    rare = [f'案件{rng.randrange(100000)}' for _ in range(args.samples)]
+    
+    # 従来方式: LIKE '%語%' で全件走査して会話ごとに集約
+    def naive_search(term):
+        with app.app_context():
+            return db.session.execute(text(
+                "SELECT conversation_id, MAX(id) FROM messages WHERE content LIKE :like "
+                "GROUP BY conversation_id ORDER BY 2 DESC LIMIT 20"
+            ), {'like': f'%{term}%'}).all()
+    
+    naive_seconds = []
+    for term in queries[:5]:
+        started = time.perf_counter()
+        naive_search(term)
+        naive_seconds.append(time.perf_counter() - started)
+    
+    client = app.test_client()
+    report = {
+        'messages': args.messages,
+        'seed_seconds': round(seed_seconds, 1),
+        'db_bytes': os.path.getsize(db_file),
+        'fts_bytes': fts_pages,
+        'bigram_bytes': bigram_pages,
+        'naive_ms': round(statistics.median(naive_seconds) * 1000, 1),
+        'search_rare': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in rare]),
+        'search_fts': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in queries]),
+        'search_fts_page3': measure(client, [f'/api/conversations/search?q={quote(q)}&offset=40' for q in queries]),
+        'search_english': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in english]),
+        'search_short': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in short]),
+        'search_short_rare': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in short_rare]),
+        'search_single': measure(client, [f'/api/conversations/search?q={quote(q)}' for q in single]),
+    }
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会話履歴の全文検索のベンチマーク')
+    parser.add_argument('--messages', type=int, default=100000, help='メッセージ数')
+    parser.add_argument('--words', type=int, default=40, help='メッセージあたりの語数')
+    parser.add_argument('--samples', type=int, default=100, help='計測するリクエスト数')
+    parser.add_argument('--no-dbstat', dest='dbstat', action='store_false', help='索引サイズを計測しない')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-search-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    command = [sys.executable, os.path.abspath(__file__), '--worker'] + [
+        value for name in ('messages', 'words', 'samples')
+        for value in (f'--{name}', str(getattr(args, name)))
+    ] + ([] if args.dbstat else ['--no-dbstat'])
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    fts = (f", うち全文索引 {report['fts_bytes'] / 1024 / 1024:.1f} MiB"
+           f" + 2文字の組の索引 {report['bigram_bytes'] / 1024 / 1024:.1f} MiB") if report['fts_bytes'] is not None else ''
+    print(f"メッセージ {report['messages']:,d} 件 (投入 {report['seed_seconds']}秒), "
+          f"DB {report['db_bytes'] / 1024 / 1024:.1f} MiB{fts}")
+    print(f"  従来 (LIKE 全件走査)      : {report['naive_ms']:9.1f} ms / 検索")
+    for key, label in (('search_rare', '検索 FTS5 まれな語'), ('search_fts', '検索 FTS5 頻出語'), ('search_fts_page3', '検索 FTS5 3ページ目'),
+                       ('search_english', '検索 英語・複数語'), ('search_short', '検索 2文字 頻出語'),
+                       ('search_short_rare', '検索 2文字 まれな語'), ('search_single', '検索 1文字')):
+        result = report[key]
+        print(f"  {label:24s}: p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
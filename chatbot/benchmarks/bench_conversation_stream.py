@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+長い会話の読み込み（GET /api/conversations/<id>）のベンチマーク
+
+1会話に大量のメッセージを持つ一時DBを作り、以下の方式で比較する。
+
+- 従来方式: Message を ORM で全件読み込み、1つの dict にして jsonify
+- ストリーミング（JSON / NDJSON）: yield_per で取得しながら1件ずつ直列化
+- 最新ページのみ（?limit=50）: 会話を開いたときに history.js が要求する範囲
+
+最初のバイトまでの時間・全体の時間・Python ヒープのピーク（tracemalloc）を計測する。
+
+使い方:
+    python benchmarks/bench_conversation_stream.py --messages 20000 --content-bytes 2000
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def seed(connection, messages: int, content_bytes: int):
+    """1つの会話にユーザー・アシスタントのメッセージを交互に投入"""
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, created_at, updated_at, message_count) "
+        "VALUES (1, 'ベンチマーク', 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?)", (messages,)
+    )
+    body = ('長い回答の本文です。' * (content_bytes // 30 + 1))[:content_bytes // 3]
+    connection.exec_driver_sql(
+        "INSERT INTO messages (conversation_id, role, content, created_at) VALUES (1, ?, ?, CURRENT_TIMESTAMP)",
+        [('user' if i % 2 == 0 else 'assistant', f'{i}: {body}') for i in range(messages)],
+    )
+
+
+def run_worker(args):
+    """子プロセス側: シード → 方式ごとに計測"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from flask import jsonify
+    from app import app, initialize_database
+    from database.models import db, Conversation, Message
+    
+    initialize_database()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            seed(connection, args.messages, args.content_bytes)
+    
+    def legacy():
+        # 変更前の get_conversation と同じ処理
+        with app.test_request_context():
+            conversation = db.session.get(Conversation, 1)
+            messages = db.session.query(Message).filter(
+                Message.conversation_id == 1,
+                db.or_(Message.role != 'assistant', Message.content != '')
+            ).order_by(Message.created_at).all()
+            result = {
+                'id': conversation.id,
+                'title': conversation.title,
+                'dify_app_id': conversation.dify_app_id,
+                'dify_conversation_id': conversation.dify_conversation_id,
+                'messages': [
+                    {'id': msg.id, 'role': msg.role, 'content': msg.content, 'created_at': msg.created_at.isoformat()}
+                    for msg in messages
+                ]
+            }
+            response = jsonify(result)
+            db.session.remove()
+            yield from response.response
+    
+    client = app.test_client()
+    
+    def endpoint(query):
+        def run():
+            response = client.get(f'/api/conversations/1{query}', buffered=False)
+            yield from response.response
+            response.close()
+        return run
+    
+    def measure(make_body):
+        tracemalloc.start()
+        started = time.perf_counter()
+        first_byte = None
+        total = 0
+        for chunk in make_body():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            total += len(chunk)
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        return {
+            'first_byte_ms': round(first_byte * 1000, 1),
+            'total_ms': round(elapsed * 1000, 1),
+            'peak_mib': round(peak / 1024 / 1024, 1),
+            'bytes': total,
+        }
+    
+    report = {'messages': args.messages}
+    for name, make_body in (
+        ('legacy', legacy),
+        ('stream_json', endpoint('')),
+        ('stream_ndjson', endpoint('?format=ndjson')),
+        ('latest_page', endpoint('?format=ndjson&limit=50')),
+    ):
+        measure(make_body)  # ウォームアップ
+        report[name] = measure(make_body)
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='長い会話の読み込みのベンチマーク')
+    parser.add_argument('--messages', type=int, default=20000, help='会話のメッセージ数')
+    parser.add_argument('--content-bytes', type=int, default=2000, help='メッセージ本文のおおよそのバイト数')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-conversation-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    command = [sys.executable, os.path.abspath(__file__), '--worker',
+               '--messages', str(args.messages), '--content-bytes', str(args.content_bytes)]
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    print(f"メッセージ {report['messages']:,d} 件（本文 約{args.content_bytes} バイト）")
+    for key, label in (('legacy', '従来 (ORM 全件 + jsonify)'), ('stream_json', 'ストリーミング JSON'),
+                       ('stream_ndjson', 'ストリーミング NDJSON'), ('latest_page', '最新50件 (limit=50)')):
+        result = report[key]
+        print(f"  {label:26s}: 最初のバイト {result['first_byte_ms']:8.1f} ms  全体 {result['total_ms']:8.1f} ms  "
+              f"ピーク {result['peak_mib']:7.1f} MiB  ({result['bytes'] / 1024 / 1024:.1f} MiB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+キーフレーズ抽出のベンチマーク
+
+retriever_resources を数百件含む応答について、従来の抽出処理（set で重複除去）と
+解析ジョブが使う KeyphraseExtractor（message_end から抽出し、初出順で重複除去・
+文書ごとと全体の出現回数を集計）の1応答あたりの時間を比較する。
+両方式の抽出結果（unique_keyphrases は集合として）が一致することも確認する。
+
+使い方:
+    python benchmarks/bench_keyphrase_extractor.py --resources 100 300 1000
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.response_parser import ResponseParser, KeyphraseExtractor
+from bench_stream_recording import best_of
+
+WORDS = ['検索', '結果', '本文', '会議', '資料', '設計', '要件', '確認', '手順', '障害', '対応', '運用', '契約', '顧客', '製品']
+
+
+def dify_stream(tokens: int, resources: int, phrases: int):
+    """retriever_resources の本文が \\r\\n 区切りのキーフレーズになっているチャンク列"""
+    rng = random.Random(resources)
+    envelope = {'conversation_id': 'dify-1', 'message_id': 'msg-1', 'task_id': 'task-1', 'created_at': 1700000000}
+    # 文書間で重複するキーフレーズが出るよう語彙を絞る
+    vocabulary = [''.join(rng.choices(WORDS, k=3)) for _ in range(resources * phrases // 4 + 1)]
+    chunks = [{'event': 'message', **envelope, 'answer': rng.choice(WORDS)} for _ in range(tokens)]
+    chunks.append({
+        'event': 'message_end',
+        **envelope,
+        'metadata': {
+            'usage': {'prompt_tokens': 800, 'completion_tokens': tokens, 'total_tokens': 800 + tokens},
+            'retriever_resources': [
+                {'position': i, 'document_name': f'doc-{i}.pdf', 'score': 0.8,
+                 'content': '\r\n'.join(rng.choices(vocabulary, k=phrases))}
+                for i in range(resources)
+            ],
+        },
+    })
+    return chunks
+
+
+def legacy_extract(raw_response_data):
+    """変更前の抽出処理（message_end 受信後に全チャンクを走査、set で重複除去）"""
+    result = {
+        'source_documents': [],
+        'all_keyphrases': [],
+        'document_keyphrases': [],
+        'unique_keyphrases': [],
+        'total_keyphrase_count': 0,
+        'unique_keyphrase_count': 0
+    }
+    for item in raw_response_data:
+        if item.get('event') == 'message_end' and 'metadata' in item:
+            for i, resource in enumerate(item['metadata'].get('retriever_resources', [])):
+                content = resource.get('content', '')
+                result['source_documents'].append({'index': i + 1, 'content': content, 'content_length': len(content)})
+                keyphrases = [p.strip() for p in content.split('\r\n') if p.strip() and len(p.strip()) > 3]
+                result['document_keyphrases'].append({
+                    'document_index': i + 1, 'keyphrases': keyphrases, 'keyphrase_count': len(keyphrases)
+                })
+                result['all_keyphrases'].extend(keyphrases)
+    result['unique_keyphrases'] = list(set(result['all_keyphrases']))
+    result['total_keyphrase_count'] = len(result['all_keyphrases'])
+    result['unique_keyphrase_count'] = len(result['unique_keyphrases'])
+    return result
+
+
+def extractor_extract(chunks):
+    extractor = KeyphraseExtractor()
+    extractor.add_message_end(chunks[-1])
+    return extractor.result()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='キーフレーズ抽出のベンチマーク')
+    parser.add_argument('--resources', nargs='+', type=int, default=[100, 300, 1000], help='retriever_resources 件数')
+    parser.add_argument('--phrases', type=int, default=40, help='文書あたりのキーフレーズ数')
+    parser.add_argument('--tokens', type=int, default=500, help='message イベント数')
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    
+    for resources in args.resources:
+        chunks = dify_stream(args.tokens, resources, args.phrases)
+        
+        legacy = legacy_extract(chunks)
+        current = extractor_extract(chunks)
+        assert set(current['unique_keyphrases']) == set(legacy['unique_keyphrases'])
+        assert current['all_keyphrases'] == legacy['all_keyphrases']
+        assert ResponseParser.extract_keyphrases(chunks)['unique_keyphrases'] == current['unique_keyphrases']
+        assert sum(current['keyphrase_frequencies'].values()) == current['total_keyphrase_count']
+        
+        legacy_seconds = best_of(lambda: legacy_extract(chunks), args.repeat)
+        extractor_seconds = best_of(lambda: extractor_extract(chunks), args.repeat)
+        
+        total = current['total_keyphrase_count']
+        print(f"\nretriever_resources {resources} 件（キーフレーズ {total:,d} 件, 重複除去後 {current['unique_keyphrase_count']:,d} 件）")
+        print(f"  従来 (set で重複除去)    : {legacy_seconds * 1000:8.2f} ms")
+        print(f"  KeyphraseExtractor       : {extractor_seconds * 1000:8.2f} ms  "
+              f"({extractor_seconds / total * 1e6:.3f} us/phrase)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+会話横断キーフレーズ検索のベンチマーク
+
+keyphrase_data（JSON）を持つメッセージを一時DBに投入し、バックフィル
+（database.keyphrase_index.backfill_keyphrase_index）で正規化テーブルと
+FTS5 索引を作成したうえで、以下を計測する。
+
+- 従来方式: 全メッセージの keyphrase_data を読み込んで解析し、語を含む会話を探す
+- GET /api/keyphrases/search?q=（FTS5 / 3文字未満は LIKE）
+- GET /api/dify-apps/<id>/keyphrases（アプリごとの上位キーフレーズ）
+
+使い方:
+    python benchmarks/bench_keyphrase_search.py --messages 50000 --phrases-per-message 20
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ['検索', '結果', '本文', '会議', '資料', '設計', '要件', '確認', '手順', '障害', '対応', '運用', '契約', '顧客', '製品',
+         'サーバ', 'ネットワーク', '請求', '承認', '申請']
+
+
+def vocabulary(size: int):
+    rng = random.Random(0)
+    return list(dict.fromkeys(''.join(rng.choices(WORDS, k=3)) + str(i) for i in range(size)))
+
+
+def keyphrase_data(rng: random.Random, vocab, phrases: int, documents: int = 5):
+    """KeyphraseExtractor.result() と同じ形式（出現の偏りを持たせる）"""
+    per_document = max(1, phrases // documents)
+    document_keyphrases = []
+    for index in range(1, documents + 1):
+        keyphrases = [vocab[min(len(vocab) - 1, int(rng.paretovariate(0.5)) - 1)] for _ in range(per_document)]
+        frequencies = {}
+        for phrase in keyphrases:
+            frequencies[phrase] = frequencies.get(phrase, 0) + 1
+        document_keyphrases.append({
+            'document_index': index, 'keyphrases': keyphrases,
+            'keyphrase_count': len(keyphrases), 'frequencies': frequencies,
+        })
+    return json.dumps({'document_keyphrases': document_keyphrases}, ensure_ascii=False)
+
+
+def seed(connection, messages: int, phrases: int, vocab):
+    """会話（1会話あたり応答5件）とキーフレーズ付きメッセージを一括投入"""
+    rng = random.Random(1)
+    conversations = max(1, messages // 5)
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, created_at, updated_at, preview_title, message_count) "
+        "VALUES (?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, 10)",
+        [(i, f'会話 {i}', i % 3 + 1, f'質問 {i}') for i in range(1, conversations + 1)],
+    )
+    connection.exec_driver_sql(
+        "INSERT INTO messages (conversation_id, role, content, keyphrase_data, analysis_status, created_at) "
+        "VALUES (?, 'assistant', '回答', ?, 'done', CURRENT_TIMESTAMP)",
+        [(i % conversations + 1, keyphrase_data(rng, vocab, phrases)) for i in range(messages)],
+    )
+
+
+def measure(client, urls):
+    latencies = []
+    for url in urls:
+        started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - started)
+        assert response.status_code == 200, (url, response.status_code)
+    ordered = sorted(latencies)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(ordered[min(len(ordered) - 1, int(0.99 * (len(ordered) - 1)))] * 1000, 2),
+    }
+
+
+def run_worker(args):
+    """子プロセス側: シード → バックフィル → 計測"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from urllib.parse import quote
+    from sqlalchemy import select, func
+    from app import app, initialize_database
+    from database.models import db, Message, MessageKeyphrase
+    from database.keyphrase_index import backfill_keyphrase_index
+    from utils.response_parser import ResponseParser
+    
+    initialize_database()
+    vocab = vocabulary(args.vocabulary)
+    with app.app_context():
+        with db.engine.begin() as connection:
+            seed(connection, args.messages, args.phrases_per_message, vocab)
+        started = time.perf_counter()
+        backfill = backfill_keyphrase_index(ResponseParser.keyphrase_rows)
+        backfill['seconds'] = round(time.perf_counter() - started, 1)
+        backfill['index_rows'] = db.session.execute(select(func.count()).select_from(MessageKeyphrase)).scalar_one()
+        backfill['occurrences'] = db.session.execute(select(func.sum(MessageKeyphrase.count))).scalar_one()
+        db_file = db.engine.url.database
+    
+    rng = random.Random(2)
+    # よく出る語とまれな語の両方を部分文字列で検索する
+    terms = [vocab[min(len(vocab) - 1, int(rng.paretovariate(0.8)) - 1)] for _ in range(args.samples)]
+    long_queries = [term[2:8] for term in terms]
+    short_queries = [term[:2] for term in terms]
+    
+    # 従来方式: keyphrase_data を全件読み込んで解析
+    def legacy_search(term):
+        with app.app_context():
+            cited = set()
+            for conversation_id, data in db.session.execute(
+                select(Message.conversation_id, Message.keyphrase_data).where(Message.keyphrase_data.is_not(None))
+            ):
+                documents = json.loads(data).get('document_keyphrases', [])
+                if any(term in phrase for document in documents for phrase in document['keyphrases']):
+                    cited.add(conversation_id)
+            return cited
+    
+    legacy_seconds = []
+    for term in long_queries[:3]:
+        started = time.perf_counter()
+        legacy_search(term)
+        legacy_seconds.append(time.perf_counter() - started)
+    
+    client = app.test_client()
+    report = {
+        'backfill': backfill,
+        'db_bytes': os.path.getsize(db_file),
+        'legacy_ms': round(statistics.median(legacy_seconds) * 1000, 1),
+        'search_fts': measure(client, [f'/api/keyphrases/search?q={quote(q)}' for q in long_queries]),
+        'search_fts_app': measure(client, [f'/api/keyphrases/search?q={quote(q)}&dify_app_id=1' for q in long_queries]),
+        'search_like': measure(client, [f'/api/keyphrases/search?q={quote(q)}' for q in short_queries]),
+        'top_n': measure(client, [f'/api/dify-apps/{i % 3 + 1}/keyphrases?limit=20' for i in range(args.samples)]),
+    }
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='会話横断キーフレーズ検索のベンチマーク')
+    parser.add_argument('--messages', type=int, default=50000, help='キーフレーズを持つメッセージ数')
+    parser.add_argument('--phrases-per-message', type=int, default=20, help='メッセージあたりのキーフレーズ出現数')
+    parser.add_argument('--vocabulary', type=int, default=50000, help='異なるキーフレーズ数')
+    parser.add_argument('--samples', type=int, default=200, help='計測するリクエスト数')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-keyphrase-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    command = [sys.executable, os.path.abspath(__file__), '--worker'] + [
+        value for name in ('messages', 'phrases_per_message', 'vocabulary', 'samples')
+        for value in (f"--{name.replace('_', '-')}", str(getattr(args, name)))
+    ]
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    backfill = report['backfill']
+    print(f"メッセージ {backfill['messages']:,d} 件, キーフレーズ出現 {backfill['occurrences']:,d} 件 "
+          f"(索引行 {backfill['index_rows']:,d}), DB {report['db_bytes'] / 1024 / 1024:.1f} MiB")
+    print(f"  バックフィル              : {backfill['seconds']}秒")
+    print(f"  従来 (keyphrase_data 全件): {report['legacy_ms']:9.1f} ms / 検索")
+    for key, label in (('search_fts', '検索 FTS5'), ('search_fts_app', '検索 FTS5 + アプリ指定'),
+                       ('search_like', '検索 2文字 (LIKE)'), ('top_n', 'アプリ別上位20件')):
+        result = report[key]
+        print(f"  {label:24s}: p50 {result['p50_ms']:7.2f} ms  p99 {result['p99_ms']:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
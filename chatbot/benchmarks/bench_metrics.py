@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+フェーズ計測のオーバーヘッドのマイクロベンチマーク
+
+Metrics.observe（ヒストグラムへの記録）、TurnTimings.chunk（上流イベントごとの
+受信間隔の記録）、計測なしの time.perf_counter() 呼び出しを比較して1回あたりの
+ナノ秒を表示する。複数スレッドから同時に記録した場合と、/metrics の出力時間も計測する。
+
+使い方:
+    python benchmarks/bench_metrics.py --iterations 200000 --threads 4
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.metrics import Metrics, TurnTimings, PHASE_CHUNK_GAP, PHASE_FIRST_BYTE
+
+
+def per_call_ns(func, iterations: int, repeat: int) -> float:
+    """func(iterations) の1回あたりのナノ秒（repeat 回の最小値）"""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter_ns()
+        func(iterations)
+        best = min(best, time.perf_counter_ns() - started)
+    return best / iterations
+
+
+def bench_baseline(iterations: int):
+    clock = time.perf_counter
+    for _ in range(iterations):
+        clock()
+
+
+def bench_observe(metrics: Metrics):
+    def run(iterations: int):
+        observe = metrics.observe
+        for i in range(iterations):
+            observe(PHASE_FIRST_BYTE, 1, (i % 1000) / 1000)
+    return run
+
+
+def bench_chunk(metrics: Metrics):
+    def run(iterations: int):
+        timings = TurnTimings(metrics, 1)
+        timings.start_upstream()
+        chunk = timings.chunk
+        for _ in range(iterations):
+            chunk()
+    return run
+
+
+def bench_threads(metrics: Metrics, threads: int, iterations: int) -> float:
+    """threads 本のスレッドから同時に observe した場合の1回あたりのナノ秒（全スレッド合計の処理量で割る）"""
+    barrier = threading.Barrier(threads + 1)
+    
+    def worker(dify_app_id: int):
+        barrier.wait()
+        observe = metrics.observe
+        for i in range(iterations):
+            observe(PHASE_CHUNK_GAP, dify_app_id % 2, (i % 1000) / 10000)
+    
+    workers = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    for thread in workers:
+        thread.start()
+    barrier.wait()
+    started = time.perf_counter_ns()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter_ns() - started) / (threads * iterations)
+
+
+def bench_render(metrics: Metrics, apps: int, repeat: int) -> float:
+    """apps 個のアプリ分のヒストグラムを出力するミリ秒"""
+    for dify_app_id in range(apps):
+        for phase in ('user_message_write', 'queue_wait', 'upstream_first_byte', 'upstream_chunk_gap',
+                      'upstream_stream', 'analysis', 'final_commit'):
+            metrics.observe(phase, dify_app_id, 0.01)
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        metrics.render_prometheus()
+        best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description='フェーズ計測のオーバーヘッドのマイクロベンチマーク')
+    parser.add_argument('--iterations', type=int, default=200000, help='1計測あたりの呼び出し回数')
+    parser.add_argument('--repeat', type=int, default=5, help='繰り返し回数（最小値を採用）')
+    parser.add_argument('--threads', type=int, default=4, help='同時に記録するスレッド数')
+    parser.add_argument('--apps', type=int, default=50, help='/metrics の出力に含めるDifyアプリ数')
+    args = parser.parse_args()
+    
+    metrics = Metrics()
+    baseline = per_call_ns(bench_baseline, args.iterations, args.repeat)
+    observe = per_call_ns(bench_observe(metrics), args.iterations, args.repeat)
+    chunk = per_call_ns(bench_chunk(metrics), args.iterations, args.repeat)
+    threaded = bench_threads(metrics, args.threads, args.iterations // args.threads)
+    render = bench_render(Metrics(), args.apps, args.repeat)
+    
+    print(f"time.perf_counter()           : {baseline:7.0f} ns/回（比較用）")
+    print(f"Metrics.observe               : {observe:7.0f} ns/回")
+    print(f"TurnTimings.chunk             : {chunk:7.0f} ns/回（perf_counter + observe）")
+    print(f"observe（{args.threads} スレッド同時）     : {threaded:7.0f} ns/回")
+    print(f"/metrics 出力（{args.apps} アプリ x 7 フェーズ）: {render:7.2f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+生レスポンス分離前後のサイズ・レイテンシ比較
+
+旧形式（messages.raw_dify_response にJSONをそのまま保存）の一時DBを作成し、
+移行（圧縮テーブルへの分離 + VACUUM）の前後で以下を計測する。
+
+- DBファイルサイズ
+- 履歴読み込み (GET /api/conversations/<id>) のレイテンシ
+- 解析データ取得 (GET /api/messages/<id>/analysis) のレイテンシ
+
+使い方:
+    python benchmarks/bench_raw_payload_store.py --conversations 2000 --turns 5
+"""
+
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+WORDS = ['検索', '結果', '本文', '会議', '資料', '設計', '要件', '確認', '手順', '障害', '対応', '運用', '契約', '顧客', '製品']
+
+
+def raw_response(rng: random.Random, turn: int, tokens: int, resources: int) -> str:
+    """Dify のストリーミングレスポンスに近い生データ"""
+    envelope = {'conversation_id': f'dify-{turn}', 'message_id': f'msg-{turn}', 'task_id': f'task-{turn}', 'created_at': 1700000000}
+    chunks = [{'event': 'message', 'answer': rng.choice(WORDS), **envelope} for _ in range(tokens)]
+    chunks.append({
+        'event': 'message_end',
+        **envelope,
+        'metadata': {
+            'usage': {'prompt_tokens': 800, 'completion_tokens': tokens, 'total_tokens': 800 + tokens},
+            'retriever_resources': [
+                {'position': i, 'document_name': f'doc-{i}.pdf', 'score': 0.8, 'content': '\r\n'.join(''.join(rng.choices(WORDS, k=8)) for _ in range(40))}
+                for i in range(resources)
+            ],
+        },
+    })
+    return json.dumps(chunks, ensure_ascii=False)
+
+
+def seed_legacy(connection, conversations: int, turns: int, tokens: int, resources: int):
+    """旧形式で会話・メッセージを一括投入"""
+    rng = random.Random(0)
+    connection.exec_driver_sql(
+        "INSERT INTO conversations (id, title, dify_app_id, created_at, updated_at, preview_title, message_count) "
+        "VALUES (?, ?, 1, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, ?, ?)",
+        [(i, f'会話 {i}', f'質問 {i}', turns * 2) for i in range(1, conversations + 1)],
+    )
+    for i in range(1, conversations + 1):
+        rows = []
+        for turn in range(turns):
+            rows.append((i, 'user', f'質問 {i}-{turn}', None))
+            rows.append((i, 'assistant', '回答' * tokens, raw_response(rng, i * turns + turn, tokens, resources)))
+        connection.exec_driver_sql(
+            "INSERT INTO messages (conversation_id, role, content, raw_dify_response, keyphrase_data, created_at) "
+            "VALUES (?, ?, ?, ?, '{}', CURRENT_TIMESTAMP)",
+            rows,
+        )
+
+
+def measure(client, urls, repeat: int = 1):
+    latencies = []
+    for _ in range(repeat):
+        for url in urls:
+            started = time.perf_counter()
+            response = client.get(url)
+            latencies.append(time.perf_counter() - started)
+            assert response.status_code == 200, (url, response.status_code)
+    ordered = sorted(latencies)
+    return {
+        'p50_ms': round(statistics.median(latencies) * 1000, 2),
+        'p99_ms': round(ordered[min(len(ordered) - 1, int(0.99 * (len(ordered) - 1)))] * 1000, 2),
+    }
+
+
+def run_worker(args):
+    """子プロセス側: シード → 計測 → 移行 → 計測"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from sqlalchemy import text, select
+    from app import app, initialize_database
+    from database.models import db, Message
+    from database.payload_store import migrate_inline_payloads
+    
+    initialize_database()
+    with app.app_context():
+        with db.engine.begin() as connection:
+            seed_legacy(connection, args.conversations, args.turns, args.tokens, args.resources)
+        db_file = db.engine.url.database
+        assistant_ids = db.session.execute(select(Message.id).where(Message.role == 'assistant')).scalars().all()
+    
+    rng = random.Random(0)
+    history_urls = [f'/api/conversations/{rng.randint(1, args.conversations)}' for _ in range(args.samples)]
+    analysis_urls = [f'/api/messages/{rng.choice(assistant_ids)}/analysis' for _ in range(args.samples)]
+    client = app.test_client()
+    
+    def snapshot():
+        with app.app_context():
+            db.engine.dispose()
+        return {
+            'db_bytes': os.path.getsize(db_file),
+            'history': measure(client, history_urls),
+            'analysis': measure(client, analysis_urls),
+        }
+    
+    report = {'before': snapshot()}
+    with app.app_context():
+        started = time.perf_counter()
+        migration = migrate_inline_payloads()
+        migration['seconds'] = round(time.perf_counter() - started, 2)
+        with db.engine.connect() as connection:
+            connection.execute(text("VACUUM"))
+    report['migration'] = migration
+    report['after'] = snapshot()
+    print(json.dumps(report))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生レスポンス分離前後の比較')
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=5, help='会話あたりの往復数')
+    parser.add_argument('--tokens', type=int, default=200, help='応答あたりの message イベント数')
+    parser.add_argument('--resources', type=int, default=5, help='retriever_resources 件数')
+    parser.add_argument('--samples', type=int, default=300, help='計測するリクエスト数')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-payload-')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}")
+    command = [sys.executable, os.path.abspath(__file__), '--worker'] + [
+        value for name in ('conversations', 'turns', 'tokens', 'resources', 'samples')
+        for value in (f'--{name}', str(getattr(args, name)))
+    ]
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    report = json.loads(output.stdout.strip().splitlines()[-1])
+    
+    migration = report['migration']
+    print(f"会話 {args.conversations} 件 × {args.turns} 往復（応答 {migration['migrated']} 件）")
+    print(f"移行: {migration['seconds']}秒, 生データ {migration['raw_bytes'] / 1024 / 1024:.1f} MiB "
+          f"-> 圧縮後 {migration['compressed_bytes'] / 1024 / 1024:.1f} MiB")
+    for label in ('before', 'after'):
+        snapshot = report[label]
+        print(
+            f"  {label:6s}: DB {snapshot['db_bytes'] / 1024 / 1024:8.1f} MiB | "
+            f"履歴 p50 {snapshot['history']['p50_ms']:7.2f}ms p99 {snapshot['history']['p99_ms']:7.2f}ms | "
+            f"解析 p50 {snapshot['analysis']['p50_ms']:7.2f}ms p99 {snapshot['analysis']['p99_ms']:7.2f}ms"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+応答キャッシュと同一質問の相乗り（single-flight）の効果測定
+
+疑似 Dify サーバー（このプロセス内）と uvicorn（ASGI版）を起動し、
+同じ質問（空白・句読点の揺れを含む）を同時に N 件送るバーストを2回行う。
+RESPONSE_CACHE_APPS を無効 / 有効にした場合で以下を比較する。
+
+- 上流（疑似 Dify）へのリクエスト数
+- 最初のイベントまでの時間（TTFE）とストリーム全体の所要時間
+- 2回目のバースト（キャッシュからの再生）の所要時間
+
+データベースは一時ディレクトリに作成するため、既存の database.db には触れない。
+
+使い方:
+    python benchmarks/bench_response_cache.py --clients 50 --tokens 20 --interval 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHATBOT_DIR, 'benchmarks'))
+
+from fake_dify_server import FakeDifyServer  # noqa: E402
+
+# 正規化で同じキーになる質問の揺れ
+QUESTION_VARIANTS = ['有給休暇の申請方法は？', '有給休暇の申請方法は', ' 有給休暇の申請方法は?', '有給休暇の申請方法は。']
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"ポート {port} が起動しませんでした")
+
+
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def _one_stream(client: httpx.AsyncClient, url: str, index: int) -> dict:
+    """1本のチャットストリームを最後まで受信"""
+    started = time.perf_counter()
+    first_event = None
+    source = None
+    completed = False
+    payload = {'message': QUESTION_VARIANTS[index % len(QUESTION_VARIANTS)], 'dify_app_id': 1}
+    async with client.stream('POST', url, json=payload) as response:
+        if response.status_code != 200:
+            return {'ok': False}
+        async for line in response.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            data = line[6:]
+            if data == '[DONE]':
+                break
+            event = json.loads(data)
+            if event.get('event') == 'stream_started':
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - started
+            if event.get('event') == 'message_end' and event.get('message_id'):
+                completed = True
+                source = event.get('response_cache', 'upstream')
+    return {
+        'ok': completed,
+        'source': source,
+        'ttfe': (first_event or 0.0) * 1000,
+        'duration': (time.perf_counter() - started) * 1000,
+    }
+
+
+async def _burst(port: int, clients: int) -> dict:
+    url = f'http://127.0.0.1:{port}/api/chat-stream'
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=clients)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120.0)) as client:
+        results = await asyncio.gather(*[_one_stream(client, url, i) for i in range(clients)])
+    ok = [r for r in results if r['ok']]
+    sources = {}
+    for result in ok:
+        sources[result['source']] = sources.get(result['source'], 0) + 1
+    return {
+        'succeeded': len(ok),
+        'sources': sources,
+        'ttfe_ms_p50': round(statistics.median([r['ttfe'] for r in ok]), 1) if ok else 0.0,
+        'ttfe_ms_p99': round(_percentile([r['ttfe'] for r in ok], 0.99), 1),
+        'duration_ms_p50': round(statistics.median([r['duration'] for r in ok]), 1) if ok else 0.0,
+        'duration_ms_p99': round(_percentile([r['duration'] for r in ok], 0.99), 1),
+    }
+
+
+async def _run_mode(args, cache_apps: str) -> dict:
+    """疑似 Dify とアプリを起動して2回のバーストを実行"""
+    fake = FakeDifyServer(tokens=args.tokens, interval=args.interval)
+    fake_port = _free_port()
+    app_port = _free_port()
+    listener = await fake.start('127.0.0.1', fake_port)
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-response-cache-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}",
+        DIFY_API_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        DIFY_API_KEY_SAMPLE1=os.getenv('DIFY_API_KEY_SAMPLE1', 'fake-key'),
+        RESPONSE_CACHE_APPS=cache_apps,
+        RESPONSE_CACHE_REPLAY_SPEED=str(args.replay_speed),
+    )
+    server_log = open(os.path.join(tmpdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(app_port), '--log-level', 'warning'],
+        cwd=CHATBOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT,
+    )
+    try:
+        await _wait_for_port(app_port)
+        first = await _burst(app_port, args.clients)
+        first['upstream_requests'] = fake.total_requests
+        second = await _burst(app_port, args.clients)
+        second['upstream_requests'] = fake.total_requests - first['upstream_requests']
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        server_log.close()
+        listener.close()
+        await listener.wait_closed()
+    return {'cache': 'on' if cache_apps else 'off', 'first_burst': first, 'second_burst': second}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='応答キャッシュ・single-flight の効果測定')
+    parser.add_argument('--clients', type=int, default=50, help='1バーストの同時リクエスト数')
+    parser.add_argument('--tokens', type=int, default=20, help='1応答の message イベント数')
+    parser.add_argument('--interval', type=float, default=0.05, help='上流イベント間隔（秒）')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='キャッシュ再生時の間隔の倍率')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+    
+    reports = [asyncio.run(_run_mode(args, '')), asyncio.run(_run_mode(args, '1'))]
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+    
+    print(f"同時 {args.clients} 件 × 2バースト、上流 {args.tokens} イベント × {args.interval * 1000:.0f}ms")
+    for report in reports:
+        for name in ('first_burst', 'second_burst'):
+            burst = report[name]
+            print(
+                f"  キャッシュ {report['cache']:3s} {name:12s}: 上流 {burst['upstream_requests']:4d} 回  "
+                f"成功 {burst['succeeded']:4d}  "
+                f"TTFE p50 {burst['ttfe_ms_p50']:7.1f}ms p99 {burst['ttfe_ms_p99']:7.1f}ms  "
+                f"所要 p50 {burst['duration_ms_p50']:7.1f}ms p99 {burst['duration_ms_p99']:7.1f}ms  "
+                f"出所 {burst['sources']}"
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+SQLite ストレージプロファイル比較ベンチマーク
+
+チャット経路の書き込み（ユーザーメッセージ保存 → アシスタントメッセージ保存）と
+/api/conversations の読み取りを並行実行し、プロファイルごとの
+p50 / p99 レイテンシとエラー数（database is locked など）を比較する。
+各プロファイルは一時DBを使う別プロセスで実行する。
+
+使い方:
+    python benchmarks/bench_sqlite_profile.py --writers 4 --readers 4 --seconds 10
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _summary(latencies, errors) -> dict:
+    return {
+        'count': len(latencies),
+        'errors': errors,
+        'p50_ms': round(statistics.median(latencies) * 1000, 2) if latencies else 0.0,
+        'p99_ms': round(_percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+def run_worker(args):
+    """子プロセス側: 指定プロファイルで混在負荷をかけて結果をJSON出力"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from app import app, initialize_database
+    from database.models import db
+    from utils.chat_service import start_chat_turn, _save_assistant_message
+    
+    initialize_database()
+    
+    raw_events = [{'event': 'message', 'answer': 'テスト'}] * 20 + [{
+        'event': 'message_end',
+        'conversation_id': 'bench',
+        'metadata': {'retriever_resources': [{'content': 'キーフレーズ一\r\nキーフレーズ二'}] * 5},
+    }]
+    
+    def chat_write(index: int):
+        with app.app_context():
+            turn = start_chat_turn({'message': f'ベンチマーク {index}', 'dify_app_id': 1})
+            _save_assistant_message(
+                turn.assistant_message_id, turn.conversation_id, 'bench', 'テスト' * 20, raw_events
+            )
+            db.session.commit()
+    
+    for i in range(args.seed):
+        chat_write(i)
+    
+    stop_at = time.monotonic() + args.seconds
+    results = {'write': ([], [0]), 'read': ([], [0])}
+    lock = threading.Lock()
+    
+    def writer(worker_id: int):
+        index = 0
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                chat_write(worker_id * 1000000 + index)
+                elapsed = time.perf_counter() - started
+                with lock:
+                    results['write'][0].append(elapsed)
+            except Exception:
+                with lock:
+                    results['write'][1][0] += 1
+            index += 1
+    
+    def reader():
+        client = app.test_client()
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            response = client.get('/api/conversations')
+            elapsed = time.perf_counter() - started
+            with lock:
+                if response.status_code == 200:
+                    results['read'][0].append(elapsed)
+                else:
+                    results['read'][1][0] += 1
+    
+    threads = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    threads += [threading.Thread(target=reader) for _ in range(args.readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    
+    print(json.dumps({
+        'profile': os.getenv('SQLITE_PROFILE', 'default'),
+        'write': _summary(results['write'][0], results['write'][1][0]),
+        'read': _summary(results['read'][0], results['read'][1][0]),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite ストレージプロファイル比較')
+    parser.add_argument('--profiles', nargs='+', default=['default', 'production'])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=50, help='事前に作成する会話数')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    reports = []
+    for profile in args.profiles:
+        tmpdir = tempfile.mkdtemp(prefix='chatbot-sqlite-')
+        env = dict(
+            os.environ,
+            SQLITE_PROFILE=profile,
+            DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'bench.db')}",
+            DIFY_API_KEY_SAMPLE1='bench-key',
+        )
+        command = [
+            sys.executable, os.path.abspath(__file__), '--worker',
+            '--writers', str(args.writers), '--readers', str(args.readers),
+            '--seconds', str(args.seconds), '--seed', str(args.seed),
+        ]
+        output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+        reports.append(json.loads(output.stdout.strip().splitlines()[-1]))
+    
+    print(f"書き込み {args.writers} スレッド / 読み取り {args.readers} スレッド / {args.seconds:.0f} 秒")
+    for report in reports:
+        write, read = report['write'], report['read']
+        print(
+            f"  {report['profile']:10s} "
+            f"write: {write['count']:6d}件 p50 {write['p50_ms']:8.2f}ms p99 {write['p99_ms']:8.2f}ms err {write['errors']:4d} | "
+            f"read: {read['count']:6d}件 p50 {read['p50_ms']:8.2f}ms p99 {read['p99_ms']:8.2f}ms err {read['errors']:4d}"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+SSEデコーダーのマイクロベンチマーク
+
+従来の「buffer += chunk → buffer.split('\\n')」方式と SSEDecoder を、
+合成ストリーム（小さな message イベントの連続 / 巨大な message_end）で比較し、
+events/s と MB/s を表示する。
+
+使い方:
+    python benchmarks/bench_sse_decoder.py --chunk-size 1024
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sse_decoder import SSEDecoder
+
+
+def legacy_parse(chunks):
+    """従来の DifyClient.stream_chat と同じ分割方式（比較用）"""
+    events = []
+    buffer = ""
+    for raw in chunks:
+        chunk = raw.decode('utf-8', errors='replace')
+        buffer += chunk
+        lines = buffer.split('\n')
+        buffer = lines.pop()
+        for line in lines:
+            line = line.strip()
+            if line.startswith('data: '):
+                events.append(line[6:])
+    return events
+
+
+def decoder_parse(chunks):
+    """SSEDecoder による分割"""
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+def token_stream(tokens: int) -> bytes:
+    """小さな message イベントが続くストリーム"""
+    envelope = {'conversation_id': 'c' * 36, 'message_id': 'm' * 36, 'task_id': 't' * 36, 'created_at': 1700000000}
+    parts = [
+        f"data: {json.dumps({'event': 'message', 'answer': 'トークン', **envelope}, ensure_ascii=False)}\n\n"
+        for _ in range(tokens)
+    ]
+    return ''.join(parts).encode('utf-8')
+
+
+def large_end_stream(resources: int, content_chars: int) -> bytes:
+    """retriever_resources を大量に含む message_end 1件のストリーム"""
+    content = '\r\n'.join(['キーフレーズの例文'] * (content_chars // 10))
+    event = {
+        'event': 'message_end',
+        'conversation_id': 'c' * 36,
+        'metadata': {'retriever_resources': [{'position': i, 'content': content} for i in range(resources)]},
+    }
+    return f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+
+
+def split_chunks(data: bytes, size: int):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def measure(func, chunks, total_bytes: int, repeat: int):
+    best = float('inf')
+    count = 0
+    for _ in range(repeat):
+        started = time.perf_counter()
+        count = len(func(chunks))
+        best = min(best, time.perf_counter() - started)
+    return count, best, count / best, total_bytes / best / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='SSEデコーダーのベンチマーク')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='ネットワークチャンクサイズ（バイト）')
+    parser.add_argument('--tokens', type=int, default=20000, help='token ストリームのイベント数')
+    parser.add_argument('--resources', type=int, default=200, help='message_end の retriever_resources 件数')
+    parser.add_argument('--content-chars', type=int, default=5000, help='各 resource の content 文字数')
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    
+    scenarios = [
+        ('token stream', token_stream(args.tokens)),
+        ('large message_end', large_end_stream(args.resources, args.content_chars)),
+    ]
+    
+    print(f"チャンクサイズ: {args.chunk_size} バイト")
+    for name, data in scenarios:
+        chunks = split_chunks(data, args.chunk_size)
+        print(f"\n[{name}] {len(data) / (1024 * 1024):.2f} MB / {len(chunks)} chunks")
+        for label, func in (('legacy split', legacy_parse), ('SSEDecoder', decoder_parse)):
+            count, seconds, eps, mbps = measure(func, chunks, len(data), args.repeat)
+            print(f"  {label:14s}: {count:7d} events  {seconds * 1000:9.1f} ms  {eps:12.0f} events/s  {mbps:8.1f} MB/s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+生ストリーム記録形式のベンチマーク
+
+Dify の message イベント列（+ message_end）を、従来の「チャンクをそのまま
+JSON配列で保存」する方式と差分形式（database.stream_recording）で比較し、
+メッセージあたりのバイト数（非圧縮 / zlib）とエンコード・デコードのコストを表示する。
+復元結果が元のリストと JSON 表現まで一致することも確認する。
+
+使い方:
+    python benchmarks/bench_stream_recording.py --tokens 50 300 1000
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database.stream_recording import encode_stream, decode_stream
+
+
+def dify_stream(tokens: int, resources: int):
+    """Dify の chat-messages ストリーミングに近いチャンク列"""
+    envelope = {
+        'conversation_id': '0f8e2c1a-7d55-4c6b-9a1e-3b2f4c5d6e7f',
+        'message_id': '9a8b7c6d-5e4f-4a3b-2c1d-0e9f8a7b6c5d',
+        'task_id': '1a2b3c4d-5e6f-4a7b-8c9d-0e1f2a3b4c5d',
+        'id': '9a8b7c6d-5e4f-4a3b-2c1d-0e9f8a7b6c5d',
+        'created_at': 1700000000,
+    }
+    rng = random.Random(tokens)
+    words = ['検索', '結果', 'について', '説明', 'します', '。', '手順', 'は', '以下', 'の', '通り', 'です']
+    chunks = [
+        {'event': 'message', **envelope, 'answer': rng.choice(words), 'from_variable_selector': None}
+        for _ in range(tokens)
+    ]
+    chunks.append({
+        'event': 'message_end',
+        **envelope,
+        'metadata': {
+            'usage': {'prompt_tokens': 812, 'completion_tokens': tokens, 'total_tokens': 812 + tokens},
+            'retriever_resources': [
+                {'position': i, 'document_name': f'doc-{i}.pdf', 'score': 0.81, 'content': f'参照文書 {i} の本文\r\n手順の説明'}
+                for i in range(resources)
+            ],
+        },
+    })
+    # 受信間隔 10〜60ms 程度のばらつき
+    offsets = []
+    elapsed = 0
+    for _ in chunks:
+        offsets.append(elapsed)
+        elapsed += rng.randint(10, 60)
+    return chunks, offsets
+
+
+def best_of(func, repeat: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='生ストリーム記録形式のベンチマーク')
+    parser.add_argument('--tokens', nargs='+', type=int, default=[50, 300, 1000], help='message イベント数')
+    parser.add_argument('--resources', type=int, default=5, help='retriever_resources 件数')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    
+    for tokens in args.tokens:
+        chunks, offsets = dify_stream(tokens, args.resources)
+        verbatim = json.dumps(chunks, ensure_ascii=False).encode('utf-8')
+        recording = encode_stream(chunks, offsets)
+        compact = json.dumps(recording, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        
+        # 可逆性の確認（キー順を含めて一致すること）
+        restored = decode_stream(json.loads(compact))
+        assert json.dumps(restored, ensure_ascii=False).encode('utf-8') == verbatim
+        
+        encode_seconds = best_of(
+            lambda: json.dumps(encode_stream(chunks, offsets), ensure_ascii=False, separators=(',', ':')), args.repeat
+        )
+        verbatim_seconds = best_of(lambda: json.dumps(chunks, ensure_ascii=False), args.repeat)
+        decode_seconds = best_of(lambda: decode_stream(json.loads(compact)), args.repeat)
+        legacy_decode_seconds = best_of(lambda: json.loads(verbatim), args.repeat)
+        
+        events = len(chunks)
+        print(f"\nmessage イベント {tokens} 件")
+        print(f"  従来 (JSON配列)   : {len(verbatim):9,d} bytes  zlib {len(zlib.compress(verbatim, 6)):8,d} bytes  "
+              f"encode {verbatim_seconds / events * 1e6:6.2f} us/event  decode {legacy_decode_seconds / events * 1e6:6.2f} us/event")
+        print(f"  差分形式          : {len(compact):9,d} bytes  zlib {len(zlib.compress(compact, 6)):8,d} bytes  "
+              f"encode {encode_seconds / events * 1e6:6.2f} us/event  decode {decode_seconds / events * 1e6:6.2f} us/event")
+        print(f"  非圧縮サイズ比    : {len(compact) / len(verbatim):.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+上流SSEイベントの転送モード（DIFY_STREAM_RELAY）のベンチマーク
+
+合成した1応答分のバイト列（generate_history.response_template）を
+SSEDecoder → DifyClient → ChatTurn.handle_chunk の順に通し、ストリーミング中に
+使うCPU時間をトークン（message イベント）あたりのマイクロ秒で比較する。
+
+    parse   従来の方式（json.loads → クライアントへ json.dumps で再エンコード）
+    relay   受信した data をそのまま転送し、event / answer だけをテキストから取り出す
+
+ストリーミング中のCPU時間（hot）に加えて、完了後に永続化キューで行う
+生レスポンスの保存（serialize_stream。転送モードでは JSON 全体のパースがここで起きる）を
+含めた合計（total）も表示する。クライアントへ送るフレームが JSON として
+同じ内容であることも確認する。
+
+使い方:
+    python benchmarks/bench_stream_relay.py --tokens 50 300 1000
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+from generate_history import response_template
+from database.payload_store import serialize_stream
+from utils.dify_client import DifyClient
+from utils.sse_decoder import SSEDecoder
+from utils.chat_service import ChatTurn
+
+logging.disable(logging.INFO)
+
+
+def upstream_chunks(tokens: int, resources: int, chunk_size: int, ensure_ascii: bool):
+    """Dify から届くバイト列（chunk_size ごとに分割）とイベント列"""
+    events, _, _ = response_template(random.Random(tokens), 0, tokens=tokens, resources=resources)
+    body = ''.join(f"data: {json.dumps(event, ensure_ascii=ensure_ascii)}\n\n" for event in events)
+    data = (body + 'data: [DONE]\n\n').encode('utf-8')
+    return [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)], events
+
+
+def stream_turn(chunks, relay: bool):
+    """1応答分をストリーミング経路に通し、(ChatTurn, フレーム) を返す"""
+    parse = DifyClient._relay_events if relay else DifyClient._parse_events
+    turn = ChatTurn('bench', 1, None, 'question', 1)
+    decoder = SSEDecoder()
+    frames = []
+    for chunk in chunks:
+        events, done = parse(decoder.feed(chunk))
+        for event in events:
+            frames.append(turn.handle_chunk(event))
+        if done:
+            break
+    return turn, frames
+
+
+def measure(chunks, relay: bool, repeat: int):
+    """ストリーミング中と保存までのCPU時間（秒、repeat 回のうち最小）"""
+    best_hot = best_total = float('inf')
+    for _ in range(repeat):
+        started = time.process_time()
+        turn, _ = stream_turn(chunks, relay)
+        streamed = time.process_time()
+        serialize_stream(turn.recorder.events, turn.recorder.offsets)
+        finished = time.process_time()
+        best_hot = min(best_hot, streamed - started)
+        best_total = min(best_total, finished - started)
+    return best_hot, best_total
+
+
+def main():
+    parser = argparse.ArgumentParser(description='上流SSEイベント転送モードのベンチマーク')
+    parser.add_argument('--tokens', type=int, nargs='+', default=[50, 300, 1000], help='応答あたりの message イベント数')
+    parser.add_argument('--resources', type=int, default=5, help='message_end の retriever_resources 件数')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='ネットワークチャンクサイズ（バイト）')
+    parser.add_argument('--ascii', action='store_true', help='上流が非ASCII文字を \\uXXXX でエスケープする場合')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    
+    print(f"{'tokens':>7}{'mode':>7}{'hot(us/token)':>15}{'total(us/token)':>17}{'hot比':>8}")
+    for tokens in args.tokens:
+        chunks, events = upstream_chunks(tokens, args.resources, args.chunk_size, args.ascii)
+        
+        # 転送モードでも同じ内容のフレームを送ること・同じ内容を保存することを確認
+        parsed_turn, parsed_frames = stream_turn(chunks, relay=False)
+        relay_turn, relay_frames = stream_turn(chunks, relay=True)
+        assert [json.loads(frame[6:]) for frame in parsed_frames] == \
+            [json.loads(frame[6:]) for frame in relay_frames] == events
+        assert relay_turn.full_response == parsed_turn.full_response
+        assert serialize_stream(relay_turn.recorder.events) == serialize_stream(parsed_turn.recorder.events)
+        
+        results = {relay: measure(chunks, relay, args.repeat) for relay in (False, True)}
+        for relay, (hot, total) in results.items():
+            ratio = hot / results[False][0]
+            print(f"{tokens:>7}{'relay' if relay else 'parse':>7}{hot / tokens * 1e6:>15.2f}"
+                  f"{total / tokens * 1e6:>17.2f}{ratio:>8.0%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+ホットパスのマイクロベンチマーク一式と回帰チェック
+
+generate_history.py で作った合成履歴DBに対して、次のケースの1回あたりの
+所要時間（中央値・p95、ミリ秒）を計測する。
+
+    sse_parse              SSEDecoder + DifyClient._parse_events（1KiB ずつ届く1応答分のバイト列）
+    stream_relay           転送モードのストリーミング経路（_relay_events + ChatTurn.handle_chunk、同じバイト列）
+                           （CPUのケースはトークン 300 件・参照文書 5 件の応答で計測）
+    extract_keyphrases     ResponseParser.extract_keyphrases（1応答分）
+    format_display         ResponseParser.format_response_for_display（1応答分）
+    run_analysis           解析ジョブ本体（1応答分）
+    conversation_list      GET /api/conversations?limit=50（カーソルを辿って5ページ）
+    conversation_messages  GET /api/conversations/<最長の会話>?limit=50
+    conversation_search    GET /api/conversations/search?q=...
+    message_analysis       GET /api/messages/<id>/analysis（解析キャッシュを外した状態）
+
+benchmarks/baseline.json に記録した中央値と比べ、--threshold（既定 25%）を
+超えて遅くなったケースがあれば --check で終了コード 1 を返す。マイクロ秒単位の
+ケースの揺れで失敗しないよう、差が --min-delta-ms 未満なら回帰とみなさない。
+計測は別プロセスで --rounds 回繰り返し、ケースごとに最も速い値を採る。
+DBのケースは基準と同じメッセージ数で計測した場合のみ比較する。
+揺れの大きいケースは baseline.json のケースに "threshold" を書いて個別に緩められる
+（--update-baseline でも引き継ぐ）。
+基準は同じマシンで計測したものと比べること（別環境なら --update-baseline で取り直す）。
+
+使い方:
+    python benchmarks/bench_suite.py                        # 計測して基準と比較
+    python benchmarks/bench_suite.py --check                # 回帰があれば終了コード 1
+    python benchmarks/bench_suite.py --update-baseline      # 基準を更新
+    python benchmarks/bench_suite.py --messages 1000000 --database /tmp/history-1m.db
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CHATBOT_DIR = os.path.dirname(BENCH_DIR)
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+
+CPU_CASES = ('sse_parse', 'stream_relay', 'extract_keyphrases', 'format_display', 'run_analysis')
+DB_CASES = ('conversation_list', 'conversation_messages', 'conversation_search', 'message_analysis')
+
+
+def measure(func, samples: int, min_sample_seconds: float = 0.005) -> dict:
+    """func の1回あたりのミリ秒（中央値・p95）。速い処理は1サンプル内で繰り返す"""
+    func()  # ウォームアップ
+    inner = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(inner):
+            func()
+        if time.perf_counter() - started >= min_sample_seconds or inner >= 10000:
+            break
+        inner *= 2
+    timings = []
+    for _ in range(samples):
+        started = time.perf_counter()
+        for _ in range(inner):
+            func()
+        timings.append((time.perf_counter() - started) * 1000 / inner)
+    timings.sort()
+    return {
+        'median_ms': round(statistics.median(timings), 4),
+        'p95_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.95))], 4),
+    }
+
+
+def cpu_cases(samples: int) -> dict:
+    """1応答分の合成データ（トークン 300 件・参照文書 5 件）に対する解析処理"""
+    import random
+    sys.path.insert(0, BENCH_DIR)
+    from generate_history import response_template
+    from utils.dify_client import DifyClient
+    from utils.sse_decoder import SSEDecoder
+    from utils.response_parser import ResponseParser
+    from utils.analysis_jobs import run_analysis
+    from utils.chat_service import ChatTurn
+    
+    events, offsets, _ = response_template(random.Random(1), 0, tokens=300, resources=5)
+    body = ''.join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in events) + 'data: [DONE]\n\n'
+    data = body.encode('utf-8')
+    chunks = [data[i:i + 1024] for i in range(0, len(data), 1024)]
+    
+    def sse_parse():
+        decoder = SSEDecoder()
+        parsed = []
+        for chunk in chunks:
+            batch, done = DifyClient._parse_events(decoder.feed(chunk))
+            parsed.extend(batch)
+            if done:
+                break
+        return parsed
+    
+    def stream_relay():
+        decoder = SSEDecoder()
+        turn = ChatTurn('bench', 1, None, 'question', 1)
+        frames = []
+        for chunk in chunks:
+            batch, done = DifyClient._relay_events(decoder.feed(chunk))
+            frames.extend(turn.handle_chunk(event) for event in batch)
+            if done:
+                break
+        return frames
+    
+    assert len(sse_parse()) == len(stream_relay()) == len(events)
+    return {
+        'sse_parse': measure(sse_parse, samples),
+        'stream_relay': measure(stream_relay, samples),
+        'extract_keyphrases': measure(lambda: ResponseParser.extract_keyphrases(events), samples),
+        'format_display': measure(lambda: ResponseParser.format_response_for_display(events), samples),
+        'run_analysis': measure(lambda: run_analysis(events, offsets), samples),
+    }
+
+
+def db_cases(samples: int) -> dict:
+    """合成履歴DBに対する履歴系エンドポイント"""
+    import random
+    from app import app
+    from database.models import db
+    from utils.analysis_cache import analysis_cache
+    
+    with app.app_context():
+        with db.engine.connect() as connection:
+            longest = connection.exec_driver_sql(
+                "SELECT id FROM conversations ORDER BY message_count DESC, id LIMIT 1").scalar()
+            assistant_ids = [row[0] for row in connection.exec_driver_sql(
+                "SELECT id FROM messages WHERE role = 'assistant' ORDER BY id LIMIT 2000").fetchall()]
+    client = app.test_client()
+    rng = random.Random(0)
+    
+    def get(url: str):
+        response = client.get(url)
+        assert response.status_code == 200, (url, response.status_code)
+        response.get_data()
+        return response
+    
+    def conversation_list():
+        cursor = None
+        for _ in range(5):
+            response = get('/api/conversations?limit=50' + (f'&before={cursor}' if cursor else ''))
+            cursor = response.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+    
+    def message_analysis():
+        message_id = rng.choice(assistant_ids)
+        analysis_cache.invalidate(message_id)
+        get(f'/api/messages/{message_id}/analysis')
+    
+    assert get('/api/conversations/search?q=障害 対応&limit=20').get_json()
+    return {
+        'conversation_list': measure(conversation_list, samples),
+        'conversation_messages': measure(lambda: get(f'/api/conversations/{longest}?limit=50'), samples),
+        'conversation_search': measure(lambda: get('/api/conversations/search?q=障害 対応&limit=20'), samples),
+        'message_analysis': measure(message_analysis, samples),
+    }
+
+
+def run_worker(args):
+    """子プロセス側: DATABASE_URL のDBで全ケースを計測してJSON出力"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    cases = cpu_cases(args.samples)
+    if not args.skip_db:
+        cases.update(db_cases(args.samples))
+    print(json.dumps(cases))
+
+
+def run_suite(args) -> dict:
+    """DBを用意（無ければ生成）して子プロセスで計測"""
+    meta = {'messages': None if args.skip_db else args.messages, 'seed': args.seed,
+            'python': platform.python_version(), 'machine': platform.machine()}
+    env = dict(os.environ)
+    if not args.skip_db:
+        path = args.database or os.path.join(tempfile.gettempdir(), f'chatbot-bench-{args.messages}-{args.seed}.db')
+        if not os.path.exists(path):
+            sys.path.insert(0, BENCH_DIR)
+            from generate_history import generate_database
+            print(f"履歴DBを生成しています: {path}（{args.messages} メッセージ）", file=sys.stderr)
+            generate_database(path, args.messages, seed=args.seed)
+        env['DATABASE_URL'] = f"sqlite:///{os.path.abspath(path)}"
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--samples', str(args.samples)]
+    if args.skip_db:
+        command.append('--skip-db')
+    # 他のプロセスの影響による揺れを抑えるため、別プロセスで rounds 回計測してケースごとに最小の値を採る
+    cases = {}
+    for _ in range(args.rounds):
+        output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            print(output.stderr, file=sys.stderr)
+            raise SystemExit(output.returncode)
+        for name, case in json.loads(output.stdout.strip().splitlines()[-1]).items():
+            best = cases.setdefault(name, case)
+            for key, value in case.items():
+                best[key] = min(best[key], value)
+    meta['rounds'] = args.rounds
+    return {'meta': meta, 'cases': cases}
+
+
+def compare(result: dict, baseline: dict, threshold: float, min_delta_ms: float) -> list:
+    """基準と比べて表示し、回帰したケース名を返す"""
+    regressions = []
+    same_data = baseline.get('meta', {}).get('messages') == result['meta']['messages']
+    print(f"{'ケース':<24}{'中央値(ms)':>12}{'p95(ms)':>12}{'基準(ms)':>12}{'変化':>9}")
+    for name, current in result['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        line = f"{name:<24}{current['median_ms']:>12.4f}{current['p95_ms']:>12.4f}"
+        if base is None or (name in DB_CASES and not same_data):
+            print(line + f"{'-':>12}{'-':>9}")
+            continue
+        change = (current['median_ms'] - base['median_ms']) / base['median_ms'] if base['median_ms'] else 0.0
+        limit = base.get('threshold', threshold)
+        regressed = change > limit and current['median_ms'] - base['median_ms'] >= min_delta_ms
+        if regressed:
+            regressions.append(name)
+        print(line + f"{base['median_ms']:>12.4f}{change:>+8.0%}" + (' !' if regressed else ''))
+    if not same_data and any(name in DB_CASES for name in result['cases']):
+        print(f"DBのケースは基準（{baseline.get('meta', {}).get('messages')} メッセージ）と件数が異なるため比較していません")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ホットパスのマイクロベンチマークと回帰チェック')
+    parser.add_argument('--messages', type=int, default=10000, help='履歴DBのメッセージ数')
+    parser.add_argument('--database', help='使う履歴DB（無ければ生成。省略時は一時ディレクトリに件数ごとに作る）')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--samples', type=int, default=30, help='ケースごとのサンプル数')
+    parser.add_argument('--rounds', type=int, default=3, help='計測を繰り返すプロセス数（ケースごとに最小値を採用）')
+    parser.add_argument('--skip-db', action='store_true', help='DBを使うケースを省略')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='基準ファイル')
+    parser.add_argument('--threshold', type=float, default=0.25, help='回帰とみなす中央値の増加率')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help='回帰とみなす中央値の最小増加量（ミリ秒）')
+    parser.add_argument('--check', action='store_true', help='回帰があれば終了コード 1')
+    parser.add_argument('--update-baseline', action='store_true', help='計測結果で基準を更新')
+    parser.add_argument('--json', action='store_true', help='計測結果をJSONで出力')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    result = run_suite(args)
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, encoding='utf-8') as f:
+                baseline = json.load(f)
+        # ケースごとに指定した threshold は引き継ぐ
+        for name, case in result['cases'].items():
+            previous = baseline.get('cases', {}).get(name, {})
+            if 'threshold' in previous:
+                case['threshold'] = previous['threshold']
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+            f.write('\n')
+        print(f"基準を更新しました: {args.baseline}")
+        return
+    
+    if not os.path.exists(args.baseline):
+        print(f"基準ファイルがありません（--update-baseline で作成）: {args.baseline}")
+        return
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(result, baseline, args.threshold, args.min_delta_ms)
+    if regressions:
+        print(f"回帰: {', '.join(regressions)}（{args.threshold:.0%} 超）")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
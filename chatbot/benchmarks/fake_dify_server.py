@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+ローカル用の疑似 Dify SSE サーバー
+
+/v1/chat-messages への POST に対して、Dify のストリーミング形式
+（message イベント × N → message_end）を一定間隔で返す。
+負荷試験で上流の待ち時間を再現するためのもので、外部依存はない。
+
+トークンの速度・大きさ、書き込み単位（SSE イベントが TCP の区切りをまたぐ）、
+message_end の retriever_resources の件数・大きさを指定でき、一定の割合で
+エラー（HTTP 500 またはストリーム途中の error イベント）と受信停止を起こせる。
+
+使い方:
+    python benchmarks/fake_dify_server.py --port 8001 --tokens 20 --token-rate 20
+    python benchmarks/fake_dify_server.py --resources 50 --resource-chars 2000 --error-rate 0.05 --stall-rate 0.05
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Any, Dict
+
+# error_rate で起こすエラーの種類
+ERROR_HTTP = 'http'      # ストリームを開始せずに HTTP 500
+ERROR_EVENT = 'event'    # ストリーム途中で error イベントを送って終了
+ERROR_MIXED = 'mixed'    # 半々
+
+
+class FakeDifyServer:
+    """asyncio ベースの最小 HTTP/1.1 SSE サーバー"""
+    
+    def __init__(self, tokens: int = 20, interval: float = 0.05, token_text: str = 'テスト', resources: int = 3,
+                 max_streams: int = 0, token_chars: int = 0, write_size: int = 0, resource_chars: int = 0,
+                 error_rate: float = 0.0, error_mode: str = ERROR_MIXED, stall_rate: float = 0.0,
+                 stall_seconds: float = 5.0, seed=None):
+        if error_mode not in (ERROR_HTTP, ERROR_EVENT, ERROR_MIXED):
+            raise ValueError(f"不明な error_mode: {error_mode}")
+        self.tokens = tokens
+        self.interval = interval
+        # token_chars を指定した場合は token_text を繰り返してその文字数にする
+        self.token_text = (token_text * (token_chars // len(token_text) + 1))[:token_chars] if token_chars else token_text
+        self.resources = resources
+        self.resource_chars = resource_chars  # retriever_resources の content の文字数（0 なら10行の短文）
+        self.write_size = write_size  # 1回に書き込むバイト数（0 ならイベントごと）
+        self.max_streams = max_streams  # 同時ストリーム数の上限（超えたら 429。0 なら無制限）
+        self.error_rate = error_rate
+        self.error_mode = error_mode
+        self.stall_rate = stall_rate
+        self.stall_seconds = stall_seconds
+        self._random = random.Random(seed)
+        self.active_streams = 0
+        self.peak_streams = 0
+        self.total_requests = 0
+        self.rejected_requests = 0
+        self.completed_streams = 0
+        self.injected_errors = 0
+        self.injected_stalls = 0
+    
+    def build_events(self, query: str, conversation_id: str):
+        """1ターン分のイベント列を生成"""
+        message_id = str(uuid.uuid4())
+        task_id = str(uuid.uuid4())
+        created_at = int(time.time())
+        envelope = {
+            'conversation_id': conversation_id,
+            'message_id': message_id,
+            'task_id': task_id,
+            'id': message_id,
+            'created_at': created_at,
+        }
+        for _ in range(self.tokens):
+            yield {'event': 'message', 'answer': self.token_text, **envelope}
+        resources = [
+            {
+                'position': i + 1,
+                'dataset_name': 'fake-dataset',
+                'document_name': f'document-{i + 1}.pdf',
+                'score': 0.9,
+                'content': self._resource_content(i),
+            }
+            for i in range(self.resources)
+        ]
+        yield {
+            'event': 'message_end',
+            **envelope,
+            'metadata': {
+                'usage': {'prompt_tokens': len(query), 'completion_tokens': self.tokens, 'total_tokens': len(query) + self.tokens},
+                'retriever_resources': resources,
+            },
+        }
+    
+    def _resource_content(self, index: int) -> str:
+        lines = [f'キーフレーズ{index + 1}-{j + 1}' for j in range(10)]
+        if not self.resource_chars:
+            return '\r\n'.join(lines)
+        content = '\r\n'.join(lines + ['検索結果の本文。' * (self.resource_chars // 8 + 1)])
+        return content[:self.resource_chars]
+    
+    def _error_event(self, envelope: Dict[str, Any]) -> Dict[str, Any]:
+        """Dify がストリーム途中で送る error イベント"""
+        return {
+            'event': 'error',
+            'task_id': envelope.get('task_id'),
+            'message_id': envelope.get('message_id'),
+            'status': 500,
+            'code': 'internal_server_error',
+            'message': 'Injected error',
+        }
+    
+    def stats(self) -> Dict[str, Any]:
+        """負荷試験のレポート用の集計"""
+        return {
+            'requests': self.total_requests,
+            'completed_streams': self.completed_streams,
+            'rejected': self.rejected_requests,
+            'injected_errors': self.injected_errors,
+            'injected_stalls': self.injected_stalls,
+            'peak_streams': self.peak_streams,
+        }
+    
+    async def _write_event(self, writer: asyncio.StreamWriter, event: Dict[str, Any]):
+        """イベントを chunked で書き込む（write_size ごとに分けて送る）"""
+        data = f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8')
+        size = self.write_size or len(data)
+        for start in range(0, len(data), size):
+            piece = data[start:start + size]
+            writer.write(f'{len(piece):x}\r\n'.encode() + piece + b'\r\n')
+            await writer.drain()
+    
+    async def _read_request(self, reader: asyncio.StreamReader):
+        """リクエストラインとヘッダー、ボディを読む"""
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length', '0'))
+        body = await reader.readexactly(length) if length else b''
+        method, path, _ = request_line.decode('latin-1').split(' ', 2)
+        return method, path, headers, body
+    
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """接続ハンドラー（keep-alive 対応）"""
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                if method != 'POST' or not path.endswith('/chat-messages'):
+                    writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n')
+                    await writer.drain()
+                    continue
+                
+                payload = json.loads(body or b'{}')
+                conversation_id = payload.get('conversation_id') or str(uuid.uuid4())
+                self.total_requests += 1
+                if self.max_streams and self.active_streams >= self.max_streams:
+                    # Dify のレート制限の再現
+                    self.rejected_requests += 1
+                    error = json.dumps({'code': 'too_many_requests', 'message': 'Too many requests'}).encode()
+                    writer.write(
+                        b'HTTP/1.1 429 Too Many Requests\r\nContent-Type: application/json\r\n'
+                        + f'Content-Length: {len(error)}\r\n\r\n'.encode() + error
+                    )
+                    await writer.drain()
+                    continue
+                
+                # エラー・受信停止の注入（どのイベントの前で起こすかもここで決める）
+                error = None
+                if self.error_rate and self._random.random() < self.error_rate:
+                    error = self.error_mode
+                    if error == ERROR_MIXED:
+                        error = self._random.choice((ERROR_HTTP, ERROR_EVENT))
+                    self.injected_errors += 1
+                stall_at = -1
+                if self.stall_rate and self._random.random() < self.stall_rate:
+                    stall_at = self._random.randrange(self.tokens + 1)
+                    self.injected_stalls += 1
+                if error == ERROR_HTTP:
+                    body = json.dumps({'code': 'internal_server_error', 'message': 'Injected error'}).encode()
+                    writer.write(
+                        b'HTTP/1.1 500 Internal Server Error\r\nContent-Type: application/json\r\n'
+                        + f'Content-Length: {len(body)}\r\n\r\n'.encode() + body
+                    )
+                    await writer.drain()
+                    continue
+                error_at = self._random.randrange(self.tokens + 1) if error == ERROR_EVENT else -1
+                
+                self.active_streams += 1
+                self.peak_streams = max(self.peak_streams, self.active_streams)
+                try:
+                    writer.write(
+                        b'HTTP/1.1 200 OK\r\n'
+                        b'Content-Type: text/event-stream\r\n'
+                        b'Transfer-Encoding: chunked\r\n'
+                        b'Connection: keep-alive\r\n\r\n'
+                    )
+                    for index, event in enumerate(self.build_events(payload.get('query', ''), conversation_id)):
+                        await asyncio.sleep(self.interval)
+                        if index == stall_at:
+                            await asyncio.sleep(self.stall_seconds)
+                        if index == error_at:
+                            await self._write_event(writer, self._error_event(event))
+                            break
+                        await self._write_event(writer, event)
+                    else:
+                        self.completed_streams += 1
+                    writer.write(b'0\r\n\r\n')
+                    await writer.drain()
+                finally:
+                    self.active_streams -= 1
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # 呼び出し側のイベントループ終了で待機中の keep-alive 接続がキャンセルされた
+            pass
+        finally:
+            writer.close()
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 8001) -> asyncio.AbstractServer:
+        """サーバーを起動"""
+        return await asyncio.start_server(self.handle, host, port, backlog=4096)
+
+
+async def _serve(args):
+    server = FakeDifyServer(
+        tokens=args.tokens, interval=1.0 / args.token_rate if args.token_rate else args.interval,
+        resources=args.resources, max_streams=args.max_streams, token_chars=args.token_chars,
+        write_size=args.write_size, resource_chars=args.resource_chars, error_rate=args.error_rate,
+        error_mode=args.error_mode, stall_rate=args.stall_rate, stall_seconds=args.stall_seconds, seed=args.seed,
+    )
+    listener = await server.start(args.host, args.port)
+    print(f"疑似Difyサーバー起動: http://{args.host}:{args.port}/v1", flush=True)
+    async with listener:
+        await listener.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='疑似 Dify SSE サーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--tokens', type=int, default=20, help='message イベント数')
+    parser.add_argument('--interval', type=float, default=0.05, help='イベント間隔（秒）')
+    parser.add_argument('--token-rate', type=float, default=0, help='1秒あたりのイベント数（指定すると --interval より優先）')
+    parser.add_argument('--token-chars', type=int, default=0, help='message イベント1件の answer の文字数')
+    parser.add_argument('--write-size', type=int, default=0, help='1回に書き込むバイト数（0 ならイベントごと）')
+    parser.add_argument('--resources', type=int, default=3, help='retriever_resources の件数')
+    parser.add_argument('--resource-chars', type=int, default=0, help='retriever_resources の content の文字数')
+    parser.add_argument('--max-streams', type=int, default=0, help='同時ストリーム数の上限（超えたら 429）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='エラーを起こすリクエストの割合')
+    parser.add_argument('--error-mode', choices=(ERROR_MIXED, ERROR_HTTP, ERROR_EVENT), default=ERROR_MIXED,
+                        help='エラーの種類（HTTP 500 / 途中の error イベント / 半々）')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='途中で受信が止まるリクエストの割合')
+    parser.add_argument('--stall-seconds', type=float, default=5.0, help='受信が止まる秒数')
+    parser.add_argument('--seed', type=int, default=None, help='エラー・停止の乱数シード')
+    args = parser.parse_args()
+    try:
+        asyncio.run(_serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+合成の会話履歴データの生成（ベンチマーク用）
+
+dify_apps / conversations / messages / message_payloads に、実運用に近い大きさの
+データを一括投入する。アシスタントの応答は Dify のストリーミング形式の生レスポンス
+（message イベント × 数百 + retriever_resources 付きの message_end）を差分形式で
+圧縮して保存し、解析結果（keyphrase_data / analysis_data）も解析ジョブと同じ形式で
+書き込む。生成を速くするため、応答は --templates 種類を作って使い回す。
+
+会話サマリー列（preview_title / message_count など）も埋めるため、生成したDBは
+そのままアプリケーションで開ける。全文索引はトリガーで更新される。
+キーフレーズ索引は --keyphrase-index を付けた場合のみ作成する（件数が多いと時間がかかる）。
+
+使い方:
+    python benchmarks/generate_history.py --database /tmp/history.db --messages 100000
+    python benchmarks/generate_history.py --database /tmp/history-1m.db --messages 1000000 --json
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SQLAlchemy が SQLite の DateTime 列に書く形式（一覧のキーセットページングは文字列で比較する）
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+WORDS = ['検索', '結果', '本文', '会議', '資料', '設計', '要件', '確認', '手順', '障害', '対応', '運用', '契約', '顧客', '製品',
+         'サーバ', 'ネットワーク', '請求', '承認', '申請', 'について', 'を', 'は', 'が', 'です。', 'ます。',
+         'database', 'deploy', 'timeout', 'latency', 'release']
+PHRASES = [f'{a}{b}' for a in WORDS[:20] for b in WORDS[:20] if a != b]
+
+# 1会話あたりの往復数の分布（短い会話が多く、長い会話が少しある）
+TURN_WEIGHTS = [(1, 30), (2, 20), (3, 15), (5, 15), (10, 10), (20, 6), (50, 3), (200, 1)]
+
+
+def text(rng: random.Random, words: int) -> str:
+    # 出現頻度に偏りを持たせる
+    return ''.join(WORDS[min(len(WORDS) - 1, int(rng.paretovariate(0.7)) - 1)] for _ in range(words))
+
+
+def response_template(rng: random.Random, index: int, tokens: Optional[int] = None, resources: Optional[int] = None):
+    """生レスポンス1件分（イベント列・受信時刻・回答本文）。件数を省略すると乱数で決める"""
+    tokens = tokens or rng.randint(50, 400)
+    resources = rng.choice([0, 1, 3, 3, 5, 5, 10]) if resources is None else resources
+    envelope = {'conversation_id': f'dify-{index}', 'message_id': f'msg-{index}', 'task_id': f'task-{index}',
+                'id': f'msg-{index}', 'created_at': 1700000000}
+    events = [{'event': 'message', 'answer': text(rng, rng.randint(1, 3)), **envelope} for _ in range(tokens)]
+    events.append({
+        'event': 'message_end',
+        **envelope,
+        'metadata': {
+            'usage': {'prompt_tokens': rng.randint(200, 4000), 'completion_tokens': tokens,
+                      'total_tokens': 0, 'latency': round(rng.uniform(1, 20), 3)},
+            'retriever_resources': [
+                {
+                    'position': i + 1,
+                    'dataset_name': 'synthetic-dataset',
+                    'document_name': f'document-{rng.randrange(10000)}.pdf',
+                    'score': round(rng.uniform(0.3, 0.95), 4),
+                    'content': '\r\n'.join(rng.choice(PHRASES) for _ in range(rng.randint(5, 30))),
+                }
+                for i in range(resources)
+            ],
+        },
+    })
+    usage = events[-1]['metadata']['usage']
+    usage['total_tokens'] = usage['prompt_tokens'] + usage['completion_tokens']
+    offsets, elapsed = [], 0
+    for _ in events:
+        elapsed += rng.randint(10, 80)
+        offsets.append(elapsed)
+    answer = ''.join(event['answer'] for event in events[:-1])
+    return events, offsets, answer
+
+
+def build_templates(count: int, seed: int):
+    """保存する行の内容（圧縮済みの生レスポンス・解析結果）を前もって作る"""
+    from database.payload_store import serialize_stream, compress
+    from database.summary import extract_token_usage
+    from utils.analysis_jobs import run_analysis
+    
+    rng = random.Random(seed)
+    templates = []
+    for index in range(count):
+        events, offsets, answer = response_template(rng, index)
+        result = run_analysis(events, offsets)
+        raw = serialize_stream(events, offsets)
+        codec, data = compress(raw)
+        templates.append({
+            'answer': answer,
+            'keyphrase_data': json.dumps(result['keyphrases'], ensure_ascii=False),
+            'analysis_data': json.dumps({'display': result['display'], 'stats': result['stats']}, ensure_ascii=False),
+            'usage': json.dumps(extract_token_usage(events), ensure_ascii=False),
+            'codec': codec,
+            'raw_size': len(raw),
+            'data': data,
+        })
+    return templates
+
+
+def generate(connection, messages: int, apps: int = 3, templates: int = 200, seed: int = 0,
+             days: int = 365, batch: int = 20000) -> dict:
+    """
+    会話・メッセージ・生レスポンスを一括投入（既存の行の後ろに追加する）
+    
+    Returns:
+        dict: 投入した件数
+    """
+    from database.summary import make_preview_title
+    
+    rng = random.Random(seed)
+    pool = build_templates(templates, seed)
+    
+    app_ids = [row[0] for row in connection.exec_driver_sql("SELECT id FROM dify_apps ORDER BY id").fetchall()]
+    for index in range(len(app_ids), apps):
+        connection.exec_driver_sql(
+            "INSERT INTO dify_apps (name, description, api_key_env_name, created_at, updated_at) "
+            "VALUES (?, ?, 'DIFY_API_KEY_SAMPLE1', CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)",
+            (f'合成アプリ {index + 1}', 'generate_history.py で作成'),
+        )
+    app_ids = [row[0] for row in connection.exec_driver_sql("SELECT id FROM dify_apps ORDER BY id").fetchall()][:apps]
+    conversation_id = connection.exec_driver_sql("SELECT COALESCE(MAX(id), 0) FROM conversations").scalar()
+    message_id = connection.exec_driver_sql("SELECT COALESCE(MAX(id), 0) FROM messages").scalar()
+    connection.commit()
+    
+    turn_choices, turn_weights = zip(*TURN_WEIGHTS)
+    now = datetime.utcnow()
+    report = {'conversations': 0, 'messages': 0, 'payload_bytes': 0}
+    conversation_rows, message_rows, payload_rows = [], [], []
+    
+    def flush():
+        connection.exec_driver_sql(
+            "INSERT INTO conversations (id, title, dify_app_id, dify_conversation_id, created_at, updated_at, "
+            "preview_title, message_count, last_message_at, last_token_usage) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            conversation_rows,
+        )
+        connection.exec_driver_sql(
+            "INSERT INTO messages (id, conversation_id, role, content, keyphrase_data, analysis_status, "
+            "analysis_data, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            message_rows,
+        )
+        if payload_rows:
+            connection.exec_driver_sql(
+                "INSERT INTO message_payloads (message_id, codec, raw_size, data) VALUES (?, ?, ?, ?)",
+                payload_rows,
+            )
+        connection.commit()
+        conversation_rows.clear()
+        message_rows.clear()
+        payload_rows.clear()
+    
+    while report['messages'] < messages:
+        conversation_id += 1
+        turns = min(rng.choices(turn_choices, turn_weights)[0], max(1, (messages - report['messages']) // 2))
+        at = now - timedelta(days=rng.uniform(0, days))
+        created_at = at
+        first_question = None
+        usage = None
+        for _ in range(turns):
+            question = text(rng, rng.randint(5, 40))
+            first_question = first_question or question
+            message_id += 1
+            message_rows.append((message_id, conversation_id, 'user', question, None, None, None, at.strftime(DATETIME_FORMAT)))
+            at += timedelta(seconds=rng.randint(2, 30))
+            template = rng.choice(pool)
+            message_id += 1
+            message_rows.append((message_id, conversation_id, 'assistant', template['answer'],
+                                 template['keyphrase_data'], 'done', template['analysis_data'], at.strftime(DATETIME_FORMAT)))
+            payload_rows.append((message_id, template['codec'], template['raw_size'], template['data']))
+            report['payload_bytes'] += len(template['data'])
+            usage = template['usage']
+            at += timedelta(seconds=rng.randint(10, 600))
+        conversation_rows.append((
+            conversation_id, f'会話 {conversation_id}', rng.choice(app_ids), f'dify-conversation-{conversation_id}',
+            created_at.strftime(DATETIME_FORMAT), at.strftime(DATETIME_FORMAT), make_preview_title(first_question), turns * 2,
+            at.strftime(DATETIME_FORMAT), usage,
+        ))
+        report['conversations'] += 1
+        report['messages'] += turns * 2
+        if len(message_rows) >= batch:
+            flush()
+    if message_rows:
+        flush()
+    return report
+
+
+def run_worker(args):
+    """子プロセス側: DATABASE_URL のDBを初期化して投入"""
+    sys.path.insert(0, CHATBOT_DIR)
+    import logging
+    logging.disable(logging.INFO)
+    
+    from app import app, initialize_database
+    from database.models import db
+    
+    started = time.perf_counter()
+    initialize_database()
+    with app.app_context():
+        with db.engine.connect() as connection:
+            report = generate(connection, args.messages, args.apps, args.templates, args.seed, args.days)
+        if args.keyphrase_index:
+            from database.keyphrase_index import backfill_keyphrase_index
+            from utils.response_parser import ResponseParser
+            report['keyphrase_index'] = backfill_keyphrase_index(ResponseParser.keyphrase_rows)
+        db.engine.dispose()
+        report['database'] = db.engine.url.database
+    report['seconds'] = round(time.perf_counter() - started, 2)
+    report['db_bytes'] = os.path.getsize(report['database'])
+    print(json.dumps(report, ensure_ascii=False))
+
+
+def generate_database(path: str, messages: int, **options) -> dict:
+    """別プロセスで path のDBを作成（他のベンチマークから呼ぶ）"""
+    command = [sys.executable, os.path.abspath(__file__), '--worker', '--messages', str(messages)]
+    for name, value in options.items():
+        if value is True:
+            command.append(f"--{name.replace('_', '-')}")
+        elif value not in (None, False):
+            command += [f"--{name.replace('_', '-')}", str(value)]
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.abspath(path)}")
+    output = subprocess.run(command, cwd=CHATBOT_DIR, env=env, capture_output=True, text=True, check=True)
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='合成の会話履歴データの生成')
+    parser.add_argument('--database', help='作成するDBファイル（省略時は一時ディレクトリ）')
+    parser.add_argument('--messages', type=int, default=10000, help='メッセージ数（ユーザーとアシスタントの合計）')
+    parser.add_argument('--apps', type=int, default=3, help='Difyアプリ数（足りない分は作成する）')
+    parser.add_argument('--templates', type=int, default=200, help='使い回す応答の種類')
+    parser.add_argument('--days', type=int, default=365, help='会話を分散させる日数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keyphrase-index', action='store_true', help='キーフレーズ索引も作成する')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    
+    if args.worker:
+        run_worker(args)
+        return
+    
+    path = args.database or os.path.join(tempfile.mkdtemp(prefix='chatbot-history-'), 'history.db')
+    if os.path.exists(path):
+        print(f"既存のDBに追加します: {path}", file=sys.stderr)
+    report = generate_database(path, args.messages, apps=args.apps, templates=args.templates, days=args.days,
+                               seed=args.seed, keyphrase_index=args.keyphrase_index)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"{report['database']}: 会話 {report['conversations']} 件 / メッセージ {report['messages']} 件 "
+          f"（生レスポンス {report['payload_bytes'] / 1024 / 1024:.1f} MiB、"
+          f"DB {report['db_bytes'] / 1024 / 1024:.1f} MiB、{report['seconds']}秒）")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Difyアプリ間の分離の負荷試験（アプリごとの同時実行数の上限と待ち行列）
+
+疑似 Dify サーバー（このプロセス内、全アプリ共通の同時ストリーム上限付き）と
+uvicorn（ASGI版）を起動し、アプリ1に大量の同時リクエストを送っている間に
+アプリ2から少数のリクエストを送る。上限なし（CHAT_MAX_CONCURRENCY=0）と
+上限あり（CHAT_MAX_CONCURRENCY / CHAT_MAX_QUEUE）で、アプリごとに以下を比較する。
+
+- 成功数・上流エラー（疑似 Dify の 429）数・アプリ側の 429 数
+- 順番待ち（queued イベント）を受け取ったリクエスト数
+- 最初のイベントまでの時間（TTFE）とストリーム全体の所要時間
+
+データベースは一時ディレクトリに作成するため、既存の database.db には触れない。
+
+使い方:
+    python benchmarks/load_app_isolation.py --flood 80 --victim 6 --upstream-limit 16 --max-concurrency 8
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHATBOT_DIR, 'benchmarks'))
+
+from fake_dify_server import FakeDifyServer  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"ポート {port} が起動しませんでした")
+
+
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+async def _one_stream(client: httpx.AsyncClient, url: str, dify_app_id: int, index: int) -> dict:
+    """1本のチャットストリームを最後まで受信して結果を分類"""
+    started = time.perf_counter()
+    first_event = None
+    queued = False
+    outcome = 'incomplete'
+    payload = {'message': f'アプリ{dify_app_id}の質問 {index}', 'dify_app_id': dify_app_id}
+    async with client.stream('POST', url, json=payload) as response:
+        if response.status_code == 429:
+            await response.aread()
+            return {'outcome': 'rejected', 'retry_after': response.headers.get('Retry-After'),
+                    'duration': (time.perf_counter() - started) * 1000}
+        if response.status_code != 200:
+            return {'outcome': f'http_{response.status_code}', 'duration': 0.0}
+        async for line in response.aiter_lines():
+            if not line.startswith('data: '):
+                continue
+            data = line[6:]
+            if data == '[DONE]':
+                break
+            event = json.loads(data)
+            if event.get('event') == 'stream_started':
+                continue
+            if event.get('event') == 'queued':
+                queued = True
+                continue
+            if first_event is None:
+                first_event = time.perf_counter() - started
+            if event.get('event') == 'error':
+                outcome = 'upstream_error'
+            elif event.get('event') == 'message_end' and event.get('message_id'):
+                outcome = 'ok'
+    return {
+        'outcome': outcome,
+        'queued': queued,
+        'ttfe': (first_event or 0.0) * 1000,
+        'duration': (time.perf_counter() - started) * 1000,
+    }
+
+
+def _summarize(results) -> dict:
+    outcomes = {}
+    for result in results:
+        outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+    ok = [r for r in results if r['outcome'] == 'ok']
+    rejected = [r['duration'] for r in results if r['outcome'] == 'rejected']
+    return {
+        'requests': len(results),
+        'outcomes': outcomes,
+        'queued': sum(1 for r in results if r.get('queued')),
+        'ttfe_ms_p50': round(statistics.median([r['ttfe'] for r in ok]), 1) if ok else 0.0,
+        'ttfe_ms_p99': round(_percentile([r['ttfe'] for r in ok], 0.99), 1),
+        'duration_ms_p50': round(statistics.median([r['duration'] for r in ok]), 1) if ok else 0.0,
+        'duration_ms_p99': round(_percentile([r['duration'] for r in ok], 0.99), 1),
+        'reject_ms_p50': round(statistics.median(rejected), 1) if rejected else None,
+    }
+
+
+async def _run_mode(args, max_concurrency: int) -> dict:
+    """疑似 Dify とアプリを起動し、アプリ1の集中中にアプリ2のリクエストを送る"""
+    fake = FakeDifyServer(tokens=args.tokens, interval=args.interval, max_streams=args.upstream_limit)
+    fake_port = _free_port()
+    app_port = _free_port()
+    listener = await fake.start('127.0.0.1', fake_port)
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-isolation-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'load.db')}",
+        DIFY_API_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        DIFY_API_KEY_SAMPLE1=os.getenv('DIFY_API_KEY_SAMPLE1', 'fake-key'),
+        DIFY_API_KEY_SAMPLE2=os.getenv('DIFY_API_KEY_SAMPLE2', 'fake-key'),
+        CHAT_MAX_CONCURRENCY=str(max_concurrency),
+        CHAT_MAX_QUEUE=str(args.max_queue),
+        RESPONSE_CACHE_APPS='',
+    )
+    server_log = open(os.path.join(tmpdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(app_port),
+         '--log-level', 'warning', '--backlog', '4096'],
+        cwd=CHATBOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT,
+    )
+    url = f'http://127.0.0.1:{app_port}/api/chat-stream'
+    connections = args.flood + args.victim
+    limits = httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    try:
+        await _wait_for_port(app_port)
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(300.0)) as client:
+            flood = [asyncio.create_task(_one_stream(client, url, 1, i)) for i in range(args.flood)]
+            # アプリ1の集中が始まってからアプリ2が質問する
+            await asyncio.sleep(args.victim_delay)
+            victim = await asyncio.gather(*[_one_stream(client, url, 2, i) for i in range(args.victim)])
+            flood = await asyncio.gather(*flood)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        server_log.close()
+        listener.close()
+        await listener.wait_closed()
+    return {
+        'mode': f'max_concurrency={max_concurrency}' if max_concurrency else 'unlimited',
+        'upstream_requests': fake.total_requests,
+        'upstream_rejected': fake.rejected_requests,
+        'upstream_peak_streams': fake.peak_streams,
+        'app1_flood': _summarize(flood),
+        'app2_victim': _summarize(victim),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Difyアプリ間の分離の負荷試験')
+    parser.add_argument('--flood', type=int, default=80, help='アプリ1の同時リクエスト数')
+    parser.add_argument('--victim', type=int, default=6, help='アプリ2の同時リクエスト数')
+    parser.add_argument('--victim-delay', type=float, default=0.3, help='アプリ2が質問するまでの秒数')
+    parser.add_argument('--upstream-limit', type=int, default=16, help='疑似 Dify の同時ストリーム上限（全アプリ共通）')
+    parser.add_argument('--max-concurrency', type=int, default=8, help='上限ありの場合のアプリごとの同時実行数')
+    parser.add_argument('--max-queue', type=int, default=16, help='アプリごとの待ち行列の長さ')
+    parser.add_argument('--tokens', type=int, default=20, help='1応答の message イベント数')
+    parser.add_argument('--interval', type=float, default=0.05, help='上流イベント間隔（秒）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+    
+    reports = [asyncio.run(_run_mode(args, 0)), asyncio.run(_run_mode(args, args.max_concurrency))]
+    if args.json:
+        print(json.dumps(reports, ensure_ascii=False, indent=2))
+        return
+    
+    print(f"アプリ1 {args.flood} 件の集中中にアプリ2 {args.victim} 件、疑似 Dify の同時上限 {args.upstream_limit}")
+    for report in reports:
+        print(f"  [{report['mode']}] 上流リクエスト {report['upstream_requests']} 件"
+              f"（429 {report['upstream_rejected']} 件、ピーク同時 {report['upstream_peak_streams']}）")
+        for name in ('app1_flood', 'app2_victim'):
+            summary = report[name]
+            reject = f"  429応答 p50 {summary['reject_ms_p50']}ms" if summary['reject_ms_p50'] is not None else ''
+            print(
+                f"    {name:11s}: {summary['outcomes']}  順番待ち {summary['queued']:3d}  "
+                f"TTFE p50 {summary['ttfe_ms_p50']:7.1f}ms p99 {summary['ttfe_ms_p99']:7.1f}ms  "
+                f"所要 p50 {summary['duration_ms_p50']:7.1f}ms p99 {summary['duration_ms_p99']:7.1f}ms{reject}"
+            )
+
+
+if __name__ == '__main__':
+    main()
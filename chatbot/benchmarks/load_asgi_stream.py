@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+ASGI版 /api/chat-stream の同時ストリーム負荷試験
+
+疑似 Dify サーバーと uvicorn（1プロセス）を起動し、指定した同時接続数で
+チャットストリームを張って、1プロセスあたりの同時ストリーム処理能力を測る。
+データベースは一時ディレクトリに作成するため、既存の database.db には触れない。
+
+使い方:
+    python benchmarks/load_asgi_stream.py --concurrency 100 500 1000
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"ポート {port} が起動しませんでした")
+
+
+def _percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def _one_stream(client: httpx.AsyncClient, url: str, state: dict, index: int) -> dict:
+    """1本のチャットストリームを最後まで受信"""
+    started = time.perf_counter()
+    first_event = None
+    message_id = None
+    try:
+        payload = {'message': f'負荷試験メッセージ {index}', 'dify_app_id': 1}
+        async with client.stream('POST', url, json=payload) as response:
+            if response.status_code != 200:
+                return {'ok': False, 'status': response.status_code}
+            state['open'] += 1
+            state['peak'] = max(state['peak'], state['open'])
+            try:
+                async for line in response.aiter_lines():
+                    if not line.startswith('data: '):
+                        continue
+                    data = line[6:]
+                    if data == '[DONE]':
+                        break
+                    event = json.loads(data)
+                    if event.get('event') == 'stream_started':
+                        continue
+                    if first_event is None:
+                        first_event = time.perf_counter() - started
+                    if event.get('event') == 'message_end' and event.get('message_id'):
+                        message_id = event['message_id']
+            finally:
+                state['open'] -= 1
+    except httpx.HTTPError as e:
+        return {'ok': False, 'error': str(e)}
+    return {
+        'ok': message_id is not None,
+        'ttfe': first_event or 0.0,
+        'duration': time.perf_counter() - started,
+    }
+
+
+async def _run_level(port: int, concurrency: int) -> dict:
+    """指定同時接続数で1ラウンド実行"""
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    timeout = httpx.Timeout(120.0)
+    state = {'open': 0, 'peak': 0}
+    url = f'http://127.0.0.1:{port}/api/chat-stream'
+    started = time.perf_counter()
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        results = await asyncio.gather(*[_one_stream(client, url, state, i) for i in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    ok = [r for r in results if r.get('ok')]
+    ttfe = [r['ttfe'] * 1000 for r in ok]
+    durations = [r['duration'] * 1000 for r in ok]
+    return {
+        'concurrency': concurrency,
+        'succeeded': len(ok),
+        'failed': len(results) - len(ok),
+        'peak_open_streams': state['peak'],
+        'wall_seconds': round(elapsed, 3),
+        'ttfe_ms_p50': round(statistics.median(ttfe), 1) if ttfe else 0.0,
+        'ttfe_ms_p99': round(_percentile(ttfe, 0.99), 1),
+        'duration_ms_p50': round(statistics.median(durations), 1) if durations else 0.0,
+        'duration_ms_p99': round(_percentile(durations, 0.99), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='ASGI チャットストリーム負荷試験')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[100, 500, 1000])
+    parser.add_argument('--tokens', type=int, default=20, help='1ストリームあたりの message イベント数')
+    parser.add_argument('--interval', type=float, default=0.05, help='上流イベント間隔（秒）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+    
+    fake_port = _free_port()
+    app_port = _free_port()
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-load-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'load.db')}",
+        DIFY_API_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        DIFY_API_KEY_SAMPLE1=os.getenv('DIFY_API_KEY_SAMPLE1', 'fake-key'),
+    )
+    
+    server_log = open(os.path.join(tmpdir, 'server.log'), 'w')
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(CHATBOT_DIR, 'benchmarks', 'fake_dify_server.py'),
+             '--port', str(fake_port), '--tokens', str(args.tokens), '--interval', str(args.interval)],
+            cwd=CHATBOT_DIR, env=env, stdout=subprocess.DEVNULL,
+        ),
+        subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(app_port),
+             '--log-level', 'warning', '--backlog', '4096'],
+            cwd=CHATBOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT,
+        ),
+    ]
+    try:
+        _wait_for_port(fake_port)
+        _wait_for_port(app_port)
+        ideal_ms = (args.tokens + 1) * args.interval * 1000
+        reports = []
+        for level in args.concurrency:
+            report = asyncio.run(_run_level(app_port, level))
+            report['ideal_stream_ms'] = round(ideal_ms, 1)
+            reports.append(report)
+            if not args.json:
+                print(
+                    f"同時 {level:5d}: 成功 {report['succeeded']:5d} / 失敗 {report['failed']:4d}  "
+                    f"ピーク同時 {report['peak_open_streams']:5d}  "
+                    f"TTFE p50 {report['ttfe_ms_p50']:8.1f}ms p99 {report['ttfe_ms_p99']:8.1f}ms  "
+                    f"所要 p50 {report['duration_ms_p50']:8.1f}ms p99 {report['duration_ms_p99']:8.1f}ms "
+                    f"(理想 {ideal_ms:.0f}ms)"
+                )
+        if args.json:
+            print(json.dumps(reports, ensure_ascii=False, indent=2))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait(timeout=10)
+        server_log.close()
+
+
+if __name__ == '__main__':
+    main()
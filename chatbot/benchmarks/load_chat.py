@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+エンドツーエンドの負荷試験（チャット・会話一覧・解析APIの混合）
+
+疑似 Dify サーバー（このプロセス内）と uvicorn（ASGI版）を起動し、指定した数の
+仮想ユーザーが一定時間、以下のリクエストを重み付きで繰り返す。
+
+- POST /api/chat-stream（毎回新しい会話）
+- GET /api/conversations
+- GET /api/messages/<ID>/analysis（このユーザーが受け取った message_id）
+
+エンドポイントごとのスループット・レイテンシ（p50/p95/p99）・エラー率、チャットの
+最初のイベントまでの時間（TTFE）、疑似 Dify の集計、/metrics のフェーズ別平均を
+JSON のレポートにまとめる。--compare で以前のレポートとの差分を表示できる。
+
+データベースは一時ディレクトリに作成するため、既存の database.db には触れない。
+--base-url を指定した場合は起動済みのインスタンスへ送る（疑似 Dify は別途
+fake_dify_server.py で起動しておく）。
+
+使い方:
+    python benchmarks/load_chat.py --users 50 --duration 30 --output report.json
+    python benchmarks/load_chat.py --users 50 --duration 30 --error-rate 0.05 --compare report.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+import httpx
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHATBOT_DIR, 'benchmarks'))
+
+from fake_dify_server import FakeDifyServer, ERROR_MIXED, ERROR_HTTP, ERROR_EVENT  # noqa: E402
+
+ENDPOINTS = ('chat_stream', 'conversations', 'analysis')
+PHASE_LINE = re.compile(r'^chatbot_phase_seconds_(sum|count)\{phase="([^"]+)",dify_app="[^"]*"\} (\S+)$')
+
+# --compare で表示する指標（値が大きいほど悪いものは True）
+COMPARED_METRICS = (
+    ('throughput_rps', False),
+    ('error_rate', True),
+    ('latency_ms.p50', True),
+    ('latency_ms.p95', True),
+    ('latency_ms.p99', True),
+    ('ttfe_ms.p50', True),
+    ('ttfe_ms.p95', True),
+    ('ttfe_ms.p99', True),
+)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"ポート {port} が起動しませんでした")
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    ordered = sorted(values)
+    
+    def pick(q: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))], 1)
+    
+    return {'p50': pick(0.5), 'p95': pick(0.95), 'p99': pick(0.99), 'max': round(ordered[-1], 1)}
+
+
+def _parse_mix(value: str) -> Dict[str, float]:
+    """'chat=6,conversations=3,analysis=1' を重みの dict に"""
+    mix = {}
+    for item in value.split(','):
+        name, _, weight = item.partition('=')
+        name = {'chat': 'chat_stream'}.get(name.strip(), name.strip())
+        if name not in ENDPOINTS:
+            raise argparse.ArgumentTypeError(f"不明なリクエスト種別: {name}")
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Recorder:
+    """エンドポイントごとの結果の蓄積"""
+    
+    def __init__(self):
+        self.results: Dict[str, List[Dict[str, Any]]] = {name: [] for name in ENDPOINTS}
+    
+    def add(self, endpoint: str, outcome: str, latency: float, **extra):
+        self.results[endpoint].append({'outcome': outcome, 'latency': latency * 1000, **extra})
+    
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        report = {}
+        for endpoint, results in self.results.items():
+            outcomes: Dict[str, int] = {}
+            for result in results:
+                outcomes[result['outcome']] = outcomes.get(result['outcome'], 0) + 1
+            ok = [r for r in results if r['outcome'] in ('ok', 'pending')]
+            errors = len(results) - len(ok)
+            summary = {
+                'requests': len(results),
+                'outcomes': outcomes,
+                'error_rate': round(errors / len(results), 4) if results else 0.0,
+                'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else 0.0,
+                'latency_ms': _percentiles([r['latency'] for r in ok]),
+            }
+            if endpoint == 'chat_stream':
+                summary['ttfe_ms'] = _percentiles([r['ttfe'] for r in ok if r.get('ttfe') is not None])
+                summary['queued'] = sum(1 for r in results if r.get('queued'))
+            report[endpoint] = summary
+        return report
+
+
+async def _chat(client: httpx.AsyncClient, base: str, state: Dict[str, Any], recorder: Recorder, args):
+    """1ターンのチャットを最後まで受信"""
+    payload = {'message': f"負荷試験の質問 {state['user']}-{state['turns']}", 'dify_app_id': random.choice(args.apps)}
+    state['turns'] += 1
+    started = time.perf_counter()
+    ttfe = None
+    queued = False
+    outcome = 'incomplete'
+    try:
+        async with client.stream('POST', f'{base}/api/chat-stream', json=payload) as response:
+            if response.status_code != 200:
+                await response.aread()
+                outcome = 'rejected' if response.status_code == 429 else f'http_{response.status_code}'
+                recorder.add('chat_stream', outcome, time.perf_counter() - started)
+                return
+            async for line in response.aiter_lines():
+                if not line.startswith('data: '):
+                    continue
+                data = line[6:]
+                if data == '[DONE]':
+                    break
+                event = json.loads(data)
+                if event.get('event') == 'stream_started':
+                    continue
+                if event.get('event') == 'queued':
+                    queued = True
+                    continue
+                if ttfe is None:
+                    ttfe = (time.perf_counter() - started) * 1000
+                if event.get('event') == 'error':
+                    outcome = 'upstream_error'
+                elif event.get('event') == 'message_end' and 'full_answer' in event:
+                    # 上流の message_end の後に送られる、アプリの message_id を含む最終イベント
+                    outcome = 'ok'
+                    state['message_ids'].append(event['message_id'])
+    except httpx.HTTPError as e:
+        outcome = f'exception_{type(e).__name__}'
+    recorder.add('chat_stream', outcome, time.perf_counter() - started, ttfe=ttfe, queued=queued)
+
+
+async def _get(client: httpx.AsyncClient, url: str, endpoint: str, recorder: Recorder):
+    started = time.perf_counter()
+    try:
+        response = await client.get(url)
+        outcome = {200: 'ok', 202: 'pending'}.get(response.status_code, f'http_{response.status_code}')
+    except httpx.HTTPError as e:
+        outcome = f'exception_{type(e).__name__}'
+    recorder.add(endpoint, outcome, time.perf_counter() - started)
+
+
+async def _user(client: httpx.AsyncClient, base: str, index: int, deadline: float, recorder: Recorder, args):
+    """仮想ユーザー（deadline まで重み付きでリクエストを繰り返す）"""
+    state = {'user': index, 'turns': 0, 'message_ids': []}
+    names, weights = zip(*args.mix.items())
+    while time.perf_counter() < deadline:
+        action = random.choices(names, weights)[0]
+        if action == 'analysis' and not state['message_ids']:
+            action = 'chat_stream'
+        if action == 'chat_stream':
+            await _chat(client, base, state, recorder, args)
+        elif action == 'conversations':
+            await _get(client, f'{base}/api/conversations?limit=50', 'conversations', recorder)
+        else:
+            message_id = random.choice(state['message_ids'])
+            await _get(client, f'{base}/api/messages/{message_id}/analysis', 'analysis', recorder)
+        if args.think:
+            await asyncio.sleep(random.uniform(0, 2 * args.think))
+
+
+def _server_phases(text: str) -> Dict[str, float]:
+    """/metrics からフェーズ別の平均（ミリ秒、全アプリ合計）"""
+    sums: Dict[str, float] = {}
+    counts: Dict[str, float] = {}
+    for line in text.splitlines():
+        match = PHASE_LINE.match(line)
+        if match:
+            target = sums if match.group(1) == 'sum' else counts
+            target[match.group(2)] = target.get(match.group(2), 0.0) + float(match.group(3))
+    return {phase: round(sums.get(phase, 0.0) / count * 1000, 3) for phase, count in sorted(counts.items()) if count}
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CHATBOT_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def _drive(base: str, args) -> Dict[str, Any]:
+    """仮想ユーザーを走らせてレポートを作る"""
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=args.users * 2, max_keepalive_connections=args.users)
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout)) as client:
+        started = time.perf_counter()
+        deadline = started + args.duration
+        await asyncio.gather(*[_user(client, base, i, deadline, recorder, args) for i in range(args.users)])
+        elapsed = time.perf_counter() - started
+        try:
+            phases = _server_phases((await client.get(f'{base}/metrics')).text)
+        except httpx.HTTPError:
+            phases = {}
+    return {'elapsed_seconds': round(elapsed, 2), 'endpoints': recorder.summary(elapsed), 'server_phases_ms': phases}
+
+
+async def _run(args) -> Dict[str, Any]:
+    meta = {
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'args': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'json')},
+    }
+    if args.base_url:
+        report = await _drive(args.base_url.rstrip('/'), args)
+        return {'meta': meta, **report, 'upstream': None}
+    
+    fake = FakeDifyServer(
+        tokens=args.tokens, interval=1.0 / args.token_rate, token_chars=args.token_chars,
+        write_size=args.write_size, resources=args.resources, resource_chars=args.resource_chars,
+        error_rate=args.error_rate, error_mode=args.error_mode, stall_rate=args.stall_rate,
+        stall_seconds=args.stall_seconds, seed=args.seed,
+    )
+    fake_port = _free_port()
+    app_port = _free_port()
+    listener = await fake.start('127.0.0.1', fake_port)
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-load-')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{os.path.join(tmpdir, 'load.db')}",
+        DIFY_API_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        DIFY_API_KEY_SAMPLE1=os.getenv('DIFY_API_KEY_SAMPLE1', 'fake-key'),
+        DIFY_API_KEY_SAMPLE2=os.getenv('DIFY_API_KEY_SAMPLE2', 'fake-key'),
+    )
+    server_log = open(os.path.join(tmpdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(app_port),
+         '--log-level', 'warning', '--backlog', '4096'],
+        cwd=CHATBOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT,
+    )
+    try:
+        await _wait_for_port(app_port)
+        report = await _drive(f'http://127.0.0.1:{app_port}', args)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        server_log.close()
+        listener.close()
+        await listener.wait_closed()
+    return {'meta': meta, **report, 'upstream': fake.stats()}
+
+
+def _lookup(summary: Dict[str, Any], path: str) -> Optional[float]:
+    value: Any = summary
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def compare(baseline: Dict[str, Any], report: Dict[str, Any]) -> List[str]:
+    """以前のレポートとの差分（悪化した指標には ! を付ける）"""
+    lines = [f"比較: {baseline['meta'].get('git_commit')} ({baseline['meta'].get('started_at')}) → "
+             f"{report['meta'].get('git_commit')} ({report['meta'].get('started_at')})"]
+    for endpoint in ENDPOINTS:
+        old, new = baseline['endpoints'].get(endpoint), report['endpoints'].get(endpoint)
+        if not old or not new:
+            continue
+        for path, higher_is_worse in COMPARED_METRICS:
+            before, after = _lookup(old, path), _lookup(new, path)
+            if before is None or after is None:
+                continue
+            worse = (after > before) if higher_is_worse else (after < before)
+            if before:
+                change = (after - before) / before * 100
+                mark, delta = ('!' if worse and abs(change) >= 10 else ' '), f'{change:+6.1f}%'
+            else:
+                mark, delta = ('!' if worse else ' '), '   新規' if after else '    ±0'
+            lines.append(f"  {mark} {endpoint:13s} {path:16s} {before:10.4g} → {after:10.4g} ({delta})")
+    return lines
+
+
+def _print_report(report: Dict[str, Any]):
+    args = report['meta']['args']
+    print(f"仮想ユーザー {args['users']} 人 x {report['elapsed_seconds']} 秒（{report['meta'].get('git_commit')}）")
+    for endpoint, summary in report['endpoints'].items():
+        latency = summary['latency_ms']
+        line = (
+            f"  {endpoint:13s} {summary['requests']:6d} 件  {summary['throughput_rps']:8.2f} req/s  "
+            f"エラー率 {summary['error_rate'] * 100:5.1f}%  "
+            f"p50 {latency['p50']:8.1f}ms p95 {latency['p95']:8.1f}ms p99 {latency['p99']:8.1f}ms"
+        )
+        if 'ttfe_ms' in summary:
+            line += f"  TTFE p50 {summary['ttfe_ms']['p50']:.1f}ms p99 {summary['ttfe_ms']['p99']:.1f}ms"
+        print(line)
+        failures = {key: value for key, value in summary['outcomes'].items() if key not in ('ok', 'pending')}
+        if failures:
+            print(f"  {'':13s} 内訳: {failures}")
+    if report['upstream']:
+        print(f"  疑似 Dify: {report['upstream']}")
+    if report['server_phases_ms']:
+        print('  サーバー側のフェーズ平均: ' + ', '.join(f'{k} {v:.1f}ms' for k, v in report['server_phases_ms'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='エンドツーエンドの負荷試験')
+    parser.add_argument('--users', type=int, default=20, help='仮想ユーザー数（同時リクエスト数）')
+    parser.add_argument('--duration', type=float, default=30.0, help='実行秒数')
+    parser.add_argument('--mix', type=_parse_mix, default=_parse_mix('chat=6,conversations=3,analysis=1'),
+                        help='リクエストの重み（chat / conversations / analysis）')
+    parser.add_argument('--think', type=float, default=0.0, help='リクエスト間の平均待ち秒数')
+    parser.add_argument('--apps', type=lambda v: [int(x) for x in v.split(',')], default=[1, 2],
+                        help='質問先の DifyアプリID（カンマ区切り）')
+    parser.add_argument('--timeout', type=float, default=120.0, help='1リクエストのタイムアウト秒数')
+    parser.add_argument('--base-url', help='起動済みのインスタンス（省略時は疑似 Dify と uvicorn を起動）')
+    parser.add_argument('--tokens', type=int, default=20, help='1応答の message イベント数')
+    parser.add_argument('--token-rate', type=float, default=20.0, help='上流の1秒あたりのイベント数')
+    parser.add_argument('--token-chars', type=int, default=0, help='message イベント1件の answer の文字数')
+    parser.add_argument('--write-size', type=int, default=0, help='上流の1回の書き込みバイト数')
+    parser.add_argument('--resources', type=int, default=3, help='message_end の retriever_resources の件数')
+    parser.add_argument('--resource-chars', type=int, default=0, help='retriever_resources の content の文字数')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='上流でエラーを起こす割合')
+    parser.add_argument('--error-mode', choices=(ERROR_MIXED, ERROR_HTTP, ERROR_EVENT), default=ERROR_MIXED)
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='上流の受信が途中で止まる割合')
+    parser.add_argument('--stall-seconds', type=float, default=5.0, help='受信が止まる秒数')
+    parser.add_argument('--seed', type=int, default=None, help='乱数シード（リクエストの選択と注入）')
+    parser.add_argument('--output', help='レポートの JSON を書き出すファイル')
+    parser.add_argument('--compare', help='差分を表示する以前のレポート（JSON）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    
+    report = asyncio.run(_run(args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        _print_report(report)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print('\n'.join(compare(json.load(f), report)))
+
+
+if __name__ == '__main__':
+    main()
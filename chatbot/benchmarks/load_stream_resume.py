@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+チャットストリームの切断・再接続の負荷試験
+
+疑似 Dify サーバー（このプロセス内）と uvicorn（ASGI版）を起動し、N 本のストリームを
+途中で切断して Last-Event-ID で再接続する。以下を確認・計測する。
+
+- 再接続で受け取ったイベントに欠落・重複がなく、回答が最後まで揃うか
+- 再接続せずに切断したままのストリームも、アシスタントメッセージが保存されるか
+- 再接続から最初のイベントまでの時間、バッファの使用量（/api/stats/turn-streams）
+
+データベースは一時ディレクトリに作成するため、既存の database.db には触れない。
+
+使い方:
+    python benchmarks/load_stream_resume.py --streams 50 --disconnect-after 5
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHATBOT_DIR, 'benchmarks'))
+
+from fake_dify_server import FakeDifyServer  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def _wait_for_port(port: int, timeout: float = 20.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise RuntimeError(f"ポート {port} が起動しませんでした")
+
+
+async def _read_events(response, state: dict, limit: int = 0) -> bool:
+    """SSE を読み、id と data を state に蓄積（limit 件で打ち切り。最後まで読めたら True）"""
+    event_id = None
+    async for line in response.aiter_lines():
+        if line.startswith('id: '):
+            event_id = line[4:]
+        elif line.startswith('data: '):
+            state['ids'].append(event_id)
+            state['stamps'].append(time.perf_counter())
+            state['last_event_id'] = event_id
+            data = line[6:]
+            if data == '[DONE]':
+                return True
+            event = json.loads(data)
+            if event.get('event') == 'stream_started':
+                state['stream_id'] = event.get('stream_id')
+                state['message_id'] = event.get('message_id')
+            elif event.get('event') == 'message':
+                state['answer'] += event.get('answer', '')
+            if limit and len(state['ids']) >= limit:
+                return False
+    return False
+
+
+async def _one_stream(client: httpx.AsyncClient, base: str, index: int, args) -> dict:
+    """途中で切断し、必要なら再接続して最後まで受信"""
+    state = {'ids': [], 'stamps': [], 'answer': '', 'last_event_id': None, 'stream_id': None, 'message_id': None}
+    payload = {'message': f'再接続試験 {index}', 'dify_app_id': 1}
+    async with client.stream('POST', f'{base}/api/chat-stream', json=payload) as response:
+        await _read_events(response, state, args.disconnect_after)
+    # ここで接続を閉じる（サーバー側では上流の受信が続く）
+    # ストリームIDは最初のイベント（stream_started）で受け取る
+    stream_id = state['stream_id']
+    abandoned = index % args.abandon_every == 0 if args.abandon_every else False
+    if abandoned:
+        return {'message_id': state['message_id'], 'abandoned': True}
+    
+    await asyncio.sleep(args.reconnect_delay)
+    started = time.perf_counter()
+    received = len(state['ids'])
+    async with client.stream('GET', f'{base}/api/chat-stream/{stream_id}',
+                             headers={'Last-Event-ID': state['last_event_id']}) as response:
+        if response.status_code != 200:
+            return {'message_id': state['message_id'], 'abandoned': False, 'ok': False, 'status': response.status_code}
+        completed = await _read_events(response, state)
+    seqs = [int(event_id.rsplit('-', 1)[1]) for event_id in state['ids']]
+    first_event = state['stamps'][received] - started if len(state['stamps']) > received else 0.0
+    return {
+        'message_id': state['message_id'],
+        'abandoned': False,
+        'ok': completed and seqs == list(range(1, len(seqs) + 1)),
+        'answer_length': len(state['answer']),
+        'resume_ttfe': first_event * 1000,
+    }
+
+
+async def _run(args) -> dict:
+    fake = FakeDifyServer(tokens=args.tokens, interval=args.interval)
+    fake_port = _free_port()
+    app_port = _free_port()
+    listener = await fake.start('127.0.0.1', fake_port)
+    tmpdir = tempfile.mkdtemp(prefix='chatbot-resume-')
+    database = os.path.join(tmpdir, 'resume.db')
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{database}",
+        DIFY_API_BASE_URL=f'http://127.0.0.1:{fake_port}/v1',
+        DIFY_API_KEY_SAMPLE1=os.getenv('DIFY_API_KEY_SAMPLE1', 'fake-key'),
+        CHAT_MAX_CONCURRENCY='0',
+        RESPONSE_CACHE_APPS='',
+    )
+    server_log = open(os.path.join(tmpdir, 'server.log'), 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', str(app_port), '--log-level', 'warning'],
+        cwd=CHATBOT_DIR, env=env, stdout=server_log, stderr=subprocess.STDOUT,
+    )
+    base = f'http://127.0.0.1:{app_port}'
+    limits = httpx.Limits(max_connections=args.streams * 2, max_keepalive_connections=args.streams)
+    try:
+        await _wait_for_port(app_port)
+        async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(120.0)) as client:
+            results = await asyncio.gather(*[_one_stream(client, base, i, args) for i in range(args.streams)])
+            buffer_stats = (await client.get(f'{base}/api/stats/turn-streams')).json()
+            # 切断したままのストリームの保存を待つ
+            await asyncio.sleep((args.tokens + 2) * args.interval + 1.0)
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+        server_log.close()
+        listener.close()
+        await listener.wait_closed()
+    
+    with sqlite3.connect(database) as connection:
+        saved = dict(connection.execute(
+            "SELECT id, length(content) FROM messages WHERE role = 'assistant'"
+        ).fetchall())
+    resumed = [r for r in results if not r['abandoned']]
+    abandoned = [r for r in results if r['abandoned']]
+    full_length = args.tokens * len(fake.token_text)
+    ttfe = [r['resume_ttfe'] for r in resumed if r.get('ok')]
+    return {
+        'streams': args.streams,
+        'resumed': len(resumed),
+        'resumed_complete': sum(1 for r in resumed if r.get('ok') and r['answer_length'] == full_length),
+        'abandoned': len(abandoned),
+        'abandoned_saved': sum(1 for r in abandoned if saved.get(r['message_id'], 0) == full_length),
+        'resume_ttfe_ms_p50': round(statistics.median(ttfe), 1) if ttfe else 0.0,
+        'buffered_streams': buffer_stats['streams'],
+        'buffered_bytes': buffer_stats['bytes'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='チャットストリームの切断・再接続の負荷試験')
+    parser.add_argument('--streams', type=int, default=50, help='同時ストリーム数')
+    parser.add_argument('--disconnect-after', type=int, default=5, help='切断するまでに受け取るイベント数')
+    parser.add_argument('--reconnect-delay', type=float, default=0.3, help='再接続までの秒数')
+    parser.add_argument('--abandon-every', type=int, default=5, help='N 本に1本は再接続しない（0 なら全て再接続）')
+    parser.add_argument('--tokens', type=int, default=20, help='1応答の message イベント数')
+    parser.add_argument('--interval', type=float, default=0.05, help='上流イベント間隔（秒）')
+    parser.add_argument('--json', action='store_true', help='結果をJSONで出力')
+    args = parser.parse_args()
+    
+    report = asyncio.run(_run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(
+        f"{report['streams']} 本を {args.disconnect_after} イベント受信後に切断: "
+        f"再接続 {report['resumed']} 本中 欠落なしで完了 {report['resumed_complete']} 本 "
+        f"(再接続後の最初のイベント p50 {report['resume_ttfe_ms_p50']}ms)、"
+        f"再接続なし {report['abandoned']} 本中 保存済み {report['abandoned_saved']} 本、"
+        f"バッファ {report['buffered_streams']} ターン / {report['buffered_bytes'] / 1024:.0f} KiB"
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+import logging
+from typing import List, Optional
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# trigram トークナイザで索引できない短い語（日本語では2文字の語が多い）の検索用。
+# 文字列を1文字ずつずらした2文字の組（最後の1文字を含む）を空白区切りにして
+# unicode61 トークナイザの contentless FTS5 表に登録する。
+#   2文字の語  → 同じ2文字のトークン
+#   1文字の語  → その文字で始まるトークン（prefix='1' の前方一致索引）
+#   3文字以上  → 含まれる2文字の組をすべて含む行
+# 区切り文字を含む組は短いトークンになるなど候補は元の文字列より広くなるため、
+# 呼び出し側で LIKE による確認と組み合わせて使う。
+
+BIGRAM_BLOCK = 64
+
+
+def _positions(count: str) -> str:
+    """0 から count - 1 までを key に持つ json_each（トリガー内では WITH 句の再帰が使えないため）"""
+    return f"json_each('[' || rtrim(replace(hex(zeroblob({count})), '00', '0,'), ',') || ']')"
+
+
+def bigram_sql(column: str) -> str:
+    """
+    column の2文字の組を空白区切りで連結するSQL式
+    
+    substr は先頭から文字数を数えるため、長い文字列を1文字ずつ切り出すと
+    長さの2乗に比例する。先に BIGRAM_BLOCK 文字（+ 次の組のための1文字）ずつの
+    ブロックに分けてから、ブロック内で2文字ずつ切り出す。ブロックの副問い合わせは
+    LIMIT で平坦化を止め、ブロックごとに1回だけ評価させる。
+    """
+    blocks = _positions(f"(length({column}) + {BIGRAM_BLOCK - 1}) / {BIGRAM_BLOCK}")
+    return (
+        f"(SELECT group_concat(substr(b.block, j.key + 1, 2), ' ') FROM "
+        f"(SELECT substr({column}, o.key * {BIGRAM_BLOCK} + 1, {BIGRAM_BLOCK + 1}) AS block "
+        f"FROM {blocks} o LIMIT -1) b, "
+        f"{_positions(f'min({BIGRAM_BLOCK}, length(b.block))')} j)"
+    )
+
+
+def create_bigram_table(connection, table: str, source: str, column: str, key: str = 'id') -> bool:
+    """
+    source.column の2文字の組を索引する FTS5 表と同期トリガーを作成
+    
+    表が無ければ既存の行から索引を作るため、件数に応じて時間がかかる。
+    
+    Returns:
+        bool: 作成済みまたは作成できた場合 True（FTS5 が使えなければ False）
+    """
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': table}
+    ).first() is not None
+    if not exists:
+        try:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {table} USING fts5("
+                f"{column}, content='', tokenize='unicode61', prefix='1')"
+            ))
+        except Exception as e:
+            logger.warning(f"FTS5 を利用できないため短い語の索引（{table}）を作成しません: {e}")
+            return False
+        connection.execute(text(
+            f"INSERT INTO {table} (rowid, {column}) SELECT {key}, {bigram_sql(column)} FROM {source}"
+        ))
+        logger.info(f"短い語の索引を作成しました: {table}")
+    
+    # contentless 表の削除は登録時と同じトークン列を渡す必要があるため、古い値から作り直す
+    new_value, old_value = bigram_sql(f'NEW.{column}'), bigram_sql(f'OLD.{column}')
+    for statement in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{source}_insert_{table} AFTER INSERT ON {source} BEGIN
+            INSERT INTO {table} (rowid, {column}) VALUES (NEW.{key}, {new_value});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{source}_delete_{table} AFTER DELETE ON {source} BEGIN
+            INSERT INTO {table} ({table}, rowid, {column}) VALUES ('delete', OLD.{key}, {old_value});
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{source}_update_{table} AFTER UPDATE OF {column} ON {source} BEGIN
+            INSERT INTO {table} ({table}, rowid, {column}) VALUES ('delete', OLD.{key}, {old_value});
+            INSERT INTO {table} (rowid, {column}) VALUES (NEW.{key}, {new_value});
+        END
+        """,
+    ):
+        connection.execute(text(statement))
+    return True
+
+
+def bigram_match(terms: List[str]) -> Optional[str]:
+    """
+    各語を含む行の候補を引く FTS5 のクエリ（AND 検索）
+    
+    Returns:
+        Optional[str]: クエリ。トークンになる文字（英数字・かな漢字など）を含まない語があれば None
+    """
+    parts = []
+    for term in terms:
+        if not any(char.isalnum() for char in term):
+            return None
+        if len(term) == 1:
+            parts.append('"' + term.replace('"', '""') + '"*')
+            continue
+        pairs = dict.fromkeys(term[i:i + 2] for i in range(len(term) - 1))
+        parts.extend('"' + pair.replace('"', '""') + '"' for pair in pairs if any(c.isalnum() for c in pair))
+    return ' '.join(parts)
@@ -0,0 +1,59 @@
+import logging
+from typing import List, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+VERSION_TABLE = 'dify_apps_version'
+
+_TRIGGERS = [
+    # dify_apps を変更するたびに版数を上げる（他のプロセスのレジストリが変更を検知する）
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_dify_apps_insert_version AFTER INSERT ON dify_apps BEGIN
+        UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_dify_apps_update_version AFTER UPDATE ON dify_apps BEGIN
+        UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1;
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_dify_apps_delete_version AFTER DELETE ON dify_apps BEGIN
+        UPDATE {VERSION_TABLE} SET version = version + 1 WHERE id = 1;
+    END
+    """,
+]
+
+
+def ensure_dify_apps_version(connection):
+    """Difyアプリの変更の版数（1行だけのテーブル）とトリガーを作成"""
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {VERSION_TABLE} ("
+        "id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)"
+    ))
+    connection.execute(text(f"INSERT OR IGNORE INTO {VERSION_TABLE} (id, version) VALUES (1, 0)"))
+    for statement in _TRIGGERS:
+        connection.execute(text(statement))
+
+
+def dify_apps_version(connection) -> int:
+    """現在の版数（変更の確認用。1行を主キーで読むだけ）"""
+    return connection.execute(text(f"SELECT version FROM {VERSION_TABLE} WHERE id = 1")).scalar() or 0
+
+
+def load_dify_apps(connection) -> Tuple[int, List[tuple]]:
+    """
+    版数とアプリ一覧を取得
+    
+    版数を先に読むため、間に変更が入っても次の確認で版数の違いから読み直される。
+    
+    Returns:
+        Tuple: (版数, [(id, name, description, api_key_env_name, max_concurrency, max_queue), ...])
+    """
+    version = dify_apps_version(connection)
+    rows = connection.execute(text(
+        "SELECT id, name, description, api_key_env_name, max_concurrency, max_queue FROM dify_apps ORDER BY id"
+    )).all()
+    return version, [tuple(row) for row in rows]
@@ -0,0 +1,283 @@
+import json
+import logging
+from typing import Callable, Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import text, select, delete, insert, exists
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .models import db, Message, Conversation, Keyphrase, MessageKeyphrase, KeyphraseAppCount
+from .bigram_index import create_bigram_table, bigram_match
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'keyphrases_fts'
+BIGRAM_TABLE = 'keyphrases_bigram'
+
+# trigram トークナイザは3文字未満の検索語を扱えないため、それより短い語は2文字の組の索引で引く
+FTS_MIN_QUERY_LENGTH = 3
+
+# SQLite のバインド変数上限より十分小さい単位で IN 句を分割する
+_IN_CHUNK = 500
+
+# (文書番号, キーフレーズ, 出現回数)。ResponseParser.keyphrase_rows で作る
+KeyphraseRow = Tuple[int, str, int]
+
+_TRIGGERS = [
+    # メッセージ削除（会話のカスケード削除を含む）で出現行も削除
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_messages_delete_keyphrases AFTER DELETE ON messages BEGIN
+        DELETE FROM message_keyphrases WHERE message_id = OLD.id;
+    END
+    """,
+    # アプリごとの集計を出現行の追加・削除に合わせて更新
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_message_keyphrases_insert AFTER INSERT ON message_keyphrases BEGIN
+        INSERT INTO keyphrase_app_counts (dify_app_id, keyphrase_id, count)
+        VALUES (NEW.dify_app_id, NEW.keyphrase_id, NEW.count)
+        ON CONFLICT (dify_app_id, keyphrase_id) DO UPDATE SET count = count + excluded.count;
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_message_keyphrases_delete AFTER DELETE ON message_keyphrases BEGIN
+        UPDATE keyphrase_app_counts SET count = count - OLD.count
+        WHERE dify_app_id = OLD.dify_app_id AND keyphrase_id = OLD.keyphrase_id;
+        DELETE FROM keyphrase_app_counts
+        WHERE dify_app_id = OLD.dify_app_id AND keyphrase_id = OLD.keyphrase_id AND count <= 0;
+    END
+    """,
+]
+
+_FTS_TRIGGERS = [
+    # 外部コンテンツ形式の FTS5 を keyphrases と同期
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_keyphrases_insert_fts AFTER INSERT ON keyphrases BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, phrase) VALUES (NEW.id, NEW.phrase);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_keyphrases_delete_fts AFTER DELETE ON keyphrases BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, phrase) VALUES ('delete', OLD.id, OLD.phrase);
+    END
+    """,
+]
+
+
+def _table_exists(connection, name: str) -> bool:
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': name}
+    ).first() is not None
+
+
+def ensure_keyphrase_index(connection) -> bool:
+    """
+    キーフレーズ索引用の FTS5 仮想テーブルとトリガーを作成
+    
+    FTS5（trigram トークナイザ）が使えない SQLite では全文索引を作らず、
+    検索は LIKE にフォールバックする。
+    
+    Returns:
+        bool: FTS5 索引が使える場合 True
+    """
+    for statement in _TRIGGERS:
+        connection.execute(text(statement))
+    
+    if not _table_exists(connection, FTS_TABLE):
+        try:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                f"phrase, content='keyphrases', content_rowid='id', tokenize='trigram')"
+            ))
+        except Exception as e:
+            logger.warning(f"FTS5 を利用できないためキーフレーズ検索は LIKE で行います: {e}")
+            return False
+        # 既存の辞書から索引を作り直す
+        connection.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"))
+        logger.info("キーフレーズの全文索引を作成しました")
+    
+    for statement in _FTS_TRIGGERS:
+        connection.execute(text(statement))
+    return True
+
+
+def ensure_keyphrase_bigram_index(connection) -> bool:
+    """3文字未満の検索語用の2文字の組の索引（database.bigram_index）を作成"""
+    return create_bigram_table(connection, BIGRAM_TABLE, 'keyphrases', 'phrase')
+
+
+def _keyphrase_ids(phrases: List[str]) -> Dict[str, int]:
+    """キーフレーズ辞書に登録して ID を返す"""
+    ids: Dict[str, int] = {}
+    for start in range(0, len(phrases), _IN_CHUNK):
+        chunk = phrases[start:start + _IN_CHUNK]
+        db.session.execute(
+            sqlite_insert(Keyphrase).on_conflict_do_nothing(index_elements=['phrase']),
+            [{'phrase': phrase} for phrase in chunk]
+        )
+        ids.update(db.session.execute(
+            select(Keyphrase.phrase, Keyphrase.id).where(Keyphrase.phrase.in_(chunk))
+        ).all())
+    return ids
+
+
+def index_message_keyphrases(message_id: int, conversation_id: int, dify_app_id: int,
+                             rows: List[KeyphraseRow]) -> int:
+    """
+    メッセージのキーフレーズ出現行を索引に登録（コミットは呼び出し側）
+    
+    同じメッセージを再登録した場合は置き換える。
+    
+    Returns:
+        int: 登録した出現行数
+    """
+    db.session.execute(delete(MessageKeyphrase).where(MessageKeyphrase.message_id == message_id))
+    if not rows:
+        return 0
+    
+    ids = _keyphrase_ids(list(dict.fromkeys(phrase for _, phrase, _ in rows)))
+    db.session.execute(insert(MessageKeyphrase), [
+        {
+            'message_id': message_id,
+            'document_index': document_index,
+            'keyphrase_id': ids[phrase],
+            'count': count,
+            'conversation_id': conversation_id,
+            'dify_app_id': dify_app_id,
+        }
+        for document_index, phrase, count in rows
+    ])
+    return len(rows)
+
+
+def backfill_keyphrase_index(normalize: Callable[[Dict[str, Any]], List[KeyphraseRow]],
+                             batch_size: int = 500) -> Dict[str, int]:
+    """
+    既存メッセージの keyphrase_data から索引を作成（一度だけ実行する移行用）
+    
+    索引に行が無いメッセージだけを対象にするため、途中で中断しても再実行できる。
+    アプリケーションコンテキスト内で呼び出すこと。
+    
+    Args:
+        normalize: keyphrase_data を出現行に変換する関数（ResponseParser.keyphrase_rows）
+    
+    Returns:
+        Dict[str, int]: 処理したメッセージ数と登録した出現行数
+    """
+    report = {'messages': 0, 'rows': 0}
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Message.id, Message.conversation_id, Conversation.dify_app_id, Message.keyphrase_data)
+            .join(Conversation, Conversation.id == Message.conversation_id)
+            .where(
+                Message.id > last_id,
+                Message.keyphrase_data.is_not(None),
+                ~exists().where(MessageKeyphrase.message_id == Message.id)
+            )
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        
+        for message_id, conversation_id, dify_app_id, keyphrase_data in rows:
+            try:
+                data = json.loads(keyphrase_data)
+            except ValueError:
+                logger.warning(f"キーフレーズデータを解析できません - ID: {message_id}")
+                continue
+            report['rows'] += index_message_keyphrases(message_id, conversation_id, dify_app_id, normalize(data))
+        db.session.commit()
+        report['messages'] += len(rows)
+        last_id = rows[-1][0]
+        logger.info(f"キーフレーズ索引バックフィル: {report['messages']}件")
+    
+    return report
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def search_keyphrases(session, query: str, dify_app_id: Optional[int] = None, limit: int = 20,
+                      conversations_per_phrase: int = 5) -> List[Dict[str, Any]]:
+    """
+    キーフレーズを部分一致で検索し、出現回数の多い順に引用した会話とともに返す
+    
+    Args:
+        session: 読み取り用セッション
+        query: 検索語（3文字以上は trigram、未満は2文字の組の索引で引き、どちらも使えなければ LIKE）
+        dify_app_id: 指定するとそのアプリの会話に限定
+        limit: 返すキーフレーズ数
+        conversations_per_phrase: キーフレーズごとに返す会話数（新しい順）
+    """
+    connection = session.connection()
+    bigrams = bigram_match([query]) if len(query) < FTS_MIN_QUERY_LENGTH else None
+    if len(query) >= FTS_MIN_QUERY_LENGTH and _table_exists(connection, FTS_TABLE):
+        # 検索語は1つのフレーズとして扱う（FTS5 の構文として解釈させない）
+        matched = f"SELECT rowid AS id FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match"
+        params = {'match': '"' + query.replace('"', '""') + '"'}
+    elif bigrams is not None and _table_exists(connection, BIGRAM_TABLE):
+        # 2文字の組の索引は候補が広いため辞書の語で確認する
+        matched = (
+            f"SELECT k.id FROM {BIGRAM_TABLE} b JOIN keyphrases k ON k.id = b.rowid "
+            f"WHERE {BIGRAM_TABLE} MATCH :match AND k.phrase LIKE :like ESCAPE '\\'"
+        )
+        params = {'match': bigrams, 'like': f"%{_escape_like(query)}%"}
+    else:
+        matched = "SELECT id FROM keyphrases WHERE phrase LIKE :like ESCAPE '\\'"
+        params = {'like': f"%{_escape_like(query)}%"}
+    
+    app_filter = "WHERE c.dify_app_id = :dify_app_id" if dify_app_id is not None else ""
+    params.update({'dify_app_id': dify_app_id, 'limit': limit})
+    phrases = connection.execute(text(f"""
+        SELECT k.id, k.phrase, SUM(c.count) AS total
+        FROM ({matched}) m
+        JOIN keyphrase_app_counts c ON c.keyphrase_id = m.id
+        JOIN keyphrases k ON k.id = m.id
+        {app_filter}
+        GROUP BY k.id
+        ORDER BY total DESC, k.id
+        LIMIT :limit
+    """), params).all()
+    
+    results = []
+    conversation_ids = set()
+    for keyphrase_id, phrase, total in phrases:
+        # (keyphrase_id, conversation_id) のインデックスだけで新しい会話から取り出す
+        statement = (
+            select(MessageKeyphrase.conversation_id)
+            .where(MessageKeyphrase.keyphrase_id == keyphrase_id)
+            .distinct()
+            .order_by(MessageKeyphrase.conversation_id.desc())
+            .limit(conversations_per_phrase)
+        )
+        if dify_app_id is not None:
+            statement = statement.where(MessageKeyphrase.dify_app_id == dify_app_id)
+        cited = session.execute(statement).scalars().all()
+        conversation_ids.update(cited)
+        results.append({'keyphrase_id': keyphrase_id, 'phrase': phrase, 'count': total, 'conversation_ids': cited})
+    
+    titles = {}
+    if conversation_ids:
+        titles = dict(session.execute(
+            select(Conversation.id, db.func.coalesce(Conversation.preview_title, Conversation.title))
+            .where(Conversation.id.in_(conversation_ids))
+        ).all())
+    for result in results:
+        result['conversations'] = [
+            {'id': conversation_id, 'title': titles.get(conversation_id)}
+            for conversation_id in result.pop('conversation_ids')
+        ]
+    return results
+
+
+def top_keyphrases(session, dify_app_id: int, limit: int = 20) -> List[Dict[str, Any]]:
+    """Difyアプリごとの出現回数上位のキーフレーズ"""
+    rows = session.execute(
+        select(Keyphrase.id, Keyphrase.phrase, KeyphraseAppCount.count)
+        .join(Keyphrase, Keyphrase.id == KeyphraseAppCount.keyphrase_id)
+        .where(KeyphraseAppCount.dify_app_id == dify_app_id)
+        .order_by(KeyphraseAppCount.count.desc())
+        .limit(limit)
+    ).all()
+    return [{'keyphrase_id': keyphrase_id, 'phrase': phrase, 'count': count} for keyphrase_id, phrase, count in rows]
@@ -0,0 +1,256 @@
+import html
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import text, select
+
+from .models import db, Conversation, DifyApp
+from .bigram_index import create_bigram_table, bigram_match
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = 'messages_fts'
+BIGRAM_TABLE = 'messages_bigram'
+
+# trigram トークナイザは3文字未満の語を検索できないため、短い語を含む検索は2文字の組の索引で行う
+FTS_MIN_TERM_LENGTH = 3
+
+# スニペットのハイライト位置（HTMLエスケープ後に <mark> へ置き換える）
+_MARK_START = '\ue000'
+_MARK_END = '\ue001'
+SNIPPET_TOKENS = 32
+
+# 一致件数がこれを超える語（ほぼ全メッセージに現れる語など）は新しい方からこの件数だけを
+# 関連度計算の対象にする（bm25 は一致した全行で計算されるため）
+RANK_CANDIDATE_LIMIT = 20000
+# 2文字の組の索引は1〜2文字の語で引くため一致件数が多くなりやすく、候補をさらに絞る
+BIGRAM_CANDIDATE_LIMIT = 5000
+
+_FTS_TRIGGERS = [
+    # 外部コンテンツ形式の FTS5 を messages と同期（会話削除のカスケードも DELETE として届く）
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_insert_fts AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE} (rowid, content) VALUES (NEW.id, NEW.content);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_delete_fts AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+    END
+    """,
+    # アシスタントメッセージは空で作成して message_end 後に内容を書き込む
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_messages_update_fts AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        INSERT INTO {FTS_TABLE} (rowid, content) VALUES (NEW.id, NEW.content);
+    END
+    """,
+]
+
+
+def _table_exists(connection, name: str) -> bool:
+    return connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE name = :name"), {'name': name}
+    ).first() is not None
+
+
+def ensure_message_search(connection) -> bool:
+    """
+    会話履歴検索用の FTS5 仮想テーブルとトリガーを作成
+    
+    既存DBでは初回に messages から索引を作り直すため、件数に応じて時間がかかる。
+    
+    Returns:
+        bool: FTS5 索引が使える場合 True（使えなければ検索は LIKE で行う）
+    """
+    if not _table_exists(connection, FTS_TABLE):
+        try:
+            connection.execute(text(
+                f"CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5("
+                f"content, content='messages', content_rowid='id', tokenize='trigram')"
+            ))
+        except Exception as e:
+            logger.warning(f"FTS5 を利用できないため会話検索は LIKE で行います: {e}")
+            return False
+        connection.execute(text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')"))
+        logger.info("会話履歴の全文索引を作成しました")
+    
+    for statement in _FTS_TRIGGERS:
+        connection.execute(text(statement))
+    return True
+
+
+def ensure_message_bigram_index(connection) -> bool:
+    """
+    3文字未満の語を含む検索用の2文字の組の索引（database.bigram_index）を作成
+    
+    Returns:
+        bool: 索引が使える場合 True（使えなければ短い語の検索は LIKE で行う）
+    """
+    return create_bigram_table(connection, BIGRAM_TABLE, 'messages', 'content')
+
+
+def split_terms(query: str) -> List[str]:
+    """検索語を空白（全角を含む）で分割"""
+    return query.replace('　', ' ').split()
+
+
+def _match_expression(terms: List[str]) -> str:
+    """各語をフレーズとして AND 検索する FTS5 のクエリ（FTS5 の構文として解釈させない）"""
+    return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+
+def _escape_like(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _highlight(snippet: str) -> str:
+    """スニペットをHTMLエスケープしてハイライト位置を <mark> にする"""
+    return html.escape(snippet).replace(_MARK_START, '<mark>').replace(_MARK_END, '</mark>')
+
+
+def _like_snippet(content: str, terms: List[str], width: int = SNIPPET_TOKENS) -> str:
+    """LIKE 検索時のスニペット（最初に一致した語の前後を切り出す）"""
+    lowered = content.lower()
+    position = min((lowered.find(term.lower()) for term in terms if term.lower() in lowered), default=0)
+    start = max(0, position - width // 4)
+    excerpt = content[start:start + width]
+    marked = html.escape(excerpt)
+    for term in terms:
+        escaped = html.escape(term)
+        marked = marked.replace(escaped, f'<mark>{escaped}</mark>')
+    return ('…' if start > 0 else '') + marked + ('…' if start + width < len(content) else '')
+
+
+def search_conversations(session, query: str, dify_app_id: Optional[int] = None,
+                         limit: int = 20, offset: int = 0) -> Tuple[List[Dict[str, Any]], bool]:
+    """
+    メッセージ本文を全文検索し、一致した会話を関連度順に返す
+    
+    会話ごとに最も関連度の高いメッセージ（bm25）を代表にし、そのスニペットを付ける。
+    空白区切りの語はすべて含むメッセージだけが一致する。一致件数が
+    RANK_CANDIDATE_LIMIT を超える場合は新しいメッセージだけが対象になる。
+    3文字未満の語を含む検索は2文字の組の索引で候補を絞り、LIKE で確認する
+    （関連度はその索引での bm25、対象は新しい方から BIGRAM_CANDIDATE_LIMIT 件）。どちらの索引も使えない語は LIKE で新しい順に探す。
+    
+    Args:
+        session: 読み取り用セッション
+        query: 検索語
+        dify_app_id: 指定するとそのアプリの会話に限定
+        limit / offset: ページング
+    
+    Returns:
+        Tuple[List[Dict[str, Any]], bool]: (検索結果, 次のページがあるか)
+    """
+    terms = split_terms(query)
+    if not terms:
+        return [], False
+    connection = session.connection()
+    
+    # 使う索引（trigram / 2文字の組）と MATCH のクエリ。どちらも使えなければ LIKE
+    fts_table, match = None, None
+    if min(len(term) for term in terms) >= FTS_MIN_TERM_LENGTH:
+        if _table_exists(connection, FTS_TABLE):
+            fts_table, match = FTS_TABLE, _match_expression(terms)
+    else:
+        match = bigram_match(terms)
+        if match is not None and _table_exists(connection, BIGRAM_TABLE):
+            fts_table = BIGRAM_TABLE
+    
+    params: Dict[str, Any] = {'limit': limit + 1, 'offset': offset, 'dify_app_id': dify_app_id}
+    like_conditions = []
+    for index, term in enumerate(terms):
+        params[f'term{index}'] = f"%{_escape_like(term)}%"
+        like_conditions.append(f"content LIKE :term{index} ESCAPE '\\'")
+    app_filter = "AND c.dify_app_id = :dify_app_id" if dify_app_id is not None else ""
+    if fts_table is not None:
+        params['match'] = match
+        floor = connection.execute(text(
+            f"SELECT rowid FROM {fts_table} WHERE {fts_table} MATCH :match "
+            f"ORDER BY rowid DESC LIMIT 1 OFFSET :candidates"
+        ), {'match': match, 'candidates': BIGRAM_CANDIDATE_LIMIT if fts_table == BIGRAM_TABLE else RANK_CANDIDATE_LIMIT}).scalar()
+        params['floor'] = floor or 0
+        # 2文字の組の索引は候補が広いため本文で確認する
+        verify = ''.join(f" AND m.{condition}" for condition in like_conditions) if fts_table == BIGRAM_TABLE else ''
+        # MIN() と同じ行の値を返す SQLite の集約仕様で、代表メッセージの ID も取り出す
+        statement = f"""
+            SELECT m.conversation_id, f.rowid AS message_id, MIN(f.rank) AS score, COUNT(*) AS hits
+            FROM {fts_table} f
+            JOIN messages m ON m.id = f.rowid
+            JOIN conversations c ON c.id = m.conversation_id
+            WHERE {fts_table} MATCH :match AND f.rowid > :floor{verify} {app_filter}
+            GROUP BY m.conversation_id
+            ORDER BY score, m.conversation_id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    else:
+        conditions = list(like_conditions)
+        if dify_app_id is not None:
+            conditions.append("conversation_id IN (SELECT id FROM conversations WHERE dify_app_id = :dify_app_id)")
+        params['candidates'] = RANK_CANDIDATE_LIMIT
+        # 関連度は計算できないため新しいメッセージを代表にして新しい会話から並べる
+        # （新しい方から走査し、一致が多い語は候補数に達した時点で打ち切る）
+        statement = f"""
+            SELECT m.conversation_id, MAX(m.id) AS message_id, NULL AS score, COUNT(*) AS hits
+            FROM (
+                SELECT id, conversation_id FROM messages
+                WHERE {' AND '.join(conditions)}
+                ORDER BY id DESC LIMIT :candidates
+            ) m
+            GROUP BY m.conversation_id
+            ORDER BY message_id DESC
+            LIMIT :limit OFFSET :offset
+        """
+    rows = connection.execute(text(statement), params).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if not rows:
+        return [], False
+    
+    message_ids = [row.message_id for row in rows]
+    placeholders = ', '.join(f':id{i}' for i in range(len(message_ids)))
+    id_params = {f'id{i}': message_id for i, message_id in enumerate(message_ids)}
+    if fts_table == FTS_TABLE:
+        # スニペットは表示する代表メッセージの分だけ作る
+        snippets = dict(connection.execute(text(
+            f"SELECT rowid, snippet({FTS_TABLE}, 0, :mark_start, :mark_end, '…', {SNIPPET_TOKENS}) "
+            f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match AND rowid IN ({placeholders})"
+        ), {'match': params['match'], 'mark_start': _MARK_START, 'mark_end': _MARK_END, **id_params}).all())
+        snippets = {message_id: _highlight(snippet) for message_id, snippet in snippets.items()}
+    else:
+        contents = connection.execute(
+            text(f"SELECT id, content FROM messages WHERE id IN ({placeholders})"), id_params
+        ).all()
+        snippets = {message_id: _like_snippet(content, terms) for message_id, content in contents}
+    
+    conversations = {
+        row.id: row for row in session.execute(
+            select(
+                Conversation.id,
+                Conversation.preview_title,
+                Conversation.created_at,
+                Conversation.updated_at,
+                DifyApp.name.label('dify_app_name'),
+            )
+            .outerjoin(DifyApp, DifyApp.id == Conversation.dify_app_id)
+            .where(Conversation.id.in_([row.conversation_id for row in rows]))
+        )
+    }
+    
+    results = []
+    for row in rows:
+        conversation = conversations.get(row.conversation_id)
+        if conversation is None:
+            continue
+        results.append({
+            'id': conversation.id,
+            'title': conversation.preview_title or "空の会話",
+            'dify_app_name': conversation.dify_app_name or 'Unknown App',
+            'created_at': conversation.created_at.isoformat(),
+            'updated_at': conversation.updated_at.isoformat(),
+            'message_id': row.message_id,
+            'hits': row.hits,
+            'score': row.score,
+            'snippet_html': snippets.get(row.message_id, ''),
+        })
+    return results, has_more
@@ -0,0 +1,213 @@
+import time
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Any, List, NamedTuple, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from .models import db
+from .schema import ensure_columns
+from .keyphrase_index import ensure_keyphrase_index, ensure_keyphrase_bigram_index
+from .message_search import ensure_message_search, ensure_message_bigram_index
+from .retention import prepare_auto_vacuum, AUTO_VACUUM_INCREMENTAL
+from .dify_apps import ensure_dify_apps_version
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Any], Any]
+    # False のものはトランザクションの外で実行する（トランザクション内では効かない PRAGMA など）
+    transactional: bool = True
+
+
+def _auto_vacuum(connection):
+    if prepare_auto_vacuum(connection):
+        # journal_mode=WAL などを接続時に設定したDBは空でもヘッダーが書かれているため、
+        # PRAGMA だけでは反映されない。テーブルが無いうちは VACUUM しても一瞬で終わる
+        if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != AUTO_VACUUM_INCREMENTAL:
+            connection.exec_driver_sql("VACUUM")
+
+
+def _create_tables(connection):
+    db.metadata.create_all(connection)
+
+
+def _create_indexes(connection):
+    for statement in (
+        "CREATE INDEX IF NOT EXISTS idx_conversations_dify_app_id ON conversations(dify_app_id)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_created_at ON conversations(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_conversation_id ON messages(conversation_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_conversations_updated_at_id ON conversations(updated_at, id)",
+    ):
+        connection.execute(text(statement))
+
+
+def _seed_dify_apps(connection):
+    if connection.execute(text("SELECT COUNT(*) FROM dify_apps")).scalar():
+        return
+    now = datetime.utcnow()
+    connection.execute(
+        text("INSERT INTO dify_apps (name, description, api_key_env_name, created_at, updated_at) "
+             "VALUES (:name, :description, :api_key_env_name, :now, :now)"),
+        [
+            {'name': f'sample{i}', 'description': f'Sample Dify Application {i}',
+             'api_key_env_name': f'DIFY_API_KEY_SAMPLE{i}', 'now': now}
+            for i in (1, 2, 3)
+        ],
+    )
+    logger.info("初期Difyアプリデータを作成しました")
+
+
+# バージョン順に適用する。導入前のDBはどこまで反映済みか分からないため、
+# 1〜7 は既に反映済みでも安全に再実行できるように書いてある。
+# スキーマを変更する場合は create_all やここの既存の移行を書き換えず、末尾に追加すること。
+MIGRATIONS: List[Migration] = [
+    # 新規DBは incremental_vacuum を使えるように作成（既存DBは run_retention.py で変換）
+    Migration(1, 'auto_vacuum', _auto_vacuum, transactional=False),
+    Migration(2, 'create_tables', _create_tables),
+    # create_all は既存テーブルに列を追加しないため、後から追加した列を反映
+    Migration(3, 'added_columns', ensure_columns),
+    Migration(4, 'indexes', _create_indexes),
+    Migration(5, 'keyphrase_index', ensure_keyphrase_index),
+    Migration(6, 'message_search', ensure_message_search),
+    Migration(7, 'seed_dify_apps', _seed_dify_apps),
+    # Difyアプリのレジストリ（utils/app_registry.py）が変更を検知するための版数
+    Migration(8, 'dify_apps_version', ensure_dify_apps_version),
+    # trigram で引けない3文字未満の語の索引（会話検索・キーフレーズ検索）
+    Migration(9, 'message_search_bigram', ensure_message_bigram_index),
+    Migration(10, 'keyphrase_bigram', ensure_keyphrase_bigram_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _applied_versions(connection) -> List[int]:
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': SCHEMA_VERSION_TABLE}
+    ).first()
+    if not exists:
+        return []
+    return [row[0] for row in connection.execute(text(f"SELECT version FROM {SCHEMA_VERSION_TABLE}"))]
+
+
+def current_version(connection) -> int:
+    """適用済みの最新バージョン（未導入のDBは 0）"""
+    return max(_applied_versions(connection), default=0)
+
+
+def _record(connection, migration: Migration, seconds: float):
+    connection.execute(text(
+        f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} ("
+        "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at DATETIME NOT NULL, duration_ms REAL)"
+    ))
+    connection.execute(
+        text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version, name, applied_at, duration_ms) "
+             "VALUES (:version, :name, :applied_at, :duration_ms)"),
+        {'version': migration.version, 'name': migration.name, 'applied_at': datetime.utcnow(),
+         'duration_ms': round(seconds * 1000, 3)},
+    )
+
+
+def migrate(engine: Engine, target: Optional[int] = None) -> Dict[str, Any]:
+    """
+    未適用の移行をバージョン順に適用
+    
+    最新まで適用済みなら schema_version を1回読むだけで戻る。適用は1件ずつ
+    BEGIN IMMEDIATE で書き込みロックを取ってから未適用かを確認し直すため、
+    複数のワーカーが同時に起動しても同じ移行が二重に実行されることはない
+    （後から来たワーカーは先のワーカーのコミットを待ってから何もせずに進む）。
+    
+    Args:
+        engine: 書き込み側のエンジン
+        target: このバージョンまで適用（省略時は最新まで）
+    
+    Returns:
+        Dict: version（適用後のバージョン）, applied（今回適用した移行名）, seconds
+    """
+    started = time.perf_counter()
+    target = LATEST_VERSION if target is None else target
+    applied: List[str] = []
+    
+    with engine.connect() as connection:
+        versions = set(_applied_versions(connection))
+        connection.rollback()
+        pending = [migration for migration in MIGRATIONS
+                   if migration.version <= target and migration.version not in versions]
+        
+        for migration in pending:
+            step_started = time.perf_counter()
+            if not migration.transactional:
+                # 他のワーカーと重なっても害のないものだけをここに置く
+                migration.apply(connection)
+                connection.commit()
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                if migration.version in _applied_versions(connection):
+                    connection.rollback()
+                    continue
+                if migration.transactional:
+                    migration.apply(connection)
+                _record(connection, migration, time.perf_counter() - step_started)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                logger.error(f"スキーマ移行に失敗しました: {migration.version} {migration.name}")
+                raise
+            applied.append(migration.name)
+            logger.info(f"スキーマ移行を適用: {migration.version} {migration.name} "
+                        f"({(time.perf_counter() - step_started) * 1000:.1f}ms)")
+        
+        version = current_version(connection)
+    
+    return {'version': version, 'applied': applied, 'seconds': time.perf_counter() - started}
+
+
+def migration_status(engine: Engine) -> List[Dict[str, Any]]:
+    """移行ごとの適用状況（CLI の表示用）"""
+    with engine.connect() as connection:
+        rows = {}
+        if _applied_versions(connection):
+            rows = {
+                row[0]: {'applied_at': row[1], 'duration_ms': row[2]}
+                for row in connection.execute(
+                    text(f"SELECT version, applied_at, duration_ms FROM {SCHEMA_VERSION_TABLE}"))
+            }
+    return [
+        {'version': migration.version, 'name': migration.name, **rows.get(migration.version, {'applied_at': None})}
+        for migration in MIGRATIONS
+    ]
+
+
+def drop_all(engine: Engine):
+    """
+    全テーブル（全文索引・schema_version を含む）を削除（リセット用）
+    
+    db.drop_all はモデルのテーブルしか削除しないため、sqlite_master から
+    仮想テーブルを先に、続けて残りのテーブルを削除する。
+    """
+    with engine.connect() as connection:
+        foreign_keys = connection.exec_driver_sql("PRAGMA foreign_keys").scalar()
+        connection.exec_driver_sql("PRAGMA foreign_keys = OFF")
+        virtual = [row[0] for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND sql LIKE 'CREATE VIRTUAL TABLE%'")]
+        for name in virtual:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{name}"')
+        tables = [row[0] for row in connection.exec_driver_sql(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for name in tables:
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS "{name}"')
+        connection.commit()
+        connection.exec_driver_sql(f"PRAGMA foreign_keys = {'ON' if foreign_keys else 'OFF'}")
+
+
+def reset_database(engine: Engine) -> Dict[str, Any]:
+    """全テーブルを削除して最新まで移行し直す（migrate.py --reset / debug_db.py reset）"""
+    drop_all(engine)
+    return migrate(engine)
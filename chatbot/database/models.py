@@ -11,6 +11,9 @@ class DifyApp(db.Model):
     name = db.Column(db.String(100), nullable=False, unique=True)
     description = db.Column(db.Text)
     api_key_env_name = db.Column(db.String(100), nullable=False)
+    # 同時に上流へ流すストリーム数と待ち行列の長さ（NULL なら CHAT_MAX_CONCURRENCY / CHAT_MAX_QUEUE）
+    max_concurrency = db.Column(db.Integer)
+    max_queue = db.Column(db.Integer)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -31,6 +34,12 @@ class Conversation(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # 一覧表示用のサマリー（メッセージ保存と同じトランザクションで更新）
+    preview_title = db.Column(db.String(60))  # 最初のユーザーメッセージから生成したタイトル
+    message_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_message_at = db.Column(db.DateTime)  # 最後のメッセージ日時
+    last_token_usage = db.Column(db.Text)  # 最後のアシスタント応答のトークン使用量（JSON）
+    
     # リレーションシップ
     messages = db.relationship('Message', backref='conversation', lazy=True, cascade='all, delete-orphan')
     
@@ -45,9 +54,69 @@ class Message(db.Model):
     conversation_id = db.Column(db.Integer, db.ForeignKey('conversations.id'), nullable=False)
     role = db.Column(db.String(20), nullable=False)  # 'user' or 'assistant'
     content = db.Column(db.Text, nullable=False)
-    raw_dify_response = db.Column(db.Text)  # Raw JSON response from Dify
+    raw_dify_response = db.deferred(db.Column(db.Text))  # 旧形式の生レスポンス（未移行の行のみ。新規は message_payloads）
     keyphrase_data = db.Column(db.Text)  # 抽出されたキーフレーズデータ
+    analysis_status = db.Column(db.String(20))  # 解析ジョブの状態（pending / done / failed、NULL は導入前の行）
+    analysis_data = db.Column(db.Text)  # 解析結果（表示用サマリーと統計のJSON）
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # リレーションシップ（解析画面でのみ読み込む）
+    payload = db.relationship('MessagePayload', uselist=False, lazy='select', cascade='all, delete-orphan')
+    
     def __repr__(self):
         return f'<Message {self.role}: {self.content[:50]}...>'
+
+class MessagePayload(db.Model):
+    """Difyの生レスポンス（圧縮保存）"""
+    __tablename__ = 'message_payloads'
+    
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
+    codec = db.Column(db.String(10), nullable=False)  # 'zlib' or 'zstd'
+    raw_size = db.Column(db.Integer, nullable=False)  # 展開後のバイト数
+    data = db.Column(db.LargeBinary, nullable=False)
+    
+    def __repr__(self):
+        return f'<MessagePayload {self.message_id}: {self.codec} {len(self.data)}/{self.raw_size} bytes>'
+
+class Keyphrase(db.Model):
+    """キーフレーズ辞書（全文検索は keyphrases_fts、database/keyphrase_index.py 参照）"""
+    __tablename__ = 'keyphrases'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    phrase = db.Column(db.Text, nullable=False, unique=True)
+    
+    def __repr__(self):
+        return f'<Keyphrase {self.phrase}>'
+
+class MessageKeyphrase(db.Model):
+    """メッセージごとのキーフレーズ出現（文書番号・回数）"""
+    __tablename__ = 'message_keyphrases'
+    __table_args__ = (
+        db.Index('idx_message_keyphrases_keyphrase_conversation', 'keyphrase_id', 'conversation_id'),
+    )
+    
+    message_id = db.Column(db.Integer, db.ForeignKey('messages.id', ondelete='CASCADE'), primary_key=True)
+    document_index = db.Column(db.Integer, primary_key=True)
+    keyphrase_id = db.Column(db.Integer, db.ForeignKey('keyphrases.id'), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=1)
+    # 検索・集計用に会話とアプリを非正規化して持つ
+    conversation_id = db.Column(db.Integer, nullable=False)
+    dify_app_id = db.Column(db.Integer, nullable=False)
+    
+    def __repr__(self):
+        return f'<MessageKeyphrase {self.message_id}/{self.document_index}: {self.keyphrase_id} x{self.count}>'
+
+class KeyphraseAppCount(db.Model):
+    """Difyアプリごとのキーフレーズ出現回数（message_keyphrases のトリガーで更新）"""
+    __tablename__ = 'keyphrase_app_counts'
+    __table_args__ = (
+        db.Index('idx_keyphrase_app_counts_app_count', 'dify_app_id', 'count'),
+    )
+    
+    # 主キーはキーフレーズ検索（keyphrase_id で引く）用、上位集計は idx_keyphrase_app_counts_app_count を使う
+    keyphrase_id = db.Column(db.Integer, db.ForeignKey('keyphrases.id'), primary_key=True)
+    dify_app_id = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<KeyphraseAppCount {self.dify_app_id}/{self.keyphrase_id}: {self.count}>'
@@ -0,0 +1,138 @@
+import os
+import json
+import zlib
+import logging
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, update
+
+try:
+    import zstandard
+except ImportError:  # zstd は任意（未インストールなら zlib を使う）
+    zstandard = None
+
+from .models import db, Message, MessagePayload
+from .stream_recording import encode_stream, decode_stream, is_recording
+
+logger = logging.getLogger(__name__)
+
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def default_codec() -> str:
+    """RAW_PAYLOAD_CODEC（zstd / zlib）。未指定なら zstd が使えれば zstd"""
+    codec = os.getenv('RAW_PAYLOAD_CODEC') or ('zstd' if zstandard else 'zlib')
+    if codec == 'zstd' and zstandard is None:
+        logger.warning("zstandard がインストールされていないため zlib で圧縮します")
+        return 'zlib'
+    if codec not in ('zstd', 'zlib'):
+        raise ValueError(f"不明な圧縮方式: {codec}")
+    return codec
+
+
+def compress(raw: bytes, codec: Optional[str] = None) -> Tuple[str, bytes]:
+    """
+    バイト列を圧縮
+    
+    Returns:
+        Tuple[str, bytes]: (使用した圧縮方式, 圧縮後データ)
+    """
+    codec = codec or default_codec()
+    if codec == 'zstd':
+        # ZstdCompressor はスレッド間で共有できないため呼び出しごとに作る
+        return codec, zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+
+
+def decompress(codec: str, data: bytes) -> bytes:
+    """圧縮データを展開"""
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstd で圧縮されたデータの展開には zstandard が必要です")
+        return zstandard.ZstdDecompressor().decompress(data)
+    raise ValueError(f"不明な圧縮方式: {codec}")
+
+
+def serialize_stream(raw_response_data: List[Dict[str, Any]], offsets: Optional[List[int]] = None) -> bytes:
+    """チャンクのリストを差分形式（stream_recording）のJSONバイト列にする"""
+    recording = encode_stream(raw_response_data, offsets)
+    return json.dumps(recording, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def store_raw_response(message_id: int, raw_response_data: List[Dict[str, Any]],
+                       offsets: Optional[List[int]] = None):
+    """
+    生レスポンスを差分形式にして圧縮し、message_payloads に保存（コミットは呼び出し側）
+    
+    既に保存済みの場合は置き換える。
+    
+    Args:
+        offsets: 各チャンクの受信時刻（先頭チャンクからの経過ミリ秒）
+    """
+    raw = serialize_stream(raw_response_data, offsets)
+    codec, data = compress(raw)
+    db.session.merge(MessagePayload(message_id=message_id, codec=codec, raw_size=len(raw), data=data))
+
+
+def load_raw_response(session, message_id: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    生レスポンスを読み込む
+    
+    message_payloads に無い場合は未移行の旧形式（messages.raw_dify_response）を参照する。
+    
+    Returns:
+        Optional[List[Dict[str, Any]]]: 生レスポンス（保存されていなければ None）
+    """
+    payload = session.get(MessagePayload, message_id)
+    if payload is not None:
+        data = json.loads(decompress(payload.codec, payload.data))
+        return decode_stream(data) if is_recording(data) else data
+    
+    legacy = session.execute(
+        select(Message.raw_dify_response).where(Message.id == message_id)
+    ).scalar_one_or_none()
+    return json.loads(legacy) if legacy else None
+
+
+def migrate_inline_payloads(batch_size: int = 200) -> Dict[str, int]:
+    """
+    messages.raw_dify_response の内容を差分形式・圧縮で message_payloads へ移して元の列を NULL にする
+    
+    アプリケーションコンテキスト内で呼び出すこと。途中で中断しても再実行できる。
+    
+    Returns:
+        Dict[str, int]: 移行件数と移行前後のバイト数
+    """
+    report = {'migrated': 0, 'raw_bytes': 0, 'compressed_bytes': 0}
+    codec = default_codec()
+    while True:
+        rows = db.session.execute(
+            select(Message.id, Message.raw_dify_response)
+            .where(Message.raw_dify_response.is_not(None))
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        
+        for message_id, raw_text in rows:
+            raw = serialize_stream(json.loads(raw_text))
+            used_codec, data = compress(raw, codec)
+            db.session.add(MessagePayload(message_id=message_id, codec=used_codec, raw_size=len(raw), data=data))
+            report['raw_bytes'] += len(raw_text.encode('utf-8'))
+            report['compressed_bytes'] += len(data)
+        
+        db.session.execute(
+            update(Message)
+            .where(Message.id.in_([row[0] for row in rows]))
+            .values(raw_dify_response=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        report['migrated'] += len(rows)
+        logger.info(f"生レスポンス移行: {report['migrated']}件")
+    
+    return report
@@ -0,0 +1,268 @@
+import os
+import time
+import logging
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional
+
+from sqlalchemy import select, delete, update, func
+
+from .models import db, Conversation, Message, MessagePayload
+
+logger = logging.getLogger(__name__)
+
+# 1トランザクションで削除する会話数（書き込みロックを長く持たないように分割してコミットする）
+DELETE_BATCH_SIZE = 500
+
+# 生レスポンスの削除を1トランザクションで行うメッセージ数
+PAYLOAD_BATCH_SIZE = 2000
+
+# PRAGMA auto_vacuum の値
+AUTO_VACUUM_INCREMENTAL = 2
+
+MessageIdsCallback = Callable[[List[int]], None]
+
+
+def _conversation_filter(conversation_ids: Optional[List[int]] = None, dify_app_id: Optional[int] = None,
+                         older_than: Optional[datetime] = None) -> list:
+    """削除対象の会話の条件（指定した条件すべてに一致）"""
+    conditions = []
+    if conversation_ids is not None:
+        conditions.append(Conversation.id.in_(conversation_ids))
+    if dify_app_id is not None:
+        conditions.append(Conversation.dify_app_id == dify_app_id)
+    if older_than is not None:
+        conditions.append(Conversation.updated_at < older_than)
+    if not conditions:
+        raise ValueError("削除条件が指定されていません")
+    return conditions
+
+
+def delete_conversation_rows(session, conversation_ids: List[int]) -> Dict[str, Any]:
+    """
+    会話とその子行を集合演算の DELETE で削除（コミットは呼び出し側）
+    
+    ORM のカスケードのように子の Message を読み込まず、テーブルごとに1文で削除する。
+    キーフレーズ索引と全文索引はメッセージ削除のトリガーで更新される。
+    
+    Returns:
+        Dict: 削除した行数と削除したメッセージID（message_ids）
+    """
+    if not conversation_ids:
+        return {'conversations': 0, 'messages': 0, 'payloads': 0, 'message_ids': []}
+    
+    target_messages = select(Message.id).where(Message.conversation_id.in_(conversation_ids))
+    payloads = session.execute(
+        delete(MessagePayload).where(MessagePayload.message_id.in_(target_messages))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    message_ids = session.execute(
+        delete(Message).where(Message.conversation_id.in_(conversation_ids)).returning(Message.id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    conversations = session.execute(
+        delete(Conversation).where(Conversation.id.in_(conversation_ids))
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    return {
+        'conversations': conversations,
+        'messages': len(message_ids),
+        'payloads': payloads,
+        'message_ids': message_ids,
+    }
+
+
+def delete_conversations(conversation_ids: Optional[List[int]] = None, dify_app_id: Optional[int] = None,
+                         older_than: Optional[datetime] = None, batch_size: int = DELETE_BATCH_SIZE,
+                         on_deleted: Optional[MessageIdsCallback] = None) -> Dict[str, Any]:
+    """
+    条件に一致する会話を一括削除（アプリケーションコンテキスト内で呼び出す）
+    
+    会話ID・Difyアプリ・最終更新日時の条件は AND で組み合わせる。batch_size 件ずつ
+    削除してコミットするため、大量に削除する場合も他の書き込みを長く止めない。
+    
+    Args:
+        conversation_ids: 削除する会話ID
+        dify_app_id: 指定したDifyアプリの会話を削除
+        older_than: 最終更新がこれより前の会話を削除
+        on_deleted: コミットごとに削除したメッセージIDを受け取る関数（キャッシュ破棄用）
+    
+    Returns:
+        Dict: 削除した会話・メッセージ・生レスポンスの件数と所要時間
+    """
+    conditions = _conversation_filter(conversation_ids, dify_app_id, older_than)
+    report = {'conversations': 0, 'messages': 0, 'payloads': 0}
+    started = time.perf_counter()
+    while True:
+        ids = db.session.execute(
+            select(Conversation.id).where(*conditions).order_by(Conversation.id).limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        try:
+            deleted = delete_conversation_rows(db.session, ids)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        for key in report:
+            report[key] += deleted[key]
+        if on_deleted is not None and deleted['message_ids']:
+            on_deleted(deleted['message_ids'])
+        if len(ids) < batch_size:
+            break
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def prune_raw_payloads(older_than: datetime, batch_size: int = PAYLOAD_BATCH_SIZE,
+                       on_pruned: Optional[MessageIdsCallback] = None) -> Dict[str, Any]:
+    """
+    作成日時が older_than より前のメッセージの生レスポンスを削除（アプリケーションコンテキスト内で呼び出す）
+    
+    メッセージ本文・キーフレーズ・解析結果は残すため、解析画面は生イベント一覧なしで表示できる。
+    旧形式（messages.raw_dify_response）も NULL にする。
+    
+    Returns:
+        Dict: 削除した件数、削除したデータのバイト数、所要時間
+    """
+    report = {'payloads': 0, 'payload_bytes': 0, 'legacy_payloads': 0}
+    started = time.perf_counter()
+    # 対象範囲の上限ID（created_at のインデックスで求め、以降は主キー順に進める）
+    max_id = db.session.execute(select(func.max(Message.id)).where(Message.created_at < older_than)).scalar()
+    if max_id is None:
+        report['seconds'] = round(time.perf_counter() - started, 3)
+        return report
+    
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(MessagePayload.message_id, func.length(MessagePayload.data))
+            .join(Message, Message.id == MessagePayload.message_id)
+            .where(MessagePayload.message_id > last_id, MessagePayload.message_id <= max_id,
+                   Message.created_at < older_than)
+            .order_by(MessagePayload.message_id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        ids = [message_id for message_id, _ in rows]
+        db.session.execute(
+            delete(MessagePayload).where(MessagePayload.message_id.in_(ids))
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        report['payloads'] += len(ids)
+        report['payload_bytes'] += sum(size for _, size in rows)
+        last_id = ids[-1]
+        if on_pruned is not None:
+            on_pruned(ids)
+    
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Message.id, func.length(Message.raw_dify_response))
+            .where(Message.id > last_id, Message.id <= max_id, Message.created_at < older_than,
+                   Message.raw_dify_response.is_not(None))
+            .order_by(Message.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        ids = [message_id for message_id, _ in rows]
+        db.session.execute(
+            update(Message).where(Message.id.in_(ids)).values(raw_dify_response=None)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        report['legacy_payloads'] += len(ids)
+        report['payload_bytes'] += sum(size for _, size in rows)
+        last_id = ids[-1]
+        if on_pruned is not None:
+            on_pruned(ids)
+    
+    report['seconds'] = round(time.perf_counter() - started, 3)
+    return report
+
+
+def _pragma(connection, name: str) -> Any:
+    return connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+
+
+def database_file(bind) -> Optional[str]:
+    """接続先（Engine / Connection）のDBファイルパス（メモリDBなら None）"""
+    path = bind.engine.url.database
+    return path if path and path != ':memory:' else None
+
+
+def prepare_auto_vacuum(connection) -> bool:
+    """
+    新規DB（テーブル作成前）を auto_vacuum=INCREMENTAL にする
+    
+    既存DBの設定は VACUUM しないと変わらないため、既存DBでは何もしない
+    （convert_to_incremental_vacuum を参照）。
+    
+    Returns:
+        bool: incremental_vacuum が使える場合 True
+    """
+    tables = connection.exec_driver_sql("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'").scalar()
+    if tables == 0:
+        connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        return True
+    return _pragma(connection, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL
+
+
+def convert_to_incremental_vacuum(connection) -> Dict[str, Any]:
+    """
+    既存DBを auto_vacuum=INCREMENTAL に変換（DB全体を書き直す VACUUM を実行する）
+    
+    DBサイズに比例して時間がかかり、その間は書き込みできないため、
+    停止中に run_retention.py --enable-incremental-vacuum から実行する。
+    """
+    path = database_file(connection)
+    size_before = os.path.getsize(path) if path else None
+    started = time.perf_counter()
+    connection.exec_driver_sql("PRAGMA auto_vacuum = INCREMENTAL")
+    connection.exec_driver_sql("VACUUM")
+    return {
+        'auto_vacuum': _pragma(connection, 'auto_vacuum'),
+        'file_bytes_before': size_before,
+        'file_bytes_after': os.path.getsize(path) if path else None,
+        'seconds': round(time.perf_counter() - started, 3),
+    }
+
+
+def incremental_vacuum(connection, max_pages: Optional[int] = None) -> Dict[str, Any]:
+    """
+    空きページをファイル末尾から切り詰める（PRAGMA incremental_vacuum）
+    
+    auto_vacuum=INCREMENTAL でないDBでは実行せず、空きページ数だけ報告する。
+    
+    Args:
+        max_pages: 1回に解放するページ数の上限（None なら全て）
+    
+    Returns:
+        Dict: 有効かどうか、解放したページ数とバイト数、ファイルサイズ、所要時間
+    """
+    started = time.perf_counter()
+    page_size = _pragma(connection, 'page_size')
+    free_before = _pragma(connection, 'freelist_count')
+    report = {
+        'enabled': _pragma(connection, 'auto_vacuum') == AUTO_VACUUM_INCREMENTAL,
+        'freelist_pages_before': free_before,
+    }
+    if report['enabled'] and free_before:
+        pages = f"({int(max_pages)})" if max_pages else ""
+        # sqlite3 モジュールの execute は1ステップ（1ページ）で止まるため、最後まで実行する executescript を使う
+        connection.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum{pages}")
+        # WAL ではチェックポイントまでファイルが縮まない
+        if str(_pragma(connection, 'journal_mode')).lower() == 'wal':
+            connection.exec_driver_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    free_after = _pragma(connection, 'freelist_count')
+    path = database_file(connection)
+    report.update({
+        'freelist_pages_after': free_after,
+        'bytes_reclaimed': (free_before - free_after) * page_size,
+        'file_bytes': os.path.getsize(path) if path else None,
+        'seconds': round(time.perf_counter() - started, 3),
+    })
+    return report
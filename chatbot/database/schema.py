@@ -0,0 +1,44 @@
+import logging
+from typing import Dict, List, Tuple
+
+from sqlalchemy import text
+
+logger = logging.getLogger(__name__)
+
+# create_all では既存テーブルに列が追加されないため、後から追加した列をここに列挙する
+# (テーブル名, 列名, 列定義)
+ADDED_COLUMNS: List[Tuple[str, str, str]] = [
+    ('conversations', 'preview_title', 'VARCHAR(60)'),
+    ('conversations', 'message_count', 'INTEGER NOT NULL DEFAULT 0'),
+    ('conversations', 'last_message_at', 'DATETIME'),
+    ('conversations', 'last_token_usage', 'TEXT'),
+    ('messages', 'analysis_status', 'VARCHAR(20)'),
+    ('messages', 'analysis_data', 'TEXT'),
+    ('dify_apps', 'max_concurrency', 'INTEGER'),
+    ('dify_apps', 'max_queue', 'INTEGER'),
+]
+
+
+def _existing_columns(connection, table: str) -> List[str]:
+    return [row[1] for row in connection.execute(text(f"PRAGMA table_info({table})"))]
+
+
+def ensure_columns(connection) -> Dict[str, List[str]]:
+    """
+    既存DBに不足している列を ALTER TABLE で追加
+    
+    Returns:
+        Dict[str, List[str]]: テーブルごとの追加した列名
+    """
+    added: Dict[str, List[str]] = {}
+    columns_cache: Dict[str, List[str]] = {}
+    for table, column, definition in ADDED_COLUMNS:
+        if table not in columns_cache:
+            columns_cache[table] = _existing_columns(connection, table)
+        if column in columns_cache[table]:
+            continue
+        connection.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {definition}"))
+        columns_cache[table].append(column)
+        added.setdefault(table, []).append(column)
+        logger.info(f"列を追加: {table}.{column}")
+    return added
@@ -0,0 +1,145 @@
+import os
+import logging
+from contextlib import contextmanager
+from typing import Dict, Any, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker
+
+from .models import db
+
+logger = logging.getLogger(__name__)
+
+# ストレージプロファイル定義
+#   default    : 従来どおり（ロールバックジャーナル、SQLAlchemy の既定値）
+#   production : WAL + synchronous=NORMAL、参照系は別の読み取り専用プールを使う
+STORAGE_PROFILES: Dict[str, Dict[str, Any]] = {
+    'default': {
+        'pragmas': {},
+        'pool_size': None,
+        'max_overflow': None,
+        'read_pool_size': 0,
+    },
+    'production': {
+        'pragmas': {
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 5000,
+            'mmap_size': 268435456,   # 256MB
+            'cache_size': -65536,     # 64MB（負数は KiB 指定）
+            'temp_store': 'MEMORY',
+        },
+        'pool_size': 5,
+        'max_overflow': 10,
+        'read_pool_size': 8,
+    },
+}
+
+_ENV_OVERRIDES = {
+    'busy_timeout': 'SQLITE_BUSY_TIMEOUT_MS',
+    'mmap_size': 'SQLITE_MMAP_SIZE',
+    'cache_size': 'SQLITE_CACHE_SIZE',
+}
+
+
+def _apply_pragmas(dbapi_connection, pragmas: Dict[str, Any], read_only: bool = False):
+    """接続確立時に PRAGMA を設定"""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in pragmas.items():
+            # journal_mode はDBファイルに永続化されるため書き込み側でのみ設定
+            if read_only and name == 'journal_mode':
+                continue
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+class SQLiteStorage:
+    """
+    SQLite ストレージプロファイル管理
+    
+    SQLITE_PROFILE（default / production）に応じて接続プールと PRAGMA を設定し、
+    production では GET エンドポイント用の読み取り専用接続プールを別に持つ。
+    db.init_app より前に configure() を、後に init_app() を呼ぶこと。
+    """
+    
+    def __init__(self):
+        self.profile_name = 'default'
+        self.profile: Dict[str, Any] = STORAGE_PROFILES['default']
+        self.pragmas: Dict[str, Any] = {}
+        self.read_engine: Optional[Engine] = None
+        self._read_sessionmaker: Optional[sessionmaker] = None
+    
+    def configure(self, app):
+        """プロファイルを決定し、書き込み側エンジンのオプションを設定"""
+        self.profile_name = app.config.get('SQLITE_PROFILE', os.getenv('SQLITE_PROFILE', 'default'))
+        if self.profile_name not in STORAGE_PROFILES:
+            raise ValueError(f"不明なストレージプロファイル: {self.profile_name}")
+        self.profile = STORAGE_PROFILES[self.profile_name]
+        
+        self.pragmas = dict(self.profile['pragmas'])
+        for name, env_name in _ENV_OVERRIDES.items():
+            if name in self.pragmas and os.getenv(env_name):
+                self.pragmas[name] = int(os.getenv(env_name))
+        
+        options = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+        if self.profile['pool_size'] is not None and self._is_file_database(app):
+            options.setdefault('pool_size', self.profile['pool_size'])
+            options.setdefault('max_overflow', self.profile['max_overflow'])
+            options.setdefault('pool_pre_ping', False)
+        if 'busy_timeout' in self.pragmas:
+            connect_args = dict(options.get('connect_args', {}))
+            connect_args.setdefault('timeout', self.pragmas['busy_timeout'] / 1000)
+            options['connect_args'] = connect_args
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    
+    def init_app(self, app):
+        """PRAGMA 設定フックを登録し、必要なら読み取り専用プールを作成"""
+        app.extensions['sqlite_storage'] = self
+        with app.app_context():
+            if self.pragmas:
+                pragmas = self.pragmas
+                event.listen(db.engine, 'connect', lambda conn, _: _apply_pragmas(conn, pragmas))
+            
+            read_pool_size = int(os.getenv('SQLITE_READ_POOL_SIZE', self.profile['read_pool_size']))
+            if read_pool_size > 0 and self._is_file_database(app):
+                self.read_engine = create_engine(
+                    app.config['SQLALCHEMY_DATABASE_URI'],
+                    pool_size=read_pool_size,
+                    max_overflow=read_pool_size,
+                    connect_args={'timeout': self.pragmas.get('busy_timeout', 5000) / 1000},
+                )
+                pragmas = self.pragmas
+                event.listen(self.read_engine, 'connect', lambda conn, _: _apply_pragmas(conn, pragmas, read_only=True))
+                self._read_sessionmaker = sessionmaker(bind=self.read_engine, expire_on_commit=False)
+        
+        logger.info(f"ストレージプロファイル: {self.profile_name} (読み取り専用プール: {'有効' if self.read_engine else '無効'})")
+    
+    @staticmethod
+    def _is_file_database(app) -> bool:
+        url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+    
+    @contextmanager
+    def read_session(self):
+        """
+        参照系エンドポイント用のセッション
+        
+        読み取り専用プールが無効なプロファイルでは通常の db.session を返す。
+        """
+        if self._read_sessionmaker is None:
+            yield db.session
+            return
+        
+        session: Session = self._read_sessionmaker()
+        try:
+            yield session
+        finally:
+            session.close()
+
+
+storage = SQLiteStorage()
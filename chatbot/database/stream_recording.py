@@ -0,0 +1,114 @@
+import time
+from typing import Dict, Any, List, Optional
+
+# 記録形式の識別子
+RECORDING_FORMAT = 'delta-v1'
+
+# エンベロープ（全チャンク共通の値）として保持する値の型
+_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+class StreamRecorder:
+    """
+    ストリーミングチャンクの記録
+    
+    受信したチャンクと受信時刻（先頭チャンクからの経過ミリ秒）を蓄積する。
+    保存時に encode() でエンベロープ + 差分の圧縮形式へ変換する。
+    """
+    
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.offsets: List[int] = []
+        self._started: Optional[float] = None
+    
+    def append(self, chunk: Dict[str, Any], at: Optional[float] = None):
+        """チャンクを記録（at は time.monotonic() の値、省略時は現在時刻）"""
+        now = time.monotonic() if at is None else at
+        if self._started is None:
+            self._started = now
+        self.events.append(chunk)
+        self.offsets.append(int((now - self._started) * 1000))
+    
+    def encode(self) -> Dict[str, Any]:
+        return encode_stream(self.events, self.offsets)
+
+
+def encode_stream(events: List[Dict[str, Any]], offsets: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    チャンクのリストをエンベロープ + 差分形式に変換
+    
+    conversation_id / message_id / task_id / created_at のように全チャンクで
+    繰り返される値は最初に現れた値を envelope に一度だけ保存し、各チャンクには
+    envelope と異なる値（answer の断片など）だけを残す。キーの並び順は
+    layouts に保存するため、復元結果は元のリストと JSON 表現まで一致する。
+    受信時刻は圧縮が効きやすいよう、直前のチャンクとの間隔を別の列にまとめる。
+    
+    形式:
+        {
+            'format': 'delta-v1',
+            'envelope': {キー: 値},
+            'layouts': [[キー, ...], ...],
+            'events': [[layout番号, {差分}], ...],
+            'gaps': [直前のチャンクからの経過ミリ秒, ...]  # offsets 指定時のみ
+        }
+    """
+    envelope: Dict[str, Any] = {}
+    layouts: List[List[str]] = []
+    layout_index: Dict[tuple, int] = {}
+    entries = []
+    
+    for chunk in events:
+        keys = tuple(chunk)
+        layout = layout_index.get(keys)
+        if layout is None:
+            layout = layout_index[keys] = len(layouts)
+            layouts.append(list(keys))
+        
+        delta = {}
+        for key, value in chunk.items():
+            if key in envelope:
+                current = envelope[key]
+                # 1 と True、1 と 1.0 を区別するため型も比較する
+                if type(current) is type(value) and current == value:
+                    continue
+            elif isinstance(value, _SCALAR_TYPES):
+                envelope[key] = value
+                continue
+            delta[key] = value
+        
+        entries.append([layout, delta])
+    
+    recording = {
+        'format': RECORDING_FORMAT,
+        'envelope': envelope,
+        'layouts': layouts,
+        'events': entries,
+    }
+    if offsets:
+        recording['gaps'] = [offsets[0]] + [offsets[i] - offsets[i - 1] for i in range(1, len(offsets))]
+    return recording
+
+
+def is_recording(data: Any) -> bool:
+    """encode_stream の出力かどうか"""
+    return isinstance(data, dict) and data.get('format') == RECORDING_FORMAT
+
+
+def decode_stream(recording: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """エンベロープ + 差分形式から元のチャンクのリストを復元"""
+    envelope = recording['envelope']
+    layouts = recording['layouts']
+    return [
+        {key: delta[key] if key in delta else envelope[key] for key in layouts[layout]}
+        for layout, delta in recording['events']
+    ]
+
+
+def stream_offsets(recording: Dict[str, Any]) -> List[int]:
+    """各チャンクの受信時刻（先頭チャンクからの経過ミリ秒、未記録なら空）"""
+    offsets = []
+    elapsed = 0
+    for gap in recording.get('gaps', []):
+        elapsed += gap
+        offsets.append(elapsed)
+    return offsets
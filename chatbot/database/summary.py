@@ -0,0 +1,181 @@
+import json
+import logging
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
+
+from sqlalchemy import select, func, update
+from sqlalchemy.sql import ColumnElement
+
+from .models import db, Conversation, Message
+from .payload_store import load_raw_response
+
+logger = logging.getLogger(__name__)
+
+# 一覧に表示するタイトルの最大文字数（超える場合は "..." を付ける）
+PREVIEW_TITLE_LENGTH = 50
+
+
+def make_preview_title(content: str) -> str:
+    """最初のユーザーメッセージから一覧用タイトルを生成"""
+    if len(content) > PREVIEW_TITLE_LENGTH:
+        return content[:PREVIEW_TITLE_LENGTH] + "..."
+    return content
+
+
+def extract_token_usage(raw_response_data: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """message_end イベントの metadata.usage を取り出す（無ければ None）"""
+    for chunk in reversed(raw_response_data):
+        if chunk.get('event') == 'message_end':
+            usage = (chunk.get('metadata') or {}).get('usage')
+            return usage or None
+    return None
+
+
+def _increment_message_count(conversation: Conversation, delta: int = 1):
+    """件数を SQL 式で加算（同時更新で失われないように。未フラッシュの加算があれば積み増す）"""
+    current = conversation.message_count
+    base = current if isinstance(current, ColumnElement) else Conversation.message_count
+    conversation.message_count = base + delta
+
+
+def record_user_message(conversation: Conversation, content: str, at: Optional[datetime] = None):
+    """
+    ユーザーメッセージ追加時のサマリー更新
+    
+    メッセージの INSERT と同じセッションで呼び、同じコミットで反映させる。
+    """
+    at = at or datetime.utcnow()
+    if conversation.preview_title is None:
+        conversation.preview_title = make_preview_title(content)
+    _increment_message_count(conversation)
+    conversation.last_message_at = at
+    conversation.updated_at = at
+
+
+def record_user_message_by_id(session, conversation_id: int, content: str,
+                              at: Optional[datetime] = None) -> Optional[Tuple[int, Optional[str]]]:
+    """
+    既存の会話へのユーザーメッセージ追加時のサマリー更新（会話を読み込まずに1文で行う）
+    
+    UPDATE ... RETURNING で Difyアプリ・Dify側の会話IDも受け取るため、チャット開始時に
+    会話を SELECT しなくてよい。メッセージの INSERT と同じセッションで呼び、同じコミットで反映させる。
+    
+    Returns:
+        Tuple: (dify_app_id, dify_conversation_id)。会話が無ければ None
+    """
+    at = at or datetime.utcnow()
+    row = session.execute(
+        update(Conversation)
+        .where(Conversation.id == conversation_id)
+        .values(
+            preview_title=func.coalesce(Conversation.preview_title, make_preview_title(content)),
+            message_count=Conversation.message_count + 1,
+            last_message_at=at,
+            updated_at=at,
+        )
+        .returning(Conversation.dify_app_id, Conversation.dify_conversation_id)
+        .execution_options(synchronize_session=False)
+    ).first()
+    return tuple(row) if row is not None else None
+
+
+def retract_user_message(conversation: Conversation):
+    """
+    応答前に破棄したユーザーメッセージの分のサマリーを戻す
+    
+    メッセージの DELETE と同じセッションで呼ぶ。最終メッセージ日時は戻さない。
+    """
+    _increment_message_count(conversation, -1)
+
+
+def record_assistant_message(conversation: Conversation, usage: Optional[Dict[str, Any]],
+                             at: Optional[datetime] = None):
+    """アシスタントメッセージ確定時のサマリー更新"""
+    at = at or datetime.utcnow()
+    _increment_message_count(conversation)
+    conversation.last_message_at = at
+    conversation.updated_at = at
+    if usage is not None:
+        conversation.last_token_usage = json.dumps(usage, ensure_ascii=False)
+
+
+def backfill_conversation_summaries(batch_size: int = 500) -> int:
+    """
+    既存データからサマリー列を再計算（一度だけ実行する移行用）
+    
+    従来は新しいメッセージで updated_at が更新されなかったため、
+    最後のメッセージ日時がある会話は updated_at もそれに合わせる。
+    アプリケーションコンテキスト内で呼び出すこと。
+    
+    Returns:
+        int: 更新した会話数
+    """
+    visible = db.or_(Message.role != 'assistant', Message.content != '')
+    first_user_content = (
+        select(Message.content)
+        .where(Message.conversation_id == Conversation.id, Message.role == 'user')
+        .order_by(Message.id)
+        .limit(1)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    message_count = (
+        select(func.count(Message.id))
+        .where(Message.conversation_id == Conversation.id, visible)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    last_message_at = (
+        select(func.max(Message.created_at))
+        .where(Message.conversation_id == Conversation.id, visible)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    last_assistant_id = (
+        select(Message.id)
+        .where(Message.conversation_id == Conversation.id, Message.role == 'assistant', Message.content != '')
+        .order_by(Message.id.desc())
+        .limit(1)
+        .correlate(Conversation)
+        .scalar_subquery()
+    )
+    
+    updated = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Conversation.id, Conversation.updated_at, first_user_content, message_count, last_message_at, last_assistant_id)
+            .where(Conversation.id > last_id)
+            .order_by(Conversation.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        
+        params = []
+        for conv_id, updated_at, first_content, count, last_at, assistant_id in rows:
+            usage = None
+            if assistant_id is not None:
+                try:
+                    raw_response = load_raw_response(db.session, assistant_id)
+                    usage = extract_token_usage(raw_response) if raw_response else None
+                except (ValueError, AttributeError):
+                    logger.warning(f"生レスポンスを解析できません - 会話ID: {conv_id}")
+            params.append({
+                'id': conv_id,
+                'preview_title': make_preview_title(first_content) if first_content is not None else None,
+                'message_count': count or 0,
+                'last_message_at': last_at,
+                'last_token_usage': json.dumps(usage, ensure_ascii=False) if usage else None,
+                'updated_at': last_at or updated_at,
+            })
+        
+        db.session.execute(
+            update(Conversation).execution_options(synchronize_session=False),
+            params
+        )
+        db.session.commit()
+        updated += len(params)
+        last_id = rows[-1][0]
+    
+    return updated
@@ -25,7 +25,9 @@ app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{database_path}'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # データベース初期化
-from database.models import db, DifyApp, Conversation, Message
+from database.models import db, DifyApp, Conversation, Message, MessagePayload
+from database.payload_store import load_raw_response
+from database.migrations import migrate, reset_database as reset_schema
 
 db.init_app(app)
 
@@ -103,8 +105,9 @@ def debug_database():
                     for msg in messages:
                         content_preview = msg.content[:100] + "..." if len(msg.content) > 100 else msg.content
                         print(f"    ID:{msg.id}, Role:{msg.role}, Content:'{content_preview}', ContentLength:{len(msg.content)}")
-                        if msg.role == 'assistant' and msg.raw_dify_response:
-                            print(f"    Raw Response Length: {len(msg.raw_dify_response)}")
+                        payload = db.session.get(MessagePayload, msg.id) if msg.role == 'assistant' else None
+                        if payload:
+                            print(f"    Raw Response Length: {payload.raw_size} ({payload.codec}: {len(payload.data)} bytes)")
                 else:
                     print("  会話が見つかりません")
             except Exception as e:
@@ -115,10 +118,8 @@ def debug_database():
             # 特定のメッセージの詳細分析（ID:21のraw_responseを確認）
             print("特定メッセージ詳細分析（ID:21）:")
             try:
-                target_message = db.session.query(Message).filter_by(id=21).first()
-                if target_message and target_message.raw_dify_response:
-                    import json
-                    raw_data = json.loads(target_message.raw_dify_response)
+                raw_data = load_raw_response(db.session, 21)
+                if raw_data:
                     print(f"  Raw Response データ数: {len(raw_data)}")
                     
                     # 各チャンクの構造を確認
@@ -181,58 +182,27 @@ def debug_database():
             
         except Exception as e:
             print(f"データベース操作エラー: {e}")
-            print("データベースを再作成します...")
+            print("未適用のスキーマ移行を確認します...")
             
-            # データベース再作成
+            # 未適用の移行を適用（テーブル作成・初期データ投入を含む）
             try:
-                db.create_all()
-                print("テーブル作成完了")
-                
-                # 初期データ挿入
-                if db.session.query(DifyApp).count() == 0:
-                    sample_apps = [
-                        DifyApp(name='sample1', description='Sample Dify Application 1', api_key_env_name='DIFY_API_KEY_SAMPLE1'),
-                        DifyApp(name='sample2', description='Sample Dify Application 2', api_key_env_name='DIFY_API_KEY_SAMPLE2'),
-                        DifyApp(name='sample3', description='Sample Dify Application 3', api_key_env_name='DIFY_API_KEY_SAMPLE3')
-                    ]
-                    
-                    for app_data in sample_apps:
-                        db.session.add(app_data)
-                    
-                    db.session.commit()
-                    print("初期データ挿入完了")
-                
+                report = migrate(db.engine)
+                print(f"スキーマ移行完了: バージョン {report['version']}（適用: {', '.join(report['applied']) or 'なし'}）")
+            
             except Exception as init_error:
                 print(f"データベース初期化エラー: {init_error}")
         
         print("=" * 50)
 
 def reset_database():
-    """データベースリセット"""
+    """データベースリセット（migrate.py --reset と同じ）"""
     global app
     with app.app_context():
         print("データベースをリセットします...")
         
-        # 既存のテーブルを削除
-        db.drop_all()
-        print("既存テーブル削除完了")
-        
-        # 新しいテーブルを作成
-        db.create_all()
-        print("新しいテーブル作成完了")
-        
-        # 初期データ挿入
-        sample_apps = [
-            DifyApp(name='sample1', description='Sample Dify Application 1', api_key_env_name='DIFY_API_KEY_SAMPLE1'),
-            DifyApp(name='sample2', description='Sample Dify Application 2', api_key_env_name='DIFY_API_KEY_SAMPLE2'),
-            DifyApp(name='sample3', description='Sample Dify Application 3', api_key_env_name='DIFY_API_KEY_SAMPLE3')
-        ]
-        
-        for app_data in sample_apps:
-            db.session.add(app_data)
-        
-        db.session.commit()
-        print("初期データ挿入完了")
+        # 全文索引・schema_version を含めて削除し、最新まで移行し直す
+        report = reset_schema(db.engine)
+        print(f"スキーマ移行完了: バージョン {report['version']}")
         
         print("データベースリセット完了")
 
@@ -27,6 +27,7 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
 # データベース初期化
 from database.models import db, DifyApp, Conversation, Message
+from database.payload_store import load_raw_response
 
 db.init_app(app)
 
@@ -40,16 +41,14 @@ def fix_empty_message():
             print("ID:21のメッセージが見つかりません")
             return
         
-        if not target_message.raw_dify_response:
+        raw_data = load_raw_response(db.session, target_message.id)
+        if not raw_data:
             print("raw_dify_responseが見つかりません")
             return
         
         print(f"修正前: Content='{target_message.content}', Length={len(target_message.content)}")
         
         try:
-            # raw_responseからmessageイベントを抽出
-            raw_data = json.loads(target_message.raw_dify_response)
-            
             # messageイベントから回答を結合
             full_answer = ""
             message_chunks = [chunk for chunk in raw_data if chunk.get('event') == 'message']
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+スキーマ移行スクリプト
+未適用の移行（database/migrations.py）を適用し、起動にかかる時間を表示する。
+uvicorn（asgi.py）や python app.py は起動時に、それ以外のWSGIサーバーは
+最初のリクエストの前に自動で適用する。デプロイ前に適用しておく場合や
+適用状況の確認に使う。
+
+使い方:
+    python migrate.py            # 最新まで適用
+    python migrate.py --status   # 適用状況を表示
+    python migrate.py --reset    # 全テーブルを削除して作り直す（debug_db.py reset と同じ）
+"""
+
+import argparse
+import sys
+import time
+
+started = time.perf_counter()
+from app import app
+from database.models import db
+from database.migrations import migrate, migration_status, reset_database
+imported = time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description='スキーマ移行')
+    parser.add_argument('--status', action='store_true', help='適用状況を表示')
+    parser.add_argument('--reset', action='store_true', help='全テーブルを削除して作り直す')
+    parser.add_argument('--target', type=int, help='このバージョンまで適用')
+    args = parser.parse_args()
+    
+    with app.app_context():
+        if args.status:
+            for row in migration_status(db.engine):
+                state = f"{row['applied_at']} ({row['duration_ms']}ms)" if row['applied_at'] else '未適用'
+                print(f"{row['version']:>4} {row['name']:<20} {state}")
+            return 0
+        
+        try:
+            if args.reset:
+                print("データベースをリセットします...")
+                report = reset_database(db.engine)
+            else:
+                report = migrate(db.engine, args.target)
+        except Exception as e:
+            print(f"スキーマ移行に失敗しました: {e}")
+            return 1
+    
+    print(f"スキーマバージョン: {report['version']}")
+    print(f"適用した移行: {', '.join(report['applied']) if report['applied'] else 'なし'}")
+    print(f"起動時間: アプリ読み込み {imported * 1000:.1f}ms + 移行 {report['seconds'] * 1000:.1f}ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+"""
+生レスポンス移行スクリプト
+messages.raw_dify_response に保存されている生レスポンスを圧縮して
+message_payloads テーブルへ移す（一度だけ実行、中断後の再実行も可）
+"""
+
+import os
+import sys
+import time
+
+from sqlalchemy import text
+
+from app import app, initialize_database
+from database.models import db
+from database.payload_store import migrate_inline_payloads
+
+
+def main():
+    """移行と（指定時は）VACUUM"""
+    print("=== 生レスポンスの圧縮テーブルへの移行 ===")
+    
+    # message_payloads テーブルの作成
+    initialize_database()
+    
+    with app.app_context():
+        started = time.perf_counter()
+        try:
+            report = migrate_inline_payloads()
+        except Exception as e:
+            print(f"移行に失敗しました: {e}")
+            return 1
+        elapsed = time.perf_counter() - started
+        
+        print(f"{report['migrated']}件を移行しました ({elapsed:.2f}秒)")
+        if report['raw_bytes']:
+            ratio = report['compressed_bytes'] / report['raw_bytes']
+            print(f"  圧縮前: {report['raw_bytes']:,} bytes / 圧縮後: {report['compressed_bytes']:,} bytes ({ratio:.1%})")
+        
+        # 空いたページを解放してファイルサイズを縮める
+        if '--vacuum' in sys.argv:
+            db_file = db.engine.url.database
+            before = os.path.getsize(db_file)
+            with db.engine.connect() as connection:
+                connection.execute(text("VACUUM"))
+            print(f"VACUUM: {before:,} bytes -> {os.path.getsize(db_file):,} bytes")
+    
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
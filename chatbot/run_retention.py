@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+保持期間ジョブの実行スクリプト
+保持期間を過ぎた会話・生レスポンスを削除し、incremental_vacuum でDBファイルを
+切り詰める（cron などから定期実行する。既定値は RETENTION_* 環境変数）
+
+既存DBで incremental_vacuum を使うには、アプリ停止中に一度だけ
+--enable-incremental-vacuum を付けて実行して auto_vacuum を変換する。
+"""
+
+import sys
+import json
+import argparse
+
+from app import app, initialize_database
+from database.models import db
+from database.retention import convert_to_incremental_vacuum
+from utils.retention_job import retention_job
+
+
+def main():
+    """保持期間ジョブを1回実行して結果を表示"""
+    parser = argparse.ArgumentParser(description='保持期間ジョブの実行')
+    parser.add_argument('--conversation-days', type=int, help='最終更新からこの日数を過ぎた会話を削除（0 で削除しない）')
+    parser.add_argument('--payload-days', type=int, help='作成からこの日数を過ぎた生レスポンスを削除（0 で削除しない）')
+    parser.add_argument('--vacuum-pages', type=int, help='解放するページ数の上限（0 で全て）')
+    parser.add_argument('--enable-incremental-vacuum', action='store_true',
+                        help='既存DBを auto_vacuum=INCREMENTAL に変換（VACUUM を実行）')
+    args = parser.parse_args()
+    
+    print("=== 保持期間ジョブ ===")
+    initialize_database()
+    
+    if args.enable_incremental_vacuum:
+        with app.app_context():
+            with db.engine.connect() as connection:
+                report = convert_to_incremental_vacuum(connection)
+        print(f"auto_vacuum を変換しました: {json.dumps(report, ensure_ascii=False)}")
+    
+    try:
+        report = retention_job.run(args.conversation_days, args.payload_days, args.vacuum_pages)
+    except Exception as e:
+        print(f"保持期間ジョブに失敗しました: {e}")
+        return 1
+    
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if not report['vacuum']['enabled']:
+        print("auto_vacuum が INCREMENTAL でないためファイルは縮小されません（--enable-incremental-vacuum を参照）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,6 +7,11 @@ window.ChatManager = (function() {
     let currentMessageDiv = null;
     let typewriterIntervalId = null;
     
+    // 切断時の再接続（サーバーは切断後も応答の受信を続け、Last-Event-ID の続きから再送する）
+    const STREAM_RETRY_LIMIT = 5;
+    const STREAM_RETRY_DELAY_MS = 1000;
+    let streamState = null;
+    
     /**
      * メッセージ送信
      */
@@ -42,6 +47,8 @@ window.ChatManager = (function() {
         
         console.log('ストリーミングリクエスト:', requestData);
         
+        streamState = { streamId: null, conversationId: null, lastEventId: null, finished: false, retries: 0 };
+        
         fetch('/api/chat-stream', {
             method: 'POST',
             headers: {
@@ -50,53 +57,138 @@ window.ChatManager = (function() {
             body: JSON.stringify(requestData)
         })
         .then(response => {
+            if (response.status === 429) {
+                // 待ち行列が満杯（Retry-After 秒後に再送できる）
+                const retryAfter = response.headers.get('Retry-After');
+                clearQueueStatus();
+                throw new Error(`混雑しています。${retryAfter || '数'}秒後に再度お試しください`);
+            }
             if (!response.ok) {
                 throw new Error(`HTTP error! status: ${response.status}`);
             }
-            
-            const reader = response.body.getReader();
-            const decoder = new TextDecoder();
-            let buffer = '';
-            
-            // ストリーミングデータ読み取り
-            function readStream() {
-                return reader.read().then(({ done, value }) => {
-                    if (done) {
-                        console.log('ストリーミング完了');
-                        window.AppUtils.setLoading(false);
-                        return;
+            return readSSEResponse(response);
+        })
+        .catch(handleStreamFailure);
+    }
+    
+    /**
+     * SSEレスポンスを最後まで読み取る（途中で切れた場合は再接続）
+     */
+    function readSSEResponse(response) {
+        const streamId = response.headers.get('X-Stream-Id');
+        if (streamId) {
+            streamState.streamId = streamId;
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        // ストリーミングデータ読み取り
+        function readStream() {
+            return reader.read().then(({ done, value }) => {
+                if (done) {
+                    if (!streamState.finished && streamState.streamId) {
+                        return resumeStreaming();
                     }
-                    
-                    buffer += decoder.decode(value, { stream: true });
-                    const lines = buffer.split('\n');
-                    buffer = lines.pop(); // 最後の不完全な行は保持
-                    
-                    for (const line of lines) {
-                        if (line.trim()) {
-                            processSSELine(line.trim());
-                        }
+                    console.log('ストリーミング完了');
+                    window.AppUtils.setLoading(false);
+                    return;
+                }
+                
+                streamState.retries = 0;
+                buffer += decoder.decode(value, { stream: true });
+                const lines = buffer.split('\n');
+                buffer = lines.pop(); // 最後の不完全な行は保持
+                
+                for (const line of lines) {
+                    if (line.trim()) {
+                        processSSELine(line.trim());
                     }
-                    
-                    return readStream();
-                });
-            }
-            
-            return readStream();
-        })
-        .catch(error => {
-            console.error('ストリーミングエラー:', error);
-            window.AppUtils.showError('チャット送信中にエラーが発生しました: ' + error.message);
+                }
+                
+                return readStream();
+            });
+        }
+        
+        return readStream();
+    }
+    
+    /**
+     * 通信エラー処理（応答の途中で接続が切れた場合は再接続）
+     */
+    function handleStreamFailure(error) {
+        // fetch・読み取りのネットワークエラーは TypeError になる
+        if (error instanceof TypeError && streamState && streamState.streamId && !streamState.finished) {
+            console.warn('ストリーム切断、再接続します:', error);
+            return resumeStreaming();
+        }
+        console.error('ストリーミングエラー:', error);
+        window.AppUtils.showError('チャット送信中にエラーが発生しました: ' + error.message);
+        window.AppUtils.setLoading(false);
+    }
+    
+    /**
+     * 切断したストリームへ再接続し、受信済みの次のイベントから受け取る
+     */
+    function resumeStreaming() {
+        if (streamState.retries >= STREAM_RETRY_LIMIT) {
+            window.AppUtils.showError('接続が切れました。履歴から会話を開き直してください');
             window.AppUtils.setLoading(false);
-        });
+            return;
+        }
+        streamState.retries += 1;
+        
+        const headers = {};
+        if (streamState.lastEventId) {
+            headers['Last-Event-ID'] = streamState.lastEventId;
+        }
+        
+        return new Promise(resolve => setTimeout(resolve, STREAM_RETRY_DELAY_MS * streamState.retries))
+            .then(() => fetch(`/api/chat-stream/${streamState.streamId}`, { headers: headers }))
+            .then(response => {
+                if (response.status === 404 || response.status === 410 || response.status === 421) {
+                    // 保持期間切れ・再送範囲外・別のワーカーに届いた（保存済みの会話を開き直す）
+                    streamState.finished = true;
+                    return response.json().then(data => {
+                        reloadStreamConversation(data.conversation_id || streamState.conversationId);
+                        throw new Error(data.error);
+                    });
+                }
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                return readSSEResponse(response);
+            })
+            .catch(handleStreamFailure);
+    }
+    
+    /**
+     * 再送できなくなったストリームの会話を保存済みの内容で表示し直す
+     */
+    function reloadStreamConversation(conversationId) {
+        if (conversationId && typeof window.HistoryManager !== 'undefined') {
+            window.HistoryManager.loadConversation(conversationId);
+        }
     }
     
     /**
      * SSEライン処理
      */
     function processSSELine(line) {
+        if (line.startsWith('id: ')) {
+            // '<ストリームID>-<連番>'（再接続時に Last-Event-ID として送る。IDにも '-' が含まれる）
+            streamState.lastEventId = line.substring(4);
+            if (!streamState.streamId) {
+                streamState.streamId = streamState.lastEventId.substring(0, streamState.lastEventId.lastIndexOf('-'));
+            }
+            return;
+        }
+        
         if (line.startsWith('data: ')) {
             const data = line.substring(6);
             if (data === '[DONE]') {
+                streamState.finished = true;
                 return;
             }
             
@@ -115,6 +207,19 @@ window.ChatManager = (function() {
     function handleStreamData(data) {
         console.log('受信データ:', data);
         
+        if (data.event === 'stream_started') {
+            // 再接続に必要なストリームID（推測できないトークン）。表示するデータは含まない
+            streamState.streamId = data.stream_id;
+            streamState.conversationId = data.conversation_id;
+            return;
+        }
+        
+        if (data.event === 'queued') {
+            showQueueStatus(data.position);
+            return;
+        }
+        clearQueueStatus();
+        
         if (data.event === 'message' && data.answer) {
             // Difyからの断片データをそのまま追加
             appendTextWithTypewriter(data.answer);
@@ -155,10 +260,40 @@ window.ChatManager = (function() {
         }
         
         if (data.event === 'error') {
+            streamState.finished = true;
+            if (data.code === 'stream_gap') {
+                reloadStreamConversation(data.conversation_id);
+            }
             window.AppUtils.showError(data.error || 'チャット処理中にエラーが発生しました');
         }
     }
     
+    /**
+     * 順番待ちの表示（実行枠が空くまでサーバーから queued イベントが届く）
+     */
+    function showQueueStatus(position) {
+        if (!currentMessageDiv) {
+            return;
+        }
+        
+        const messageDiv = currentMessageDiv.parent();
+        let status = messageDiv.find('.queue-status');
+        if (status.length === 0) {
+            status = $('<div class="queue-status"></div>');
+            messageDiv.append(status);
+        }
+        status.text(`順番待ち中です（${position}番目）`);
+    }
+    
+    /**
+     * 順番待ちの表示を消す
+     */
+    function clearQueueStatus() {
+        if (currentMessageDiv) {
+            currentMessageDiv.parent().find('.queue-status').remove();
+        }
+    }
+    
     /**
      * ユーザーメッセージ追加
      */
@@ -301,47 +436,105 @@ window.ChatManager = (function() {
         $('#dify-app-select').val(conversationData.dify_app_id);
         
         // メッセージを順次表示
-        conversationData.messages.forEach((msg, index) => {
-            console.log(`メッセージ ${index}:`, msg);
-            if (msg.role === 'user') {
-                addUserMessage(msg.content);
-                console.log('ユーザーメッセージ追加完了:', msg.content);
-            } else if (msg.role === 'assistant') {
-                console.log('アシスタントメッセージ処理開始:', msg.content);
-                const assistantDiv = addAssistantMessage('');
-                const contentDiv = assistantDiv.find('.message-content');
-                
-                console.log('contentDiv取得:', contentDiv.length);
-                
-                // data-raw-content属性を設定
-                contentDiv.attr('data-raw-content', msg.content);
-                
-                // マークダウンレンダリング
-                if (typeof marked !== 'undefined') {
-                    const renderedContent = marked.parse(msg.content);
-                    console.log('マークダウンレンダリング完了:', renderedContent);
-                    contentDiv.html(renderedContent);
-                } else {
-                    console.log('マークダウンなしでテキスト設定');
-                    contentDiv.text(msg.content);
-                }
-                
-                // メッセージアクションボタン追加
-                if (msg.id) {
-                    console.log('アクションボタン追加:', msg.id);
-                    addMessageActions(assistantDiv, msg.id);
-                }
-                console.log('アシスタントメッセージ追加完了');
-            }
-        });
+        appendHistoryMessages(conversationData.messages);
+        setOlderMessagesLoader(null);
+    }
+    
+    /**
+     * 履歴のメッセージ要素を作成（チャット画面には追加しない）
+     */
+    function createHistoryMessage(msg) {
+        if (msg.role === 'user') {
+            return $(`
+                <div class="message user-message">
+                    <div class="message-content">${escapeHtml(msg.content)}</div>
+                </div>
+            `);
+        }
+        
+        const assistantDiv = $(`
+            <div class="message assistant-message">
+                <div class="message-content" data-raw-content=""></div>
+            </div>
+        `);
+        const contentDiv = assistantDiv.find('.message-content');
+        
+        // data-raw-content属性を設定
+        contentDiv.attr('data-raw-content', msg.content);
         
+        // マークダウンレンダリング
+        if (typeof marked !== 'undefined') {
+            contentDiv.html(marked.parse(msg.content));
+        } else {
+            contentDiv.text(msg.content);
+        }
+        
+        // メッセージアクションボタン追加
+        if (msg.id) {
+            addMessageActions(assistantDiv, msg.id);
+        }
+        return assistantDiv;
+    }
+    
+    /**
+     * 履歴のメッセージを末尾に追加（ストリーミング受信中に順次呼び出される）
+     */
+    function appendHistoryMessages(messages) {
+        const chatContainer = $('#chat-container');
+        messages.forEach(msg => {
+            chatContainer.append(createHistoryMessage(msg));
+        });
         scrollToBottom();
     }
     
+    /**
+     * 古いメッセージを先頭に追加（表示位置は維持する）
+     */
+    function prependHistoryMessages(messages) {
+        const chatContainer = $('#chat-container');
+        const previousHeight = chatContainer[0].scrollHeight;
+        const elements = messages.map(createHistoryMessage);
+        const loader = chatContainer.children('.load-older-messages');
+        if (loader.length > 0) {
+            loader.after(elements);
+        } else {
+            chatContainer.prepend(elements);
+        }
+        chatContainer.scrollTop(chatContainer.scrollTop() + chatContainer[0].scrollHeight - previousHeight);
+    }
+    
+    /**
+     * 先頭の「以前のメッセージを読み込む」ボタンを設定
+     * 
+     * @param {Function|null} loader - クリック時に呼び出す関数（null ならボタンを消す）
+     */
+    function setOlderMessagesLoader(loader) {
+        const chatContainer = $('#chat-container');
+        chatContainer.children('.load-older-messages').remove();
+        if (!loader) {
+            return;
+        }
+        
+        const button = $(`
+            <button class="load-older-messages"
+                    style="display: block; margin: 0 auto 1rem; padding: 0.4rem 1rem; cursor: pointer;">
+                以前のメッセージを読み込む
+            </button>
+        `);
+        button.on('click', () => {
+            button.prop('disabled', true).text('読み込み中...');
+            loader();
+        });
+        chatContainer.prepend(button);
+    }
+    
     // 外部関数として公開
     return {
         sendMessage: sendMessage,
-        loadConversation: loadConversation
+        loadConversation: loadConversation,
+        appendHistoryMessages: appendHistoryMessages,
+        prependHistoryMessages: prependHistoryMessages,
+        setOlderMessagesLoader: setOlderMessagesLoader
     };
 })();
 
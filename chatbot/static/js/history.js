@@ -5,22 +5,41 @@
 window.HistoryManager = (function() {
     
     let historyData = [];
+    let nextCursor = null;
+    let searchTerm = '';
+    let searchResults = [];
+    let nextSearchOffset = null;
+    let searchTimer = null;
+    
+    // 入力が止まってから検索するまでの待ち時間（ミリ秒）
+    const SEARCH_DEBOUNCE_MS = 300;
+    
+    // 会話を開いたときに最初に読み込むメッセージ数（古いメッセージは要求に応じて読み込む）
+    const MESSAGE_PAGE_SIZE = 50;
     
     /**
      * 履歴データロード
+     * 
+     * @param {boolean} loadMore - true の場合は次のページを取得して末尾に追加
      */
-    function loadHistory() {
+    function loadHistory(loadMore = false) {
         console.log('履歴データロード開始');
         
-        fetch('/api/conversations')
+        let url = '/api/conversations';
+        if (loadMore && nextCursor) {
+            url += `?before=${encodeURIComponent(nextCursor)}`;
+        }
+        
+        fetch(url)
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`HTTP error! status: ${response.status}`);
                 }
+                nextCursor = response.headers.get('X-Next-Cursor');
                 return response.json();
             })
             .then(data => {
-                historyData = data;
+                historyData = loadMore ? historyData.concat(data) : data;
                 displayHistory(historyData);
                 console.log('履歴データロード完了:', historyData.length, '件');
             })
@@ -40,7 +59,7 @@ window.HistoryManager = (function() {
         if (conversations.length === 0) {
             historyList.html(`
                 <div style="text-align: center; color: #666; padding: 2rem;">
-                    まだ会話履歴がありません
+                    ${searchTerm ? '一致する会話がありません' : 'まだ会話履歴がありません'}
                 </div>
             `);
             return;
@@ -51,6 +70,20 @@ window.HistoryManager = (function() {
             historyList.append(historyItemHtml);
         });
         
+        // 続きがある場合は「もっと見る」ボタンを表示
+        const hasMore = searchTerm ? nextSearchOffset : nextCursor;
+        if (hasMore) {
+            const loadMore = searchTerm
+                ? 'window.HistoryManager.searchHistory(true)'
+                : 'window.HistoryManager.loadHistory(true)';
+            historyList.append(`
+                <button class="history-load-more" onclick="${loadMore}"
+                        style="width: 100%; padding: 0.5rem; margin-top: 0.5rem; cursor: pointer;">
+                    もっと見る
+                </button>
+            `);
+        }
+        
         // アクティブな会話をハイライト
         if (window.ChatApp.currentConversationId) {
             $(`.history-item[data-conversation-id="${window.ChatApp.currentConversationId}"]`)
@@ -87,25 +120,65 @@ window.HistoryManager = (function() {
                     </div>
                 </div>
                 <div class="history-date">${createdDate} ${createdTime}</div>
+                ${conversation.snippet_html ? `<div class="history-snippet">${conversation.snippet_html}</div>` : ''}
             </div>
         `;
     }
     
     /**
      * 履歴検索・フィルタリング
+     * 
+     * 入力が止まってからサーバー側の全文検索（メッセージ本文）を実行する
      */
-    function filterHistory(searchTerm) {
+    function filterHistory(term) {
+        searchTerm = term.trim();
+        clearTimeout(searchTimer);
+        
         if (!searchTerm) {
+            searchResults = [];
+            nextSearchOffset = null;
             displayHistory(historyData);
             return;
         }
         
-        const filteredData = historyData.filter(conv => 
-            conv.title.toLowerCase().includes(searchTerm.toLowerCase()) ||
-            conv.dify_app_name.toLowerCase().includes(searchTerm.toLowerCase())
-        );
+        searchTimer = setTimeout(() => searchHistory(false), SEARCH_DEBOUNCE_MS);
+    }
+    
+    /**
+     * 会話履歴の全文検索
+     * 
+     * @param {boolean} loadMore - true の場合は次のページを取得して末尾に追加
+     */
+    function searchHistory(loadMore = false) {
+        const term = searchTerm;
+        let url = `/api/conversations/search?q=${encodeURIComponent(term)}`;
+        if (loadMore && nextSearchOffset) {
+            url += `&offset=${nextSearchOffset}`;
+        }
         
-        displayHistory(filteredData);
+        fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                // 応答待ちの間に検索語が変わっていたら破棄
+                if (term !== searchTerm) {
+                    return null;
+                }
+                nextSearchOffset = response.headers.get('X-Next-Offset');
+                return response.json();
+            })
+            .then(data => {
+                if (data === null) {
+                    return;
+                }
+                searchResults = loadMore ? searchResults.concat(data) : data;
+                displayHistory(searchResults);
+            })
+            .catch(error => {
+                console.error('履歴検索エラー:', error);
+                window.AppUtils.showError('履歴の検索に失敗しました: ' + error.message);
+            });
     }
     
     /**
@@ -147,6 +220,7 @@ window.HistoryManager = (function() {
             
             // ローカルのhistoryDataから削除
             historyData = historyData.filter(conv => conv.id !== conversationId);
+            searchResults = searchResults.filter(conv => conv.id !== conversationId);
             
             // UIから即座に削除
             const historyItem = $(`.history-item[data-conversation-id="${conversationId}"]`);
@@ -179,27 +253,83 @@ window.HistoryManager = (function() {
         });
     }
     
+    /**
+     * NDJSON レスポンスを1行ずつ読み込む
+     * 
+     * @param {Response} response - fetch のレスポンス
+     * @param {Function} onItem - 各行のオブジェクトを受け取る関数
+     */
+    function readNdjson(response, onItem) {
+        const handleLine = line => {
+            if (line.trim()) {
+                const item = JSON.parse(line);
+                if (item.error) {
+                    throw new Error(item.error);
+                }
+                onItem(item);
+            }
+        };
+        
+        // ストリーム読み込み非対応のブラウザでは全体を受信してから処理
+        if (!response.body || typeof TextDecoder === 'undefined') {
+            return response.text().then(text => text.split('\n').forEach(handleLine));
+        }
+        
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        
+        function pump() {
+            return reader.read().then(({ done, value }) => {
+                buffer += decoder.decode(value || new Uint8Array(), { stream: !done });
+                const lines = buffer.split('\n');
+                buffer = lines.pop();
+                lines.forEach(handleLine);
+                if (done) {
+                    handleLine(buffer);
+                    return;
+                }
+                return pump();
+            });
+        }
+        return pump();
+    }
+    
     /**
      * 会話読み込み
+     * 
+     * 最新のメッセージから表示し、それより古いメッセージは
+     * 「以前のメッセージを読み込む」で順に取得する。
      */
     function loadConversation(conversationId) {
         console.log('会話読み込み:', conversationId);
         
-        fetch(`/api/conversations/${conversationId}`)
+        fetch(`/api/conversations/${conversationId}?format=ndjson&limit=${MESSAGE_PAGE_SIZE}`)
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`HTTP error! status: ${response.status}`);
                 }
-                return response.json();
-            })
-            .then(conversationData => {
-                console.log('会話データ取得成功:', conversationData);
-                
-                // チャット管理に会話ロードを依頼
-                if (typeof window.ChatManager !== 'undefined') {
-                    window.ChatManager.loadConversation(conversationData);
-                }
+                const beforeMessageId = response.headers.get('X-Before-Message-Id');
+                let conversationData = null;
                 
+                // 1行目が会話情報、以降はメッセージ（受信した順に表示する）
+                return readNdjson(response, item => {
+                    if (conversationData === null) {
+                        conversationData = item;
+                        if (typeof window.ChatManager !== 'undefined') {
+                            window.ChatManager.loadConversation({ ...item, messages: [] });
+                        }
+                    } else if (typeof window.ChatManager !== 'undefined') {
+                        window.ChatManager.appendHistoryMessages([item]);
+                    }
+                }).then(() => {
+                    console.log('会話データ取得成功:', conversationData);
+                    if (typeof window.ChatManager !== 'undefined') {
+                        setOlderMessagesLoader(conversationId, beforeMessageId);
+                    }
+                });
+            })
+            .then(() => {
                 // 履歴のアクティブ状態を更新
                 $('.history-item').removeClass('active');
                 $(`.history-item[data-conversation-id="${conversationId}"]`).addClass('active');
@@ -210,6 +340,52 @@ window.HistoryManager = (function() {
             });
     }
     
+    /**
+     * 古いメッセージの読み込みボタンを設定（続きが無ければ消す）
+     */
+    function setOlderMessagesLoader(conversationId, beforeMessageId) {
+        window.ChatManager.setOlderMessagesLoader(
+            beforeMessageId ? () => loadOlderMessages(conversationId, beforeMessageId) : null
+        );
+    }
+    
+    /**
+     * 指定したメッセージより古いメッセージを1ページ読み込んで先頭に追加
+     */
+    function loadOlderMessages(conversationId, beforeMessageId) {
+        const url = `/api/conversations/${conversationId}?format=ndjson` +
+            `&limit=${MESSAGE_PAGE_SIZE}&before_message_id=${encodeURIComponent(beforeMessageId)}`;
+        
+        fetch(url)
+            .then(response => {
+                if (!response.ok) {
+                    throw new Error(`HTTP error! status: ${response.status}`);
+                }
+                const nextBeforeMessageId = response.headers.get('X-Before-Message-Id');
+                const messages = [];
+                let headerRead = false;
+                
+                return readNdjson(response, item => {
+                    if (headerRead) {
+                        messages.push(item);
+                    }
+                    headerRead = true;
+                }).then(() => {
+                    // 読み込み中に別の会話へ切り替えていたら破棄
+                    if (window.ChatApp.currentConversationId !== conversationId) {
+                        return;
+                    }
+                    window.ChatManager.prependHistoryMessages(messages);
+                    setOlderMessagesLoader(conversationId, nextBeforeMessageId);
+                });
+            })
+            .catch(error => {
+                console.error('メッセージ読み込みエラー:', error);
+                window.AppUtils.showError('以前のメッセージの読み込みに失敗しました: ' + error.message);
+                setOlderMessagesLoader(conversationId, beforeMessageId);
+            });
+    }
+    
     /**
      * HTMLエスケープ
      */
@@ -223,6 +399,7 @@ window.HistoryManager = (function() {
     return {
         loadHistory: loadHistory,
         filterHistory: filterHistory,
+        searchHistory: searchHistory,
         deleteConversation: deleteConversation,
         loadConversation: loadConversation
     };
@@ -0,0 +1,9 @@
+import os
+import sys
+import tempfile
+
+CHATBOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CHATBOT_DIR)
+
+# app を読み込むテストが既存の database/database.db に触れないよう一時ディレクトリのDBを使う
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='chatbot-test-'), 'test.db')}")
@@ -0,0 +1,159 @@
+import pytest
+
+from utils.chat_scheduler import ChatScheduler, QueueFullError, QueueTimeoutError
+
+
+def test_admit_until_limit_then_queue_in_order():
+    scheduler = ChatScheduler(max_concurrency=2, max_queue=2)
+    running = [scheduler.admit(1), scheduler.admit(1)]
+    queued = [scheduler.admit(1), scheduler.admit(1)]
+    
+    assert [ticket.granted for ticket in running + queued] == [True, True, False, False]
+    assert [ticket.position() for ticket in queued] == [1, 2]
+    
+    running[0].release()
+    running[0].release()  # 二重の解放は無視
+    
+    assert queued[0].granted and not queued[1].granted
+    assert queued[1].position() == 1
+    assert scheduler.stats()['apps']['1']['running'] == 2
+
+
+def test_queue_full_with_retry_after():
+    scheduler = ChatScheduler(max_concurrency=2, max_queue=1)
+    tickets = [scheduler.admit(1) for _ in range(3)]
+    
+    with pytest.raises(QueueFullError) as raised:
+        scheduler.admit(1)
+    
+    # 所要時間の見積もり（初期値 10 秒）を実行枠数で割った秒数
+    assert raised.value.retry_after == 5
+    assert scheduler.stats()['apps']['1']['rejected'] == 1
+    # 他のアプリは影響を受けない
+    assert scheduler.admit(2).granted
+    
+    tickets[0].release()
+    assert scheduler.admit(1).position() == 1
+
+
+def test_app_limits_override_defaults():
+    scheduler = ChatScheduler(max_concurrency=8, max_queue=32)
+    assert scheduler.admit(1, max_concurrency=1, max_queue=0).granted
+    
+    with pytest.raises(QueueFullError):
+        scheduler.admit(1, max_concurrency=1, max_queue=0)
+    # 上限 0 は制限なし
+    assert all(scheduler.admit(2, max_concurrency=0).granted for _ in range(20))
+
+
+def test_total_limit_is_shared_fairly():
+    scheduler = ChatScheduler(max_concurrency=0, max_queue=10, max_total=2)
+    running = [scheduler.admit(1), scheduler.admit(1)]
+    busy = [scheduler.admit(1) for _ in range(3)]
+    quiet = scheduler.admit(2)
+    
+    running[0].release()
+    running[1].release()
+    
+    # 混んでいるアプリの待ちが先に3件あっても、空いた枠はアプリごとに順番に割り当てる
+    assert busy[0].granted and quiet.granted
+    assert not busy[1].granted and not busy[2].granted
+
+
+def test_wait_reports_position_and_times_out():
+    scheduler = ChatScheduler(max_concurrency=1, max_queue=2, queue_timeout=0.2, position_interval=0.05)
+    scheduler.admit(1)
+    ticket = scheduler.admit(1)
+    positions = []
+    
+    with pytest.raises(QueueTimeoutError):
+        for position in ticket.wait():
+            positions.append(position)
+    
+    assert positions == [1]
+    assert ticket.released and ticket.position() == 0
+    assert scheduler.stats()['apps']['1']['timed_out'] == 1
+    assert scheduler.stats()['apps']['1']['queued'] == 0
+
+
+def test_wait_returns_when_granted():
+    scheduler = ChatScheduler(max_concurrency=1, max_queue=2, position_interval=0.05)
+    first = scheduler.admit(1)
+    ticket = scheduler.admit(1)
+    positions = []
+    
+    for position in ticket.wait():
+        positions.append(position)
+        first.release()
+    
+    assert positions == [1] and ticket.granted
+
+
+@pytest.fixture
+def busy_app(monkeypatch):
+    """実行枠1つを使用中にしたアプリ1（上限を変えた ChatScheduler に差し替える）"""
+    from app import app
+    from utils import chat_service
+    from utils.app_registry import AppEntry
+    
+    def configure(max_queue, queue_timeout=120.0):
+        scheduler = ChatScheduler(queue_timeout=queue_timeout, position_interval=0.05)
+        entry = AppEntry(id=1, name='test', description=None, api_key_env_name='TEST_KEY', api_key='key',
+                         max_concurrency=1, max_queue=max_queue)
+        monkeypatch.setattr(chat_service, 'chat_scheduler', scheduler)
+        monkeypatch.setattr(chat_service.app_registry, 'get', lambda dify_app_id: entry)
+        scheduler.admit(1, 1, max_queue)
+        return app.test_client()
+    
+    return configure
+
+
+def counts():
+    from app import app
+    from database.models import Conversation, Message
+    
+    with app.app_context():
+        return Conversation.query.count(), Message.query.count()
+
+
+def test_chat_stream_returns_429_with_retry_after(busy_app):
+    client = busy_app(max_queue=0)
+    client.get('/api/dify-apps')
+    before = counts()
+    
+    response = client.post('/api/chat-stream', json={'message': '質問', 'dify_app_id': 1})
+    
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '10'
+    assert counts() == before
+
+
+def test_queue_timeout_removes_unanswered_turn(busy_app):
+    from app import app
+    from database.models import db, Conversation
+    from utils.persistence import persistence
+    
+    client = busy_app(max_queue=1, queue_timeout=0.2)
+    client.get('/api/dify-apps')
+    before = counts()
+    
+    # 新規会話: 会話ごと削除
+    body = client.post('/api/chat-stream', json={'message': '質問', 'dify_app_id': 1}).get_data(as_text=True)
+    persistence.flush(5)
+    
+    assert '"queued"' in body and '"error"' in body
+    assert counts() == before
+    
+    # 既存の会話: このターンのメッセージだけ削除し、件数を戻す
+    with app.app_context():
+        conversation = Conversation(title='既存', dify_app_id=1, message_count=0)
+        db.session.add(conversation)
+        db.session.commit()
+        conversation_id = conversation.id
+    client.post('/api/chat-stream', json={'message': '質問', 'dify_app_id': 1,
+                                          'conversation_id': conversation_id}).get_data()
+    persistence.flush(5)
+    
+    assert counts() == (before[0] + 1, before[1])
+    with app.app_context():
+        assert db.session.get(Conversation, conversation_id).message_count == 0
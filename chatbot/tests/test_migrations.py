@@ -0,0 +1,55 @@
+from sqlalchemy import create_engine, text
+
+from database.migrations import migrate, current_version, MIGRATIONS, LATEST_VERSION
+
+
+def test_fresh_database_reaches_latest_version(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fresh.db'}")
+    
+    report = migrate(engine)
+    
+    assert report['version'] == LATEST_VERSION
+    assert report['applied'] == [migration.name for migration in MIGRATIONS]
+    with engine.connect() as connection:
+        assert current_version(connection) == LATEST_VERSION
+        assert connection.execute(text("SELECT COUNT(*) FROM dify_apps")).scalar() == 3
+
+
+def test_second_migrate_does_nothing(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'twice.db'}")
+    migrate(engine)
+    with engine.connect() as connection:
+        recorded = connection.execute(text("SELECT version, applied_at FROM schema_version")).all()
+    
+    report = migrate(engine)
+    
+    assert report['applied'] == []
+    assert report['version'] == LATEST_VERSION
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT version, applied_at FROM schema_version")).all() == recorded
+        assert connection.execute(text("SELECT COUNT(*) FROM dify_apps")).scalar() == 3
+
+
+def test_partial_migration_continues_from_target(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'partial.db'}")
+    
+    assert migrate(engine, target=4)['version'] == 4
+    report = migrate(engine)
+    
+    assert report['applied'] == [migration.name for migration in MIGRATIONS if migration.version > 4]
+    assert report['version'] == LATEST_VERSION
+
+
+def test_first_request_initializes_database():
+    """起動時に initialize_database を呼ばないWSGIサーバーでも最初のリクエストで移行される"""
+    import app as app_module
+    from database.models import db
+    
+    app_module.database_initialized.clear()
+    response = app_module.app.test_client().get('/api/dify-apps')
+    
+    assert response.status_code == 200
+    assert app_module.database_initialized.is_set()
+    assert app_module.startup_report['schema_version'] == LATEST_VERSION
+    with app_module.app.app_context(), db.engine.connect() as connection:
+        assert current_version(connection) == LATEST_VERSION
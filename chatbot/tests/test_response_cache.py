@@ -0,0 +1,228 @@
+import json
+import asyncio
+import threading
+from types import SimpleNamespace
+
+from utils.response_cache import ResponseCache, SOURCE_CACHE, SOURCE_SHARED, SOURCE_UPSTREAM
+
+
+def answer_events(text):
+    return [
+        {'event': 'message', 'conversation_id': 'dify-1', 'answer': text},
+        {'event': 'message_end', 'conversation_id': 'dify-1', 'metadata': {}},
+    ]
+
+
+class FakeClient:
+    """上流の代わり（release が呼ばれるまで最初のイベントの後で止まる）"""
+    
+    def __init__(self, events, block=False):
+        self.events = events
+        self.calls = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+        if not block:
+            self.released.set()
+    
+    def stream_chat(self, message, conversation_id):
+        self.calls.append((message, conversation_id))
+        yield self.events[0]
+        self.started.set()
+        self.released.wait(5)
+        yield from self.events[1:]
+
+
+def reserve(cache, message, dify_app_id=1, dify_conversation_id=None):
+    admitted = []
+    reservation, _ = cache.reserve(dify_app_id, message, dify_conversation_id is not None,
+                                   lambda: admitted.append(True))
+    turn = SimpleNamespace(cache_reservation=reservation, message_content=message,
+                           dify_conversation_id=dify_conversation_id, response_source=None)
+    return turn, bool(admitted)
+
+
+def ask(cache, client, message, **kwargs):
+    turn, _ = reserve(cache, message, **kwargs)
+    return turn, list(cache.stream_chat(turn, client))
+
+
+def test_single_flight_fan_out_and_cache():
+    cache = ResponseCache(apps='1', replay_speed=0)
+    client = FakeClient(answer_events('回答'), block=True)
+    
+    first, admitted = reserve(cache, '障害対応の手順は？')
+    assert admitted and first.cache_reservation.source == SOURCE_UPSTREAM
+    first_events = []
+    reader = threading.Thread(target=lambda: first_events.extend(cache.stream_chat(first, client)))
+    reader.start()
+    assert client.started.wait(5)
+    
+    # 実行中の同じ質問（正規化後）は実行枠を取らずに相乗りする
+    second, admitted = reserve(cache, '障害対応の手順は')
+    assert not admitted and second.cache_reservation.source == SOURCE_SHARED
+    client.released.set()
+    second_events = list(cache.stream_chat(second, client))
+    reader.join(5)
+    
+    assert len(client.calls) == 1
+    assert first.response_source == SOURCE_UPSTREAM and first_events == client.events
+    # 他の会話へは Dify 側の会話IDを渡さない
+    assert second.response_source == SOURCE_SHARED
+    assert second_events == [{key: value for key, value in chunk.items() if key != 'conversation_id'}
+                             for chunk in client.events]
+    
+    third, admitted = reserve(cache, '障害対応の手順は？')
+    assert not admitted and third.cache_reservation.source == SOURCE_CACHE
+    assert list(cache.stream_chat(third, client)) == second_events
+    assert len(client.calls) == 1
+    stats = cache.stats()
+    assert (stats['misses'], stats['shared'], stats['hits'], stats['stored']) == (1, 1, 1, 1)
+
+
+def test_not_eligible_goes_upstream():
+    cache = ResponseCache(apps='1')
+    client = FakeClient(answer_events('回答'))
+    
+    # 対象外のアプリ・会話の続きは予約なしで毎回上流へ
+    for kwargs in ({'dify_app_id': 2}, {'dify_conversation_id': 'dify-1'}):
+        turn, events = ask(cache, client, '質問', **kwargs)
+        assert turn.cache_reservation is None and turn.response_source == SOURCE_UPSTREAM
+        assert events == client.events
+    assert client.calls == [('質問', None), ('質問', 'dify-1')]
+    assert cache.stats()['entries'] == 0
+
+
+def test_error_response_is_not_cached():
+    cache = ResponseCache(apps='1')
+    client = FakeClient([{'event': 'message', 'answer': '途中'}, {'event': 'error', 'message': 'upstream'}])
+    
+    ask(cache, client, '質問')
+    
+    assert cache.stats()['entries'] == 0 and cache.stats()['not_stored'] == 1
+
+
+def test_ttl_expiration():
+    cache = ResponseCache(apps='1', ttl=60, replay_speed=0)
+    client = FakeClient(answer_events('回答'))
+    ask(cache, client, '質問')
+    
+    for entry in cache._entries.values():
+        entry.expires_at = 0
+    turn, admitted = reserve(cache, '質問')
+    
+    assert admitted and turn.cache_reservation.source == SOURCE_UPSTREAM
+    assert cache.stats()['expirations'] == 1 and cache.stats()['entries'] == 0
+
+
+def test_lru_eviction_by_entries():
+    cache = ResponseCache(apps='1', max_entries=2, replay_speed=0)
+    client = FakeClient(answer_events('回答'))
+    ask(cache, client, 'a')
+    ask(cache, client, 'b')
+    
+    # a を使うと b が最も古くなる
+    assert ask(cache, client, 'a')[0].response_source == SOURCE_CACHE
+    ask(cache, client, 'c')
+    
+    assert [key[1] for key in cache._entries] == ['a', 'c']
+    assert cache.stats()['evictions'] == 1
+
+
+def test_eviction_by_bytes():
+    client = FakeClient(answer_events('回答' * 100))
+    probe = ResponseCache(apps='1')
+    ask(probe, client, 'a')
+    size = probe.stats()['bytes']
+    
+    cache = ResponseCache(apps='1', max_bytes=size * 2 + size // 2)
+    for message in ('a', 'b', 'c'):
+        ask(cache, client, message)
+    
+    assert [key[1] for key in cache._entries] == ['b', 'c']
+    assert cache.stats()['bytes'] == size * 2
+    
+    # 1件で上限を超える応答は登録しない
+    small = ResponseCache(apps='1', max_bytes=size - 1)
+    ask(small, client, 'a')
+    assert small.stats()['entries'] == 0 and small.stats()['not_stored'] == 1
+
+
+def test_single_flight_async():
+    cache = ResponseCache(apps='1', replay_speed=0)
+    events = answer_events('回答')
+    calls = []
+    
+    class AsyncClient:
+        async def astream_chat(self, message, conversation_id):
+            calls.append(message)
+            for chunk in events:
+                await asyncio.sleep(0.01)
+                yield chunk
+    
+    async def run(turn):
+        return [chunk async for chunk in cache.astream_chat(turn, AsyncClient())]
+    
+    async def main():
+        first, _ = reserve(cache, '質問')
+        task = asyncio.create_task(run(first))
+        await asyncio.sleep(0.005)
+        second, admitted = reserve(cache, '質問')
+        assert not admitted
+        return first, second, await task, await run(second)
+    
+    first, second, first_events, second_events = asyncio.run(main())
+    
+    assert calls == ['質問']
+    assert (first.response_source, second.response_source) == (SOURCE_UPSTREAM, SOURCE_SHARED)
+    assert first_events == events
+    assert second_events == [{key: value for key, value in chunk.items() if key != 'conversation_id'} for chunk in events]
+
+
+def test_follow_up_of_cached_conversation_goes_upstream(monkeypatch):
+    import app as app_module
+    from utils.app_registry import AppEntry
+    from utils.persistence import persistence
+    from utils.response_cache import response_cache
+    from utils import chat_service
+    
+    calls = []
+    
+    class FakeDifyClient:
+        def __init__(self, api_key):
+            pass
+        
+        def stream_chat(self, message, conversation_id):
+            calls.append((message, conversation_id))
+            yield from answer_events('回答')
+    
+    entry = AppEntry(id=1, name='test', description=None, api_key_env_name='TEST_KEY', api_key='key',
+                     max_concurrency=None, max_queue=None)
+    monkeypatch.setattr(app_module, 'DifyClient', FakeDifyClient)
+    monkeypatch.setattr(chat_service.app_registry, 'get', lambda dify_app_id: entry)
+    monkeypatch.setattr(response_cache, 'app_ids', {1})
+    monkeypatch.setattr(response_cache, 'replay_speed', 0)
+    client = app_module.app.test_client()
+    
+    def chat(**data):
+        body = client.post('/api/chat-stream', json={'message': '障害対応の手順は？', 'dify_app_id': 1, **data})
+        events = [json.loads(line[len('data: '):]) for line in body.get_data(as_text=True).splitlines()
+                  if line.startswith('data: {')]
+        persistence.flush(5)
+        return events[0]['conversation_id'], events[-1]
+    
+    try:
+        chat()
+        conversation_id, cached_end = chat()
+        assert cached_end['response_cache'] == SOURCE_CACHE
+        assert len(calls) == 1
+        
+        # キャッシュから応答した会話は Dify側の会話IDが無いが、続きの質問はキャッシュを使わない
+        _, follow_up_end = chat(conversation_id=conversation_id)
+        
+        assert 'response_cache' not in follow_up_end
+        assert calls == [('障害対応の手順は？', None), ('障害対応の手順は？', None)]
+        # 続きの質問で受け取った Dify側の会話IDを保存し、以降は文脈付きで送る
+        chat(conversation_id=conversation_id)
+        assert calls[-1] == ('障害対応の手順は？', 'dify-1')
+    finally:
+        response_cache.clear()
@@ -0,0 +1,45 @@
+from utils.response_parser import ResponseParser, KeyphraseExtractor
+from utils.analysis_jobs import run_analysis
+
+
+def message_end(*contents):
+    return {
+        'event': 'message_end',
+        'conversation_id': 'dify-1',
+        'metadata': {'retriever_resources': [{'content': content} for content in contents]},
+    }
+
+
+def test_frequencies_per_document_and_overall():
+    extractor = KeyphraseExtractor()
+    extractor.add_message_end(message_end('障害対応手順\r\n設計資料\r\n障害対応手順', '設計資料\r\n顧客契約書\r\nab'))
+    
+    result = extractor.result()
+    
+    assert [document['frequencies'] for document in result['document_keyphrases']] == [
+        {'障害対応手順': 2, '設計資料': 1},
+        {'設計資料': 1, '顧客契約書': 1},
+    ]
+    assert result['unique_keyphrases'] == ['障害対応手順', '設計資料', '顧客契約書']
+    assert result['keyphrase_frequencies'] == {'障害対応手順': 2, '設計資料': 2, '顧客契約書': 1}
+    assert result['total_keyphrase_count'] == 5
+    assert result['unique_keyphrase_count'] == 3
+
+
+def test_extract_keyphrases_reads_only_message_end():
+    chunks = [{'event': 'message', 'answer': '障害対応手順'}, message_end('障害対応手順\r\n設計資料')]
+    
+    result = ResponseParser.extract_keyphrases(chunks)
+    
+    assert result['unique_keyphrases'] == ['障害対応手順', '設計資料']
+    assert ResponseParser.keyphrase_rows(result) == [(1, '障害対応手順', 1), (1, '設計資料', 1)]
+
+
+def test_run_analysis_includes_frequencies():
+    chunks = [{'event': 'message', 'answer': 'a'}, message_end('設計資料\r\n設計資料')]
+    
+    result = run_analysis(chunks, [0, 5])
+    
+    assert result['keyphrases']['document_keyphrases'][0]['frequencies'] == {'設計資料': 2}
+    assert result['keyphrases']['keyphrase_frequencies'] == {'設計資料': 2}
+    assert result['stats']['event_counts'] == {'message': 1, 'message_end': 1}
@@ -0,0 +1,56 @@
+import pytest
+
+from utils.sse_decoder import SSEDecoder, ServerSentEvent
+
+STREAM = (
+    '\ufeff: ping\r\n'
+    'event: message\r\n'
+    'id: 1\r\n'
+    'data: {"answer": "障害"}\r\n'
+    '\r\n'
+    'data: 一行目\r'
+    'data: 二行目\r'
+    '\r'
+    'retry: 3000\n'
+    'data: {"event": "message_end"}\n'
+    '\n'
+).encode('utf-8')
+
+EXPECTED = [
+    ServerSentEvent('{"answer": "障害"}', 'message', '1', None),
+    ServerSentEvent('一行目\n二行目', 'message', '1', None),
+    ServerSentEvent('{"event": "message_end"}', 'message', '1', 3000),
+]
+
+
+def decode(chunks):
+    decoder = SSEDecoder()
+    events = []
+    for chunk in chunks:
+        events.extend(decoder.feed(chunk))
+    events.extend(decoder.flush())
+    return events
+
+
+def test_decode_whole_stream():
+    assert decode([STREAM]) == EXPECTED
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 5, 7])
+def test_decode_split_at_every_position(size):
+    # CRLF の CR と LF、UTF-8 の多バイト文字、BOM がチャンク境界で分かれても同じ結果
+    assert decode([STREAM[i:i + size] for i in range(0, len(STREAM), size)]) == EXPECTED
+
+
+def test_crlf_split_across_chunks_is_one_line_end():
+    chunks = [b'data: a\r', b'\ndata: b\r', b'\n\r', b'\n']
+    assert decode(chunks) == [ServerSentEvent('a\nb')]
+
+
+def test_cr_then_empty_line():
+    # 末尾の CR の後に CR が続く場合は空行（イベントの確定）
+    assert decode([b'data: a\r', b'\r']) == [ServerSentEvent('a')]
+
+
+def test_flush_returns_unterminated_event():
+    assert decode([b'data: a\n', b'data: b']) == [ServerSentEvent('a\nb')]
@@ -0,0 +1,54 @@
+import json
+
+from database.stream_recording import StreamRecorder, encode_stream, decode_stream, is_recording, stream_offsets
+
+CHUNKS = [
+    {'event': 'message', 'conversation_id': 'c-1', 'message_id': 'm-1', 'answer': '障害', 'created_at': 1},
+    {'event': 'message', 'conversation_id': 'c-1', 'message_id': 'm-1', 'answer': '対応', 'created_at': 1},
+    {'event': 'message_end', 'conversation_id': 'c-1', 'message_id': 'm-1', 'created_at': 1,
+     'metadata': {'usage': {'total_tokens': 10}}},
+]
+
+
+def round_trip(events, offsets=None):
+    # DBには JSON で保存される
+    return json.loads(json.dumps(encode_stream(events, offsets), ensure_ascii=False))
+
+
+def test_round_trip_keeps_json():
+    recording = round_trip(CHUNKS)
+    
+    assert is_recording(recording)
+    assert json.dumps(decode_stream(recording), ensure_ascii=False) == json.dumps(CHUNKS, ensure_ascii=False)
+    # 繰り返される値は envelope に一度だけ
+    assert recording['envelope']['conversation_id'] == 'c-1'
+    assert recording['events'][1][1] == {'answer': '対応'}
+
+
+def test_round_trip_keeps_types():
+    events = [{'value': 1}, {'value': True}, {'value': 1.0}, {'value': 1}, {'value': None}, {'value': 0}, {'value': False}]
+    
+    decoded = decode_stream(round_trip(events))
+    
+    assert decoded == events
+    assert [type(chunk['value']) for chunk in decoded] == [type(chunk['value']) for chunk in events]
+
+
+def test_key_order_and_missing_keys():
+    events = [{'a': 1, 'b': 2}, {'b': 2, 'a': 1}, {'b': 3}, {}]
+    
+    decoded = decode_stream(round_trip(events))
+    
+    assert [list(chunk.items()) for chunk in decoded] == [list(chunk.items()) for chunk in events]
+
+
+def test_recorder_offsets():
+    recorder = StreamRecorder()
+    for chunk, at in zip(CHUNKS, [10.0, 10.25, 11.5]):
+        recorder.append(chunk, at=at)
+    
+    recording = json.loads(json.dumps(recorder.encode()))
+    
+    assert recording['gaps'] == [0, 250, 1250]
+    assert stream_offsets(recording) == [0, 250, 1500]
+    assert decode_stream(recording) == CHUNKS
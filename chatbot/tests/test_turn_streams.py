@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from utils.chat_service import sse_event, SSE_DONE
+from utils.turn_streams import (TurnStreamRegistry, StreamElsewhereError, StreamGapError, WORKER_TAG_LENGTH,
+                                resume_position)
+
+CHAT_JS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'js', 'chat.js')
+
+UPSTREAM_FRAMES = [
+    sse_event({'event': 'queued', 'position': 1}),
+    sse_event({'event': 'message', 'answer': '障害対応は'}),
+    sse_event({'event': 'message', 'answer': '手順書を参照'}),
+    sse_event({'event': 'message_end', 'conversation_id': 'dify-1', 'message_id': 7}),
+    SSE_DONE,
+]
+
+
+def run_turn(registry, frames, message_id=7):
+    turn = SimpleNamespace(conversation_id=3, assistant_message_id=message_id)
+    stream = registry.start(turn, iter(frames))
+    return stream, list(stream.frames())
+
+
+def strip_id(framed):
+    header, _, frame = framed.partition('\n')
+    assert header.startswith('id: ')
+    return frame
+
+
+def test_stream_started_then_upstream_frames_unchanged():
+    registry = TurnStreamRegistry()
+    stream, framed = run_turn(registry, UPSTREAM_FRAMES)
+    
+    started = json.loads(strip_id(framed[0])[len('data: '):])
+    assert started == {'event': 'stream_started', 'stream_id': stream.stream_id, 'conversation_id': 3, 'message_id': 7}
+    # stream_started の後は上流から作ったフレームがそのまま（id 行を付けるだけ）
+    assert [strip_id(frame) for frame in framed[1:]] == UPSTREAM_FRAMES
+    assert [frame.partition('\n')[0] for frame in framed] == \
+        [f"id: {stream.stream_id}-{seq}" for seq in range(1, len(UPSTREAM_FRAMES) + 2)]
+
+
+def test_resume_from_last_event_id():
+    registry = TurnStreamRegistry()
+    stream, framed = run_turn(registry, UPSTREAM_FRAMES)
+    
+    after_seq = resume_position(stream.stream_id, f"{stream.stream_id}-3")
+    assert after_seq == 3
+    assert list(registry.get(stream.stream_id).frames(after_seq)) == framed[3:]
+    # 別のストリームの Last-Event-ID は先頭から
+    assert resume_position(stream.stream_id, 'other-3') == 0
+
+
+def test_ring_buffer_gap():
+    registry = TurnStreamRegistry(max_events=3)
+    frames = [sse_event({'event': 'message', 'answer': str(i)}) for i in range(10)]
+    stream, _ = run_turn(registry, frames)
+    
+    # stream_started を含む11件のうち最新の3件だけ残る
+    assert stream.dropped == 8
+    assert [strip_id(frame) for frame in stream.frames(8)] == frames[-3:]
+    with pytest.raises(StreamGapError):
+        stream.check(2)
+    gap = list(stream.frames(2))
+    assert len(gap) == 1 and '"stream_gap"' in gap[0]
+
+
+def test_stream_from_other_worker():
+    registry = TurnStreamRegistry()
+    stream, _ = run_turn(registry, UPSTREAM_FRAMES)
+    other_tag = format((int(registry.worker_tag, 16) + 1) % 16 ** WORKER_TAG_LENGTH, f'0{WORKER_TAG_LENGTH}x')
+    
+    assert registry.get(stream.stream_id) is stream
+    with pytest.raises(StreamElsewhereError):
+        registry.get(other_tag + stream.stream_id[WORKER_TAG_LENGTH:])
+    # ワーカーの識別子の形式でないIDは存在しないストリーム
+    assert registry.get('42') is None
+    assert registry.get('XYZ' + stream.stream_id) is None
+    assert registry.stats()['elsewhere'] == 1
+
+
+def test_resume_route_status():
+    from app import app, turn_streams
+    
+    other_tag = format((int(turn_streams.worker_tag, 16) + 1) % 16 ** WORKER_TAG_LENGTH, f'0{WORKER_TAG_LENGTH}x')
+    client = app.test_client()
+    
+    response = client.get(f"/api/chat-stream/{other_tag}abcdefghijklmnop")
+    assert response.status_code == 421
+    assert response.get_json()['error']
+    assert client.get(f"/api/chat-stream/{turn_streams.worker_tag}abcdefghijklmnop").status_code == 404
+
+
+# chat.js を jQuery・fetch のスタブの上で動かし、受信したイベントの表示結果を出力する
+CHAT_JS_HARNESS = r"""
+const fs = require('fs');
+const vm = require('vm');
+
+function element(state) {
+    const attrs = {};
+    return new Proxy({}, {
+        get(target, name) {
+            if (name === 'length') return 0;
+            if (name === 'attr') return (key, value) => {
+                if (value === undefined) return attrs[key];
+                attrs[key] = value;
+                return element(state);
+            };
+            if (name === 'text' || name === 'html') return (value) => {
+                if (value !== undefined) state.rendered = value;
+                return element(state);
+            };
+            return () => element(state);
+        }
+    });
+}
+
+const state = { rendered: '', errors: [], requests: [] };
+const body = process.argv[3];
+const context = {
+    console: { log() {}, warn() {}, error() {} },
+    TextDecoder, TextEncoder, setTimeout, clearInterval, Promise, Error, TypeError, JSON,
+    fetch(url, options) {
+        state.requests.push(url);
+        return Promise.resolve({
+            status: 200, ok: true,
+            headers: { get: () => null },
+            body: new Response(body).body,
+        });
+    },
+};
+context.$ = () => element(state);
+context.document = { createElement: () => ({ textContent: '', get innerHTML() { return this.textContent; } }) };
+context.window = {
+    AppUtils: { setLoading() {}, showError(message) { state.errors.push(message); } },
+    ChatApp: { currentDifyAppId: 1, currentConversationId: null },
+};
+vm.createContext(context);
+vm.runInContext(fs.readFileSync(process.argv[2], 'utf8'), context);
+context.window.ChatManager.sendMessage('質問');
+setTimeout(() => {
+    state.conversationId = context.window.ChatApp.currentConversationId;
+    process.stdout.write(JSON.stringify(state));
+}, 200);
+"""
+
+
+@pytest.mark.skipif(shutil.which('node') is None, reason='node が必要')
+def test_chat_js_ignores_stream_started(tmp_path):
+    _, framed = run_turn(TurnStreamRegistry(), UPSTREAM_FRAMES)
+    harness = tmp_path / 'harness.js'
+    harness.write_text(CHAT_JS_HARNESS, encoding='utf-8')
+    
+    result = subprocess.run(['node', str(harness), CHAT_JS, ''.join(framed)],
+                            capture_output=True, text=True, timeout=30, check=True)
+    state = json.loads(result.stdout)
+    
+    # stream_started は表示に影響せず、再接続も起きない
+    assert state['rendered'] == '障害対応は手順書を参照'
+    assert state['errors'] == []
+    assert state['requests'] == ['/api/chat-stream']
+    assert state['conversationId'] == 'dify-1'
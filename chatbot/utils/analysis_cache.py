@@ -0,0 +1,287 @@
+import os
+import json
+import zlib
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, Any, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# /api/messages/<id>/analysis で選択できるフィールド
+ANALYSIS_FIELDS = ('content', 'raw_response', 'keyphrases', 'analysis', 'created_at')
+
+
+@dataclass(slots=True)
+class AnalysisEntry:
+    """解析データ（パース済み）"""
+    message_id: int
+    content: str
+    raw_response: List[Dict[str, Any]]
+    keyphrases: Dict[str, Any]
+    analysis: Dict[str, Any]  # 解析ジョブの表示用サマリーと統計
+    created_at: datetime
+    etag: str
+    size: int  # メモリ使用量の目安（シリアライズ済みサイズ）
+    
+    def to_dict(self, fields=ANALYSIS_FIELDS, events_offset: int = 0, limit: Optional[int] = None) -> Dict[str, Any]:
+        """
+        レスポンス用の辞書を作成
+        
+        Args:
+            fields: 含めるフィールド（message_id は常に含める）
+            events_offset: raw_response の開始位置
+            limit: raw_response の最大件数（None なら末尾まで）
+        """
+        result: Dict[str, Any] = {'message_id': self.message_id, 'status': 'done'}
+        if 'content' in fields:
+            result['content'] = self.content
+        if 'raw_response' in fields:
+            end = None if limit is None else events_offset + limit
+            result['raw_response'] = self.raw_response[events_offset:end]
+            result['raw_response_offset'] = events_offset
+            result['raw_response_total'] = len(self.raw_response)
+        if 'keyphrases' in fields:
+            result['keyphrases'] = self.keyphrases
+        if 'analysis' in fields:
+            result['analysis'] = self.analysis
+        if 'created_at' in fields:
+            result['created_at'] = self.created_at.isoformat()
+        return result
+
+
+def build_analysis_entry(message_id: int, content: str, raw_response: List[Dict[str, Any]],
+                         keyphrase_data: Optional[str], created_at: datetime,
+                         analysis_data: Optional[str] = None) -> AnalysisEntry:
+    """DBから読み込んだ値で AnalysisEntry を作成（ETag もここで決める）"""
+    digest = hashlib.sha1()
+    digest.update(content.encode('utf-8'))
+    digest.update(b'\0')
+    digest.update((keyphrase_data or '').encode('utf-8'))
+    digest.update(b'\0')
+    digest.update((analysis_data or '').encode('utf-8'))
+    etag = f"{message_id}-{len(raw_response)}-{digest.hexdigest()[:16]}"
+    return AnalysisEntry(
+        message_id=message_id,
+        content=content,
+        raw_response=raw_response,
+        keyphrases=json.loads(keyphrase_data) if keyphrase_data else {},
+        analysis=json.loads(analysis_data) if analysis_data else {},
+        created_at=created_at,
+        etag=etag,
+        size=(len(content.encode('utf-8')) + len(keyphrase_data or '') + len(analysis_data or '')
+              + len(json.dumps(raw_response, ensure_ascii=False))),
+    )
+
+
+class AnalysisCache:
+    """
+    解析データのLRUキャッシュ（メッセージID単位）
+    
+    メモリ上は件数とサイズの上限を持つLRU。ANALYSIS_CACHE_DIR を指定すると
+    ディスク層（zlib 圧縮JSON）を併用し、メモリから追い出された後や
+    プロセス再起動後もパースし直さずに返せる。
+    
+    使い方:
+        analysis_cache = AnalysisCache()
+        analysis_cache.init_app(app)
+        entry = analysis_cache.get(message_id)
+    """
+    
+    def __init__(self, app=None, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024,
+                 disk_dir: Optional[str] = None, disk_max_bytes: int = 512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._entries: 'OrderedDict[int, AnalysisEntry]' = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._open_disk()
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.max_entries = int(app.config.get('ANALYSIS_CACHE_MAX_ENTRIES', os.getenv('ANALYSIS_CACHE_MAX_ENTRIES', self.max_entries)))
+        self.max_bytes = int(app.config.get('ANALYSIS_CACHE_MAX_BYTES', os.getenv('ANALYSIS_CACHE_MAX_BYTES', self.max_bytes)))
+        self.disk_dir = app.config.get('ANALYSIS_CACHE_DIR', os.getenv('ANALYSIS_CACHE_DIR', self.disk_dir))
+        self.disk_max_bytes = int(app.config.get('ANALYSIS_CACHE_DISK_MAX_BYTES',
+                                                 os.getenv('ANALYSIS_CACHE_DISK_MAX_BYTES', self.disk_max_bytes)))
+        self._open_disk()
+        app.extensions['analysis_cache'] = self
+    
+    def _open_disk(self):
+        """ディスク層のディレクトリを用意して使用量を数える"""
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(self.disk_dir) if entry.is_file())
+    
+    def get(self, message_id: int) -> Optional[AnalysisEntry]:
+        """キャッシュから取得（メモリ → ディスクの順）"""
+        with self._lock:
+            entry = self._entries.get(message_id)
+            if entry is not None:
+                self._entries.move_to_end(message_id)
+                self._stats['hits'] += 1
+                return entry
+        
+        entry = self._read_disk(message_id)
+        with self._lock:
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._stats['disk_hits'] += 1
+            self._store(entry)
+        return entry
+    
+    def put(self, entry: AnalysisEntry):
+        """キャッシュに登録（ディスク層があれば書き出す）"""
+        with self._lock:
+            self._store(entry)
+        self._write_disk(entry)
+    
+    def invalidate(self, message_id: int):
+        """メッセージ更新時にキャッシュを破棄"""
+        with self._lock:
+            entry = self._entries.pop(message_id, None)
+            if entry is not None:
+                self._bytes -= entry.size
+        path = self._disk_path(message_id)
+        if path and os.path.exists(path):
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                with self._lock:
+                    self._disk_bytes -= size
+            except OSError:
+                pass
+    
+    def invalidate_many(self, message_ids: List[int]):
+        """削除したメッセージのキャッシュをまとめて破棄"""
+        if len(message_ids) <= 64:
+            for message_id in message_ids:
+                self.invalidate(message_id)
+            return
+        
+        with self._lock:
+            for message_id in message_ids:
+                entry = self._entries.pop(message_id, None)
+                if entry is not None:
+                    self._bytes -= entry.size
+        if not self.disk_dir:
+            return
+        
+        # 件数が多い場合はファイルごとに存在確認せず、ディレクトリを1回走査する
+        targets = {f"{message_id}.json.z" for message_id in message_ids}
+        removed = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name in targets:
+                try:
+                    size = entry.stat().st_size
+                    os.remove(entry.path)
+                    removed += size
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_bytes -= removed
+    
+    def _store(self, entry: AnalysisEntry):
+        """メモリ層へ登録して上限を超えた分を追い出す（ロック保持中に呼ぶ）"""
+        if entry.size > self.max_bytes:
+            return
+        previous = self._entries.pop(entry.message_id, None)
+        if previous is not None:
+            self._bytes -= previous.size
+        self._entries[entry.message_id] = entry
+        self._bytes += entry.size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self._stats['evictions'] += 1
+    
+    def _disk_path(self, message_id: int) -> Optional[str]:
+        if not self.disk_dir:
+            return None
+        return os.path.join(self.disk_dir, f"{message_id}.json.z")
+    
+    def _read_disk(self, message_id: int) -> Optional[AnalysisEntry]:
+        path = self._disk_path(message_id)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                data = json.loads(zlib.decompress(f.read()))
+            data['created_at'] = datetime.fromisoformat(data['created_at'])
+            data.setdefault('analysis', {})
+            return AnalysisEntry(**data)
+        except (OSError, ValueError, TypeError, zlib.error) as e:
+            logger.warning(f"解析キャッシュの読み込みに失敗しました - ID: {message_id}: {e}")
+            return None
+    
+    def _write_disk(self, entry: AnalysisEntry):
+        path = self._disk_path(entry.message_id)
+        if not path:
+            return
+        data = {
+            'message_id': entry.message_id,
+            'content': entry.content,
+            'raw_response': entry.raw_response,
+            'keyphrases': entry.keyphrases,
+            'analysis': entry.analysis,
+            'created_at': entry.created_at.isoformat(),
+            'etag': entry.etag,
+            'size': entry.size,
+        }
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode('utf-8'), 6)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"解析キャッシュの書き込みに失敗しました - ID: {entry.message_id}: {e}")
+            return
+        with self._lock:
+            self._disk_bytes += len(blob)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._trim_disk()
+    
+    def _trim_disk(self):
+        """ディスク層が上限を超えたら古いファイルから削除"""
+        files = sorted(
+            (entry for entry in os.scandir(self.disk_dir) if entry.is_file() and entry.name.endswith('.json.z')),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        total = sum(entry.stat().st_size for entry in files)
+        for entry in files:
+            if total <= self.disk_max_bytes * 0.9:
+                break
+            try:
+                size = entry.stat().st_size
+                os.remove(entry.path)
+                total -= size
+            except OSError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率・使用量などの統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['disk_bytes'] = self._disk_bytes if self.disk_dir else 0
+        lookups = stats['hits'] + stats['disk_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['disk_hits']) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+analysis_cache = AnalysisCache()
@@ -0,0 +1,287 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
+
+from database.models import db, Message, Conversation
+from database.keyphrase_index import index_message_keyphrases
+from .response_parser import ResponseParser, KeyphraseExtractor
+from .persistence import persistence
+from .analysis_cache import analysis_cache
+from .metrics import metrics, PHASE_ANALYSIS
+
+logger = logging.getLogger(__name__)
+
+# Message.analysis_status の値（NULL は解析ジョブ導入前の行で、完了扱い）
+STATUS_PENDING = 'pending'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+# ジョブの実行段階（/api/messages/<id>/analysis の pending 応答で返す）
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_STORING = 'storing'
+
+
+def run_analysis(raw_response_data: List[Dict[str, Any]], offsets: Optional[List[int]] = None) -> Dict[str, Any]:
+    """
+    ストリーム完了後の解析（キーフレーズ抽出・表示用整形・統計）
+    
+    プロセスプールでも実行できるよう、DBやアプリケーションに依存しない関数にしておく。
+    
+    Args:
+        raw_response_data: Dify APIからの生レスポンスデータリスト
+        offsets: 各チャンクの受信時刻（先頭チャンクからの経過ミリ秒）
+    
+    Returns:
+        Dict: keyphrases（extract_keyphrases と同じ形式）, display, stats
+    """
+    extractor = KeyphraseExtractor()
+    event_counts: Dict[str, int] = {}
+    first_token_index = None
+    for index, chunk in enumerate(raw_response_data):
+        event = chunk.get('event', 'unknown')
+        if event == 'message_end':
+            extractor.add_message_end(chunk)
+        event_counts[event] = event_counts.get(event, 0) + 1
+        if first_token_index is None and event == 'message':
+            first_token_index = index
+    keyphrases = extractor.result()
+    
+    # イベント一覧は raw_response から取得できるため、表示用データからは除いて保存する
+    display = ResponseParser.format_response_for_display(raw_response_data)
+    display.pop('events', None)
+    final_answer = display.pop('final_answer', '')
+    
+    stats = {
+        'event_count': len(raw_response_data),
+        'event_counts': event_counts,
+        'answer_length': len(final_answer),
+        'source_document_count': len(keyphrases['source_documents']),
+        'stream_ms': offsets[-1] if offsets else None,
+        'first_token_ms': offsets[first_token_index] if offsets and first_token_index is not None else None,
+    }
+    return {'keyphrases': keyphrases, 'display': display, 'stats': stats}
+
+
+def _timed_analysis(raw_response_data: List[Dict[str, Any]], offsets: Optional[List[int]]) -> Tuple[Dict[str, Any], float]:
+    """run_analysis と実行時間（ワーカー側で計測）"""
+    started = time.perf_counter()
+    result = run_analysis(raw_response_data, offsets)
+    return result, time.perf_counter() - started
+
+
+class AnalysisJobQueue:
+    """
+    ストリーム完了後の解析ジョブ（スレッド / プロセスプール）
+    
+    キーフレーズ抽出や表示用整形はCPU処理のため、ストリーミング中のスレッドで
+    行うと他のストリームとGILを奪い合う。message_end 受信後にプールへ投入し、
+    結果は永続化キュー経由で Message に保存する。実行中のジョブ状態は
+    status() で参照でき、解析APIは完了まで pending を返す。
+    
+    設定:
+        ANALYSIS_WORKERS: ワーカー数（0 なら投入したスレッドでそのまま実行）
+        ANALYSIS_EXECUTOR: 'thread'（既定）または 'process'
+    
+    使い方:
+        analysis_jobs = AnalysisJobQueue()
+        analysis_jobs.init_app(app)
+        analysis_jobs.submit(message_id, raw_response_data, offsets, dify_app_id)
+        analysis_jobs.status(message_id)  # 'queued' / 'running' / 'storing' / None
+    """
+    
+    def __init__(self, app=None, workers: int = 2, executor: str = 'thread'):
+        self.workers = workers
+        self.executor_type = executor
+        self._executor: Optional[Executor] = None
+        self._jobs: Dict[int, Future] = {}
+        self._cond = threading.Condition()
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'job_seconds_total': 0.0,
+            'job_seconds_max': 0.0,
+            'queue_wait_seconds_total': 0.0,
+        }
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.workers = int(app.config.get('ANALYSIS_WORKERS', os.getenv('ANALYSIS_WORKERS', self.workers)))
+        self.executor_type = app.config.get('ANALYSIS_EXECUTOR', os.getenv('ANALYSIS_EXECUTOR', self.executor_type))
+        if self.executor_type not in ('thread', 'process'):
+            raise ValueError(f"不明な ANALYSIS_EXECUTOR: {self.executor_type}")
+        app.extensions['analysis_jobs'] = self
+        atexit.register(self.shutdown)
+    
+    def _ensure_executor(self) -> Optional[Executor]:
+        """初回投入時にプールを作成（ロック保持中に呼ぶ）"""
+        if self.workers <= 0:
+            return None
+        if self._executor is None:
+            if self.executor_type == 'process':
+                # ストリーミング用のスレッドが動いているプロセスから fork しないよう spawn を使う
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='analysis')
+        return self._executor
+    
+    def submit(self, message_id: int, raw_response_data: List[Dict[str, Any]],
+               offsets: Optional[List[int]] = None, dify_app_id: Optional[int] = None) -> str:
+        """
+        解析ジョブを投入（同じメッセージのジョブが実行中なら何もしない）
+        
+        dify_app_id は実行時間のヒストグラム（/metrics）のラベルに使う。
+        
+        Returns:
+            str: ジョブの実行段階
+        """
+        with self._cond:
+            if message_id in self._jobs:
+                return self._job_state(self._jobs[message_id])
+            executor = self._ensure_executor()
+            self._stats['submitted'] += 1
+            enqueued = time.monotonic()
+            if executor is None:
+                future: Future = Future()
+                self._jobs[message_id] = future
+            else:
+                try:
+                    future = executor.submit(_timed_analysis, raw_response_data, offsets)
+                except BrokenProcessPool:
+                    # ワーカープロセスが異常終了していたらプールを作り直す
+                    logger.warning("解析ジョブのプロセスプールを再作成します")
+                    self._executor = None
+                    future = self._ensure_executor().submit(_timed_analysis, raw_response_data, offsets)
+                self._jobs[message_id] = future
+        
+        if executor is None:
+            # ワーカー数 0: 呼び出し元のスレッドで実行
+            try:
+                future.set_result(_timed_analysis(raw_response_data, offsets))
+            except Exception as e:
+                future.set_exception(e)
+        future.add_done_callback(lambda done: self._on_done(message_id, enqueued, done, dify_app_id))
+        return self.status(message_id) or JOB_STORING
+    
+    def _on_done(self, message_id: int, enqueued: float, future: Future, dify_app_id: Optional[int] = None):
+        """ジョブ完了時に結果の保存を永続化キューへ投入"""
+        result = None
+        try:
+            result, elapsed = future.result()
+            metrics.observe(PHASE_ANALYSIS, dify_app_id, elapsed)
+            with self._cond:
+                self._stats['completed'] += 1
+                self._stats['job_seconds_total'] += elapsed
+                self._stats['job_seconds_max'] = max(self._stats['job_seconds_max'], elapsed)
+                self._stats['queue_wait_seconds_total'] += max(0.0, time.monotonic() - enqueued - elapsed)
+        except Exception as e:
+            logger.error(f"解析ジョブエラー (ID: {message_id}): {str(e)}")
+            with self._cond:
+                self._stats['failed'] += 1
+        
+        try:
+            persistence.submit(f"解析結果保存 (ID: {message_id})", lambda: self._store(message_id, result))
+        except RuntimeError as e:
+            # 終了処理中で永続化キューが停止している
+            logger.error(f"解析結果を保存できません (ID: {message_id}): {str(e)}")
+            self._finish(message_id)
+    
+    def _store(self, message_id: int, result: Optional[Dict[str, Any]]):
+        """解析結果を Message に保存（永続化キューのワーカーで実行）"""
+        try:
+            message = db.session.get(Message, message_id)
+            if message is None:
+                return
+            if result is None:
+                message.analysis_status = STATUS_FAILED
+            else:
+                message.keyphrase_data = json.dumps(result['keyphrases'], ensure_ascii=False)
+                message.analysis_data = json.dumps(
+                    {'display': result['display'], 'stats': result['stats']}, ensure_ascii=False
+                )
+                message.analysis_status = STATUS_DONE
+                
+                # 会話横断検索用のキーフレーズ索引
+                dify_app_id = db.session.execute(
+                    db.select(Conversation.dify_app_id).where(Conversation.id == message.conversation_id)
+                ).scalar_one()
+                index_message_keyphrases(
+                    message_id, message.conversation_id, dify_app_id,
+                    ResponseParser.keyphrase_rows(result['keyphrases'])
+                )
+            analysis_cache.invalidate(message_id)
+        finally:
+            self._finish(message_id)
+    
+    def _finish(self, message_id: int):
+        with self._cond:
+            self._jobs.pop(message_id, None)
+            self._cond.notify_all()
+    
+    @staticmethod
+    def _job_state(future: Future) -> str:
+        if future.done():
+            return JOB_STORING
+        return JOB_RUNNING if future.running() else JOB_QUEUED
+    
+    def status(self, message_id: int) -> Optional[str]:
+        """実行中のジョブの段階（ジョブが無ければ None）"""
+        with self._cond:
+            future = self._jobs.get(message_id)
+            return None if future is None else self._job_state(future)
+    
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """
+        投入済みのジョブが全て保存処理まで進むのを待つ
+        
+        Returns:
+            bool: タイムアウトせずに完了した場合 True
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._jobs:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+    
+    def shutdown(self, timeout: Optional[float] = 30.0):
+        """実行中のジョブを待ってプールを停止"""
+        if not self.wait(timeout):
+            logger.error(f"解析ジョブの完了待ちがタイムアウトしました - 残り {len(self._jobs)} 件")
+        with self._cond:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True)
+    
+    def stats(self) -> Dict[str, Any]:
+        """ジョブ数・実行時間などの統計"""
+        with self._cond:
+            stats = dict(self._stats)
+            states = [self._job_state(future) for future in self._jobs.values()]
+            stats['workers'] = self.workers
+            stats['executor'] = self.executor_type if self.workers > 0 else 'inline'
+        stats['queued'] = states.count(JOB_QUEUED)
+        stats['running'] = states.count(JOB_RUNNING)
+        stats['storing'] = states.count(JOB_STORING)
+        processed = stats['completed'] + stats['failed']
+        stats['avg_job_ms'] = round(stats['job_seconds_total'] / stats['completed'] * 1000, 3) if stats['completed'] else 0.0
+        stats['max_job_ms'] = round(stats['job_seconds_max'] * 1000, 3)
+        stats['avg_queue_wait_ms'] = round(stats['queue_wait_seconds_total'] / processed * 1000, 3) if processed else 0.0
+        return stats
+
+
+analysis_jobs = AnalysisJobQueue()
@@ -0,0 +1,218 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Tuple
+
+from dotenv import find_dotenv, load_dotenv
+
+from database.models import db
+from database.dify_apps import load_dify_apps, dify_apps_version
+
+logger = logging.getLogger(__name__)
+
+# 未登録のIDで引かれたときに変更を確認し直す最短間隔（存在しないIDの連続でDBを読み続けないように）
+MISS_RECHECK_SECONDS = 1.0
+
+
+@dataclass(frozen=True, slots=True)
+class AppEntry:
+    """Difyアプリ（APIキー解決済み）"""
+    id: int
+    name: str
+    description: Optional[str]
+    api_key_env_name: str
+    api_key: Optional[str]  # 環境変数が未設定なら None
+    max_concurrency: Optional[int]
+    max_queue: Optional[int]
+    
+    def to_dict(self) -> Dict[str, Any]:
+        """一覧API・画面用（APIキーは含めない）"""
+        return {'id': self.id, 'name': self.name, 'description': self.description}
+
+
+@dataclass(frozen=True, slots=True)
+class _Snapshot:
+    apps: Dict[int, AppEntry]
+    ordered: Tuple[AppEntry, ...]
+    version: int
+    env_mtime: Optional[float]
+
+
+_EMPTY = _Snapshot({}, (), -1, None)
+
+
+def _env_mtime(path: Optional[str]) -> Optional[float]:
+    if not path:
+        return None
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+class AppRegistry:
+    """
+    Difyアプリと解決済みAPIキーのプロセス内レジストリ
+    
+    dify_apps と APIキー（環境変数）を読み込んだ不変のスナップショットを持ち、
+    参照はロックを取らずにスナップショットの dict から引く。チャットの開始時に
+    DifyApp を読んだり os.getenv を呼んだりしない。
+    
+    変更は次のいずれかで反映する（再読み込みはスナップショットを丸ごと差し替える）。
+        - DIFY_APPS_POLL_SECONDS ごとにバックグラウンドスレッドが dify_apps の版数
+          （dify_apps_version、トリガーで更新）と .env の更新時刻を確認する
+        - POST /api/maintenance/dify-apps/reload
+        - 未登録のIDで引かれたとき（MISS_RECHECK_SECONDS に1回まで）
+    .env が変更された場合は読み込み直してから（override）APIキーを解決し直す。
+    
+    設定:
+        DIFY_APPS_POLL_SECONDS: 変更を確認する間隔（秒、0 なら定期確認しない）
+        DIFY_APPS_ENV_FILE: 監視する .env（既定は find_dotenv で見つかるファイル）
+    
+    使い方:
+        app_registry = AppRegistry()
+        app_registry.init_app(app)
+        app_registry.load()            # 起動時（initialize_database）
+        entry = app_registry.get(dify_app_id)
+    """
+    
+    def __init__(self, app=None, poll_seconds: float = 5.0):
+        self.app = None
+        self.poll_seconds = poll_seconds
+        self.env_file: Optional[str] = None
+        self._snapshot = _EMPTY
+        self._lock = threading.Lock()  # 再読み込みの直列化のみ（参照では取らない）
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_miss_check = 0.0
+        self._stats = {'reloads': 0, 'failures': 0, 'checks': 0, 'misses': 0}
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.app = app
+        self.poll_seconds = float(app.config.get('DIFY_APPS_POLL_SECONDS',
+                                                 os.getenv('DIFY_APPS_POLL_SECONDS', self.poll_seconds)))
+        env_file = app.config.get('DIFY_APPS_ENV_FILE', os.getenv('DIFY_APPS_ENV_FILE'))
+        if env_file:
+            # 既定の .env は app.py の load_dotenv で読み込み済み。別のファイルを指定した場合はここで読む
+            load_dotenv(env_file)
+        self.env_file = env_file or find_dotenv() or None
+        app.extensions['app_registry'] = self
+    
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not _EMPTY
+    
+    def load(self, reason: str = 'startup', reload_env: bool = False) -> Dict[str, Any]:
+        """
+        dify_apps を読み込んでスナップショットを差し替え、定期確認を開始する
+        
+        Returns:
+            Dict: 版数・アプリ数・APIキー未設定のアプリ
+        """
+        with self._lock:
+            env_mtime = _env_mtime(self.env_file)
+            if reload_env and self.env_file:
+                load_dotenv(self.env_file, override=True)
+            try:
+                with self.app.app_context(), db.engine.connect() as connection:
+                    version, rows = load_dify_apps(connection)
+            except Exception:
+                self._stats['failures'] += 1
+                raise
+            ordered = tuple(
+                AppEntry(id=row[0], name=row[1], description=row[2], api_key_env_name=row[3],
+                         api_key=os.getenv(row[3]) or None, max_concurrency=row[4], max_queue=row[5])
+                for row in rows
+            )
+            self._snapshot = _Snapshot({entry.id: entry for entry in ordered}, ordered, version, env_mtime)
+            self._stats['reloads'] += 1
+            self._start_watcher()
+        
+        missing = [entry.api_key_env_name for entry in ordered if entry.api_key is None]
+        logger.info(f"Difyアプリを読み込みました（{reason}）: {len(ordered)}件, 版数 {version}"
+                    + (f", APIキー未設定: {', '.join(missing)}" if missing else ''))
+        return {'version': version, 'apps': len(ordered), 'missing_api_keys': missing}
+    
+    def _ensure_loaded(self):
+        if not self.loaded:
+            self.load(reason='first_use')
+    
+    def get(self, dify_app_id) -> Optional[AppEntry]:
+        """IDで引く（未登録なら None）"""
+        try:
+            key = int(dify_app_id)
+        except (TypeError, ValueError):
+            return None
+        self._ensure_loaded()
+        entry = self._snapshot.apps.get(key)
+        if entry is None:
+            # 他のプロセスで追加された直後かもしれないため、間隔を空けて変更を確認する
+            self._stats['misses'] += 1
+            now = time.monotonic()
+            if now - self._last_miss_check >= MISS_RECHECK_SECONDS:
+                self._last_miss_check = now
+                if self.check():
+                    entry = self._snapshot.apps.get(key)
+        return entry
+    
+    def all(self) -> Tuple[AppEntry, ...]:
+        """全アプリ（ID順）"""
+        self._ensure_loaded()
+        return self._snapshot.ordered
+    
+    def check(self) -> bool:
+        """
+        版数と .env の更新時刻を確認し、変わっていれば読み込み直す
+        
+        Returns:
+            bool: 読み込み直した場合 True
+        """
+        self._stats['checks'] += 1
+        snapshot = self._snapshot
+        env_changed = _env_mtime(self.env_file) != snapshot.env_mtime
+        with self.app.app_context(), db.engine.connect() as connection:
+            version = dify_apps_version(connection)
+        if version == snapshot.version and not env_changed:
+            return False
+        self.load(reason='env_changed' if env_changed else 'db_changed', reload_env=env_changed)
+        return True
+    
+    def reload(self) -> Dict[str, Any]:
+        """手動で読み込み直す（.env も読み込み直す）"""
+        return self.load(reason='manual', reload_env=True)
+    
+    def _start_watcher(self):
+        if self.poll_seconds <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name='app-registry', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+    
+    def _loop(self):
+        """定期確認スレッド本体"""
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"Difyアプリの変更確認エラー: {str(e)}")
+    
+    def stop(self):
+        self._stop.set()
+    
+    def stats(self) -> Dict[str, Any]:
+        """読み込み状況"""
+        snapshot = self._snapshot
+        stats = dict(self._stats)
+        stats['apps'] = len(snapshot.ordered)
+        stats['version'] = snapshot.version
+        stats['missing_api_keys'] = sum(1 for entry in snapshot.ordered if entry.api_key is None)
+        return stats
+
+
+app_registry = AppRegistry()
@@ -0,0 +1,302 @@
+import os
+import math
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Any, Deque, Iterator, AsyncIterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Retry-After の見積もりに使う1ストリームの所要時間の初期値（秒）と平滑化係数
+INITIAL_RUN_SECONDS = 10.0
+RUN_SECONDS_SMOOTHING = 0.2
+
+
+class QueueFullError(Exception):
+    """待ち行列が満杯（429 で即時に断る）"""
+    
+    def __init__(self, dify_app_id: int, retry_after: int):
+        super().__init__(f"Difyアプリ {dify_app_id} の待ち行列が満杯です")
+        self.dify_app_id = dify_app_id
+        self.retry_after = retry_after
+
+
+class QueueTimeoutError(Exception):
+    """待ち行列で CHAT_QUEUE_TIMEOUT を超えて待った"""
+
+
+def _resolve(future: 'asyncio.Future'):
+    if not future.done():
+        future.set_result(None)
+
+
+class Ticket:
+    """
+    1リクエスト分の実行枠の予約
+    
+    admit で作成し、実行が終わったら（待ち中に切断した場合も）必ず release する。
+    """
+    
+    def __init__(self, scheduler: 'ChatScheduler', dify_app_id: int):
+        self.scheduler = scheduler
+        self.dify_app_id = dify_app_id
+        self.granted = False
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.granted_at: Optional[float] = None
+        self._event = threading.Event()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+    
+    def _grant(self):
+        """実行枠を割り当てる（スケジューラのロック保持中に呼ぶ）"""
+        self.granted = True
+        self.granted_at = time.monotonic()
+        self._event.set()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+    
+    @property
+    def waited_ms(self) -> int:
+        """待ち行列にいた時間"""
+        end = self.granted_at if self.granted_at is not None else time.monotonic()
+        return int((end - self.enqueued_at) * 1000)
+    
+    def position(self) -> int:
+        """待ち行列での順番（1始まり。実行中なら 0）"""
+        return self.scheduler.position(self)
+    
+    def release(self):
+        self.scheduler.release(self)
+    
+    def wait(self) -> Iterator[int]:
+        """
+        実行枠が割り当てられるまで待ち、その間の順番を変化するたびに返す
+        
+        Raises:
+            QueueTimeoutError: CHAT_QUEUE_TIMEOUT を超えた（予約は解放済み）
+        """
+        deadline = self.enqueued_at + self.scheduler.queue_timeout
+        last = None
+        while not self._event.is_set():
+            position = self.position()
+            if position and position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.scheduler.expire(self)
+                raise QueueTimeoutError(f"待ち時間が {self.scheduler.queue_timeout:.0f} 秒を超えました")
+            self._event.wait(min(self.scheduler.position_interval, remaining))
+    
+    async def await_slot(self) -> AsyncIterator[int]:
+        """wait の非同期版（イベントループを止めずに待つ）"""
+        loop = asyncio.get_running_loop()
+        deadline = self.enqueued_at + self.scheduler.queue_timeout
+        last = None
+        while True:
+            with self.scheduler._lock:
+                if self.granted:
+                    return
+                future = loop.create_future()
+                self._async_waiters.append((loop, future))
+            position = self.position()
+            if position and position != last:
+                last = position
+                yield position
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.scheduler.expire(self)
+                raise QueueTimeoutError(f"待ち時間が {self.scheduler.queue_timeout:.0f} 秒を超えました")
+            await asyncio.wait({future}, timeout=min(self.scheduler.position_interval, remaining))
+
+
+@dataclass
+class _AppState:
+    """Difyアプリごとの実行中数と待ち行列"""
+    max_concurrency: int
+    max_queue: int
+    running: int = 0
+    queue: Deque[Ticket] = field(default_factory=deque)
+    admitted: int = 0
+    rejected: int = 0
+    timed_out: int = 0
+    run_seconds: float = INITIAL_RUN_SECONDS
+
+
+class ChatScheduler:
+    """
+    Difyアプリごとの同時実行数の上限と待ち行列
+    
+    アプリごとに同時に上流へ流すストリーム数を制限し、超えた分は上限付きの
+    待ち行列で待たせる（待ち行列も満杯なら QueueFullError で即時に断る）。
+    全体の上限（CHAT_MAX_CONCURRENCY_TOTAL）を設けた場合は、空いた枠を
+    待ちのあるアプリへ順番に割り当てるため、1つのアプリの集中で他のアプリが待たされない。
+    
+    アプリごとの上限は DifyApp.max_concurrency / max_queue（NULL なら下記の既定値）。
+    
+    設定:
+        CHAT_MAX_CONCURRENCY: アプリごとの同時実行数の既定値（0 なら制限しない）
+        CHAT_MAX_QUEUE: アプリごとの待ち行列の長さの既定値
+        CHAT_MAX_CONCURRENCY_TOTAL: 全アプリ合計の同時実行数（0 なら制限しない）
+        CHAT_QUEUE_TIMEOUT: 待ち行列で待つ最大秒数
+        CHAT_QUEUE_POSITION_INTERVAL: 順番の通知を確認する間隔（秒）
+    
+    使い方:
+        ticket = chat_scheduler.admit(dify_app.id, dify_app.max_concurrency, dify_app.max_queue)
+        for position in ticket.wait(): ...   # async for position in ticket.await_slot()
+        ...
+        ticket.release()
+    """
+    
+    def __init__(self, app=None, max_concurrency: int = 8, max_queue: int = 32, max_total: int = 0,
+                 queue_timeout: float = 120.0, position_interval: float = 1.0):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_total = max_total
+        self.queue_timeout = queue_timeout
+        self.position_interval = position_interval
+        self._apps: Dict[int, _AppState] = {}
+        self._round_robin: Deque[int] = deque()
+        self._running_total = 0
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.max_concurrency = int(app.config.get('CHAT_MAX_CONCURRENCY', os.getenv('CHAT_MAX_CONCURRENCY', self.max_concurrency)))
+        self.max_queue = int(app.config.get('CHAT_MAX_QUEUE', os.getenv('CHAT_MAX_QUEUE', self.max_queue)))
+        self.max_total = int(app.config.get('CHAT_MAX_CONCURRENCY_TOTAL', os.getenv('CHAT_MAX_CONCURRENCY_TOTAL', self.max_total)))
+        self.queue_timeout = float(app.config.get('CHAT_QUEUE_TIMEOUT', os.getenv('CHAT_QUEUE_TIMEOUT', self.queue_timeout)))
+        self.position_interval = float(app.config.get('CHAT_QUEUE_POSITION_INTERVAL',
+                                                      os.getenv('CHAT_QUEUE_POSITION_INTERVAL', self.position_interval)))
+        app.extensions['chat_scheduler'] = self
+    
+    def _state(self, dify_app_id: int, max_concurrency: Optional[int], max_queue: Optional[int]) -> _AppState:
+        """アプリの状態を取得し、上限を最新の設定に合わせる（ロック保持中に呼ぶ）"""
+        concurrency = self.max_concurrency if max_concurrency is None else max_concurrency
+        queue = self.max_queue if max_queue is None else max_queue
+        state = self._apps.get(dify_app_id)
+        if state is None:
+            state = self._apps[dify_app_id] = _AppState(max_concurrency=concurrency, max_queue=queue)
+        else:
+            state.max_concurrency, state.max_queue = concurrency, queue
+        return state
+    
+    @staticmethod
+    def _has_slot(state: _AppState) -> bool:
+        return state.max_concurrency <= 0 or state.running < state.max_concurrency
+    
+    def _has_total_slot(self) -> bool:
+        return self.max_total <= 0 or self._running_total < self.max_total
+    
+    def _start(self, state: _AppState, ticket: Ticket):
+        state.running += 1
+        self._running_total += 1
+        ticket._grant()
+    
+    def _retry_after(self, state: _AppState) -> int:
+        """待ち行列が1件空くまで（実行中のどれかが終わるまで）の見積もり秒数"""
+        slots = state.max_concurrency if state.max_concurrency > 0 else 1
+        return max(1, math.ceil(state.run_seconds / slots))
+    
+    def admit(self, dify_app_id: int, max_concurrency: Optional[int] = None,
+              max_queue: Optional[int] = None) -> Ticket:
+        """
+        実行枠を予約（空きがあれば即時に実行可能、なければ待ち行列に入る）
+        
+        Raises:
+            QueueFullError: 待ち行列が満杯
+        """
+        with self._lock:
+            state = self._state(dify_app_id, max_concurrency, max_queue)
+            ticket = Ticket(self, dify_app_id)
+            if not state.queue and self._has_slot(state) and self._has_total_slot():
+                state.admitted += 1
+                self._start(state, ticket)
+                return ticket
+            if len(state.queue) >= state.max_queue:
+                state.rejected += 1
+                raise QueueFullError(dify_app_id, self._retry_after(state))
+            state.admitted += 1
+            state.queue.append(ticket)
+            if dify_app_id not in self._round_robin:
+                self._round_robin.append(dify_app_id)
+            return ticket
+    
+    def release(self, ticket: Ticket):
+        """予約を解放して次の待ちに枠を割り当てる（何度呼んでもよい）"""
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            state = self._apps[ticket.dify_app_id]
+            if ticket.granted:
+                state.running -= 1
+                self._running_total -= 1
+                elapsed = time.monotonic() - ticket.granted_at
+                state.run_seconds += RUN_SECONDS_SMOOTHING * (elapsed - state.run_seconds)
+            else:
+                state.queue.remove(ticket)
+            self._dispatch()
+    
+    def expire(self, ticket: Ticket):
+        """待ち時間切れで予約を解放"""
+        with self._lock:
+            if not ticket.granted and not ticket.released:
+                self._apps[ticket.dify_app_id].timed_out += 1
+        self.release(ticket)
+    
+    def _dispatch(self):
+        """空いた枠を待ちのあるアプリへ順番に割り当てる（ロック保持中に呼ぶ）"""
+        while self._round_robin and self._has_total_slot():
+            progressed = False
+            for _ in range(len(self._round_robin)):
+                if not self._has_total_slot():
+                    break
+                dify_app_id = self._round_robin.popleft()
+                state = self._apps[dify_app_id]
+                if state.queue and self._has_slot(state):
+                    self._start(state, state.queue.popleft())
+                    progressed = True
+                if state.queue:
+                    self._round_robin.append(dify_app_id)
+            if not progressed:
+                break
+    
+    def position(self, ticket: Ticket) -> int:
+        """待ち行列での順番（1始まり。実行中・解放済みなら 0）"""
+        with self._lock:
+            if ticket.granted or ticket.released:
+                return 0
+            return self._apps[ticket.dify_app_id].queue.index(ticket) + 1
+    
+    def stats(self) -> Dict[str, Any]:
+        """アプリごとの実行中数・待ち数・拒否数"""
+        with self._lock:
+            apps = {
+                str(dify_app_id): {
+                    'running': state.running,
+                    'queued': len(state.queue),
+                    'max_concurrency': state.max_concurrency,
+                    'max_queue': state.max_queue,
+                    'admitted': state.admitted,
+                    'rejected': state.rejected,
+                    'timed_out': state.timed_out,
+                    'avg_run_seconds': round(state.run_seconds, 2),
+                }
+                for dify_app_id, state in self._apps.items()
+            }
+            return {
+                'running': self._running_total,
+                'queued': sum(len(state.queue) for state in self._apps.values()),
+                'max_concurrency_total': self.max_total,
+                'apps': apps,
+            }
+
+
+chat_scheduler = ChatScheduler()
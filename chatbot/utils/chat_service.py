@@ -0,0 +1,374 @@
+import json
+import time
+import logging
+from datetime import datetime
+from functools import partial
+from typing import Dict, Any, Iterator, AsyncIterator, List, Optional
+
+from sqlalchemy import select
+
+from database.models import db, Conversation, Message
+from database.summary import (record_user_message, record_user_message_by_id, record_assistant_message,
+                              retract_user_message, extract_token_usage)
+from database.payload_store import store_raw_response
+from database.stream_recording import StreamRecorder
+from .persistence import persistence
+from .analysis_cache import analysis_cache
+from .analysis_jobs import analysis_jobs, STATUS_PENDING
+from .response_cache import response_cache, Reservation, SOURCE_UPSTREAM
+from .chat_scheduler import chat_scheduler, QueueFullError, Ticket
+from .app_registry import app_registry
+from .sse_relay import RelayEvent
+from .metrics import metrics, TurnTimings, PHASE_USER_MESSAGE, PHASE_QUEUE_WAIT, PHASE_FINAL_COMMIT
+
+logger = logging.getLogger(__name__)
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def sse_event(data: Dict[str, Any]) -> str:
+    """SSE の data フレームを生成（RelayEvent は受信した JSON をそのまま使う）"""
+    if type(data) is RelayEvent:
+        return f"data: {data.raw}\n\n"
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+class ChatRequestError(Exception):
+    """チャットリクエストの検証・保存エラー（HTTPステータス付き）"""
+    
+    def __init__(self, message: str, status_code: int, retry_after: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+        self.retry_after = retry_after  # 429 のときの Retry-After（秒）
+
+
+class ChatTurn:
+    """
+    1回のチャットターン（ユーザー発話 → アシスタント応答）の状態管理
+    
+    WSGI・ASGI どちらのストリーミング経路からも同じイベント形式と
+    DB保存処理を使えるように、ストリームの蓄積と保存をここにまとめる。
+    """
+    
+    def __init__(self, api_key: str, conversation_id: int, dify_conversation_id: Optional[str],
+                 message_content: str, assistant_message_id: int, dify_app_id: Optional[int] = None,
+                 ticket: Optional[Ticket] = None, timing_event: bool = False,
+                 cache_reservation: Optional[Reservation] = None, user_message_id: Optional[int] = None,
+                 new_conversation: bool = False):
+        self.api_key = api_key
+        self.dify_app_id = dify_app_id
+        self.ticket = ticket  # 上流の実行枠（キャッシュから応答できる場合は None）
+        self.cache_reservation = cache_reservation  # 応答キャッシュの予約（対象外なら None）
+        self.conversation_id = conversation_id
+        self.assistant_message_id = assistant_message_id
+        self.user_message_id = user_message_id
+        self.new_conversation = new_conversation  # このターンで会話を作成した
+        self.slot_ready = False  # 実行枠を得た（上流・キャッシュから応答を受け取り始めた）
+        self.completed = False
+        self.dify_conversation_id = dify_conversation_id
+        self.message_content = message_content
+        self.full_response = ''
+        self.recorder = StreamRecorder()
+        # 応答の出所（ResponseCache が設定する。upstream / shared / cache）
+        self.response_source: Optional[str] = None
+        # フェーズ別の所要時間（末尾の timing イベントで返す。Server-Timing ヘッダーは開始までのフェーズのみ）
+        self.timings = TurnTimings(metrics, dify_app_id)
+        self.timing_event = timing_event
+    
+    def wait_for_slot(self) -> Iterator[str]:
+        """実行枠が割り当てられるまで待ち、その間は順番待ちのフレームを返す"""
+        if self.ticket is not None:
+            for position in self.ticket.wait():
+                yield sse_event({'event': 'queued', 'position': position})
+        self._slot_ready()
+    
+    async def await_slot(self) -> AsyncIterator[str]:
+        """wait_for_slot の非同期版"""
+        if self.ticket is not None:
+            async for position in self.ticket.await_slot():
+                yield sse_event({'event': 'queued', 'position': position})
+        self._slot_ready()
+    
+    def _slot_ready(self):
+        self.slot_ready = True
+        if self.ticket is not None:
+            self.timings.record(PHASE_QUEUE_WAIT, self.ticket.waited_ms / 1000)
+        self.timings.start_upstream()
+    
+    def release(self):
+        """実行枠を解放（ストリーム終了・切断時に呼ぶ。何度呼んでもよい）"""
+        if self.ticket is not None:
+            self.ticket.release()
+    
+    @property
+    def raw_response_data(self) -> List[Dict[str, Any]]:
+        """受信したチャンクのリスト"""
+        return self.recorder.events
+    
+    def handle_chunk(self, chunk: Dict[str, Any]) -> str:
+        """
+        上流イベントを蓄積し、クライアントへ転送するフレームを返す
+        
+        DBアクセスは行わないため、イベントループ上から直接呼び出せる。
+        """
+        # レスポンスデータ蓄積（受信時刻も記録）
+        self.recorder.append(chunk)
+        if self.response_source == SOURCE_UPSTREAM:
+            self.timings.chunk()
+        
+        # messageイベントから回答内容を蓄積（Difyワークフロー形式）
+        if chunk.get('event') == 'message':
+            answer_part = chunk.get('answer', '')
+            if answer_part:
+                self.full_response += answer_part
+        
+        return sse_event(chunk)
+    
+    def complete(self, chunk: Dict[str, Any]) -> str:
+        """
+        message_end 受信時に最終フレームを返し、保存処理を永続化キューへ、
+        解析（キーフレーズ抽出など）を解析ジョブのプールへ投入
+        
+        アシスタントメッセージのIDはターン開始時に確保済みのため、
+        DB書き込みや解析の完了を待たずに message_id を含む最終イベントを送信できる。
+        
+        Returns:
+            str: message_id を含む最終フレーム
+        """
+        self.completed = True
+        if self.response_source == SOURCE_UPSTREAM:
+            self.timings.finish_upstream()
+        dify_conversation_id = chunk.get('conversation_id')
+        completed_at = time.perf_counter()
+        timings = self.timings
+        persistence.submit(
+            f"アシスタントメッセージ保存 (ID: {self.assistant_message_id})",
+            partial(
+                _save_assistant_message,
+                self.assistant_message_id,
+                self.conversation_id,
+                dify_conversation_id,
+                self.full_response,
+                self.recorder.events,
+                self.recorder.offsets
+            ),
+            on_commit=lambda: timings.record(PHASE_FINAL_COMMIT, time.perf_counter() - completed_at)
+        )
+        analysis_jobs.submit(self.assistant_message_id, self.recorder.events, self.recorder.offsets, self.dify_app_id)
+        
+        # message_id を含む最終データ送信
+        final_data = chunk.copy()
+        final_data['message_id'] = self.assistant_message_id
+        final_data['full_answer'] = self.full_response  # 完全な回答も送信
+        if self.response_source and self.response_source != SOURCE_UPSTREAM:
+            final_data['response_cache'] = self.response_source
+        logger.info(f"フロントエンドに送信するmessage_id: {final_data['message_id']}")
+        return sse_event(final_data)
+    
+    def timing_frame(self) -> str:
+        """
+        [DONE] の直前に送る timing イベント（self.timing_event が有効な場合のみ送る）
+        
+        アシスタントメッセージのコミット・解析は応答の送信後に行うため含まない（/metrics で参照する）。
+        """
+        return sse_event({'event': 'timing', 'phases': self.timings.as_dict()})
+    
+    def abort(self):
+        """
+        message_end を受信せずに終了した場合、確保済みのメッセージ行を削除
+            
+        クライアント切断やストリーミングエラー時に呼ぶ。完了済みなら何もしない。
+        実行枠を得る前（待ち時間切れなど）に終了した場合は上流に質問が届いていないため、
+        応答の無いユーザーメッセージも削除する（このターンで作成した会話は会話ごと）。
+        """
+        if self.completed:
+            return
+        self.completed = True
+        if not self.slot_ready and self.user_message_id is not None:
+            logger.info(f"実行前に終了したターンのメッセージを削除 - ID: {self.user_message_id}, {self.assistant_message_id}")
+            persistence.submit(
+                f"未実行ターン削除 (ID: {self.user_message_id}, {self.assistant_message_id})",
+                partial(_delete_unanswered_turn, self.conversation_id, self.user_message_id,
+                        self.assistant_message_id, self.new_conversation)
+            )
+            return
+        logger.info(f"未完了ターンのメッセージ行を削除 - ID: {self.assistant_message_id}")
+        persistence.submit(
+            f"未完了メッセージ削除 (ID: {self.assistant_message_id})",
+            partial(_delete_placeholder_message, self.assistant_message_id)
+        )
+            
+            
+def _save_assistant_message(message_id: int, conversation_id: int, dify_conversation_id: Optional[str],
+                            content: str, raw_response_data: List[Dict[str, Any]],
+                            offsets: Optional[List[int]] = None):
+    """アシスタントメッセージと会話の更新（永続化キューのワーカーで実行）"""
+    conversation = db.session.get(Conversation, conversation_id)
+    message = db.session.get(Message, message_id)
+    if conversation is None or message is None:
+        # ストリーミング中に会話が削除された
+        logger.info(f"保存対象のメッセージが存在しません - ID: {message_id}")
+        return
+    
+    # conversation_id 更新
+    if dify_conversation_id:
+        conversation.dify_conversation_id = dify_conversation_id
+    
+    # 会話サマリー更新（メッセージと同じトランザクション）
+    record_assistant_message(conversation, extract_token_usage(raw_response_data))
+    
+    # 完全なレスポンス構築（messageイベントから蓄積した内容を使用）
+    message.content = content
+    store_raw_response(message_id, raw_response_data, offsets)
+    
+    # キーフレーズ抽出などの解析結果は解析ジョブが後から書き込む
+    message.analysis_status = STATUS_PENDING
+    
+    analysis_cache.invalidate(message_id)
+    logger.info(f"メッセージ保存完了 - DB message_id: {message_id}, content_length: {len(content)}")
+
+
+def _delete_placeholder_message(message_id: int):
+    """確保済みの空メッセージ行を削除（永続化キューのワーカーで実行）"""
+    message = db.session.get(Message, message_id)
+    if message is not None and not message.content:
+        db.session.delete(message)
+
+
+def _delete_unanswered_turn(conversation_id: int, user_message_id: int, assistant_message_id: int,
+                            new_conversation: bool):
+    """上流に届かなかったターンのユーザーメッセージと確保済みの行を削除（永続化キューのワーカーで実行）"""
+    conversation = db.session.get(Conversation, conversation_id)
+    if conversation is None:
+        # 待っている間に会話が削除された
+        return
+    for message_id in (user_message_id, assistant_message_id):
+        message = db.session.get(Message, message_id)
+        if message is not None:
+            db.session.delete(message)
+    db.session.flush()
+    
+    # このターンで作成した会話は、他のメッセージが無ければ会話ごと削除
+    if new_conversation and db.session.scalar(
+            select(Message.id).where(Message.conversation_id == conversation_id).limit(1)) is None:
+        db.session.delete(conversation)
+    else:
+        retract_user_message(conversation)
+
+
+def start_chat_turn(data: Optional[Dict[str, Any]]) -> ChatTurn:
+    """
+    リクエストを検証し、ユーザーメッセージを保存してターンを開始
+    
+    アプリケーションコンテキスト内で呼び出すこと。
+    
+    上流を呼ぶ必要がある場合はコミットの前にアプリの実行枠を予約し、待ち行列が
+    満杯なら何も保存せずに 429 で断る。
+    
+    アプリとAPIキーはレジストリ（メモリ）から引き、既存の会話は Dify側の会話IDを
+    サマリー更新の UPDATE ... RETURNING で受け取るため、上流を呼ぶまでにDBを読まない。
+    
+    Raises:
+        ChatRequestError: 入力不正・アプリ未登録・待ち行列が満杯・保存失敗時
+    """
+    data = data or {}
+    message_content = data.get('message', '').strip()
+    conversation_id = data.get('conversation_id')
+    timing_event = metrics.timing_event or bool(data.get('timing'))
+    
+    if not message_content:
+        raise ChatRequestError('メッセージが空です', 400)
+    
+    # Difyアプリ情報・APIキー取得（レジストリから。DBは読まない）
+    dify_app = app_registry.get(data.get('dify_app_id'))
+    if not dify_app:
+        raise ChatRequestError('指定されたDifyアプリが見つかりません', 404)
+    if not dify_app.api_key:
+        raise ChatRequestError(f'APIキー {dify_app.api_key_env_name} が設定されていません', 500)
+    
+    # 既存の会話はサマリーを更新しつつ Dify側の会話IDを受け取る（コミットは実行枠の予約後）
+    write_started = time.perf_counter()
+    at = datetime.utcnow()
+    conversation_row = None
+    try:
+        if conversation_id:
+            conversation_row = record_user_message_by_id(db.session, conversation_id, message_content, at)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"メッセージ保存エラー: {str(e)}")
+        raise ChatRequestError(f'メッセージの保存に失敗しました: {str(e)}', 500)
+    write_seconds = time.perf_counter() - write_started
+    dify_conversation_id = conversation_row[1] if conversation_row else None
+    
+    # 上流の実行枠を予約（キャッシュ・実行中の同じ質問から応答できる場合は不要。確認と予約は reserve で一度に行う）
+    # 会話の続きはキャッシュの対象外（キャッシュから応答した会話は Dify側の会話IDを持たないため、会話の有無で判定）
+    try:
+        reservation, ticket = response_cache.reserve(
+            dify_app.id, message_content, conversation_row is not None,
+            lambda: chat_scheduler.admit(dify_app.id, dify_app.max_concurrency, dify_app.max_queue)
+        )
+    except QueueFullError as e:
+        db.session.rollback()
+        logger.warning(f"待ち行列が満杯のため拒否 - DifyアプリID: {dify_app.id}")
+        raise ChatRequestError('混雑しています。しばらくしてから再度お試しください', 429, e.retry_after)
+    
+    # 会話管理（トランザクション統一）
+    write_started = time.perf_counter()
+    try:
+        if conversation_row is None:
+            # 新規会話作成（指定された会話が存在しない場合も）
+            conversation = Conversation(
+                title=f"新しい会話 - {datetime.now().strftime('%Y/%m/%d %H:%M')}",
+                dify_app_id=dify_app.id
+            )
+            db.session.add(conversation)
+            db.session.flush()  # IDを取得するためflush
+            record_user_message(conversation, message_content, at)
+            conversation_id = conversation.id
+            logger.info(f"新規会話作成 - ID: {conversation_id}")
+        
+        # ユーザーメッセージ保存
+        user_message = Message(
+            conversation_id=conversation_id,
+            role='user',
+            content=message_content
+        )
+        db.session.add(user_message)
+        
+        # アシスタントメッセージのIDを先に確保（内容は message_end 後に書き込む）
+        assistant_message = Message(
+            conversation_id=conversation_id,
+            role='assistant',
+            content=''
+        )
+        db.session.add(assistant_message)
+        # IDはコミット前に取り出す（コミット後に参照すると期限切れの属性を SELECT し直すため）
+        db.session.flush()
+        user_message_id, assistant_message_id = user_message.id, assistant_message.id
+        db.session.commit()  # 一度だけコミット
+        logger.info(f"ユーザーメッセージ保存 - ID: {user_message_id}, 応答用ID: {assistant_message_id}")
+    
+    except Exception as e:
+        db.session.rollback()
+        if ticket is not None:
+            ticket.release()
+        logger.error(f"メッセージ保存エラー: {str(e)}")
+        raise ChatRequestError(f'メッセージの保存に失敗しました: {str(e)}', 500)
+    write_seconds += time.perf_counter() - write_started
+    
+    turn = ChatTurn(
+        api_key=dify_app.api_key,
+        conversation_id=conversation_id,
+        dify_conversation_id=dify_conversation_id,
+        message_content=message_content,
+        assistant_message_id=assistant_message_id,
+        dify_app_id=dify_app.id,
+        ticket=ticket,
+        timing_event=timing_event,
+        cache_reservation=reservation,
+        user_message_id=user_message_id,
+        new_conversation=conversation_row is None
+    )
+    turn.timings.record(PHASE_USER_MESSAGE, write_seconds)
+    return turn
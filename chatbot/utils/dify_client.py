@@ -1,32 +1,51 @@
+import os
 import requests
 import json
 import logging
-from typing import Generator, Dict, Any
+from typing import Generator, AsyncGenerator, Dict, Any, List, Optional, Tuple
+
+from .http_pool import DifySessionPool, get_default_pool, get_async_client
+from .sse_decoder import SSEDecoder, ServerSentEvent
+from .sse_relay import RelayEvent
+
+try:
+    import httpx
+except ImportError:  # ASGI経路を使わない場合は不要
+    httpx = None
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_BASE_URL = "https://api.dify.ai/v1"
+
+
+def relay_enabled() -> bool:
+    """DIFY_STREAM_RELAY（既定で有効）: 上流のイベントをパース・再シリアライズせずに転送する"""
+    return os.getenv('DIFY_STREAM_RELAY', '1').lower() in ('1', 'true', 'yes', 'on')
+
+
 class DifyClient:
-    """Dify API ストリーミングクライアント"""
+    """
+    Dify API ストリーミングクライアント
     
-    def __init__(self, api_key: str, base_url: str = "https://api.dify.ai/v1"):
+    relay が有効な場合、stream_chat / astream_chat は受信した data を保持する
+    RelayEvent を返す（クライアントへはそのまま転送され、JSON全体のパースは
+    保存・解析で参照されるまで遅延する）。無効なら従来どおりパース済みの dict を返す。
+    """
+    
+    def __init__(self, api_key: str, base_url: Optional[str] = None, pool: Optional[DifySessionPool] = None,
+                 relay: Optional[bool] = None):
         self.api_key = api_key
-        self.base_url = base_url
+        self.base_url = base_url or os.getenv('DIFY_API_BASE_URL', DEFAULT_BASE_URL)
+        self.pool = pool or get_default_pool()
+        self.relay = relay_enabled() if relay is None else relay
+        self._parse = self._relay_events if self.relay else self._parse_events
         self.headers = {
             "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
     
-    def stream_chat(self, message: str, conversation_id: str = None) -> Generator[Dict[Any, Any], None, None]:
-        """
-        Dify APIでストリーミングチャットを実行
-        
-        Args:
-            message: ユーザーメッセージ
-            conversation_id: 継続する会話のID（初回はNone）
-        
-        Yields:
-            Dict: パースされたレスポンスデータ
-        """
+    def _build_request(self, message: str, conversation_id: Optional[str]) -> Tuple[str, Dict[str, Any]]:
+        """chat-messages エンドポイントのURLとペイロードを生成"""
         url = f"{self.base_url}/chat-messages"
         
         payload = {
@@ -41,53 +60,45 @@ class DifyClient:
             payload["conversation_id"] = conversation_id
         
         logger.info(f"Dify API リクエスト: {payload}")
+        return url, payload
+    
+    def stream_chat(self, message: str, conversation_id: str = None) -> Generator[Dict[Any, Any], None, None]:
+        """
+        Dify APIでストリーミングチャットを実行
+        
+        Args:
+            message: ユーザーメッセージ
+            conversation_id: 継続する会話のID（初回はNone）
+        
+        Yields:
+            Dict: パースされたレスポンスデータ（転送モードでは RelayEvent）
+        """
+        url, payload = self._build_request(message, conversation_id)
         
         try:
-            response = requests.post(
-                url,
-                headers=self.headers,
-                json=payload,
-                stream=True,
-                timeout=30
-            )
-            
-            response.raise_for_status()
-            
-            buffer = ""
-            for chunk in response.iter_content(chunk_size=None, decode_unicode=True):
-                if chunk:
-                    buffer += chunk
-                    lines = buffer.split('\n')
-                    buffer = lines.pop()  # 最後の不完全な行は保持
+            with self.pool.session(self.api_key) as pooled:
+                response = self.pool.post(
+                    pooled,
+                    url,
+                    headers=self.headers,
+                    json=payload,
+                    stream=True,
+                    timeout=30
+                )
+                
+                with response:
+                    response.raise_for_status()
                     
-                    for line in lines:
-                        line = line.strip()
-                        if line.startswith('data: '):
-                            data_content = line[6:]  # "data: " を除去
-                            
-                            if data_content == '[DONE]':
-                                logger.info("ストリーミング完了")
-                                return
-                            
-                            try:
-                                parsed_data = json.loads(data_content)
-                                logger.debug(f"受信データ: {parsed_data}")
-                                yield parsed_data
-                                
-                            except json.JSONDecodeError as e:
-                                logger.warning(f"JSON解析エラー: {e}, データ: {data_content}")
-                                continue
-            
-            # 残りのバッファ処理
-            if buffer.strip():
-                if buffer.strip().startswith('data: '):
-                    data_content = buffer.strip()[6:]
-                    if data_content != '[DONE]':
-                        try:
-                            parsed_data = json.loads(data_content)
-                            yield parsed_data
-                        except json.JSONDecodeError:
-                            pass
+                    decoder = SSEDecoder()
+                    for chunk in response.iter_content(chunk_size=None):
+                        events, done = self._parse(decoder.feed(chunk))
+                        yield from events
+                        if done:
+                            return
+                    
+                    # 残りのバッファ処理
+                    events, _ = self._parse(decoder.flush())
+                    yield from events
         
         except requests.exceptions.RequestException as e:
             logger.error(f"Dify API リクエストエラー: {e}")
@@ -96,3 +107,96 @@ class DifyClient:
         except Exception as e:
             logger.error(f"予期しないエラー: {e}")
             raise Exception(f"チャット処理エラー: {str(e)}")
+
+    async def astream_chat(self, message: str, conversation_id: str = None) -> AsyncGenerator[Dict[Any, Any], None]:
+        """
+        stream_chat の非同期版（ASGI経路用）
+        
+        イベントループ単位で共有される httpx.AsyncClient を使うため、
+        待機中にワーカースレッドを占有しない。
+        
+        Args:
+            message: ユーザーメッセージ
+            conversation_id: 継続する会話のID（初回はNone）
+        
+        Yields:
+            Dict: パースされたレスポンスデータ（転送モードでは RelayEvent）
+        """
+        if httpx is None:
+            raise RuntimeError("非同期ストリーミングには httpx が必要です")
+        
+        url, payload = self._build_request(message, conversation_id)
+        client = get_async_client(self.api_key)
+        
+        try:
+            async with client.stream('POST', url, headers=self.headers, json=payload, timeout=30) as response:
+                response.raise_for_status()
+                
+                decoder = SSEDecoder()
+                async for chunk in response.aiter_bytes():
+                    events, done = self._parse(decoder.feed(chunk))
+                    for event in events:
+                        yield event
+                    if done:
+                        return
+                        
+                # 残りのバッファ処理
+                events, _ = self._parse(decoder.flush())
+                for event in events:
+                    yield event
+                            
+        except httpx.HTTPError as e:
+            logger.error(f"Dify API リクエストエラー: {e}")
+            raise Exception(f"Dify API 接続エラー: {str(e)}")
+        
+    @staticmethod
+    def _parse_events(sse_events: List[ServerSentEvent]) -> Tuple[List[Dict[Any, Any]], bool]:
+        """
+        デコード済みSSEイベントの data をJSONとしてパース
+        
+        Returns:
+            Tuple: (パース済みイベント, [DONE]受信フラグ)
+        """
+        events = []
+        for sse_event in sse_events:
+            data_content = sse_event.data
+        
+            if data_content == '[DONE]':
+                logger.info("ストリーミング完了")
+                return events, True
+                
+            try:
+                parsed_data = json.loads(data_content)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"受信データ: {parsed_data}")
+                events.append(parsed_data)
+                
+            except json.JSONDecodeError as e:
+                logger.warning(f"JSON解析エラー: {e}, データ: {data_content[:200]}")
+                continue
+                
+        return events, False
+    
+    @staticmethod
+    def _relay_events(sse_events: List[ServerSentEvent]) -> Tuple[List[RelayEvent], bool]:
+        """
+        _parse_events の転送モード版（data をパースせずに RelayEvent で包む）
+        
+        Returns:
+            Tuple: (RelayEvent のリスト, [DONE]受信フラグ)
+        """
+        events = []
+        for sse_event in sse_events:
+            data_content = sse_event.data
+            
+            if data_content == '[DONE]':
+                logger.info("ストリーミング完了")
+                return events, True
+            
+            try:
+                events.append(RelayEvent.decode(data_content))
+            except json.JSONDecodeError as e:
+                logger.warning(f"JSON解析エラー: {e}, データ: {data_content[:200]}")
+                continue
+        
+        return events, False
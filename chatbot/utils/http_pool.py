@@ -0,0 +1,294 @@
+import os
+import asyncio
+import socket
+import threading
+import time
+import logging
+from contextlib import contextmanager
+from typing import Dict, List, Any, Optional, Generator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+except ImportError:  # ASGI経路を使わない場合は不要
+    httpx = None
+
+logger = logging.getLogger(__name__)
+
+
+class _PooledSession:
+    """プールで管理される requests.Session とそのメタ情報"""
+
+    def __init__(self, session: requests.Session, adapter: HTTPAdapter):
+        self.session = session
+        self.adapter = adapter
+        self.created_at = time.monotonic()
+        self.last_used = self.created_at
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """TCP keep-alive ソケットオプションを設定する HTTPAdapter"""
+
+    def __init__(self, keepalive_idle: int = 0, **kwargs):
+        self.keepalive_idle = keepalive_idle
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self.keepalive_idle > 0:
+            socket_options = [
+                (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+                (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+            ]
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, self.keepalive_idle))
+            if hasattr(socket, 'TCP_KEEPINTVL'):
+                socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, self.keepalive_idle // 3)))
+            kwargs['socket_options'] = socket_options
+        super().init_poolmanager(*args, **kwargs)
+
+
+class DifySessionPool:
+    """
+    APIキーごとの keep-alive セッションプール
+
+    セッションはリクエストごとにチェックアウトされ、ストリーミング終了後に
+    プールへ返却される。返却されたセッションは保持している接続を再利用するため、
+    次のターンでは TCP/TLS ハンドシェイクが省略される。
+    """
+
+    def __init__(
+        self,
+        max_idle_per_key: int = 8,
+        connections_per_session: int = 1,
+        idle_timeout: float = 90.0,
+        keepalive_idle: int = 60,
+        max_retries: int = 2,
+        backoff_factor: float = 0.3,
+    ):
+        self.max_idle_per_key = max_idle_per_key
+        self.connections_per_session = connections_per_session
+        self.idle_timeout = idle_timeout
+        self.keepalive_idle = keepalive_idle
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+
+        self._idle: Dict[str, List[_PooledSession]] = {}
+        self._lock = threading.Lock()
+        self._stats = {
+            'pool_hits': 0,
+            'pool_misses': 0,
+            'evicted_idle': 0,
+            'discarded_overflow': 0,
+            'connections_created': 0,
+            'connections_reused': 0,
+            'handshake_seconds_total': 0.0,
+            'reused_request_seconds_total': 0.0,
+        }
+        self._checked_out = 0
+
+    @classmethod
+    def from_env(cls) -> 'DifySessionPool':
+        """環境変数からプール設定を読み込んで生成"""
+        return cls(
+            max_idle_per_key=int(os.getenv('DIFY_POOL_MAX_IDLE_PER_KEY', '8')),
+            connections_per_session=int(os.getenv('DIFY_POOL_CONNECTIONS_PER_SESSION', '1')),
+            idle_timeout=float(os.getenv('DIFY_POOL_IDLE_TIMEOUT', '90')),
+            keepalive_idle=int(os.getenv('DIFY_POOL_KEEPALIVE_IDLE', '60')),
+            max_retries=int(os.getenv('DIFY_POOL_MAX_RETRIES', '2')),
+            backoff_factor=float(os.getenv('DIFY_POOL_BACKOFF_FACTOR', '0.3')),
+        )
+
+    def _create_session(self, api_key: str) -> _PooledSession:
+        """新しいセッションを作成（接続エラー時のみリトライ）"""
+        # POSTは冪等ではないため、リトライは接続確立の失敗に限定する
+        retry = Retry(
+            total=self.max_retries,
+            connect=self.max_retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=self.backoff_factor,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = _KeepAliveAdapter(
+            keepalive_idle=self.keepalive_idle,
+            pool_connections=1,
+            pool_maxsize=self.connections_per_session,
+            max_retries=retry,
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            'Authorization': f'Bearer {api_key}',
+            'Connection': 'keep-alive',
+        })
+        return _PooledSession(session, adapter)
+
+    def _evict_expired(self, now: float) -> List[_PooledSession]:
+        """アイドル時間を超えたセッションを取り除く（ロック保持中に呼ぶ）"""
+        expired = []
+        for key, sessions in self._idle.items():
+            alive = []
+            for pooled in sessions:
+                if now - pooled.last_used > self.idle_timeout:
+                    expired.append(pooled)
+                else:
+                    alive.append(pooled)
+            self._idle[key] = alive
+        self._stats['evicted_idle'] += len(expired)
+        return expired
+
+    def acquire(self, api_key: str) -> _PooledSession:
+        """セッションをチェックアウト"""
+        now = time.monotonic()
+        with self._lock:
+            expired = self._evict_expired(now)
+            sessions = self._idle.get(api_key)
+            pooled = sessions.pop() if sessions else None
+            if pooled:
+                self._stats['pool_hits'] += 1
+            else:
+                self._stats['pool_misses'] += 1
+            self._checked_out += 1
+
+        for old in expired:
+            old.session.close()
+
+        if pooled is None:
+            pooled = self._create_session(api_key)
+        return pooled
+
+    def release(self, api_key: str, pooled: _PooledSession, reusable: bool = True):
+        """セッションをプールへ返却"""
+        pooled.last_used = time.monotonic()
+        discard = not reusable
+        with self._lock:
+            self._checked_out -= 1
+            if not discard:
+                sessions = self._idle.setdefault(api_key, [])
+                if len(sessions) < self.max_idle_per_key:
+                    sessions.append(pooled)
+                else:
+                    self._stats['discarded_overflow'] += 1
+                    discard = True
+        if discard:
+            pooled.session.close()
+
+    @contextmanager
+    def session(self, api_key: str) -> Generator[_PooledSession, None, None]:
+        """with 文でセッションを借用する"""
+        pooled = self.acquire(api_key)
+        reusable = True
+        try:
+            yield pooled
+        except requests.exceptions.ConnectionError:
+            # 接続が壊れている可能性があるため再利用しない
+            reusable = False
+            raise
+        finally:
+            self.release(api_key, pooled, reusable)
+
+    def post(self, pooled: _PooledSession, url: str, **kwargs) -> requests.Response:
+        """
+        POSTを送信し、新規接続か再利用接続かを記録
+
+        レスポンスヘッダ受信までの時間を、新規接続の場合はハンドシェイク込みの
+        時間として、再利用の場合は比較用の時間として集計する。
+        """
+        conn_pool = pooled.adapter.poolmanager.connection_from_url(url)
+        before = conn_pool.num_connections
+        started = time.perf_counter()
+        response = pooled.session.post(url, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            if conn_pool.num_connections > before:
+                self._stats['connections_created'] += 1
+                self._stats['handshake_seconds_total'] += elapsed
+            else:
+                self._stats['connections_reused'] += 1
+                self._stats['reused_request_seconds_total'] += elapsed
+        return response
+
+    def stats(self) -> Dict[str, Any]:
+        """プール統計を取得"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle_sessions'] = sum(len(s) for s in self._idle.values())
+            stats['checked_out_sessions'] = self._checked_out
+            stats['api_keys'] = len(self._idle)
+        created = stats['connections_created']
+        reused = stats['connections_reused']
+        avg_new = stats['handshake_seconds_total'] / created if created else 0.0
+        avg_reused = stats['reused_request_seconds_total'] / reused if reused else 0.0
+        stats['avg_new_connection_ttfb_ms'] = round(avg_new * 1000, 3)
+        stats['avg_reused_connection_ttfb_ms'] = round(avg_reused * 1000, 3)
+        stats['estimated_saved_ms_per_reuse'] = round(max(0.0, avg_new - avg_reused) * 1000, 3) if created and reused else 0.0
+        return stats
+
+    def close(self):
+        """全てのアイドルセッションを閉じる"""
+        with self._lock:
+            sessions = [p for items in self._idle.values() for p in items]
+            self._idle.clear()
+        for pooled in sessions:
+            pooled.session.close()
+
+
+_default_pool: Optional[DifySessionPool] = None
+_default_pool_lock = threading.Lock()
+
+
+def get_default_pool() -> DifySessionPool:
+    """プロセス共有のデフォルトプールを取得"""
+    global _default_pool
+    if _default_pool is None:
+        with _default_pool_lock:
+            if _default_pool is None:
+                _default_pool = DifySessionPool.from_env()
+    return _default_pool
+
+
+_async_clients: Dict[Any, Any] = {}
+_async_clients_lock = threading.Lock()
+
+
+def get_async_client(api_key: str) -> 'httpx.AsyncClient':
+    """
+    イベントループ・APIキー単位で共有される httpx.AsyncClient を取得
+    
+    AsyncClient はイベントループをまたいで使えないため、ループごとに保持する。
+    """
+    loop = asyncio.get_running_loop()
+    key = (id(loop), api_key)
+    client = _async_clients.get(key)
+    if client is None or client.is_closed:
+        with _async_clients_lock:
+            client = _async_clients.get(key)
+            if client is None or client.is_closed:
+                limits = httpx.Limits(
+                    max_connections=int(os.getenv('DIFY_ASYNC_MAX_CONNECTIONS', '1000')),
+                    max_keepalive_connections=int(os.getenv('DIFY_POOL_MAX_IDLE_PER_KEY', '8')) * 4,
+                    keepalive_expiry=float(os.getenv('DIFY_POOL_IDLE_TIMEOUT', '90')),
+                )
+                transport = httpx.AsyncHTTPTransport(
+                    limits=limits,
+                    retries=int(os.getenv('DIFY_POOL_MAX_RETRIES', '2')),
+                )
+                client = httpx.AsyncClient(transport=transport)
+                _async_clients[key] = client
+    return client
+
+
+async def close_async_clients():
+    """現在のイベントループに属する AsyncClient を全て閉じる"""
+    loop_id = id(asyncio.get_running_loop())
+    with _async_clients_lock:
+        keys = [key for key in _async_clients if key[0] == loop_id]
+        clients = [_async_clients.pop(key) for key in keys]
+    for client in clients:
+        await client.aclose()
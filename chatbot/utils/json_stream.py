@@ -0,0 +1,33 @@
+import json
+from typing import Dict, Any, Iterable, Iterator
+
+# NDJSON（1行1オブジェクト）の MIME タイプ
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _dumps(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def stream_json_object(header: Dict[str, Any], items_key: str, items: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """
+    header に items_key の配列を加えた1つのJSONオブジェクトを分割して出力
+    
+    配列の要素は1件ずつ直列化するため、全件をメモリに載せずに jsonify と
+    同じ構造のレスポンスを返せる。
+    """
+    opening = _dumps(header)
+    if header:
+        yield opening[:-1] + f',{_dumps(items_key)}:['
+    else:
+        yield '{' + f'{_dumps(items_key)}:['
+    for index, item in enumerate(items):
+        yield (',' if index else '') + _dumps(item)
+    yield ']}'
+
+
+def stream_ndjson(header: Dict[str, Any], items: Iterable[Dict[str, Any]]) -> Iterator[str]:
+    """header を1行目、items の各要素を以降の行として NDJSON で出力"""
+    yield _dumps(header) + '\n'
+    for item in items:
+        yield _dumps(item) + '\n'
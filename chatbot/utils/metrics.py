@@ -0,0 +1,265 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Any, Iterable, List, Optional, Tuple
+
+# チャットターンのフェーズ名（ヒストグラムの phase ラベル）
+PHASE_USER_MESSAGE = 'user_message_write'    # ユーザーメッセージと応答用の行のコミット
+PHASE_QUEUE_WAIT = 'queue_wait'              # 実行枠の順番待ち
+PHASE_FIRST_BYTE = 'upstream_first_byte'     # 上流の呼び出しから最初のイベントまで
+PHASE_CHUNK_GAP = 'upstream_chunk_gap'       # 上流イベントの受信間隔
+PHASE_STREAM = 'upstream_stream'             # 上流の呼び出しから message_end まで
+PHASE_ANALYSIS = 'analysis'                  # 解析ジョブ（キーフレーズ抽出・表示用整形）
+PHASE_FINAL_COMMIT = 'final_commit'          # message_end からアシスタントメッセージのコミットまで
+PHASE_PERSISTENCE_COMMIT = 'persistence_commit'  # 永続化キューの1バッチのコミット
+
+# 応答ヘッダーの送信（ストリーム開始）までに記録が終わるフェーズ（Server-Timing ヘッダーで返す）
+START_PHASES = (PHASE_USER_MESSAGE,)
+
+# ヒストグラムの既定のバケット境界（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+StatsCollector = Callable[[], Dict[str, Any]]
+
+
+class Histogram:
+    """
+    固定バケットのヒストグラム
+    
+    observe はバケットの二分探索とロック内の加算だけで、1回あたり1マイクロ秒程度。
+    バケットごとの件数は累積せずに持ち、出力時に累積する。
+    """
+    
+    __slots__ = ('bounds', 'counts', 'total', 'count', '_lock')
+    
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 末尾は +Inf
+        self.total = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+    
+    def observe(self, seconds: float):
+        index = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[index] += 1
+            self.total += seconds
+            self.count += 1
+    
+    def snapshot(self) -> Tuple[List[int], float, int]:
+        """累積済みのバケット件数・合計・件数"""
+        with self._lock:
+            counts, total, count = list(self.counts), self.total, self.count
+        cumulative, running = [], 0
+        for value in counts:
+            running += value
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        return repr(value) if value == value else 'NaN'
+    return str(value)
+
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + '}'
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+class Metrics:
+    """
+    チャットターンのフェーズ別レイテンシの計測と Prometheus 形式の出力
+    
+    フェーズ（PHASE_*）と Difyアプリごとにヒストグラムへ記録し、/metrics で
+    各コンポーネントの stats()（接続プール・永続化キュー・待ち行列など）を
+    ゲージとして合わせて出力する。1ターン分の計測値は ChatTurn が保持し、
+    末尾の timing イベントで返す。Server-Timing ヘッダーはストリームの開始前に
+    送るため、開始までのフェーズ（START_PHASES）だけを含む。
+    
+    設定:
+        METRICS_BUCKETS: バケット境界（秒、カンマ区切り）
+        METRICS_TIMING_EVENT: 全てのストリームの末尾に timing イベントを付ける
+                              （無効でもリクエストの "timing": true で個別に付けられる）
+    
+    使い方:
+        metrics = Metrics()
+        metrics.init_app(app)
+        metrics.register_stats('persistence', persistence.stats)
+        metrics.observe(PHASE_ANALYSIS, dify_app_id, seconds)
+        metrics.render_prometheus()
+    """
+    
+    def __init__(self, app=None, buckets: Tuple[float, ...] = DEFAULT_BUCKETS, timing_event: bool = False):
+        self.buckets = tuple(sorted(buckets))
+        self.timing_event = timing_event
+        self._histograms: Dict[Tuple[str, Optional[int]], Histogram] = {}
+        self._collectors: List[Tuple[str, StatsCollector]] = []
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        buckets = app.config.get('METRICS_BUCKETS', os.getenv('METRICS_BUCKETS'))
+        if buckets:
+            if isinstance(buckets, str):
+                buckets = [value for value in buckets.split(',') if value.strip()]
+            self.buckets = tuple(sorted(float(value) for value in buckets))
+        timing_event = app.config.get('METRICS_TIMING_EVENT', os.getenv('METRICS_TIMING_EVENT', self.timing_event))
+        self.timing_event = str(timing_event).lower() in ('1', 'true', 'yes', 'on')
+        app.extensions['metrics'] = self
+    
+    def histogram(self, phase: str, dify_app_id: Optional[int] = None) -> Histogram:
+        """フェーズ・アプリのヒストグラム（初回のみロックを取って作成）"""
+        key = (phase, dify_app_id)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.get(key)
+                if histogram is None:
+                    histogram = self._histograms[key] = Histogram(self.buckets)
+        return histogram
+    
+    def observe(self, phase: str, dify_app_id: Optional[int], seconds: float):
+        """フェーズの所要時間（秒）を記録"""
+        self.histogram(phase, dify_app_id).observe(seconds)
+    
+    def register_stats(self, component: str, collector: StatsCollector):
+        """
+        stats() の数値をゲージとして出力する（chatbot_<component>_<キー>）
+        
+        値が dict の dict（chat_scheduler の apps など）の場合は、外側のキーを
+        dify_app ラベルにして出力する。
+        """
+        with self._lock:
+            self._collectors = [item for item in self._collectors if item[0] != component]
+            self._collectors.append((component, collector))
+    
+    def _render_histograms(self) -> Iterable[str]:
+        with self._lock:
+            histograms = sorted(self._histograms.items(), key=lambda item: (item[0][0], str(item[0][1] or '')))
+        if not histograms:
+            return
+        name = 'chatbot_phase_seconds'
+        yield f'# HELP {name} チャットターンのフェーズ別の所要時間（秒）'
+        yield f'# TYPE {name} histogram'
+        for (phase, dify_app_id), histogram in histograms:
+            labels = {'phase': phase, 'dify_app': '' if dify_app_id is None else dify_app_id}
+            cumulative, total, count = histogram.snapshot()
+            for bound, value in zip(histogram.bounds, cumulative):
+                yield f'{name}_bucket{_labels({**labels, "le": _format_value(float(bound))})} {value}'
+            yield f'{name}_bucket{_labels({**labels, "le": "+Inf"})} {cumulative[-1]}'
+            yield f'{name}_sum{_labels(labels)} {_format_value(total)}'
+            yield f'{name}_count{_labels(labels)} {count}'
+    
+    def _render_stats(self, component: str, stats: Dict[str, Any]) -> Iterable[str]:
+        for key, value in stats.items():
+            name = f'chatbot_{component}_{key}'
+            if _is_number(value):
+                yield f'# TYPE {name} gauge'
+                yield f'{name} {_format_value(value)}'
+            elif isinstance(value, dict) and value and all(isinstance(item, dict) for item in value.values()):
+                fields: Dict[str, List[str]] = {}
+                for label, item in value.items():
+                    for field, number in item.items():
+                        if _is_number(number):
+                            fields.setdefault(field, []).append(
+                                f'{name}_{field}{_labels({"dify_app": label})} {_format_value(number)}'
+                            )
+                for field, lines in fields.items():
+                    yield f'# TYPE {name}_{field} gauge'
+                    yield from lines
+    
+    def render_prometheus(self) -> str:
+        """Prometheus のテキスト形式で出力"""
+        lines = list(self._render_histograms())
+        with self._lock:
+            collectors = list(self._collectors)
+        for component, collector in collectors:
+            try:
+                lines.extend(self._render_stats(component, collector()))
+            except Exception as e:
+                lines.append(f'# {component} の統計を取得できません: {_escape_label(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+class TurnTimings:
+    """
+    1ターン分のフェーズ計測（ChatTurn が保持）
+    
+    記録と同時に Metrics のヒストグラムへも反映する。受信間隔はイベントごとに
+    記録されるため、ターン単位では最大値と件数だけを残す。
+    """
+    
+    __slots__ = ('metrics', 'dify_app_id', 'phases', 'upstream_started', 'last_chunk_at', 'max_gap', 'gaps')
+    
+    def __init__(self, metrics: Metrics, dify_app_id: Optional[int]):
+        self.metrics = metrics
+        self.dify_app_id = dify_app_id
+        self.phases: Dict[str, float] = {}
+        self.upstream_started: Optional[float] = None
+        self.last_chunk_at: Optional[float] = None
+        self.max_gap = 0.0
+        self.gaps = 0
+    
+    def record(self, phase: str, seconds: float):
+        """フェーズの所要時間（秒）を記録"""
+        self.phases[phase] = seconds
+        self.metrics.observe(phase, self.dify_app_id, seconds)
+    
+    def start_upstream(self):
+        """上流の呼び出しを始める直前に呼ぶ"""
+        self.upstream_started = time.perf_counter()
+    
+    def chunk(self):
+        """上流イベントの受信ごとに呼ぶ（最初の1件は first_byte、以降は受信間隔）"""
+        now = time.perf_counter()
+        if self.last_chunk_at is None:
+            if self.upstream_started is not None:
+                self.record(PHASE_FIRST_BYTE, now - self.upstream_started)
+        else:
+            gap = now - self.last_chunk_at
+            self.metrics.observe(PHASE_CHUNK_GAP, self.dify_app_id, gap)
+            self.gaps += 1
+            if gap > self.max_gap:
+                self.max_gap = gap
+        self.last_chunk_at = now
+    
+    def finish_upstream(self):
+        """message_end の受信時に呼ぶ"""
+        if self.upstream_started is not None:
+            self.record(PHASE_STREAM, time.perf_counter() - self.upstream_started)
+    
+    def as_dict(self) -> Dict[str, float]:
+        """フェーズごとのミリ秒"""
+        result = {phase: round(seconds * 1000, 3) for phase, seconds in self.phases.items()}
+        if self.gaps:
+            result[f'{PHASE_CHUNK_GAP}_max'] = round(self.max_gap * 1000, 3)
+        return result
+    
+    def server_timing(self) -> str:
+        """
+        Server-Timing ヘッダーの値（START_PHASES のうち記録済みのもの）
+        
+        ヘッダーはストリームの開始前に送るため、順番待ち（queue_wait）や上流の
+        フェーズは含まない。全フェーズは末尾の timing イベント（timing_frame）で返す。
+        """
+        phases = self.as_dict()
+        return ', '.join(f'{phase};dur={phases[phase]}' for phase in START_PHASES if phase in phases)
+
+
+metrics = Metrics()
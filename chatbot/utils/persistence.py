@@ -0,0 +1,218 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from typing import Callable, Deque, Dict, Any, List, Optional, Tuple
+
+from database.models import db
+from .metrics import metrics, PHASE_PERSISTENCE_COMMIT
+
+logger = logging.getLogger(__name__)
+
+Operation = Callable[[], None]
+Item = Tuple[str, Operation, float, Optional[Callable[[], None]]]
+
+
+class PersistenceQueue:
+    """
+    ライトビハインド方式のDB書き込みキュー
+    
+    ストリーミング応答の完了処理など、ユーザーへの応答を待たせる必要のない
+    書き込みをバックグラウンドスレッドへ回し、複数件を1トランザクションに
+    まとめてコミットする。プロセス終了時には atexit で残りを書き出す。
+    
+    使い方:
+        persistence = PersistenceQueue()
+        persistence.init_app(app)
+        persistence.submit('説明', lambda: db.session.add(...))
+    """
+    
+    def __init__(self, app=None, max_batch: int = 64, max_delay: float = 0.02):
+        self.app = None
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._items: Deque[Item] = deque()
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self._stats = {
+            'submitted': 0,
+            'committed_ops': 0,
+            'failed_ops': 0,
+            'batches': 0,
+            'commit_seconds_total': 0.0,
+            'commit_seconds_max': 0.0,
+            'last_commit_seconds': 0.0,
+            'queue_wait_seconds_total': 0.0,
+        }
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.app = app
+        self.max_batch = int(app.config.get('PERSISTENCE_MAX_BATCH', os.getenv('PERSISTENCE_MAX_BATCH', self.max_batch)))
+        self.max_delay = float(app.config.get('PERSISTENCE_MAX_DELAY', os.getenv('PERSISTENCE_MAX_DELAY', self.max_delay)))
+        app.extensions['persistence_queue'] = self
+        atexit.register(self.shutdown)
+    
+    def _ensure_started(self):
+        """初回投入時にワーカースレッドを起動（ロック保持中に呼ぶ）"""
+        if self._thread is None or not self._thread.is_alive():
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='persistence-writer', daemon=True)
+            self._thread.start()
+    
+    def submit(self, description: str, operation: Operation, on_commit: Optional[Callable[[], None]] = None):
+        """
+        書き込み処理を投入
+        
+        Args:
+            description: ログ用の説明
+            operation: アプリケーションコンテキスト内で db.session を操作する関数。
+                       コミットはキュー側で行うため operation 内では呼ばない。
+            on_commit: コミットに成功した後にワーカーで呼ぶ関数（計測用。例外は無視する）
+        """
+        with self._cond:
+            if self._stopping:
+                raise RuntimeError('永続化キューは停止しています')
+            self._items.append((description, operation, time.monotonic(), on_commit))
+            self._stats['submitted'] += 1
+            self._ensure_started()
+            self._cond.notify_all()
+    
+    def pending(self) -> int:
+        """未コミットの件数（キュー滞留 + 処理中）"""
+        with self._cond:
+            return len(self._items) + self._in_flight
+    
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        投入済みの書き込みが全てコミットされるまで待つ
+        
+        Returns:
+            bool: タイムアウトせずに完了した場合 True
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._items or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+    
+    def shutdown(self, timeout: Optional[float] = 30.0):
+        """残りを書き出してワーカーを停止"""
+        if not self.flush(timeout):
+            logger.error(f"永続化キューのフラッシュがタイムアウトしました - 残り {self.pending()} 件")
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+    
+    def _take_batch(self) -> List[Item]:
+        """バッチを取り出す（ロック保持中に呼ぶ）"""
+        while not self._items and not self._stopping:
+            self._cond.wait()
+        if not self._items:
+            return []
+        
+        # 先頭が届いてから max_delay だけ後続を待ってまとめる
+        deadline = self._items[0][2] + self.max_delay
+        while len(self._items) < self.max_batch and not self._stopping:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            self._cond.wait(remaining)
+        
+        batch = []
+        while self._items and len(batch) < self.max_batch:
+            batch.append(self._items.popleft())
+        self._in_flight = len(batch)
+        return batch
+    
+    def _run(self):
+        """ワーカースレッド本体"""
+        while True:
+            with self._cond:
+                batch = self._take_batch()
+                if not batch:
+                    return
+            
+            try:
+                with self.app.app_context():
+                    self._commit_batch(batch)
+            except Exception as e:
+                logger.error(f"永続化ワーカーエラー: {str(e)}", exc_info=True)
+            finally:
+                with self._cond:
+                    self._in_flight = 0
+                    self._cond.notify_all()
+    
+    def _commit_batch(self, batch: List[Item]):
+        """バッチを1トランザクションでコミット（失敗時は1件ずつ再実行）"""
+        started = time.monotonic()
+        wait_total = sum(started - enqueued for _, _, enqueued, _ in batch)
+        succeeded: List[Item] = []
+        try:
+            for _, operation, _, _ in batch:
+                operation()
+            db.session.commit()
+            committed, failed = len(batch), 0
+            succeeded = batch
+        except Exception as e:
+            db.session.rollback()
+            logger.warning(f"一括コミット失敗、個別に再実行します: {str(e)}")
+            committed, failed = 0, 0
+            for item in batch:
+                description, operation = item[0], item[1]
+                try:
+                    operation()
+                    db.session.commit()
+                    committed += 1
+                    succeeded.append(item)
+                except Exception as op_error:
+                    db.session.rollback()
+                    failed += 1
+                    logger.error(f"永続化エラー ({description}): {str(op_error)}")
+        
+        elapsed = time.monotonic() - started
+        with self._cond:
+            self._stats['batches'] += 1
+            self._stats['committed_ops'] += committed
+            self._stats['failed_ops'] += failed
+            self._stats['commit_seconds_total'] += elapsed
+            self._stats['commit_seconds_max'] = max(self._stats['commit_seconds_max'], elapsed)
+            self._stats['last_commit_seconds'] = elapsed
+            self._stats['queue_wait_seconds_total'] += wait_total
+        metrics.observe(PHASE_PERSISTENCE_COMMIT, None, elapsed)
+        
+        for description, _, _, on_commit in succeeded:
+            if on_commit is not None:
+                try:
+                    on_commit()
+                except Exception as e:
+                    logger.warning(f"コミット後の処理に失敗しました ({description}): {str(e)}")
+    
+    def stats(self) -> Dict[str, Any]:
+        """キュー深さ・コミットレイテンシなどの統計"""
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._items)
+            stats['in_flight'] = self._in_flight
+        batches = stats['batches']
+        processed = stats['committed_ops'] + stats['failed_ops']
+        stats['avg_commit_ms'] = round(stats['commit_seconds_total'] / batches * 1000, 3) if batches else 0.0
+        stats['max_commit_ms'] = round(stats['commit_seconds_max'] * 1000, 3)
+        stats['last_commit_ms'] = round(stats['last_commit_seconds'] * 1000, 3)
+        stats['avg_batch_size'] = round(processed / batches, 2) if batches else 0.0
+        stats['avg_queue_wait_ms'] = round(stats['queue_wait_seconds_total'] / processed * 1000, 3) if processed else 0.0
+        return stats
+
+
+persistence = PersistenceQueue()
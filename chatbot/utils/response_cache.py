@@ -0,0 +1,475 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import unicodedata
+from collections import OrderedDict
+from contextlib import aclosing
+from dataclasses import dataclass
+from typing import Callable, Dict, Any, Iterator, AsyncIterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+# ChatTurn.response_source の値
+SOURCE_UPSTREAM = 'upstream'   # 自分のリクエストで上流を呼び出した
+SOURCE_SHARED = 'shared'       # 同じ質問の実行中ストリームに相乗りした
+SOURCE_CACHE = 'cache'         # キャッシュから再生した
+
+# 正規化時に末尾から取り除く文字
+_TRAILING_PUNCTUATION = '?？!！。．.、,， '
+
+CacheKey = Tuple[int, str]
+
+
+def normalize_query(query: str) -> str:
+    """キャッシュキー用に質問文を正規化（NFKC・大文字小文字・空白の連続・末尾の句読点）"""
+    text = unicodedata.normalize('NFKC', query).casefold()
+    return ' '.join(text.split()).rstrip(_TRAILING_PUNCTUATION)
+
+
+def _shareable(chunk: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    他の会話へ返すイベント
+    
+    Dify 側の会話IDを共有すると別のユーザーの続きの質問が同じ Dify 会話に
+    入ってしまうため取り除く。このため応答した会話は Dify 側の会話IDを持たず、
+    続きの質問はそれまでの文脈なしで Dify 上の新しい会話として送られる
+    （対象を会話の文脈を使わないアプリ RESPONSE_CACHE_APPS に限るのはこのため）。
+    転送モードの RelayEvent も dict にする（キャッシュのサイズ計算で JSON にするため）。
+    """
+    if 'conversation_id' not in chunk:
+        return chunk if isinstance(chunk, dict) else dict(chunk)
+    shared = dict(chunk)
+    del shared['conversation_id']
+    return shared
+
+
+@dataclass
+class CachedResponse:
+    """キャッシュした応答（イベント列と先頭からの経過ミリ秒）"""
+    events: List[Dict[str, Any]]
+    offsets: List[int]
+    size: int
+    expires_at: float
+    hits: int = 0
+
+
+@dataclass
+class Reservation:
+    """
+    ターン開始時に決めた応答の出所（ResponseCache.reserve）
+    
+    キャッシュと実行中のストリームは参照を持つため、実行枠の予約から
+    ストリーミング開始までの間に期限切れ・完了しても同じ応答を返せる。
+    """
+    key: CacheKey
+    source: str
+    value: Any = None  # SOURCE_CACHE: CachedResponse / SOURCE_SHARED: _Flight / SOURCE_UPSTREAM: None
+
+
+def _resolve(future: 'asyncio.Future'):
+    if not future.done():
+        future.set_result(None)
+
+
+class _Flight:
+    """
+    実行中の上流ストリーム1本を複数の購読者へ配る
+    
+    受信したイベントは全て保持し、途中から購読した場合も先頭から受け取れる。
+    スレッド（WSGI）とイベントループ（ASGI）のどちらからも購読できる。
+    """
+    
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.offsets: List[int] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._started = time.monotonic()
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+    
+    def publish(self, chunk: Dict[str, Any]):
+        with self._cond:
+            self.events.append(chunk)
+            self.offsets.append(int((time.monotonic() - self._started) * 1000))
+            self._wake()
+    
+    def finish(self, error: Optional[BaseException] = None):
+        with self._cond:
+            self.done = True
+            self.error = error
+            self._wake()
+    
+    def _wake(self):
+        """待機中の購読者を起こす（ロック保持中に呼ぶ）"""
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+    
+    def iter_sync(self) -> Iterator[Dict[str, Any]]:
+        index = 0
+        while True:
+            with self._cond:
+                while index >= len(self.events) and not self.done:
+                    self._cond.wait()
+                pending = self.events[index:]
+                done, error = self.done, self.error
+            index += len(pending)
+            yield from pending
+            if done:
+                if error is not None:
+                    raise error
+                return
+    
+    async def iter_async(self) -> AsyncIterator[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        index = 0
+        while True:
+            future = None
+            with self._cond:
+                pending = self.events[index:]
+                done, error = self.done, self.error
+                if not pending and not done:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            if future is not None:
+                await future
+                continue
+            index += len(pending)
+            for chunk in pending:
+                yield chunk
+            if done:
+                if error is not None:
+                    raise error
+                return
+
+
+class ResponseCache:
+    """
+    新規会話の最初の質問に対する応答キャッシュと、同じ質問の同時実行の相乗り（single-flight）
+    
+    キーは (Difyアプリ, 正規化した質問文)。既存の会話への質問（会話の続き）は対象外。
+    キャッシュ・相乗りで応答した会話には Dify 側の会話IDが記録されないため、
+    Dify 側の会話IDの有無ではなく会話が既にあるかで判定する（続きの質問が
+    再びキャッシュから応答されないように）。続きの質問はそれまでの文脈なしで
+    Dify へ送られるため、文脈を使わないアプリだけを RESPONSE_CACHE_APPS に指定する。
+    キャッシュにあれば記録した受信間隔で再生し、同じ質問が実行中なら上流のストリーム
+    1本を全員に配る。上流の呼び出しはリクエストから切り離して実行するため、
+    最初に質問したクライアントが切断しても他の購読者とキャッシュ登録は続く。
+    
+    設定:
+        RESPONSE_CACHE_APPS: 会話の文脈を使わない（1問1答の）DifyApp ID（カンマ区切り。未指定なら無効）。
+            キャッシュ・相乗りで応答した会話の続きの質問は、それまでのやり取りを Dify に渡せない
+        RESPONSE_CACHE_TTL: 有効期間（秒）
+        RESPONSE_CACHE_MAX_ENTRIES / RESPONSE_CACHE_MAX_BYTES: 件数・メモリの上限（LRUで追い出し）
+        RESPONSE_CACHE_REPLAY_SPEED: 再生時の間隔の倍率（1.0 で記録どおり、0 で待たない）
+        RESPONSE_CACHE_MAX_REPLAY_GAP: 再生時に1イベントあたり待つ最大秒数
+    
+    使い方:
+        response_cache = ResponseCache()
+        response_cache.init_app(app)
+        reservation, ticket = response_cache.reserve(dify_app_id, message, follow_up, admit)
+        for chunk in response_cache.stream_chat(turn, dify_client): ...
+        async for chunk in response_cache.astream_chat(turn, dify_client): ...
+    """
+    
+    def __init__(self, app=None, apps: str = '', ttl: float = 3600.0, max_entries: int = 256,
+                 max_bytes: int = 32 * 1024 * 1024, replay_speed: float = 1.0, max_replay_gap: float = 1.0):
+        self.app_ids: Set[int] = set()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.replay_speed = replay_speed
+        self.max_replay_gap = max_replay_gap
+        self._entries: 'OrderedDict[CacheKey, CachedResponse]' = OrderedDict()
+        self._bytes = 0
+        self._flights: Dict[CacheKey, _Flight] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0, 'misses': 0, 'shared': 0, 'bypassed': 0,
+            'stored': 0, 'not_stored': 0, 'evictions': 0, 'expirations': 0,
+        }
+        self.configure_apps(apps)
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.configure_apps(app.config.get('RESPONSE_CACHE_APPS', os.getenv('RESPONSE_CACHE_APPS', '')))
+        self.ttl = float(app.config.get('RESPONSE_CACHE_TTL', os.getenv('RESPONSE_CACHE_TTL', self.ttl)))
+        self.max_entries = int(app.config.get('RESPONSE_CACHE_MAX_ENTRIES', os.getenv('RESPONSE_CACHE_MAX_ENTRIES', self.max_entries)))
+        self.max_bytes = int(app.config.get('RESPONSE_CACHE_MAX_BYTES', os.getenv('RESPONSE_CACHE_MAX_BYTES', self.max_bytes)))
+        self.replay_speed = float(app.config.get('RESPONSE_CACHE_REPLAY_SPEED',
+                                                 os.getenv('RESPONSE_CACHE_REPLAY_SPEED', self.replay_speed)))
+        self.max_replay_gap = float(app.config.get('RESPONSE_CACHE_MAX_REPLAY_GAP',
+                                                   os.getenv('RESPONSE_CACHE_MAX_REPLAY_GAP', self.max_replay_gap)))
+        app.extensions['response_cache'] = self
+    
+    def configure_apps(self, apps):
+        """対象アプリを設定（空なら無効）"""
+        if isinstance(apps, str):
+            apps = [value.strip() for value in apps.split(',') if value.strip()]
+        apps = list(apps or [])
+        if '*' in apps:
+            # 文脈を使うアプリまで対象にしないよう、全アプリの指定は受け付けない
+            logger.warning("RESPONSE_CACHE_APPS の '*' は使用できません。対象のアプリIDを列挙してください")
+            apps = [value for value in apps if value != '*']
+        self.app_ids = {int(value) for value in apps}
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(self.app_ids)
+    
+    def _key(self, dify_app_id: Optional[int], message: str, follow_up: bool) -> Optional[CacheKey]:
+        if follow_up or dify_app_id not in self.app_ids:
+            return None
+        normalized = normalize_query(message)
+        return (dify_app_id, normalized) if normalized else None
+    
+    def reserve(self, dify_app_id: Optional[int], message: str, follow_up: bool,
+                admit: Callable[[], Any]) -> Tuple[Optional[Reservation], Any]:
+        """
+        応答の出所を決め、上流を呼ぶ場合だけ admit で実行枠を予約
+        
+        follow_up（既存の会話への質問）は対象外で、そのまま admit する。
+        
+        キャッシュ・実行中のストリームの確認と購読の登録を同じロックの中で行い、
+        その参照を返す（確認した後に消えて、実行枠なしで上流を呼ぶことはない）。
+        
+        Returns:
+            Tuple[Optional[Reservation], Any]: (予約。対象外なら None, admit の戻り値。上流を呼ばないなら None)
+        
+        Raises:
+            admit が送出した例外（待ち行列が満杯など）
+        """
+        key = self._key(dify_app_id, message, follow_up)
+        if key is not None:
+            with self._lock:
+                entry = self._get(key)
+                if entry is not None:
+                    self._stats['hits'] += 1
+                    return Reservation(key, SOURCE_CACHE, entry), None
+                flight = self._flights.get(key)
+                if flight is not None:
+                    flight.subscribers += 1
+                    self._stats['shared'] += 1
+                    return Reservation(key, SOURCE_SHARED, flight), None
+        ticket = admit()
+        return (Reservation(key, SOURCE_UPSTREAM) if key is not None else None), ticket
+    
+    def _get(self, key: CacheKey) -> Optional[CachedResponse]:
+        """有効なキャッシュを取得（ロック保持中に呼ぶ）"""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self._stats['expirations'] += 1
+            return None
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        return entry
+    
+    def _remove(self, key: CacheKey):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+    
+    def _put(self, key: CacheKey, flight: _Flight):
+        """完了したストリームを登録（ロック保持中に呼ぶ）"""
+        events = flight.events
+        if not any(chunk.get('event') == 'message_end' for chunk in events) or \
+                any(chunk.get('event') == 'error' for chunk in events):
+            self._stats['not_stored'] += 1
+            return
+        events = [_shareable(chunk) for chunk in events]
+        size = len(json.dumps(events, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_bytes:
+            self._stats['not_stored'] += 1
+            return
+        first = flight.offsets[0]
+        self._remove(key)
+        self._entries[key] = CachedResponse(
+            events=events,
+            offsets=[offset - first for offset in flight.offsets],
+            size=size,
+            expires_at=time.monotonic() + self.ttl,
+        )
+        self._bytes += size
+        self._stats['stored'] += 1
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.size
+            self._stats['evictions'] += 1
+    
+    def _acquire(self, key: CacheKey, start: Callable[[_Flight], None]) -> Tuple[str, Any]:
+        """
+        キャッシュ・実行中のストリーム・新しいストリームのいずれかを選ぶ
+        
+        上流を呼ぶ予約のターンが実行枠を得た時点で呼ぶ（待つ間に同じ質問が
+        登録・開始されていればそちらを使う）。
+        
+        Returns:
+            Tuple[str, Any]: (SOURCE_CACHE, CachedResponse) / (SOURCE_SHARED, _Flight) / (SOURCE_UPSTREAM, _Flight)
+        """
+        with self._lock:
+            entry = self._get(key)
+            if entry is not None:
+                self._stats['hits'] += 1
+                return SOURCE_CACHE, entry
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.subscribers += 1
+                self._stats['shared'] += 1
+                return SOURCE_SHARED, flight
+            flight = _Flight()
+            flight.subscribers = 1
+            self._flights[key] = flight
+            self._stats['misses'] += 1
+            start(flight)
+            return SOURCE_UPSTREAM, flight
+    
+    def _land(self, key: CacheKey, flight: _Flight, error: Optional[BaseException]):
+        """上流ストリームの終了処理（キャッシュ登録 → 実行中から外す → 購読者へ通知）"""
+        with self._lock:
+            if error is None:
+                self._put(key, flight)
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+        flight.finish(error)
+    
+    def _replay_delay(self, gap_ms: int) -> float:
+        return min(gap_ms / 1000 * self.replay_speed, self.max_replay_gap)
+    
+    # --- 同期版（WSGI） ---
+    
+    def _produce(self, key: CacheKey, flight: _Flight, client, message: str):
+        """上流ストリームを受信して購読者へ配る（専用スレッドで実行）"""
+        error = None
+        try:
+            for chunk in client.stream_chat(message, None):
+                if chunk:
+                    flight.publish(chunk)
+        except Exception as e:
+            error = e
+        self._land(key, flight, error)
+    
+    def stream_chat(self, turn, client) -> Iterator[Dict[str, Any]]:
+        """
+        DifyClient.stream_chat の代わりに使うイベント列
+        
+        turn.cache_reservation（reserve の予約）に従い、予約の無いターンはそのまま
+        上流を呼び出す。応答の出所は turn.response_source に設定する。
+        """
+        reservation = turn.cache_reservation
+        if reservation is None:
+            with self._lock:
+                self._stats['bypassed'] += 1
+            turn.response_source = SOURCE_UPSTREAM
+            yield from client.stream_chat(turn.message_content, turn.dify_conversation_id)
+            return
+        
+        def start(flight: _Flight):
+            threading.Thread(
+                target=self._produce, args=(reservation.key, flight, client, turn.message_content),
+                name='response-cache-upstream', daemon=True
+            ).start()
+        
+        source, value = reservation.source, reservation.value
+        if source == SOURCE_UPSTREAM:
+            source, value = self._acquire(reservation.key, start)
+        turn.response_source = source
+        if source == SOURCE_CACHE:
+            previous = 0
+            for chunk, offset in zip(value.events, value.offsets):
+                delay = self._replay_delay(offset - previous)
+                previous = offset
+                if delay > 0:
+                    time.sleep(delay)
+                yield chunk
+            return
+        
+        for chunk in value.iter_sync():
+            yield chunk if source == SOURCE_UPSTREAM else _shareable(chunk)
+    
+    # --- 非同期版（ASGI） ---
+    
+    async def _aproduce(self, key: CacheKey, flight: _Flight, client, message: str):
+        """上流ストリームを受信して購読者へ配る（イベントループ上のタスク）"""
+        error = None
+        try:
+            async with aclosing(client.astream_chat(message, None)) as stream:
+                async for chunk in stream:
+                    if chunk:
+                        flight.publish(chunk)
+        except Exception as e:
+            error = e
+        self._land(key, flight, error)
+    
+    async def astream_chat(self, turn, client) -> AsyncIterator[Dict[str, Any]]:
+        """DifyClient.astream_chat の代わりに使うイベント列（stream_chat の非同期版）"""
+        reservation = turn.cache_reservation
+        if reservation is None:
+            with self._lock:
+                self._stats['bypassed'] += 1
+            turn.response_source = SOURCE_UPSTREAM
+            async with aclosing(client.astream_chat(turn.message_content, turn.dify_conversation_id)) as stream:
+                async for chunk in stream:
+                    yield chunk
+            return
+        
+        loop = asyncio.get_running_loop()
+        
+        def start(flight: _Flight):
+            # リクエストのタスクから切り離し、クライアント切断でキャンセルされないようにする
+            task = loop.create_task(self._aproduce(reservation.key, flight, client, turn.message_content))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        
+        source, value = reservation.source, reservation.value
+        if source == SOURCE_UPSTREAM:
+            source, value = self._acquire(reservation.key, start)
+        turn.response_source = source
+        if source == SOURCE_CACHE:
+            previous = 0
+            for chunk, offset in zip(value.events, value.offsets):
+                delay = self._replay_delay(offset - previous)
+                previous = offset
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                yield chunk
+            return
+        
+        async for chunk in value.iter_async():
+            yield chunk if source == SOURCE_UPSTREAM else _shareable(chunk)
+    
+    def clear(self) -> int:
+        """キャッシュを全て破棄（実行中のストリームはそのまま）"""
+        with self._lock:
+            count = len(self._entries)
+            self._entries.clear()
+            self._bytes = 0
+        return count
+    
+    def stats(self) -> Dict[str, Any]:
+        """ヒット率・使用量などの統計"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self._bytes
+            stats['in_flight'] = len(self._flights)
+            stats['subscribers'] = sum(flight.subscribers for flight in self._flights.values())
+        stats['enabled'] = self.enabled
+        stats['apps'] = sorted(self.app_ids)
+        requests = stats['hits'] + stats['misses'] + stats['shared']
+        stats['upstream_saved_ratio'] = round((stats['hits'] + stats['shared']) / requests, 4) if requests else 0.0
+        return stats
+
+
+response_cache = ResponseCache()
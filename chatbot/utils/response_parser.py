@@ -1,6 +1,7 @@
 import json
 import re
-from typing import List, Dict, Any
+from collections import Counter
+from typing import List, Dict, Any, Tuple
 
 class ResponseParser:
     """Difyレスポンス解析ユーティリティ"""
@@ -16,52 +17,36 @@ class ResponseParser:
         Returns:
             Dict: 整理されたキーフレーズと文書データ
         """
-        result = {
-            'source_documents': [],
-            'all_keyphrases': [],
-            'document_keyphrases': []
-        }
-        
+        extractor = KeyphraseExtractor()
         try:
-            # message_endイベントからretriever_resourcesを抽出
             for item in raw_response_data:
                 if item.get('event') == 'message_end':
-                    metadata = item.get('metadata', {})
-                    retriever_resources = metadata.get('retriever_resources', [])
-                    
-                    for i, resource in enumerate(retriever_resources):
-                        content = resource.get('content', '')
-                        
-                        # ソース文書として保存
-                        doc_info = {
-                            'index': i + 1,
-                            'content': content,
-                            'content_length': len(content)
-                        }
-                        result['source_documents'].append(doc_info)
-                        
-                        # キーフレーズ抽出（\r\nで分割）
-                        keyphrases = ResponseParser._extract_keyphrases_from_content(content)
-                        
-                        doc_keyphrases = {
-                            'document_index': i + 1,
-                            'keyphrases': keyphrases,
-                            'keyphrase_count': len(keyphrases)
-                        }
-                        result['document_keyphrases'].append(doc_keyphrases)
-                        
-                        # 全キーフレーズに追加
-                        result['all_keyphrases'].extend(keyphrases)
-            
-            # 重複除去と統計
-            result['unique_keyphrases'] = list(set(result['all_keyphrases']))
-            result['total_keyphrase_count'] = len(result['all_keyphrases'])
-            result['unique_keyphrase_count'] = len(result['unique_keyphrases'])
-            
+                    extractor.add_message_end(item)
         except Exception as e:
+            result = extractor.result()
             result['error'] = f"キーフレーズ抽出エラー: {str(e)}"
+            return result
+        
+        return extractor.result()
+    
+    @staticmethod
+    def keyphrase_rows(keyphrase_data: Dict[str, Any]) -> List[Tuple[int, str, int]]:
+        """
+        キーフレーズデータを (文書番号, キーフレーズ, 出現回数) の行に正規化
         
-        return result
+        Args:
+            keyphrase_data: extract_keyphrases の結果
+        
+        Returns:
+            List[Tuple[int, str, int]]: 文書ごと・キーフレーズごとの行
+        """
+        rows = []
+        for document in keyphrase_data.get('document_keyphrases', []):
+            # frequencies を含めずに保存した期間のデータはキーフレーズの並びから数える
+            frequencies = document.get('frequencies') or Counter(document.get('keyphrases', []))
+            index = document['document_index']
+            rows.extend((index, phrase, count) for phrase, count in frequencies.items())
+        return rows
     
     @staticmethod
     def _extract_keyphrases_from_content(content: str) -> List[str]:
@@ -80,11 +65,11 @@ class ResponseParser:
         # \r\nで分割
         phrases = content.split('\r\n')
         
-        # 空の文字列や短すぎる文字列を除去、前後の空白を削除
+        # 前後の空白を削除し、空の文字列や短すぎる文字列を除去
         keyphrases = [
-            phrase.strip() 
-            for phrase in phrases 
-            if phrase.strip() and len(phrase.strip()) > 3
+            phrase
+            for phrase in map(str.strip, phrases)
+            if len(phrase) > 3
         ]
         
         return keyphrases
@@ -142,3 +127,67 @@ class ResponseParser:
             formatted['error'] = f"レスポンス整形エラー: {str(e)}"
         
         return formatted
+
+
+class KeyphraseExtractor:
+    """
+    message_end の retriever_resources からのキーフレーズ抽出
+    
+    キーフレーズは message_end にしか含まれないため、ストリーム完了後の解析ジョブ
+    （analysis_jobs.run_analysis）が message_end のチャンクを渡して抽出する。
+    文書ごとの出現回数（frequencies）と全文書での出現回数（keyphrase_frequencies）は
+    Counter で数え、全体でキーフレーズ数に比例する時間で済ませる。
+    
+    使い方:
+        extractor = KeyphraseExtractor()
+        extractor.add_message_end(message_end_chunk)
+        keyphrase_data = extractor.result()
+    """
+    
+    def __init__(self):
+        self.source_documents: List[Dict[str, Any]] = []
+        self.document_keyphrases: List[Dict[str, Any]] = []
+        self.all_keyphrases: List[str] = []
+        self._frequencies: Counter = Counter()  # 初出順のキーフレーズ → 全文書での出現回数
+    
+    def add_message_end(self, chunk: Dict[Any, Any]):
+        """message_end のチャンクに含まれるソース文書を全て追加"""
+        metadata = chunk.get('metadata') or {}
+        for resource in metadata.get('retriever_resources') or []:
+            self.add_document(resource.get('content', ''))
+    
+    def add_document(self, content: str):
+        """ソース文書を1件追加してキーフレーズを索引に反映"""
+        index = len(self.source_documents) + 1
+        self.source_documents.append({
+            'index': index,
+            'content': content,
+            'content_length': len(content)
+        })
+        
+        keyphrases = ResponseParser._extract_keyphrases_from_content(content)
+        frequencies = Counter(keyphrases)
+        self.document_keyphrases.append({
+            'document_index': index,
+            'keyphrases': keyphrases,
+            'keyphrase_count': len(keyphrases),
+            'frequencies': frequencies
+        })
+        self.all_keyphrases.extend(keyphrases)
+        self._frequencies.update(keyphrases)
+    
+    def result(self) -> Dict[str, Any]:
+        """
+        抽出結果（extract_keyphrases と同じ形式）
+        
+        unique_keyphrases は初出順、keyphrase_frequencies は全文書での出現回数。
+        """
+        return {
+            'source_documents': self.source_documents,
+            'all_keyphrases': self.all_keyphrases,
+            'document_keyphrases': self.document_keyphrases,
+            'unique_keyphrases': list(self._frequencies),
+            'keyphrase_frequencies': dict(self._frequencies),
+            'total_keyphrase_count': len(self.all_keyphrases),
+            'unique_keyphrase_count': len(self._frequencies)
+        }
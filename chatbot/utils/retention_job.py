@@ -0,0 +1,132 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, Any, Optional
+
+from database.models import db
+from database.retention import delete_conversations, prune_raw_payloads, incremental_vacuum, database_file
+from .analysis_cache import analysis_cache
+
+logger = logging.getLogger(__name__)
+
+
+class RetentionJob:
+    """
+    保持期間を過ぎた履歴の削除とDBファイルの切り詰め
+    
+    古い会話の削除・古い生レスポンスの削除・incremental_vacuum を順に行い、
+    削除件数・解放したバイト数・所要時間を報告する。RETENTION_INTERVAL_HOURS を
+    指定するとバックグラウンドスレッドで定期実行する（複数プロセスで起動する場合は
+    1プロセスだけで有効にするか、cron から run_retention.py を実行する）。
+    
+    設定:
+        RETENTION_CONVERSATION_DAYS: 最終更新からこの日数を過ぎた会話を削除（0 なら削除しない）
+        RETENTION_PAYLOAD_DAYS: 作成からこの日数を過ぎたメッセージの生レスポンスを削除（0 なら削除しない）
+        RETENTION_VACUUM_PAGES: 1回に解放するページ数の上限（0 なら全て）
+        RETENTION_INTERVAL_HOURS: 定期実行の間隔（0 なら定期実行しない）
+    
+    使い方:
+        retention_job = RetentionJob()
+        retention_job.init_app(app)
+        report = retention_job.run()
+    """
+    
+    def __init__(self, app=None):
+        self.app = None
+        self.conversation_days = 0
+        self.payload_days = 0
+        self.vacuum_pages = 0
+        self.interval_hours = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._last_report: Optional[Dict[str, Any]] = None
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録（間隔が指定されていれば定期実行を開始）"""
+        self.app = app
+        self.conversation_days = int(app.config.get('RETENTION_CONVERSATION_DAYS',
+                                                    os.getenv('RETENTION_CONVERSATION_DAYS', self.conversation_days)))
+        self.payload_days = int(app.config.get('RETENTION_PAYLOAD_DAYS', os.getenv('RETENTION_PAYLOAD_DAYS', self.payload_days)))
+        self.vacuum_pages = int(app.config.get('RETENTION_VACUUM_PAGES', os.getenv('RETENTION_VACUUM_PAGES', self.vacuum_pages)))
+        self.interval_hours = float(app.config.get('RETENTION_INTERVAL_HOURS',
+                                                   os.getenv('RETENTION_INTERVAL_HOURS', self.interval_hours)))
+        app.extensions['retention_job'] = self
+        if self.interval_hours > 0:
+            self._thread = threading.Thread(target=self._loop, name='retention', daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+    
+    def _loop(self):
+        """定期実行スレッド本体"""
+        while not self._stop.wait(self.interval_hours * 3600):
+            try:
+                self.run()
+            except Exception as e:
+                logger.error(f"保持期間ジョブエラー: {str(e)}", exc_info=True)
+    
+    def stop(self):
+        self._stop.set()
+    
+    def run(self, conversation_days: Optional[int] = None, payload_days: Optional[int] = None,
+            vacuum_pages: Optional[int] = None) -> Dict[str, Any]:
+        """
+        保持期間ジョブを1回実行（同時に1つだけ。実行中なら終わるのを待つ）
+        
+        引数を省略した項目は設定値を使う。
+        
+        Returns:
+            Dict: 処理ごとの削除件数・バイト数・所要時間
+        """
+        conversation_days = self.conversation_days if conversation_days is None else conversation_days
+        payload_days = self.payload_days if payload_days is None else payload_days
+        vacuum_pages = self.vacuum_pages if vacuum_pages is None else vacuum_pages
+        
+        with self._lock, self.app.app_context():
+            started = time.perf_counter()
+            now = datetime.utcnow()
+            path = database_file(db.engine)
+            report: Dict[str, Any] = {
+                'started_at': now.isoformat(),
+                'file_bytes_before': os.path.getsize(path) if path else None,
+            }
+            if conversation_days > 0:
+                report['conversations'] = delete_conversations(
+                    older_than=now - timedelta(days=conversation_days), on_deleted=analysis_cache.invalidate_many
+                )
+            if payload_days > 0:
+                report['payloads'] = prune_raw_payloads(
+                    now - timedelta(days=payload_days), on_pruned=analysis_cache.invalidate_many
+                )
+            with db.engine.connect() as connection:
+                report['vacuum'] = incremental_vacuum(connection, vacuum_pages or None)
+            report['file_bytes_after'] = os.path.getsize(path) if path else None
+            report['seconds'] = round(time.perf_counter() - started, 3)
+            db.session.remove()
+        
+        self._last_report = report
+        logger.info(
+            f"保持期間ジョブ完了 - 会話 {report.get('conversations', {}).get('conversations', 0)}件, "
+            f"生レスポンス {report.get('payloads', {}).get('payloads', 0)}件削除, "
+            f"解放 {report['vacuum']['bytes_reclaimed']} バイト, {report['seconds']}秒"
+        )
+        return report
+    
+    def status(self) -> Dict[str, Any]:
+        """設定と前回の実行結果"""
+        return {
+            'conversation_days': self.conversation_days,
+            'payload_days': self.payload_days,
+            'vacuum_pages': self.vacuum_pages,
+            'interval_hours': self.interval_hours,
+            'running': self._lock.locked(),
+            'last_report': self._last_report,
+        }
+
+
+retention_job = RetentionJob()
@@ -0,0 +1,185 @@
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+# 行終端は CRLF / LF / CR のいずれか（SSE仕様）
+_LINE_END = re.compile(rb'\r\n|\r|\n')
+_UTF8_BOM = b'\xef\xbb\xbf'
+
+
+@dataclass(slots=True)
+class ServerSentEvent:
+    """デコード済みSSEイベント"""
+    data: str
+    event: str = 'message'
+    id: str = ''
+    retry: Optional[int] = None
+
+
+class SSEDecoder:
+    """
+    インクリメンタルSSEデコーダー（バイト列入力 → イベント出力）
+    
+    受信済みバッファのうち未走査の部分だけを行終端について走査するため、
+    大きなイベントが多数のチャンクに分割されて届いても処理量は入力長に比例する。
+    フィールド処理は WHATWG の SSE 仕様に従う:
+    
+    - 行終端は CRLF / LF / CR
+    - 空行でイベントを確定（data が空ならディスパッチしない）
+    - ``:`` で始まる行はコメント
+    - 複数の ``data:`` 行は改行で連結
+    - ``event:`` / ``id:`` / ``retry:`` を解釈し、``id`` はイベント間で保持
+    """
+    
+    def __init__(self):
+        self._buffer = bytearray()
+        self._scan_pos = 0
+        self._skip_lf = False
+        self._started = False
+        self._data_lines: List[bytes] = []
+        self._event_type = ''
+        self.last_event_id = ''
+        self.retry: Optional[int] = None
+    
+    def feed(self, chunk: bytes) -> List[ServerSentEvent]:
+        """
+        受信チャンクを投入し、確定したイベントを返す
+        
+        Args:
+            chunk: ネットワークから受信したバイト列
+        
+        Returns:
+            List[ServerSentEvent]: このチャンクで確定したイベント
+        """
+        if not chunk:
+            return []
+        
+        buffer = self._buffer
+        buffer += chunk
+        
+        if not self._started:
+            if len(buffer) < len(_UTF8_BOM) and _UTF8_BOM.startswith(bytes(buffer)):
+                return []
+            if buffer.startswith(_UTF8_BOM):
+                del buffer[:len(_UTF8_BOM)]
+            self._started = True
+        
+        # 前チャンクが CR で終わっていた場合、直後の LF は同じ行終端の一部
+        if self._skip_lf and buffer:
+            if buffer[0] == 0x0A:
+                del buffer[0]
+            self._skip_lf = False
+        
+        events: List[ServerSentEvent] = []
+        if b'\r' in chunk:
+            line_start = self._split_mixed(buffer, events)
+        else:
+            # 未走査部分に CR が無ければ LF 区切りだけを C レベルで分割する
+            line_end = buffer.rfind(b'\n', self._scan_pos)
+            line_start = 0
+            if line_end >= 0:
+                line_start = line_end + 1
+                self._process_lines(bytes(buffer[:line_end]).split(b'\n'), events)
+        
+        if line_start:
+            del buffer[:line_start]
+        self._scan_pos = len(buffer)
+        return events
+    
+    def _split_mixed(self, buffer: bytearray, events: List[ServerSentEvent]) -> int:
+        """CR / CRLF を含む未走査部分を行に分割して処理し、消費したバイト数を返す"""
+        lines = []
+        line_start = 0
+        for match in _LINE_END.finditer(buffer, self._scan_pos):
+            end = match.start()
+            # バッファ末尾の CR は次チャンクの LF と対になる可能性がある
+            if match.end() == len(buffer) and buffer[end] == 0x0D:
+                self._skip_lf = True
+            lines.append(bytes(buffer[line_start:end]))
+            line_start = match.end()
+        self._process_lines(lines, events)
+        return line_start
+    
+    def _process_lines(self, lines, events: List[ServerSentEvent]):
+        """行のリストを順に処理（data 行と空行は高速パス）"""
+        data_lines = self._data_lines
+        for line in lines:
+            if line.startswith(b'data: '):
+                data_lines.append(line[6:])
+            elif line:
+                self._process_line(line)
+            elif data_lines:
+                if len(data_lines) == 1:
+                    data = data_lines[0]
+                else:
+                    data = b'\n'.join(data_lines)
+                data_lines.clear()
+                events.append(ServerSentEvent(
+                    data.decode('utf-8', errors='replace'),
+                    self._event_type or 'message',
+                    self.last_event_id,
+                    self.retry,
+                ))
+                self._event_type = ''
+            else:
+                self._event_type = ''
+    
+    def flush(self) -> List[ServerSentEvent]:
+        """
+        ストリーム終端で残りのバッファを処理
+        
+        仕様上は終端の空行がない未完了イベントは破棄されるが、
+        従来の実装との互換のため、残っている data はイベントとして返す。
+        """
+        events: List[ServerSentEvent] = []
+        if self._buffer:
+            event = self._process_line(bytes(self._buffer))
+            if event is not None:
+                events.append(event)
+            self._buffer.clear()
+            self._scan_pos = 0
+        event = self._dispatch()
+        if event is not None:
+            events.append(event)
+        return events
+    
+    def _process_line(self, line: bytes) -> Optional[ServerSentEvent]:
+        """1行を解釈し、空行ならイベントを確定"""
+        if not line:
+            return self._dispatch()
+        
+        if line[0] == 0x3A:  # ':' で始まる行はコメント
+            return None
+        
+        field, sep, value = line.partition(b':')
+        if sep and value[:1] == b' ':
+            value = value[1:]
+        
+        if field == b'data':
+            self._data_lines.append(value)
+        elif field == b'event':
+            self._event_type = value.decode('utf-8', errors='replace')
+        elif field == b'id':
+            if b'\x00' not in value:
+                self.last_event_id = value.decode('utf-8', errors='replace')
+        elif field == b'retry':
+            if value.isdigit():
+                self.retry = int(value)
+        return None
+    
+    def _dispatch(self) -> Optional[ServerSentEvent]:
+        """蓄積した data からイベントを生成してリセット"""
+        data_lines = self._data_lines
+        event_type = self._event_type or 'message'
+        self._event_type = ''
+        if not data_lines:
+            return None
+        
+        data = data_lines[0] if len(data_lines) == 1 else b'\n'.join(data_lines)
+        data_lines.clear()
+        return ServerSentEvent(
+            data=data.decode('utf-8', errors='replace'),
+            event=event_type,
+            id=self.last_event_id,
+            retry=self.retry,
+        )
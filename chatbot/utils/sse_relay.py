@@ -0,0 +1,109 @@
+import re
+import json
+import logging
+from collections.abc import Mapping
+from json.decoder import scanstring
+from typing import Dict, Any, Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+# Dify のイベントは先頭のキーが event（{"event": "message", ...}）
+_EVENT_PREFIX = re.compile(r'\{\s*"event"\s*:\s*"')
+_ANSWER_KEY = re.compile(r'"answer"\s*:\s*"')
+
+# 受信したまま転送し、必要なフィールドだけを取り出すイベント（トークン単位で大量に届くもの）
+LAZY_EVENTS = frozenset({'message', 'agent_message'})
+
+
+class RelayEvent(Mapping):
+    """
+    上流から受信した data をそのまま保持するイベント（転送モード）
+    
+    クライアントへは受信した JSON テキストをそのまま転送し（sse_event）、
+    サーバー側で使う event と answer は JSON 全体をパースせずにテキストから
+    取り出す。それ以外のキーを参照したとき（保存・解析・応答キャッシュ）に
+    初めて json.loads する。message_end などトークン以外のイベントは
+    受信時にパースする（metadata や conversation_id を読むため）。
+    
+    読み取り専用の Mapping なので、dict と同じく get / items / in で参照できる。
+    """
+    
+    __slots__ = ('raw', 'event', '_answer', '_parsed')
+    
+    def __init__(self, raw: str, event: Optional[str], answer: Optional[str] = None,
+                 parsed: Optional[Dict[str, Any]] = None):
+        self.raw = raw
+        self.event = event
+        self._answer = answer
+        self._parsed = parsed
+    
+    @classmethod
+    def decode(cls, raw: str) -> 'RelayEvent':
+        """
+        data のテキストから生成
+        
+        Raises:
+            json.JSONDecodeError: 即時にパースするイベントが JSON として不正な場合
+        """
+        multiline = '\n' in raw
+        match = _EVENT_PREFIX.match(raw)
+        if match is not None and not multiline:
+            event, end = scanstring(raw, match.end())
+            if event in LAZY_EVENTS:
+                # 入れ子のオブジェクトが無ければ "answer" は最上位のキー
+                answer = None
+                if raw.find('{', end) < 0:
+                    found = _ANSWER_KEY.search(raw, end)
+                    answer = scanstring(raw, found.end())[0] if found else ''
+                if answer is not None:
+                    return cls(raw, event, answer)
+        parsed = json.loads(raw)
+        if multiline:
+            # 複数行の data は1行の data フレームとして転送できないため整形し直す
+            raw = json.dumps(parsed, ensure_ascii=False)
+        return cls(raw, parsed.get('event'), parsed=parsed)
+    
+    @property
+    def parsed(self) -> Dict[str, Any]:
+        """JSON 全体（初回参照時にパース）"""
+        parsed = self._parsed
+        if parsed is None:
+            try:
+                parsed = json.loads(self.raw)
+            except json.JSONDecodeError as e:
+                # 先頭と answer だけを読んで転送したイベントが後半で壊れていた場合
+                logger.warning(f"JSON解析エラー: {e}, データ: {self.raw[:200]}")
+                parsed = {'event': self.event, 'answer': self._answer}
+            self._parsed = parsed
+        return parsed
+    
+    def get(self, key, default=None):
+        # トークンごとに参照される event / answer はパースせずに返す
+        if key == 'event' and self.event is not None:
+            return self.event
+        if key == 'answer' and self._parsed is None and self._answer is not None:
+            return self._answer
+        return self.parsed.get(key, default)
+    
+    def __getitem__(self, key):
+        return self.parsed[key]
+    
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.parsed)
+    
+    def __len__(self) -> int:
+        return len(self.parsed)
+    
+    def __bool__(self) -> bool:
+        # 転送時の「if chunk:」でパースしない（遅延するのは event を持つイベントだけ）
+        return self._parsed is None or bool(self._parsed)
+    
+    def copy(self) -> Dict[str, Any]:
+        return dict(self.parsed)
+    
+    def __reduce__(self):
+        # 解析ジョブのプロセスプールへ渡すときはテキストと読み取り済みの値だけを送る
+        return (RelayEvent, (self.raw, self.event, self._answer, self._parsed))
+    
+    def __repr__(self) -> str:
+        return f"RelayEvent({self.raw[:80]!r})"
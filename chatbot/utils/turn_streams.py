@@ -0,0 +1,402 @@
+import os
+import time
+import asyncio
+import secrets
+import logging
+import threading
+from collections import deque, OrderedDict
+from contextlib import aclosing
+from itertools import islice
+from typing import Dict, Any, Deque, Iterator, AsyncIterator, List, Optional, Set, Tuple
+
+from .chat_service import sse_event
+
+logger = logging.getLogger(__name__)
+
+# ストリームID（再接続用のトークン）の乱数バイト数
+STREAM_TOKEN_BYTES = 16
+# ストリームIDの先頭に付けるワーカー（プロセス）の識別子の文字数
+WORKER_TAG_LENGTH = 8
+
+
+class StreamElsewhereError(Exception):
+    """再接続先のストリームが別のワーカープロセスで開始されている（このプロセスでは再送できない）"""
+    
+    def __init__(self, stream_id: str):
+        super().__init__(f"ストリーム {stream_id[:WORKER_TAG_LENGTH]}... は別のワーカーのものです")
+        self.stream_id = stream_id
+
+
+class StreamGapError(Exception):
+    """再接続位置のイベントがリングバッファから既に押し出されている"""
+    
+    def __init__(self, stream: 'TurnStream', after_seq: int):
+        super().__init__(f"メッセージ {stream.message_id} のストリームの {after_seq + 1} 番目以降は再送できません")
+        self.stream = stream
+        self.after_seq = after_seq
+
+
+def is_stream_id(value: str) -> bool:
+    """再接続のURLに含まれる値がストリームIDの形式か"""
+    return 0 < len(value) <= 64 and all(char.isascii() and (char.isalnum() or char in '-_') for char in value)
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    """Last-Event-ID（'<ストリームID>-<連番>'）を分解（不正なら None）"""
+    if not value:
+        return None
+    # ストリームIDにも '-' が含まれるため最後の '-' で分ける
+    stream_id, _, seq = value.strip().rpartition('-')
+    try:
+        return stream_id, int(seq)
+    except ValueError:
+        return None
+
+
+def resume_position(stream_id: str, last_event_id: Optional[str]) -> int:
+    """再接続時に受信済みの連番（Last-Event-ID が無い・別のストリームを指す場合は先頭から）"""
+    parsed = parse_last_event_id(last_event_id)
+    if parsed is None or parsed[0] != stream_id:
+        return 0
+    return parsed[1]
+
+
+def _resolve(future: 'asyncio.Future'):
+    if not future.done():
+        future.set_result(None)
+
+
+class TurnStream:
+    """
+    1ターン分のSSEフレームのリングバッファ
+    
+    フレームには '<ストリームID>-<連番>' の SSE id を付ける。ストリームIDは
+    推測できないランダムなトークン（連番のメッセージIDは使わない）で、
+    最初のイベント（stream_started）と X-Stream-Id ヘッダーで送信先のクライアントにだけ渡す。
+    保持するフレーム数とバイト数には上限があり、超えた分は古い方から捨てる
+    （その位置からの再接続はできなくなる）。
+    """
+    
+    def __init__(self, registry: 'TurnStreamRegistry', stream_id: str, conversation_id: int, message_id: int):
+        self.registry = registry
+        self.stream_id = stream_id
+        self.conversation_id = conversation_id
+        self.message_id = message_id
+        self.created_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.bytes = 0
+        self.dropped = 0
+        self._frames: Deque[Tuple[int, str, int]] = deque()
+        self._next_seq = 1
+        self._cond = threading.Condition()
+        self._async_waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+    
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+    
+    @property
+    def last_seq(self) -> int:
+        return self._next_seq - 1
+    
+    def publish(self, frame: str) -> int:
+        """
+        フレームに id を付けて追加し、待機中の購読者を起こす
+        
+        Returns:
+            int: バッファのバイト数の増減
+        """
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq += 1
+            framed = f"id: {self.stream_id}-{seq}\n{frame}"
+            size = len(framed.encode('utf-8'))
+            self._frames.append((seq, framed, size))
+            delta = size - self._trim(self.bytes + size)
+            self.bytes += delta
+            self._wake()
+        return delta
+    
+    def _trim(self, total: int) -> int:
+        """1ターンの上限を超えた古いフレームを捨てる（ロック保持中に呼ぶ。最新の1件は残す）"""
+        max_events, max_bytes = self.registry.max_events, self.registry.max_bytes
+        freed = 0
+        while len(self._frames) > 1 and (len(self._frames) > max_events or total - freed > max_bytes):
+            freed += self._frames.popleft()[2]
+            self.dropped += 1
+        return freed
+    
+    def shrink(self, max_bytes: int) -> int:
+        """全体の上限を超えた場合に古いフレームを捨てる（解放したバイト数を返す）"""
+        with self._cond:
+            freed = 0
+            while len(self._frames) > 1 and self.bytes - freed > max_bytes:
+                freed += self._frames.popleft()[2]
+                self.dropped += 1
+            self.bytes -= freed
+        return freed
+    
+    def finish(self):
+        with self._cond:
+            if self.finished_at is None:
+                self.finished_at = time.monotonic()
+            self._wake()
+    
+    def _wake(self):
+        self._cond.notify_all()
+        waiters, self._async_waiters = self._async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve, future)
+    
+    def _pending(self, after_seq: int) -> List[str]:
+        """after_seq より後のフレーム（ロック保持中に呼ぶ）"""
+        if not self._frames or after_seq >= self.last_seq:
+            return []
+        first = self._frames[0][0]
+        if after_seq + 1 < first:
+            raise StreamGapError(self, after_seq)
+        return [framed for _, framed, _ in islice(self._frames, after_seq + 1 - first, None)]
+    
+    def check(self, after_seq: int):
+        """after_seq から再送できるか確認（できなければ StreamGapError）"""
+        with self._cond:
+            self._pending(after_seq)
+    
+    def _gap_frame(self) -> str:
+        return sse_event({
+            'event': 'error',
+            'code': 'stream_gap',
+            'error': '受信が遅れたため続きを再送できません。会話を開き直してください',
+            'conversation_id': self.conversation_id,
+        })
+    
+    def frames(self, after_seq: int = 0) -> Iterator[str]:
+        """after_seq より後のフレームを、ストリームの終了まで返す"""
+        while True:
+            with self._cond:
+                while after_seq >= self.last_seq and not self.done:
+                    self._cond.wait()
+                try:
+                    pending = self._pending(after_seq)
+                except StreamGapError:
+                    yield self._gap_frame()
+                    return
+                done = self.done
+            after_seq += len(pending)
+            yield from pending
+            if done and after_seq >= self.last_seq:
+                return
+    
+    async def aframes(self, after_seq: int = 0) -> AsyncIterator[str]:
+        """frames の非同期版"""
+        loop = asyncio.get_running_loop()
+        while True:
+            future = None
+            with self._cond:
+                if after_seq >= self.last_seq and not self.done:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+                else:
+                    try:
+                        pending = self._pending(after_seq)
+                    except StreamGapError:
+                        pending = None
+                    done = self.done
+            if future is not None:
+                await future
+                continue
+            if pending is None:
+                yield self._gap_frame()
+                return
+            after_seq += len(pending)
+            for frame in pending:
+                yield frame
+            if done and after_seq >= self.last_seq:
+                return
+
+
+class TurnStreamRegistry:
+    """
+    上流ストリームをクライアント接続から切り離して実行し、SSEフレームをバッファする
+    
+    上流の受信（ChatTurn の蓄積・保存を含む）はスレッド（WSGI）またはイベントループの
+    タスク（ASGI）で最後まで実行するため、クライアントが切断してもアシスタント
+    メッセージは保存される。クライアントは最初のイベントで受け取ったストリームIDと
+    Last-Event-ID を付けて再接続すると、受信できなかったフレームから続きを受け取れる。終了したストリームは
+    STREAM_RETAIN_SECONDS の間だけ再接続用に残す。
+    
+    バッファはプロセスごとに持つため、再接続はストリームを開始したワーカーにしか
+    届けられない。ストリームIDの先頭にワーカーの識別子を付け、別のワーカーに
+    届いた再接続は StreamElsewhereError（HTTP 421）で区別する。複数ワーカーで
+    動かす場合は単一ワーカー（uvicorn は1プロセスで多数の同時ストリームを扱える）か、
+    同じクライアントを同じワーカーへ送るスティッキールーティングにすること。
+    
+    設定:
+        STREAM_BUFFER_EVENTS / STREAM_BUFFER_BYTES: 1ターンで保持するフレーム数・バイト数
+        STREAM_TOTAL_BYTES: 全ターン合計のバイト数（超えたら終了済みのターンから破棄）
+        STREAM_RETAIN_SECONDS: 終了後に再接続を受け付ける秒数
+    
+    使い方:
+        turn_streams = TurnStreamRegistry()
+        turn_streams.init_app(app)
+        stream = turn_streams.start(turn, generate_response())   # ASGI は astart
+        Response(stream.frames())
+    """
+    
+    def __init__(self, app=None, max_events: int = 2000, max_bytes: int = 1024 * 1024,
+                 max_total_bytes: int = 64 * 1024 * 1024, retain_seconds: float = 120.0):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_total_bytes = max_total_bytes
+        self.retain_seconds = retain_seconds
+        self._streams: 'OrderedDict[str, TurnStream]' = OrderedDict()
+        self._bytes = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._lock = threading.Lock()
+        self._stats = {'started': 0, 'evicted': 0, 'expired': 0, 'shrunk_bytes': 0, 'elsewhere': 0}
+        self._worker: Tuple[Optional[int], str] = (None, '')
+        if app is not None:
+            self.init_app(app)
+    
+    def init_app(self, app):
+        """Flaskアプリケーションに登録"""
+        self.max_events = int(app.config.get('STREAM_BUFFER_EVENTS', os.getenv('STREAM_BUFFER_EVENTS', self.max_events)))
+        self.max_bytes = int(app.config.get('STREAM_BUFFER_BYTES', os.getenv('STREAM_BUFFER_BYTES', self.max_bytes)))
+        self.max_total_bytes = int(app.config.get('STREAM_TOTAL_BYTES', os.getenv('STREAM_TOTAL_BYTES', self.max_total_bytes)))
+        self.retain_seconds = float(app.config.get('STREAM_RETAIN_SECONDS',
+                                                   os.getenv('STREAM_RETAIN_SECONDS', self.retain_seconds)))
+        app.extensions['turn_streams'] = self
+    
+    @property
+    def worker_tag(self) -> str:
+        """このプロセスの識別子（fork 後のワーカーでは作り直す）"""
+        pid, tag = self._worker
+        if pid != os.getpid():
+            with self._lock:
+                pid, tag = self._worker
+                if pid != os.getpid():
+                    tag = secrets.token_hex(WORKER_TAG_LENGTH // 2)
+                    self._worker = (os.getpid(), tag)
+        return tag
+    
+    def _register(self, turn) -> TurnStream:
+        stream = TurnStream(self, self.worker_tag + secrets.token_urlsafe(STREAM_TOKEN_BYTES),
+                            turn.conversation_id, turn.assistant_message_id)
+        with self._lock:
+            self._expire()
+            self._streams[stream.stream_id] = stream
+            self._stats['started'] += 1
+        # 最初のイベントで再接続に必要なストリームIDを渡す
+        self._publish(stream, sse_event({
+            'event': 'stream_started',
+            'stream_id': stream.stream_id,
+            'conversation_id': stream.conversation_id,
+            'message_id': stream.message_id,
+        }))
+        return stream
+    
+    def _publish(self, stream: TurnStream, frame: str):
+        delta = stream.publish(frame)
+        with self._lock:
+            self._bytes += delta
+            if self._bytes <= self.max_total_bytes:
+                return
+            # 終了済みのターンを古い順に破棄し、それでも超える場合は受信中のターンの古いフレームを捨てる
+            for stream_id in [key for key, value in self._streams.items() if value.done]:
+                self._bytes -= self._streams.pop(stream_id).bytes
+                self._stats['evicted'] += 1
+                if self._bytes <= self.max_total_bytes:
+                    return
+            freed = stream.shrink(max(0, stream.bytes - (self._bytes - self.max_total_bytes)))
+            self._bytes -= freed
+            self._stats['shrunk_bytes'] += freed
+    
+    def _expire(self):
+        """保持期間を過ぎた終了済みのターンを破棄（ロック保持中に呼ぶ）"""
+        now = time.monotonic()
+        for stream_id in [key for key, value in self._streams.items()
+                          if value.done and now - value.finished_at > self.retain_seconds]:
+            self._bytes -= self._streams.pop(stream_id).bytes
+            self._stats['expired'] += 1
+    
+    def start(self, turn, frames: Iterator[str]) -> TurnStream:
+        """frames をスレッドで最後まで読み、フレームをバッファへ追加"""
+        stream = self._register(turn)
+        
+        def pump():
+            try:
+                for frame in frames:
+                    self._publish(stream, frame)
+            except Exception as e:
+                logger.error(f"ストリーム送出エラー - メッセージID: {stream.message_id}: {str(e)}")
+            finally:
+                stream.finish()
+        
+        threading.Thread(target=pump, name=f'turn-stream-{stream.message_id}', daemon=True).start()
+        return stream
+    
+    def astart(self, turn, frames: AsyncIterator[str]) -> TurnStream:
+        """start の非同期版（実行中のイベントループにタスクとして登録）"""
+        stream = self._register(turn)
+        
+        async def pump():
+            try:
+                async with aclosing(frames) as iterator:
+                    async for frame in iterator:
+                        self._publish(stream, frame)
+            except Exception as e:
+                logger.error(f"ストリーム送出エラー - メッセージID: {stream.message_id}: {str(e)}")
+            finally:
+                stream.finish()
+        
+        task = asyncio.get_running_loop().create_task(pump())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return stream
+    
+    async def adrain(self, timeout: Optional[float] = 30.0) -> int:
+        """
+        astart で開始したストリームの終了を待つ（ASGI の終了処理で、解析ジョブ・永続化キューの停止前に呼ぶ）
+        
+        Returns:
+            int: timeout までに終わらなかったストリーム数
+        """
+        tasks = list(self._tasks)
+        if not tasks:
+            return 0
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        if pending:
+            logger.warning(f"終了処理までに完了しなかったストリーム: {len(pending)} 件")
+        return len(pending)
+    
+    def get(self, stream_id: str) -> Optional[TurnStream]:
+        """
+        再接続先のストリーム（保持期間切れ・破棄済み・存在しないIDなら None）
+        
+        Raises:
+            StreamElsewhereError: 別のワーカーが開始したストリームのID
+        """
+        if not stream_id.startswith(self.worker_tag):
+            if len(stream_id) <= WORKER_TAG_LENGTH or \
+                    any(char not in '0123456789abcdef' for char in stream_id[:WORKER_TAG_LENGTH]):
+                return None
+            with self._lock:
+                self._stats['elsewhere'] += 1
+            raise StreamElsewhereError(stream_id)
+        with self._lock:
+            self._expire()
+            return self._streams.get(stream_id)
+    
+    def stats(self) -> Dict[str, Any]:
+        """バッファ中のターン数・使用量"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['streams'] = len(self._streams)
+            stats['active'] = sum(1 for stream in self._streams.values() if not stream.done)
+            stats['bytes'] = self._bytes
+            stats['max_total_bytes'] = self.max_total_bytes
+            stats['dropped_frames'] = sum(stream.dropped for stream in self._streams.values())
+        return stats
+
+
+turn_streams = TurnStreamRegistry()